@@ -26,9 +26,14 @@ implementations.
 
 * [Multi-headed attention](transformers/mha.html)
 * [Triton Flash Attention](transformers/flash/index.html)
+* [Chunked memory-efficient attention](transformers/chunked/index.html)
+* [Attention backends](transformers/attention_backend/index.html)
+* [Benchmark of attention and token mixing layers](transformers/benchmark.html)
+* [Cache of attention masks and biases](transformers/mask_cache.html)
 * [Transformer building blocks](transformers/models.html)
 * [Transformer XL](transformers/xl/index.html)
     * [Relative multi-headed attention](transformers/xl/relative_mha.html)
+    * [Ring buffer memory](transformers/xl/memory.html)
 * [Rotary Positional Embeddings (RoPE)](transformers/rope/index.html)
 * [Attention with Linear Biases (ALiBi)](transformers/alibi/index.html)
 * [RETRO](transformers/retro/index.html)
@@ -98,7 +98,7 @@ class AutoregressiveTransformer(nn.Module):
         # Create auto-regressive mask
         if self.mask is None or self.mask.size(0) != len(x):
             # Subsequent mask, will mask out tokens from seeing future tokens
-            self.mask = subsequent_mask(len(x)).to(x.device)
+            self.mask = subsequent_mask(len(x), x.device)
 
         # Get the token embeddings
         x = self.emb(x)
@@ -22,6 +22,8 @@ import torch
 import torch.nn.functional as F
 from torch import nn
 
+from labml_nn.transformers.attention_backend import attention, select_backend
+
 
 class SpatialTransformer(nn.Module):
     """
@@ -151,6 +153,10 @@ class CrossAttention(nn.Module):
         # Final linear layer
         self.to_out = nn.Sequential(nn.Linear(d_attn, d_model))
 
+        # [Attention backend](../../../transformers/attention_backend/index.html) to use;
+        # it's selected automatically if `None`
+        self.backend: Optional[str] = None
+
         # Setup [flash attention](https://github.com/HazyResearch/flash-attention).
         # Flash attention is only used if it's installed
         # and `CrossAttention.use_flash_attention` is set to `True`.
@@ -248,6 +254,17 @@ class CrossAttention(nn.Module):
         k = k.view(*k.shape[:2], self.n_heads, -1)
         v = v.view(*v.shape[:2], self.n_heads, -1)
 
+        # Use an [attention backend](../../../transformers/attention_backend/index.html),
+        # unless the einsum implementation (with the in-place softmax below) is selected
+        backend = select_backend(q.transpose(1, 2), k.transpose(1, 2), backend=self.backend)
+        if backend != 'einsum':
+            # Attention with tensors of shape `[batch_size, n_heads, seq_len, d_head]`
+            out = attention(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), scale=self.scale, backend=backend)
+            # Reshape to `[batch_size, height * width, n_heads * d_head]`
+            out = out.transpose(1, 2).reshape(*q.shape[:2], -1)
+            # Map to `[batch_size, height * width, d_model]` with a linear layer
+            return self.to_out(out)
+
         # Calculate attention $\frac{Q K^\top}{\sqrt{d_{key}}}$
         attn = torch.einsum('bihd,bjhd->bhij', q, k) * self.scale
 
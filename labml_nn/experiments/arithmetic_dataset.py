@@ -19,6 +19,7 @@ from torch.utils.data import DataLoader, Dataset
 from labml import monit, logger, tracker
 from labml.configs import option
 from labml_nn.experiments.nlp_autoregression import NLPAutoRegressionConfigs, transpose_batch
+from labml_nn.transformers.utils import IncrementalDecoding
 
 
 class ArithmeticDataset(Dataset):
@@ -186,34 +187,37 @@ class ArithmeticAutoregression(NLPAutoRegressionConfigs):
         # Sampled results
         results = [p[0] for p in questions]
 
-        # Sample upto sequence length
-        for i in monit.iterate('Sample', self.seq_len - 1):
-            # If all the sequences have completed we skip this
-            if finished.sum() == len(finished):
-                continue
-
-            # Get the model output
-            output, *_ = self.model(data)
-            # Get the model prediction (greedy)
-            output = output[-1].argmax(dim=-1)
-
-            # Find which sequences have finished
-            finished = finished | (output == new_line)
-            # Skip if all have finished
-            if finished.sum() == len(finished):
-                continue
-
-            # Override with the question
-            for j, p in enumerate(questions):
-                if len(p) > i + 1:
-                    output[j] = dataset.stoi[p[i + 1]]
-
-            # Add the next token to the input
-            data = torch.cat([data, output[None, :]], dim=0)
-
-            # Get the sampled results
-            for j, c in enumerate(output):
-                results[j] += dataset.itos[c]
+        # Feed only the new tokens to the model if it supports
+        # [incremental decoding](../transformers/utils.html#IncrementalDecoding)
+        with IncrementalDecoding(self.model) as decoder:
+            # Sample upto sequence length
+            for i in monit.iterate('Sample', self.seq_len - 1):
+                # If all the sequences have completed we skip this
+                if finished.sum() == len(finished):
+                    continue
+
+                # Get the model output
+                output, *_ = decoder(data)
+                # Get the model prediction (greedy)
+                output = output[-1].argmax(dim=-1)
+
+                # Find which sequences have finished
+                finished = finished | (output == new_line)
+                # Skip if all have finished
+                if finished.sum() == len(finished):
+                    continue
+
+                # Override with the question
+                for j, p in enumerate(questions):
+                    if len(p) > i + 1:
+                        output[j] = dataset.stoi[p[i + 1]]
+
+                # Add the next token to the input
+                data = torch.cat([data, output[None, :]], dim=0)
+
+                # Get the sampled results
+                for j, c in enumerate(output):
+                    results[j] += dataset.itos[c]
 
         # Discard everything after the answer in the results
         results = [r.split('\n')[0] for r in results]
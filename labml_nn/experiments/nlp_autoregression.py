@@ -20,6 +20,7 @@ from labml_nn.helpers.device import DeviceConfigs
 from labml_nn.helpers.metrics import Accuracy
 from labml_nn.helpers.trainer import TrainValidConfigs, BatchIndex
 from labml_nn.optimizers.configs import OptimizerConfigs
+from labml_nn.transformers.utils import IncrementalDecoding
 from torch.utils.data import DataLoader, RandomSampler
 
 
@@ -173,19 +174,22 @@ class NLPAutoRegressionConfigs(TrainValidConfigs):
         prompt = self.prompt
         # Collect output for printing
         log = [(prompt, Text.subtle)]
-        # Sample 25 tokens
-        for i in monit.iterate('Sample', 25):
-            # Tokenize the prompt
-            data = self.text.text_to_i(prompt).unsqueeze(-1)
-            data = data.to(self.device)
-            # Get the model output
-            output, *_ = self.model(data)
-            # Get the model prediction (greedy)
-            output = output.argmax(dim=-1).squeeze()
-            # Add the prediction to prompt
-            prompt += self.prompt_separator + self.text.itos[output[-1]]
-            # Add the prediction for logging
-            log += [(self.prompt_separator + self.text.itos[output[-1]], Text.value)]
+        # Feed only the new tokens to the model if it supports
+        # [incremental decoding](../transformers/utils.html#IncrementalDecoding)
+        with IncrementalDecoding(self.model) as decoder:
+            # Sample 25 tokens
+            for i in monit.iterate('Sample', 25):
+                # Tokenize the prompt
+                data = self.text.text_to_i(prompt).unsqueeze(-1)
+                data = data.to(self.device)
+                # Get the model output
+                output, *_ = decoder(data)
+                # Get the model prediction at the last token (greedy)
+                output = output[-1].argmax(dim=-1).squeeze()
+                # Add the prediction to prompt
+                prompt += self.prompt_separator + self.text.itos[output]
+                # Add the prediction for logging
+                log += [(self.prompt_separator + self.text.itos[output], Text.value)]
 
         tracker.add({'sampled': prompt})
         # Print the sampled output
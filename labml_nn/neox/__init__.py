@@ -13,19 +13,34 @@ This is a simple implementation of [Eleuther GPT-NeoX](https://arxiv.org/abs/220
 * [Model definition](model.html)
 * [Tokenizer](tokenizer.html)
 * [Checkpoint downloading and loading helpers](checkpoint.html)
+* [Pre-merged memory-mapped checkpoint](utils/mmap_checkpoint.html)
+* [Pre-tokenized memory-mapped token file](utils/token_file.html)
 * [Utilities](utils/index.html)
 * [LLM.int8() quantization](utils/llm_int8.html)
+* [CPU weight-only int8/int4 quantization](utils/cpu_quantization.html)
+* [Layer-streaming offloaded inference](utils/offload.html)
+* [Speculative decoding](utils/speculative.html)
+* [Profile-guided pipeline balancing](utils/pipeline_balance.html)
 
 ### [Samples](samples/__init__.py)
 
 * [Generating text](samples/generate.html)
+* [Benchmark the static key-value cache](samples/kv_cache_benchmark.html)
+* [Local generation server with continuous batching](samples/server.html)
+* [Benchmark continuous batching](samples/serving_benchmark.html)
+* [Benchmark loading checkpoints](samples/load_benchmark.html)
+* [Benchmark CPU weight-only quantization](samples/cpu_quantization_benchmark.html)
+* [Benchmark layer-streaming offloaded inference](samples/offload_benchmark.html)
+* [Speculative decoding with a truncated draft model](samples/speculative_decoding.html)
 * [Fine-tuning the biases with pipeline-parallel](samples/finetune.html)
+* [Benchmark profile-guided pipeline balancing](samples/pipeline_balance_benchmark.html)
 * [Generating text with LLM.int8()](samples/llm_int8.html)
 
 ### [Evaluation](evaluation/__init__.py)
 
 * [Evaluating half precision model on a single GPU](evaluation/half_precision.html)
 * [Evaluating LLM.int8() model](evaluation/llm_int8.html)
+* [Benchmark prefix-sharing evaluation](evaluation/prefix_sharing_benchmark.html)
 
 **Official [Eleuther](https://www.eleuther.ai)
 GPT-NoeX is source code is available at [eleutherai/gpt-neox](https://github.com/eleutherai/gpt-neox).**
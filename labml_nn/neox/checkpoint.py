@@ -80,6 +80,20 @@ def download(n_layers: int = 44):
         download_file(CHECKPOINTS_URL + f, get_checkpoints_download_path() / f)
 
 
+def read_checkpoint_files(files: Tuple[str, str]):
+    """
+    ### Read a pair of checkpoint files
+
+    This doesn't open a `monit` section, so it can be called from loader threads;
+    the section stack of `monit` is shared and is not thread-safe.
+
+    :param files: pair of files to load
+    :return: the loaded parameter tensors
+    """
+    checkpoint_path = get_checkpoints_download_path() / 'global_step150000'
+    return [torch.load(checkpoint_path / f) for f in files]
+
+
 def load_checkpoint_files(files: Tuple[str, str]):
     """
     ### Load a pair of checkpoint files
@@ -87,11 +101,8 @@ def load_checkpoint_files(files: Tuple[str, str]):
     :param files: pair of files to load
     :return: the loaded parameter tensors
     """
-    checkpoint_path = get_checkpoints_download_path() / 'global_step150000'
     with monit.section('Load checkpoint'):
-        data = [torch.load(checkpoint_path / f) for f in files]
-
-    return data
+        return read_checkpoint_files(files)
 
 
 def merge_params_dim_0(param: Union[nn.Parameter, torch.Tensor], key: str, p1: Dict[str, torch.Tensor],
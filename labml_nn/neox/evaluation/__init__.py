@@ -11,9 +11,11 @@ This is the code to test the model on
 [EleutherAI/lm-evaluation-harness](https://github.com/EleutherAI/lm-evaluation-harness).
 
 * [Evaluating half precision model on a single GPU](half_precision.html)
+* [Benchmark prefix-sharing evaluation](prefix_sharing_benchmark.html)
 """
 import math
-from typing import List
+from collections import defaultdict
+from typing import List, Tuple, Dict
 
 import torch
 import torch.nn.functional as F
@@ -25,6 +27,7 @@ from tqdm import tqdm
 
 from labml import monit
 from labml_nn.neox.tokenizer import get_tokenizer
+from labml_nn.neox.utils.kv_cache import KVCache
 
 
 class EvalHarnessAdapter(BaseLM):
@@ -232,9 +235,175 @@ class NoeXEvalHarnessAdapter(EvalHarnessAdapter):
         return self.model(inps.to(self._device))
 
 
-def run_eval_harness(model: nn.Module, name: str, eval_tasks: List[str], device: torch.device, batch_size: int = 8):
+class PrefixSharingEvalHarnessAdapter(NoeXEvalHarnessAdapter):
+    """
+    ## Evaluation Harness Adapter with prefix sharing
+
+    Multiple-choice tasks repeat the same context for every choice.
+    This adapter computes each distinct context once, with the
+    [static key-value cache](../utils/kv_cache.html),
+    and scores all the continuations of the context from the cached keys and values.
+
+    Requests are grouped by their context and the groups are sorted by length,
+    so that batches have similar lengths and little padding.
+    The model is called twice per batch; once for the distinct contexts
+    and once for the continuations.
+    The cached keys and values of each context are copied to the rows of its
+    other continuations in between.
+    One cache, large enough for the largest batch, is allocated and is reset for each batch.
+
+    The continuation tokens see exactly the same tokens at the same positions as with
+    [`EvalHarnessAdapter`](#EvalHarnessAdapter), so the results are the same
+    up to floating point rounding of the different batch shapes.
+    """
+
+    def _split_requests(self, requests):
+        """
+        #### Split requests into the shared prefix and the tokens to score
+
+        The input to the model is the context and continuation without the last token,
+        truncated from the left to `max_length`; same as
+        [`EvalHarnessAdapter`](#EvalHarnessAdapter).
+        The logits of the last `len(continuation)` input tokens are needed to score the continuation.
+        Everything before that is the prefix that is shared.
+
+        :return: a dictionary of lists of `(request index, suffix, continuation)` keyed by the prefix
+        """
+        groups: Dict[Tuple[int, ...], List[Tuple[int, List[int], List[int]]]] = defaultdict(list)
+        for i, (_, context_enc, continuation_enc) in enumerate(requests):
+            # Concatenate the context and continuation, truncate from left and remove final token
+            inp = (context_enc + continuation_enc)[-(self.max_length + 1):][:-1]
+            # Split where the logits are needed
+            split = len(inp) - len(continuation_enc)
+            groups[tuple(inp[:split])].append((i, inp[split:], continuation_enc))
+
+        return groups
+
+    def _schedule(self, requests):
+        """
+        #### Create batches of groups
+
+        Groups are sorted in the descending order of prefix and suffix lengths,
+        and are added to a batch as long as it has at most `batch_size` continuations.
+        Groups with more than `batch_size` continuations are split.
+
+        :return: a list of batches, each a list of `(prefix, [(request index, suffix, continuation)])`
+        """
+        # Split large groups
+        groups = []
+        for prefix, items in self._split_requests(requests).items():
+            for i in range(0, len(items), self.batch_size):
+                groups.append((list(prefix), items[i:i + self.batch_size]))
+
+        # Sort by lengths
+        groups.sort(key=lambda g: (-len(g[0]), -max(len(s) for _, s, _ in g[1])))
+
+        # Collect groups into batches
+        batches = []
+        batch, n_rows = [], 0
+        for prefix, items in groups:
+            if batch and n_rows + len(items) > self.batch_size:
+                batches.append(batch)
+                batch, n_rows = [], 0
+            batch.append((prefix, items))
+            n_rows += len(items)
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    @staticmethod
+    def _pad(seqs: List[List[int]]):
+        """
+        #### Right pad token sequences to the same length
+        """
+        padded = torch.zeros((len(seqs), max(len(s) for s in seqs)), dtype=torch.long)
+        for i, s in enumerate(seqs):
+            padded[i, :len(s)] = torch.tensor(s, dtype=torch.long)
+
+        return padded
+
+    @torch.no_grad()
+    def _loglikelihood_tokens(self, requests, disable_tqdm=False):
+        """
+        ### Get log-likelihoods of the next tokens
+
+        :param requests: List of requests containing the context and the expected continuation.
+        :param disable_tqdm: If True, disable tqdm progress bar.
+        """
+
+        # For results, in the original order
+        res = [None] * len(requests)
+
+        batches = self._schedule(requests)
+        if not batches:
+            return res
+
+        # Allocate a cache for the largest batch, and reuse it for all batches
+        max_len = max(max(len(prefix) for prefix, _ in batch) +
+                      max(len(suffix) for _, group in batch for _, suffix, _ in group)
+                      for batch in batches)
+        kv_cache = KVCache.for_model(self.model, self.batch_size, max_len)
+
+        for batch in tqdm(batches, disable=disable_tqdm):
+            # The first continuation of each group goes in the first rows of the cache,
+            # so that the prefixes can be computed in a single call
+            prefixes = [prefix for prefix, _ in batch]
+            items = [group[0] for _, group in batch]
+            # Rows of the other continuations and the row of their prefix
+            copies = []
+            for g, (_, group) in enumerate(batch):
+                for item in group[1:]:
+                    copies.append((g, len(items)))
+                    items.append(item)
+            suffixes = [suffix for _, suffix, _ in items]
+
+            # Clear the sequences of the previous batch.
+            # The buffers are not cleared since stale keys and values are masked.
+            kv_cache.reset()
+
+            # Compute the prefixes once
+            if any(prefixes):
+                with kv_cache.step([len(p) for p in prefixes]):
+                    self._model_call(self._pad(prefixes))
+
+            # Copy the prefixes to the rows of the other continuations
+            for src, dst in copies:
+                kv_cache.copy(src, dst)
+
+            # Get logits of the continuations
+            with kv_cache.step([len(s) for s in suffixes]):
+                logits = self._model_call(self._pad(suffixes))
+
+            # Get log softmaxes
+            multi_logits = F.log_softmax(logits, dim=-1)
+
+            # Loop through the input/output pairs of the batch
+            for logits, (i, suffix, cont_toks) in zip(multi_logits, items):
+                # Get logits of the predicted tokens
+                logits = logits[:len(suffix)]
+                # Get the tokens with the highest probabilities
+                greedy_tokens = logits.argmax(dim=-1)
+                # Get the target tokens
+                cont_toks = torch.tensor(cont_toks, dtype=torch.long).to(logits.device)
+                # Whether there's an exact match
+                max_equal = (greedy_tokens == cont_toks).all()
+                # Log-likelihoods of the target tokens
+                logits = torch.gather(logits, 1, cont_toks[:, None])
+                # Add the total log-likelihoods and whether there was a match to the results
+                res[i] = (float(logits.sum()), bool(max_equal))
+
+        #
+        return res
+
+
+def run_eval_harness(model: nn.Module, name: str, eval_tasks: List[str], device: torch.device, batch_size: int = 8,
+                     is_prefix_sharing: bool = False):
     """
     ## Run evaluation harness with a given model
+
+    Set `is_prefix_sharing` to compute the shared contexts of requests once with
+    [`PrefixSharingEvalHarnessAdapter`](#PrefixSharingEvalHarnessAdapter).
     """
 
     # Load the tokenizer
@@ -256,7 +425,10 @@ def run_eval_harness(model: nn.Module, name: str, eval_tasks: List[str], device:
         ]
 
     # Create the adapter
-    adapter = NoeXEvalHarnessAdapter(model, tokenizer, 50_432, batch_size, device)
+    if is_prefix_sharing:
+        adapter = PrefixSharingEvalHarnessAdapter(model, tokenizer, 50_432, batch_size, device)
+    else:
+        adapter = NoeXEvalHarnessAdapter(model, tokenizer, 50_432, batch_size, device)
 
     # Run
     return adapter.run_eval(name, eval_tasks)
@@ -23,6 +23,7 @@ def main():
     parser = argparse.ArgumentParser()
 
     parser.add_argument("--flash", action='store_true', help="whether to use Flash Attention")
+    parser.add_argument("--prefix_sharing", action='store_true', help="whether to compute shared contexts once")
 
     opt = parser.parse_args()
 
@@ -40,7 +41,8 @@ def main():
     model = nn.Sequential(*layers)
 
     # Run [evaluation harness](index.html)
-    print(run_eval_harness(model, 'half_precision', ['lambada'], device))
+    print(run_eval_harness(model, 'half_precision', ['lambada'], device,
+                           is_prefix_sharing=opt.prefix_sharing))
 
 
 #
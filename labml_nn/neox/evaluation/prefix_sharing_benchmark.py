@@ -0,0 +1,159 @@
+r"""
+---
+title: Benchmark prefix-sharing evaluation
+summary: >
+     Compare wall time and results of GPT-NeoX evaluation with and without prefix sharing
+---
+
+#  Benchmark prefix-sharing evaluation
+
+This collects the log-likelihood requests of
+[lm-evaluation-harness](https://github.com/EleutherAI/lm-evaluation-harness) tasks
+and scores them with [`NoeXEvalHarnessAdapter`](index.html#NoeXEvalHarnessAdapter) and
+[`PrefixSharingEvalHarnessAdapter`](index.html#PrefixSharingEvalHarnessAdapter).
+It reports the wall time of each task, and asserts that the results are the same.
+
+The exact match flags must be equal.
+The log-likelihoods must be equal within a tolerance,
+$\lvert a - b \rvert \le atol + rtol \lvert a \rvert$,
+where $a$ is the log-likelihood without prefix sharing and $b$ is the one with prefix sharing.
+Prefix sharing computes the same tokens with different batch shapes,
+which changes the order of the reductions in matrix multiplications and attention.
+With `float16` on the GPU this changes the rounding of each token's logits,
+and the errors add up over the tokens of a continuation,
+so the default tolerance is $atol = 0.05, rtol = 10^{-3}$ with `float16`
+and $atol = 10^{-3}, rtol = 10^{-5}$ with `float32` on the CPU.
+"""
+
+import argparse
+import random
+import time
+from typing import List, Tuple
+
+import torch
+from lm_eval import tasks
+from torch import nn
+
+from labml import logger, monit
+from labml.logger import Text
+from labml_nn.neox.evaluation import NoeXEvalHarnessAdapter, PrefixSharingEvalHarnessAdapter
+from labml_nn.neox.model import LayerGenerator
+from labml_nn.neox.tokenizer import get_tokenizer
+
+
+def get_requests(task_name: str, limit: int) -> List[Tuple[str, str]]:
+    """
+    ### Get the `(context, continuation)` log-likelihood requests of a task
+    """
+    task = tasks.get_task_dict([task_name])[task_name]
+    docs = task.validation_docs() if task.has_validation_docs() else task.test_docs()
+
+    rnd = random.Random(1234)
+    requests = []
+    for i, doc in enumerate(docs):
+        if i >= limit:
+            break
+        ctx = task.fewshot_context(doc=doc, num_fewshot=0, rnd=rnd, description=None)
+        reqs = task.construct_requests(doc, ctx)
+        if not isinstance(reqs, (list, tuple)):
+            reqs = [reqs]
+        requests += [req.args for req in reqs if req.request_type == 'loglikelihood']
+
+    return requests
+
+
+def measure(adapter: NoeXEvalHarnessAdapter, requests: List[Tuple[str, str]]):
+    """
+    ### Score the requests and measure the wall time
+    """
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    res = adapter.loglikelihood(requests)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+    return res, time.perf_counter() - start
+
+
+def main():
+    # Argument parser
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--tasks", type=str, nargs='+', default=['hellaswag', 'piqa', 'winogrande', 'lambada'],
+                        help="tasks to benchmark")
+    parser.add_argument("--limit", type=int, default=200, help="number of documents per task")
+    parser.add_argument("--layers", type=int, default=None, help="number of transformer layers")
+    parser.add_argument("--batch_size", type=int, default=8, help="batch size")
+    parser.add_argument("--cuda", action='store_true', help="whether to use the GPU")
+    parser.add_argument("--atol", type=float, default=None, help="absolute tolerance of log-likelihoods")
+    parser.add_argument("--rtol", type=float, default=None, help="relative tolerance of log-likelihoods")
+
+    opt = parser.parse_args()
+
+    # Device and data type
+    if opt.cuda:
+        device, dtype = torch.device('cuda:0'), torch.float16
+    else:
+        device, dtype = torch.device('cpu'), torch.float
+
+    # Tolerances for the reordered reductions
+    if dtype == torch.float16:
+        atol, rtol = 5e-2, 1e-3
+    else:
+        atol, rtol = 1e-3, 1e-5
+    if opt.atol is not None:
+        atol = opt.atol
+    if opt.rtol is not None:
+        rtol = opt.rtol
+
+    filter_layers = None
+    if opt.layers is not None:
+        filter_layers = {0, *range(1, opt.layers + 1), 45, 46}
+
+    # Load the model
+    model = nn.Sequential(*LayerGenerator(is_clone_layers=True,
+                                          filter_layers=filter_layers,
+                                          dtype=dtype,
+                                          device=device,
+                                          ).load()).eval()
+
+    tokenizer = get_tokenizer()
+    baseline = NoeXEvalHarnessAdapter(model, tokenizer, 50_432, opt.batch_size, device)
+    prefix_sharing = PrefixSharingEvalHarnessAdapter(model, tokenizer, 50_432, opt.batch_size, device)
+
+    failed = []
+    for task_name in opt.tasks:
+        with monit.section(f'Load {task_name}'):
+            requests = get_requests(task_name, opt.limit)
+
+        res, baseline_time = measure(baseline, requests)
+        shared_res, shared_time = measure(prefix_sharing, requests)
+
+        # Compare the results
+        max_diff = max(abs(a[0] - b[0]) for a, b in zip(res, shared_res))
+        n_out_of_tolerance = sum(abs(a[0] - b[0]) > atol + rtol * abs(a[0]) for a, b in zip(res, shared_res))
+        n_mismatches = sum(a[1] != b[1] for a, b in zip(res, shared_res))
+        n_contexts = len({ctx for ctx, _ in requests})
+        if n_out_of_tolerance or n_mismatches:
+            failed.append(task_name)
+
+        logger.log([(f'{task_name :<12}', Text.key),
+                    ' requests ', (f'{len(requests) :6d}', Text.value),
+                    ' contexts ', (f'{n_contexts :6d}', Text.value),
+                    ' baseline ', (f'{baseline_time :8.2f}s', Text.value),
+                    ' prefix sharing ', (f'{shared_time :8.2f}s', Text.value),
+                    ' speedup ', (f'{baseline_time / shared_time :.2f}x', Text.success),
+                    ' max log-likelihood difference ', (f'{max_diff :.2e}', Text.value),
+                    ' out of tolerance ',
+                    (f'{n_out_of_tolerance}', Text.danger if n_out_of_tolerance else Text.value),
+                    ' exact match mismatches ',
+                    (f'{n_mismatches}', Text.danger if n_mismatches else Text.value)])
+
+    # The results must be the same
+    assert not failed, f'Results of prefix sharing differ (atol={atol}, rtol={rtol}) for tasks: {failed}'
+
+
+#
+if __name__ == '__main__':
+    main()
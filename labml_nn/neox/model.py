@@ -10,12 +10,17 @@ summary: >
 Here is the code for layers of GPT-NeoX model and the code to load
 20B checkpoint.
 
-The method `load_state` in the layers load the checkpoints of that layer.
+The method `merge_state` in the layers loads the checkpoints of that layer,
+and `load_state` does the same inside a `monit` section.
 The checkpoint loading helpers are on [`checkpoint.py`](checkpoint.html)
 """
 import copy
 import math
-from typing import Dict, Optional, Set, Callable, Any, Generator, Tuple
+from contextlib import nullcontext
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from pathlib import PurePath
+from typing import Dict, Optional, Set, Callable, Any, Generator, Tuple, Union, Deque
 
 import torch
 from torch import nn
@@ -25,10 +30,33 @@ from labml import monit, logger
 from labml.logger import Text
 from labml_nn.neox import checkpoint
 from labml_nn.neox.utils.cache import get_cache
+from labml_nn.transformers.attention_backend import attention
+
+
+def _section(name: str, is_monit: bool):
+    """
+    #### A `monit` section, or nothing if `is_monit` is `False`
+    """
+    return monit.section(name) if is_monit else nullcontext()
 
 
 class NeoXModule(nn.Module):
+    # Name of the `monit` section shown when loading the checkpoint
+    load_section: str = 'Load layer'
+
     def load_state(self, p1: Dict[str, torch.Tensor], p2: Dict[str, torch.Tensor]):
+        """
+        Load the checkpoint within a `monit` section
+        """
+        with monit.section(self.load_section):
+            self.merge_state(p1, p2)
+
+    def merge_state(self, p1: Dict[str, torch.Tensor], p2: Dict[str, torch.Tensor]):
+        """
+        Code to load the checkpoint.
+
+        This doesn't open `monit` sections, so that it can run on loader threads.
+        """
         pass
 
 
@@ -54,12 +82,13 @@ class Embedding(NeoXModule):
         """
         return self.emb(x)
 
-    def load_state(self, p1: Dict[str, torch.Tensor], p2: Dict[str, torch.Tensor]):
+    load_section = 'Load embedding layer'
+
+    def merge_state(self, p1: Dict[str, torch.Tensor], p2: Dict[str, torch.Tensor]):
         """
         Code to load the checkpoint
         """
-        with monit.section('Load embedding layer'):
-            checkpoint.merge_params_dim_0(self.emb.weight, 'word_embeddings.weight', p1, p2)
+        checkpoint.merge_params_dim_0(self.emb.weight, 'word_embeddings.weight', p1, p2)
 
 
 class RoPE(nn.Module):
@@ -100,15 +129,20 @@ class RoPE(nn.Module):
         x1, x2 = x[..., : x.shape[-1] // 2], x[..., x.shape[-1] // 2:]
         return torch.cat((-x2, x1), dim=-1)
 
-    def forward(self, x: torch.Tensor, offset: int = 0):
+    def forward(self, x: torch.Tensor, offset: Union[int, torch.Tensor] = 0):
         """
         :param x: has shape `[..., seq, n_heads, d_k]`
         :param offset: is the starting position of `x`. This is $\gt 0$ when we have
-        cached the keys and queries of previous positions
+        cached the keys and queries of previous positions.
+        It can be a tensor of shape `[batch_size]` when the sequences in the batch start at
+        different positions; `x` should have shape `[batch_size, seq, n_heads, d_k]` then.
         """
 
         # Get the actual sequence length
-        seq_len = x.shape[-3] + offset
+        if isinstance(offset, torch.Tensor):
+            seq_len = x.shape[-3] + int(offset.max())
+        else:
+            seq_len = x.shape[-3] + offset
 
         # Initialize $\theta$
         if self.theta is None:
@@ -119,12 +153,17 @@ class RoPE(nn.Module):
         # Initialize $\cos m\theta_i$ and $\sin m\theta_i$ cache
         if (
                 self.cos_cached is None or
-                seq_len > self.cos_cached.shape[1] or
+                seq_len > self.cos_cached.shape[0] or
                 self.cos_cached.device != x.device or
                 self.cos_cached.dtype != x.dtype
         ):
+            # Number of positions to cache. We double the cache size when it grows,
+            # so that it is not recomputed for every new token during incremental decoding.
+            n_pos = seq_len
+            if self.cos_cached is not None:
+                n_pos = max(seq_len, 2 * self.cos_cached.shape[0])
             # Get position indexes $m$
-            seq_idx = torch.arange(seq_len, device=x.device).type_as(self.theta)
+            seq_idx = torch.arange(n_pos, device=x.device).type_as(self.theta)
             # $m \theta_i$
             idx_theta = torch.einsum("s,d->sd", seq_idx, self.theta)
             # Concatenate so that for row $m$ we have
@@ -147,7 +186,13 @@ class RoPE(nn.Module):
         x_rope, x_pass = x[..., :self.d_rope], x[..., self.d_rope:]
 
         # Get the sin and cos values from the cache
-        cos, sin = self.cos_cached[offset: seq_len], self.sin_cached[offset: seq_len]
+        if isinstance(offset, torch.Tensor):
+            # Positions of each sequence `[batch_size, seq]`
+            positions = offset[:, None] + torch.arange(x.shape[-3], device=offset.device)[None, :]
+            # Shape `[batch_size, seq, 1, d_rope]`
+            cos, sin = self.cos_cached[positions], self.sin_cached[positions]
+        else:
+            cos, sin = self.cos_cached[offset: seq_len], self.sin_cached[offset: seq_len]
 
         # RoPE embeddings
         #
@@ -198,11 +243,9 @@ class AttentionLayer(nn.Module):
         # Attention scaling factor
         self.scale = 1 / math.sqrt(d_k)
 
-        # To cache causal mask
-        self.causal_mask = None
-
-        # Attention softmax module
-        self.softmax = nn.Softmax(dim=-2)
+        # [Attention backend](../transformers/attention_backend/index.html) to use;
+        # it's selected automatically if `None`
+        self.backend: Optional[str] = None
 
         # [FlashAttention](https://github.com/HazyResearch/flash-attention)
         if is_flash_attention:
@@ -216,28 +259,6 @@ class AttentionLayer(nn.Module):
         else:
             self.flash_attention = None
 
-    def _get_mask(self, attn: torch.Tensor):
-        """
-        #### Calculate the causal mask
-
-        * `attn` has shape [batch_size, query_seq_len, key_seq_len, n_heads]
-        """
-
-        # Query and key lengths
-        nq, nk = attn.shape[1:3]
-
-        # Create mask
-        if (
-                self.causal_mask is None or
-                self.causal_mask.shape[0] != nq or
-                self.causal_mask.shape[1] != nk or
-                self.causal_mask.device != attn.device
-        ):
-            self.causal_mask = torch.triu(attn.new_ones([nq, nk], dtype=torch.bool), 1 + nk - nq)
-
-        # Return from cache
-        return self.causal_mask[None, :, :, None]
-
     def forward(self, x: torch.Tensor):
         """
         :param x: has shape `[batch_size, seq_len, n_hidden]`
@@ -251,8 +272,25 @@ class AttentionLayer(nn.Module):
         # Split into query, key and value each of shape `[batch_size, seq_len, n_heads, 3 * d_k]`
         q, k, v = torch.split(qkv, qkv.shape[-1] // 3, dim=-1)
 
+        # Attention mask for sequences of different lengths in the [static key-value cache](utils/kv_cache.html)
+        mask = None
+        # Get the [static key-value cache](utils/kv_cache.html)
+        kv_cache = get_cache().get('kv_cache')
+
+        # If we are using the static key-value cache
+        if kv_cache is not None:
+            # Position offset of the current embeddings
+            offset = kv_cache.get_offset(q)
+
+            # Add RoPE embeddings
+            q = self.rope(q, offset=offset)
+            k = self.rope(k, offset=offset)
+
+            # Write to the cache in place and get views of
+            # the keys and values of shape `[batch_size, prev_seq_len + seq_len, n_heads, d_k]`
+            k, v, mask = kv_cache.update(k, v)
         # If we are caching the states of previous tokens
-        if get_cache().get('use_cache', False):
+        elif get_cache().get('use_cache', False):
             # Get the state id's. We use to retrieve previous states and store the next states
             prev_state_id, next_state_id = get_cache().get('state_ids')
             # If there's cache
@@ -282,11 +320,11 @@ class AttentionLayer(nn.Module):
             k = self.rope(k)
 
         # Use flash attention
-        if self.flash_attention is not None and q.shape[1] == k.shape[1] and q.shape[-1] <= 128:
+        if self.flash_attention is not None and mask is None and q.shape[1] == k.shape[1] and q.shape[-1] <= 128:
             output = self.compute_flash_attention(q, k, v)
         # Otherwise, use normal attention
         else:
-            output = self.compute_attention(q, k, v)
+            output = self.compute_attention(q, k, v, mask)
 
         # Reshape from `[batch_size, seq_len, n_heads, d_k] to `[batch_size, seq_len, n_hidden]`
         output = output.reshape(*x.shape)
@@ -316,31 +354,33 @@ class AttentionLayer(nn.Module):
 
         return output
 
-    def compute_attention(self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor):
-        # Disable auto-casting to fp16 for attention computation
-        with autocast(enabled=False):
-            if q.dtype == torch.float16:
-                # Convert to fp32 if the current dtype is fp16
-                attn = torch.einsum('bihk,bjhk->bijh', q.float(), k.float())
-            else:
-                # Do not cast for bfloat
-                attn = torch.einsum('bihk,bjhk->bijh', q, k)
-
-            # Scale attention
-            attn = attn * self.scale
+    def compute_attention(self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor,
+                          mask: Optional[torch.Tensor] = None):
+        """
+        #### Compute attention
 
-            # Get causal mask
-            mask = self._get_mask(attn)
-            # Apply mask
-            attn.masked_fill_(mask, self.mask_fill)
+        :param q: are the queries of shape `[batch_size, query_seq_len, n_heads, d_k]`
+        :param k: are the keys of shape `[batch_size, key_seq_len, n_heads, d_k]`
+        :param v: are the values of shape `[batch_size, key_seq_len, n_heads, d_k]`
+        :param mask: is the attention mask of shape `[batch_size, query_seq_len, key_seq_len, 1]`.
+            The causal mask is used if it is `None`.
+        """
+        # Change to shape `[batch_size, n_heads, seq_len, d_k]`
+        q, k, v = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)
 
-            # Attention softmax
-            attn = self.softmax(attn)
+        # Add `mask_fill` to the scores of masked positions.
+        # This keeps rows with all positions masked finite.
+        if mask is not None:
+            mask = q.new_zeros(mask.shape).masked_fill_(mask, self.mask_fill).permute(0, 3, 1, 2)
 
-        # Get attention weighted values
-        output = torch.einsum('bijh,bjhk->bihk', attn.to(v.dtype), v)
+        # Disable auto-casting to fp16 for attention computation.
+        # The [attention backends](../transformers/attention_backend/index.html)
+        # compute half precision scores in `float32` when they are not fused.
+        with autocast(enabled=False):
+            output = attention(q, k, v, mask, is_causal=mask is None, scale=self.scale, backend=self.backend)
 
-        return output
+        # Change back to shape `[batch_size, seq_len, n_heads, d_k]`
+        return output.transpose(1, 2)
 
 
 class FFNLayer(nn.Module):
@@ -414,34 +454,35 @@ class TransformerLayer(NeoXModule):
         # Add them and the residual connection
         return attn + ffn + residual
 
-    def load_state(self, p1: Dict[str, torch.Tensor], p2: Dict[str, torch.Tensor]):
+    load_section = 'Load transformer layer'
+
+    def merge_state(self, p1: Dict[str, torch.Tensor], p2: Dict[str, torch.Tensor]):
         """
         Code to load the checkpoint
         """
-        with monit.section('Load transformer layer'):
-            # Attention output transform
-            checkpoint.merge_params_sum(self.attention.output.bias, 'attention.dense.bias', p1, p2)
-            checkpoint.merge_params_dim_1(self.attention.output.weight, 'attention.dense.weight', p1, p2)
+        # Attention output transform
+        checkpoint.merge_params_sum(self.attention.output.bias, 'attention.dense.bias', p1, p2)
+        checkpoint.merge_params_dim_1(self.attention.output.weight, 'attention.dense.weight', p1, p2)
 
-            # Attention query, key and value transform
-            checkpoint.merge_params_dim_0(self.attention.qkv_lin.bias, 'attention.query_key_value.bias', p1, p2)
-            checkpoint.merge_params_dim_0(self.attention.qkv_lin.weight, 'attention.query_key_value.weight', p1, p2)
+        # Attention query, key and value transform
+        checkpoint.merge_params_dim_0(self.attention.qkv_lin.bias, 'attention.query_key_value.bias', p1, p2)
+        checkpoint.merge_params_dim_0(self.attention.qkv_lin.weight, 'attention.query_key_value.weight', p1, p2)
 
-            # Layer norm before attention
-            checkpoint.merge_params_duplicate(self.pre_ln_attn.bias, 'input_layernorm.bias', p1, p2)
-            checkpoint.merge_params_duplicate(self.pre_ln_attn.weight, 'input_layernorm.weight', p1, p2)
+        # Layer norm before attention
+        checkpoint.merge_params_duplicate(self.pre_ln_attn.bias, 'input_layernorm.bias', p1, p2)
+        checkpoint.merge_params_duplicate(self.pre_ln_attn.weight, 'input_layernorm.weight', p1, p2)
 
-            # FFN second transform
-            checkpoint.merge_params_dim_0(self.ffn.dense_h_h4.bias, 'mlp.dense_h_to_4h.bias', p1, p2)
-            checkpoint.merge_params_dim_0(self.ffn.dense_h_h4.weight, 'mlp.dense_h_to_4h.weight', p1, p2)
+        # FFN second transform
+        checkpoint.merge_params_dim_0(self.ffn.dense_h_h4.bias, 'mlp.dense_h_to_4h.bias', p1, p2)
+        checkpoint.merge_params_dim_0(self.ffn.dense_h_h4.weight, 'mlp.dense_h_to_4h.weight', p1, p2)
 
-            # FFN first transform
-            checkpoint.merge_params_sum(self.ffn.dense_h4_h.bias, 'mlp.dense_4h_to_h.bias', p1, p2)
-            checkpoint.merge_params_dim_1(self.ffn.dense_h4_h.weight, 'mlp.dense_4h_to_h.weight', p1, p2)
+        # FFN first transform
+        checkpoint.merge_params_sum(self.ffn.dense_h4_h.bias, 'mlp.dense_4h_to_h.bias', p1, p2)
+        checkpoint.merge_params_dim_1(self.ffn.dense_h4_h.weight, 'mlp.dense_4h_to_h.weight', p1, p2)
 
-            # Layer norm before FFN
-            checkpoint.merge_params_duplicate(self.pre_ln_ffn.bias, 'post_attention_layernorm.bias', p1, p2)
-            checkpoint.merge_params_duplicate(self.pre_ln_ffn.weight, 'post_attention_layernorm.weight', p1, p2)
+        # Layer norm before FFN
+        checkpoint.merge_params_duplicate(self.pre_ln_ffn.bias, 'post_attention_layernorm.bias', p1, p2)
+        checkpoint.merge_params_duplicate(self.pre_ln_ffn.weight, 'post_attention_layernorm.weight', p1, p2)
 
 
 class FinalNorm(NeoXModule):
@@ -463,13 +504,14 @@ class FinalNorm(NeoXModule):
         """
         return self.ln(x)
 
-    def load_state(self, p1: Dict[str, torch.Tensor], p2: Dict[str, torch.Tensor]):
+    load_section = 'Load final normalization layer'
+
+    def merge_state(self, p1: Dict[str, torch.Tensor], p2: Dict[str, torch.Tensor]):
         """
         Code to load the checkpoint
         """
-        with monit.section('Load final normalization layer'):
-            checkpoint.merge_params_duplicate(self.ln.bias, 'norm.bias', p1, p2)
-            checkpoint.merge_params_duplicate(self.ln.weight, 'norm.weight', p1, p2)
+        checkpoint.merge_params_duplicate(self.ln.bias, 'norm.bias', p1, p2)
+        checkpoint.merge_params_duplicate(self.ln.weight, 'norm.weight', p1, p2)
 
 
 class ReadoutLayer(NeoXModule):
@@ -492,12 +534,13 @@ class ReadoutLayer(NeoXModule):
         """
         return self.linear(x)
 
-    def load_state(self, p1: Dict[str, torch.Tensor], p2: Dict[str, torch.Tensor]):
+    load_section = 'Load final linear layer'
+
+    def merge_state(self, p1: Dict[str, torch.Tensor], p2: Dict[str, torch.Tensor]):
         """
         Code to load the checkpoint
         """
-        with monit.section('Load final linear layer'):
-            checkpoint.merge_params_dim_0(self.linear.weight, 'final_linear.weight', p1, p2)
+        checkpoint.merge_params_dim_0(self.linear.weight, 'final_linear.weight', p1, p2)
 
 
 class LayerGenerator:
@@ -511,7 +554,10 @@ class LayerGenerator:
                  device: torch.device = torch.device('cpu'),
                  is_llm_int8: bool = False,
                  llm_int8_threshold: float = 6.0,
-                 is_flash_attention: bool = False
+                 is_flash_attention: bool = False,
+                 mmap_checkpoint: Optional[PurePath] = None,
+                 cpu_quantization_bits: Optional[int] = None,
+                 cpu_quantization_group_size: int = 128,
                  ):
         """
         ### Generator to create layers
@@ -534,6 +580,11 @@ class LayerGenerator:
         :param llm_int8_threshold: is the threshold $\alpha$ used to separate outlier features
         :param is_flash_attention: specifies whether to use
             [FlashAttention](https://github.com/HazyResearch/flash-attention)
+        :param mmap_checkpoint: is the path of a [pre-merged memory-mapped checkpoint](utils/mmap_checkpoint.html).
+            The layers are constructed directly on the memory-mapped weights if this is given.
+        :param cpu_quantization_bits: is the number of bits (`8` or `4`) for
+            [CPU weight-only quantization](utils/cpu_quantization.html). No quantization if `None`.
+        :param cpu_quantization_group_size: is the number of input features that share a quantization scale
         """
         if filter_layers is None:
             filter_layers = set(range(n_layers + 3))
@@ -549,6 +600,10 @@ class LayerGenerator:
         self.is_llm_int8 = is_llm_int8
         self.llm_int8_threshold = llm_int8_threshold
         self.is_flash_attention = is_flash_attention
+        self.mmap_checkpoint = mmap_checkpoint
+        self._mmap_checkpoint_reader = None
+        self.cpu_quantization_bits = cpu_quantization_bits
+        self.cpu_quantization_group_size = cpu_quantization_group_size
 
         self.pre_created_layers = dict(
             transformer_layer=None,
@@ -570,6 +625,8 @@ class LayerGenerator:
                           is_llm_int8: bool = None,
                           device: torch.device = None,
                           llm_int8_threshold: float = None,
+                          cpu_quantization_bits: Optional[int] = None,
+                          is_monit: bool = True,
                           ):
         """
         <a id="post_load_prepare"></a>
@@ -578,12 +635,14 @@ class LayerGenerator:
 
         This function implements layer transformations after loading the checkpoint.
 
-        Currently, it only applies the int8 quantization.
+        Currently, it only applies the int8 quantization or the CPU weight-only quantization.
 
         :param layer: is the layer to prepare
         :param is_llm_int8: specifies whether to use int8 quantization
         :param device: is the device of the model
         :param llm_int8_threshold: is the threshold $\alpha$ used to separate outlier features
+        :param cpu_quantization_bits: is the number of bits for CPU weight-only quantization
+        :param is_monit: is whether to open `monit` sections; it should be `False` on background threads
         :return: the prepared layer
         """
 
@@ -594,20 +653,37 @@ class LayerGenerator:
             device = self.device
         if llm_int8_threshold is None:
             llm_int8_threshold = self.llm_int8_threshold
-
-        # Skip if not using int8 quantization
-        if not is_llm_int8:
-            return layer
+        if cpu_quantization_bits is None:
+            cpu_quantization_bits = self.cpu_quantization_bits
 
         # Only convert the linear layers in the transformer layers
         if not isinstance(layer, TransformerLayer):
             return layer
 
+        # CPU weight-only quantization
+        if cpu_quantization_bits is not None:
+            # Use `make_cpu_quantized_linear` defined in [utilities](./utils/cpu_quantization.html).
+            from labml_nn.neox.utils.cpu_quantization import make_cpu_quantized_linear
+
+            bits, group_size = cpu_quantization_bits, self.cpu_quantization_group_size
+            # Convert the linear layers
+            with _section(f'Convert to int{bits}', is_monit):
+                layer.attention.output = make_cpu_quantized_linear(layer.attention.output, bits, group_size)
+                layer.attention.qkv_lin = make_cpu_quantized_linear(layer.attention.qkv_lin, bits, group_size)
+                layer.ffn.dense_h_h4 = make_cpu_quantized_linear(layer.ffn.dense_h_h4, bits, group_size)
+                layer.ffn.dense_h4_h = make_cpu_quantized_linear(layer.ffn.dense_h4_h, bits, group_size)
+            #
+            return layer
+
+        # Skip if not using int8 quantization
+        if not is_llm_int8:
+            return layer
+
         # Use `make_llm_int8_linear` defined in [utilities](./utils/llm_int8.html).
         from labml_nn.neox.utils.llm_int8 import make_llm_int8_linear
 
         # Convert the linear layers
-        with monit.section('Convert to int8'):
+        with _section('Convert to int8', is_monit):
             layer.attention.output = make_llm_int8_linear(layer.attention.output,
                                                           device=device,
                                                           threshold=llm_int8_threshold)
@@ -659,41 +735,48 @@ class LayerGenerator:
     def _create_readout_layer(self):
         return ReadoutLayer(self.n_hidden, self.n_vocab)
 
-    @torch.no_grad()
-    def get_layers(self) -> Generator[Tuple[NeoXModule, Tuple[str, str]], None, None]:
+    def _layer_specs(self) -> Generator[Tuple[str, Callable[[], NeoXModule], Tuple[str, str]], None, None]:
         """
-        ### Generator to get layers
+        #### Generator of the layers to load
+
+        This yields the name of the layer, a function to create it, and its checkpoint files.
         """
         # Embedding layer
         if 0 in self.filter_layers:
-            with monit.section('Embedding layer'):
-                layer = self._prepare_layer(self._create_embedding_layer())
-            yield layer, ('layer_00-model_00-model_states.pt', 'layer_00-model_01-model_states.pt')
+            yield 'Embedding layer', lambda: self._prepare_layer(self._create_embedding_layer()), \
+                  ('layer_00-model_00-model_states.pt', 'layer_00-model_01-model_states.pt')
 
         # Transformer layers
         for i in range(self.n_layers):
             # Transformer layer
             if i + 1 in self.filter_layers:
-                with monit.section(f'Transformer Layer {i}'):
-                    yield self._create_transformer_layer(), \
-                          (f'layer_{i + 2 :02d}-model_00-model_states.pt',
-                           f'layer_{i + 2 :02d}-model_01-model_states.pt')
+                yield f'Transformer Layer {i}', self._create_transformer_layer, \
+                      (f'layer_{i + 2 :02d}-model_00-model_states.pt',
+                       f'layer_{i + 2 :02d}-model_01-model_states.pt')
 
         # Final normalization layer
         if self.n_layers + 1 in self.filter_layers:
-            with monit.section('Final norm layer'):
-                layer = self._prepare_layer(self._create_final_norm_layer())
-            yield layer, ('layer_47-model_00-model_states.pt', 'layer_47-model_01-model_states.pt')
+            yield 'Final norm layer', lambda: self._prepare_layer(self._create_final_norm_layer()), \
+                  ('layer_47-model_00-model_states.pt', 'layer_47-model_01-model_states.pt')
 
         # Readout layer
         if self.n_layers + 2 in self.filter_layers:
-            with monit.section('Readout layer'):
-                layer = self._prepare_layer(self._create_readout_layer())
-            yield layer, ('layer_48-model_00-model_states.pt', 'layer_48-model_01-model_states.pt')
+            yield 'Readout layer', lambda: self._prepare_layer(self._create_readout_layer()), \
+                  ('layer_48-model_00-model_states.pt', 'layer_48-model_01-model_states.pt')
 
         for k in self.pre_created_layers.keys():
             self.pre_created_layers[k] = None
 
+    @torch.no_grad()
+    def get_layers(self) -> Generator[Tuple[NeoXModule, Tuple[str, str]], None, None]:
+        """
+        ### Generator to get layers
+        """
+        for name, create, files in self._layer_specs():
+            with monit.section(name):
+                layer = create()
+            yield layer, files
+
     @property
     def total_layers(self):
         """
@@ -702,10 +785,24 @@ class LayerGenerator:
         return self.n_layers + 3
 
     @torch.no_grad()
-    def load(self) -> Generator[NeoXModule, None, None]:
+    def load(self, *, n_workers: int = 0, prefetch: int = 2) -> Generator[NeoXModule, None, None]:
         """
         ### Generator to load layers
+
+        :param n_workers: is the number of threads that read and merge the checkpoints of upcoming layers
+            while the current layer is prepared (e.g. quantized) and used.
+            Layers are loaded one after the other if this is `0`.
+        :param prefetch: is the maximum number of layers loaded ahead.
+            At most `prefetch + 1` layers are held by the loader, which caps the memory used for prefetching.
         """
+        if self.mmap_checkpoint is not None:
+            yield from self._load_mmap()
+            return
+
+        if n_workers > 0:
+            yield from self._load_parallel(n_workers, prefetch)
+            return
+
         with monit.section("Layers"):
             for i, (layer, files) in enumerate(self.get_layers()):
                 if files is not None:
@@ -715,3 +812,158 @@ class LayerGenerator:
 
                 monit.progress(min(0.99, (i + 1) / self.total_layers))
                 yield layer
+
+    @staticmethod
+    def _load_layer_state(layer: NeoXModule, files: Optional[Tuple[str, str]]):
+        """
+        #### Read and merge the checkpoint of a layer
+
+        This runs on the loader threads.
+        Reading files and copying tensors release the GIL, so layers load in parallel.
+        It doesn't open `monit` sections, because the section stack is shared by all threads
+        and is not thread-safe; sections are only opened on the thread consuming the layers.
+        """
+        if files is not None:
+            layer.merge_state(*checkpoint.read_checkpoint_files(files))
+
+        return layer
+
+    def _load_parallel(self, n_workers: int, prefetch: int) -> Generator[NeoXModule, None, None]:
+        """
+        #### Load layers with a thread pool and a bounded prefetch queue
+        """
+        # Layers are created on this thread in order, and their checkpoints are loaded on the pool
+        specs = self._layer_specs()
+        # Queue of layers being loaded, with their names
+        pending: Deque[Tuple[str, Future]] = deque()
+
+        with monit.section("Layers"), ThreadPoolExecutor(n_workers) as pool:
+            def submit_next():
+                # Create the next layer and start loading it
+                try:
+                    name, create, files = next(specs)
+                except StopIteration:
+                    return
+                pending.append((name, pool.submit(self._load_layer_state, create(), files)))
+
+            # Start loading the first `prefetch` layers
+            for _ in range(max(1, prefetch)):
+                submit_next()
+
+            i = 0
+            while pending:
+                name, future = pending.popleft()
+                # Wait for the next layer in order
+                with monit.section(name):
+                    layer = future.result()
+                # Start loading another layer so that the queue stays full
+                submit_next()
+
+                # Prepare the layer while the upcoming layers are being loaded
+                layer = self.post_load_prepare(layer)
+
+                monit.progress(min(0.99, (i + 1) / self.total_layers))
+                i += 1
+                yield layer
+
+    def _create_layer_by_index(self, idx: int) -> NeoXModule:
+        """
+        #### Create a layer from its index (as in `filter_layers`) without moving it to the device
+        """
+        if idx == 0:
+            return self._create_embedding_layer()
+        elif idx <= self.n_layers:
+            return TransformerLayer(self.n_hidden, self.n_heads, is_flash_attention=self.is_flash_attention)
+        elif idx == self.n_layers + 1:
+            return self._create_final_norm_layer()
+        elif idx == self.n_layers + 2:
+            return self._create_readout_layer()
+        else:
+            raise ValueError(f'Invalid layer index {idx}')
+
+    def _get_checkpoint_files(self, idx: int) -> Tuple[str, str]:
+        """
+        #### Get the checkpoint files of a layer from its index
+        """
+        if idx == 0:
+            layer = 0
+        elif idx <= self.n_layers:
+            layer = idx + 1
+        elif idx == self.n_layers + 1:
+            layer = 47
+        else:
+            layer = 48
+
+        return f'layer_{layer :02d}-model_00-model_states.pt', f'layer_{layer :02d}-model_01-model_states.pt'
+
+    def _get_mmap_checkpoint(self, is_monit: bool = True):
+        """
+        #### Open the [memory-mapped checkpoint](utils/mmap_checkpoint.html) once
+        """
+        if self._mmap_checkpoint_reader is None:
+            from labml_nn.neox.utils.mmap_checkpoint import MmapCheckpoint
+
+            with _section('Map checkpoint', is_monit):
+                reader = MmapCheckpoint(self.mmap_checkpoint)
+                reader.check_config(n_vocab=self.n_vocab, n_hidden=self.n_hidden,
+                                    n_layers=self.n_layers, n_heads=self.n_heads)
+            self._mmap_checkpoint_reader = reader
+
+        return self._mmap_checkpoint_reader
+
+    def layer_size(self, idx: int) -> int:
+        """
+        ### Get the number of bytes of the parameters of a layer
+
+        The layer is created on the `meta` device, so this doesn't allocate memory.
+        """
+        with torch.device('meta'):
+            layer = self._create_layer_by_index(idx)
+
+        return sum(p.numel() for p in layer.parameters()) * torch.finfo(self.dtype).bits // 8
+
+    @torch.no_grad()
+    def load_layer(self, idx: int, *, is_monit: bool = True) -> NeoXModule:
+        """
+        ### Load a single layer
+
+        This is used to [stream layers](utils/offload.html) when the model doesn't fit in memory.
+
+        :param idx: is the index of the layer (as in `filter_layers`)
+        :param is_monit: is whether to open `monit` sections.
+            It should be `False` when loading on a background thread,
+            because the section stack of `monit` is shared by all threads and is not thread-safe.
+        :return: the prepared layer
+        """
+        if self.mmap_checkpoint is not None:
+            # Create the layer without allocating parameters
+            with torch.device('meta'):
+                layer = self._create_layer_by_index(idx)
+            # Assign the memory-mapped tensors as parameters
+            state = self._get_mmap_checkpoint(is_monit).state_dict(idx, dtype=self.dtype, device=self.device)
+            layer.load_state_dict(state, assign=True)
+        else:
+            layer = self._prepare_layer(self._create_layer_by_index(idx))
+            files = self._get_checkpoint_files(idx)
+            if is_monit:
+                layer.load_state(*checkpoint.load_checkpoint_files(files))
+            else:
+                layer.merge_state(*checkpoint.read_checkpoint_files(files))
+
+        return self.post_load_prepare(layer, is_monit=is_monit)
+
+    def _load_mmap(self) -> Generator[NeoXModule, None, None]:
+        """
+        #### Load layers from a [memory-mapped checkpoint](utils/mmap_checkpoint.html)
+
+        Layers are created on the `meta` device, so no memory is allocated for parameters,
+        and then the memory-mapped tensors are assigned as parameters.
+        """
+        self._get_mmap_checkpoint()
+
+        with monit.section("Layers"):
+            for i, idx in enumerate(sorted(self.filter_layers)):
+                layer = self.load_layer(idx)
+
+                monit.progress(min(0.99, (i + 1) / self.total_layers))
+                yield layer
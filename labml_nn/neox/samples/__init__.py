@@ -8,5 +8,13 @@ summary: >
 # Samples
 
 * [Generating text](generate.html)
+* [Benchmark the static key-value cache](kv_cache_benchmark.html)
+* [Local generation server with continuous batching](server.html)
+* [Benchmark continuous batching](serving_benchmark.html)
+* [Benchmark loading checkpoints](load_benchmark.html)
+* [Benchmark CPU weight-only quantization](cpu_quantization_benchmark.html)
+* [Benchmark layer-streaming offloaded inference](offload_benchmark.html)
+* [Speculative decoding with a truncated draft model](speculative_decoding.html)
 * [Fine tuning the biases with pipeline-parallel training](finetune.html)
+* [Benchmark profile-guided pipeline balancing](pipeline_balance_benchmark.html)
 """
\ No newline at end of file
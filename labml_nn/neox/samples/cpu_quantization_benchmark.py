@@ -0,0 +1,143 @@
+"""
+---
+title: Benchmark CPU weight-only quantization
+summary: >
+     Compare quality, memory and speed of fp32, int8 and int4 GPT-NeoX on CPU
+---
+
+#  Benchmark CPU weight-only quantization
+
+This compares GPT-NeoX with [CPU weight-only quantization](../utils/cpu_quantization.html)
+against the fp32 model on CPU, with a small number of transformer layers (`filter_layers`).
+
+* **Quality**: perplexity on held-out text (the end of tiny Shakespeare), and how often the
+  most likely next token matches the fp32 model
+* **Memory**: size of the parameters and buffers of the model
+* **Speed**: tokens per second for prefill and for decoding with the
+  [static key-value cache](../utils/kv_cache.html)
+"""
+
+import argparse
+import copy
+import time
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from labml import lab, logger
+from labml.logger import Text
+from labml_nn.neox.model import LayerGenerator
+from labml_nn.neox.tokenizer import get_tokenizer
+from labml_nn.neox.utils.kv_cache import KVCache
+from labml_nn.neox.utils.text_dataset import load_text, DATASETS
+
+
+def model_size(model: nn.Module):
+    """
+    ### Size of parameters and buffers in MB
+    """
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors) / 1024 / 1024
+
+
+def get_held_out_tokens(n_windows: int, seq_len: int):
+    """
+    ### Get token windows from the end of tiny Shakespeare
+
+    :return: a tensor of shape `[n_windows, seq_len + 1]`
+    """
+    ds = DATASETS['tiny_shakespeare']
+    text = load_text(lab.get_data_path() / ds['file'], ds['url'])
+    # Use the last 10% of the text
+    text = text[-len(text) // 10:]
+    ids = get_tokenizer().encode(text).ids
+    n = n_windows * (seq_len + 1)
+
+    return torch.tensor(ids[-n:]).view(n_windows, seq_len + 1)
+
+
+@torch.no_grad()
+def evaluate(model: nn.Module, reference: nn.Module, tokens: torch.Tensor):
+    """
+    ### Perplexity and agreement of most likely tokens with the reference model
+    """
+    logits = model(tokens[:, :-1])
+    ref_logits = reference(tokens[:, :-1])
+
+    loss = F.cross_entropy(logits.view(-1, logits.shape[-1]), tokens[:, 1:].reshape(-1))
+    agreement = (logits.argmax(dim=-1) == ref_logits.argmax(dim=-1)).float().mean()
+
+    return float(loss.exp()), float(agreement)
+
+
+@torch.no_grad()
+def measure_speed(model: nn.Module, prompt: torch.Tensor, n_tokens: int):
+    """
+    ### Prefill and decoding tokens per second
+    """
+    kv_cache = KVCache.for_model(model, 1, prompt.shape[1] + n_tokens)
+
+    # Prefill
+    start = time.perf_counter()
+    with kv_cache.step():
+        logits = model(prompt)
+    prefill = prompt.shape[1] / (time.perf_counter() - start)
+
+    # Decode greedily
+    next_token = logits[:, -1:].argmax(dim=-1)
+    start = time.perf_counter()
+    for _ in range(n_tokens):
+        with kv_cache.step():
+            next_token = model(next_token)[:, -1:].argmax(dim=-1)
+    decode = n_tokens / (time.perf_counter() - start)
+
+    return prefill, decode
+
+
+def main():
+    # Argument parser
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--layers", type=int, nargs='+', default=[1, 2, 4],
+                        help="numbers of transformer layers to benchmark")
+    parser.add_argument("--group_size", type=int, default=128, help="quantization group size")
+    parser.add_argument("--threads", type=int, default=None, help="number of CPU threads")
+
+    opt = parser.parse_args()
+
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+
+    tokens = get_held_out_tokens(8, 256)
+
+    for n_layers in opt.layers:
+        # Load the fp32 model
+        generator = LayerGenerator(is_clone_layers=True,
+                                   filter_layers={0, *range(1, n_layers + 1), 45, 46},
+                                   dtype=torch.float,
+                                   device=torch.device('cpu'),
+                                   cpu_quantization_group_size=opt.group_size)
+        fp32 = nn.Sequential(*generator.load()).eval()
+
+        models = {'fp32': fp32}
+        for bits in [8, 4]:
+            layers = [generator.post_load_prepare(copy.deepcopy(layer), cpu_quantization_bits=bits)
+                      for layer in fp32]
+            models[f'int{bits}'] = nn.Sequential(*layers).eval()
+
+        logger.log([(f'{n_layers} transformer layers', Text.title)])
+        for name, model in models.items():
+            perplexity, agreement = evaluate(model, fp32, tokens)
+            prefill, decode = measure_speed(model, tokens[:1, :128], 32)
+            logger.log([(f'{name :<5}', Text.key),
+                        ' perplexity ', (f'{perplexity :9.2f}', Text.value),
+                        ' top-1 agreement ', (f'{agreement * 100 :6.2f}%', Text.value),
+                        ' size ', (f'{model_size(model) :8.1f}MB', Text.value),
+                        ' prefill ', (f'{prefill :8.1f} tokens/s', Text.value),
+                        ' decode ', (f'{decode :6.1f} tokens/s', Text.value)])
+
+
+#
+if __name__ == '__main__':
+    main()
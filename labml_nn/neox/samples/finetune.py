@@ -24,7 +24,6 @@ from labml.logger import inspect
 from labml_nn.neox.utils.text_dataset import get_training_data
 from labml_nn.neox.utils.finetune import FineTuneBiases
 from labml_nn.neox.model import LayerGenerator, NeoXModule
-from labml_nn.neox.utils import balance_layers_simple
 from labml_nn.neox.utils.trainer import PipelineParallelTrainerConf
 
 
@@ -70,7 +69,7 @@ def pipe_model(c: PipelineParallelTrainerConf):
     # Create the Pipe module
     with monit.section('Pipe'):
         # Get the layer distribution across GPUs
-        balance = balance_layers_simple(len(layers), c.n_gpus)
+        balance = c.balance
         inspect(balance=balance)
         # Devices for each GPU
         devices = [torch.device(f'cuda:{i}') for i in range(c.n_gpus)]
@@ -109,6 +108,8 @@ def main():
         'max_seq_len': 128,
         'batch_size': 64,
         'chunks': 8,
+        # Split the layers among GPUs by their measured time and memory
+        'balance': 'Profiled',
     })
 
     # Start the experiment
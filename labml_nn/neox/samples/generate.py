@@ -21,7 +21,7 @@ from torch import nn
 from labml import monit
 from labml_nn.neox.model import LayerGenerator
 from labml_nn.neox.utils import get_tokens, print_tokens
-from labml_nn.neox.utils.cache import get_cache
+from labml_nn.neox.utils.kv_cache import KVCache
 
 # List of layers to load. This is used for testing.
 # You can assign a subset of layers like `{0, 1}` so that it only loads
@@ -56,10 +56,6 @@ def generate():
     ## Generate text
     """
 
-    # Setup [cache](../utils/cache.html) to cache intermediate key/value pairs for faster generation
-    cache = get_cache()
-    cache.set('use_cache', True)
-
     # Device
     device = torch.device('cuda:0')
 
@@ -72,12 +68,15 @@ def generate():
 
     model = nn.Sequential(*layers)
 
+    # Setup a [static key-value cache](../utils/kv_cache.html) to cache keys and values
+    # of previous tokens for faster generation
+    kv_cache = KVCache.for_model(model, batch_size=1, max_len=2048)
+
     # Get token ids
     ids = get_tokens(PROMPT)
 
     # Run the model
-    cache.set('state_ids', (None, 1))
-    with monit.section('Infer'):
+    with monit.section('Infer'), kv_cache.step():
         next_token = infer(model, ids, device)[-1]
 
     # Append the predicted token
@@ -85,11 +84,9 @@ def generate():
 
     # Predict 100 tokens
     for i in range(1, 100):
-        # Set the state to use cached activations
-        cache.set('state_ids', (i, i + 1))
         # Get next token. Note that we only feed the last token to the model because
         # we cache the key/value pairs of previous tokens.
-        with monit.section('Infer'):
+        with monit.section('Infer'), kv_cache.step():
             next_token = infer(model, [next_token], device)[-1]
         # Append the predicted token
         ids += [next_token]
@@ -0,0 +1,139 @@
+"""
+---
+title: Benchmark the static key-value cache
+summary: >
+     Compare per-token decoding latency of the queue based cache and the static key-value cache
+---
+
+#  Benchmark the static key-value cache
+
+This compares the per-token decoding latency of the [queue based cache](../utils/cache.html)
+and the [static key-value cache](../utils/kv_cache.html) at different context lengths.
+
+It uses small randomly initialized transformer layers on CPU, so it doesn't need the checkpoints.
+The queue based cache copies the whole key/value history on every token,
+so its latency grows with the context length,
+whereas the static cache writes in place.
+"""
+
+import time
+from typing import List
+
+import torch
+from torch import nn
+
+from labml import logger
+from labml.logger import Text
+from labml_nn.neox.model import TransformerLayer
+from labml_nn.neox.utils.cache import get_cache
+from labml_nn.neox.utils.kv_cache import KVCache
+
+
+def build_model(n_layers: int, n_hidden: int, n_heads: int):
+    """
+    ### Create a model of randomly initialized transformer layers
+    """
+    return nn.Sequential(*[TransformerLayer(n_hidden, n_heads) for _ in range(n_layers)]).eval()
+
+
+@torch.no_grad()
+def time_queue_cache(model: nn.Module, context_len: int, n_tokens: int, n_hidden: int):
+    """
+    ### Time decoding with the queue based cache
+
+    :return: the average time per token in seconds
+    """
+    cache = get_cache()
+    cache.clear_all()
+    cache.set('use_cache', True)
+
+    # Fill the context
+    cache.set('state_ids', (None, 0))
+    model(torch.randn(1, context_len, n_hidden))
+
+    # Decode
+    start = time.perf_counter()
+    for i in range(n_tokens):
+        cache.set('state_ids', (i, i + 1))
+        model(torch.randn(1, 1, n_hidden))
+    elapsed = time.perf_counter() - start
+
+    cache.clear_all()
+
+    return elapsed / n_tokens
+
+
+@torch.no_grad()
+def time_static_cache(model: nn.Module, context_len: int, n_tokens: int, n_hidden: int, max_len: int):
+    """
+    ### Time decoding with the static key-value cache
+
+    :return: the average time per token in seconds
+    """
+    kv_cache = KVCache.for_model(model, 1, max_len)
+
+    # Fill the context
+    with kv_cache.step():
+        model(torch.randn(1, context_len, n_hidden))
+
+    # Decode
+    start = time.perf_counter()
+    for i in range(n_tokens):
+        with kv_cache.step():
+            model(torch.randn(1, 1, n_hidden))
+    elapsed = time.perf_counter() - start
+
+    return elapsed / n_tokens
+
+
+@torch.no_grad()
+def check_outputs(model: nn.Module, n_hidden: int):
+    """
+    ### Check that the static cache gives the same outputs as the full computation
+
+    This uses a batch with sequences of different lengths.
+    """
+    torch.manual_seed(0)
+    lengths = [7, 12]
+    xs = [torch.randn(1, n, n_hidden) for n in lengths]
+    expected = [model(x)[0, -1] for x in xs]
+
+    kv_cache = KVCache.for_model(model, 2, 32)
+    # Prefill with right padded prompts. The last token of each prompt is not fed here.
+    prompts = torch.zeros(2, max(lengths) - 1, n_hidden)
+    for i, x in enumerate(xs):
+        prompts[i, :lengths[i] - 1] = x[0, :-1]
+    with kv_cache.step([n - 1 for n in lengths]):
+        model(prompts)
+
+    # Feed the last tokens together
+    with kv_cache.step():
+        outputs = model(torch.stack([x[:, -1] for x in xs]))
+
+    for i in range(len(lengths)):
+        assert torch.allclose(outputs[i, 0], expected[i], atol=1e-4), 'Static cache output mismatch'
+
+
+def main():
+    n_layers, n_hidden, n_heads = 4, 512, 8
+    context_lens: List[int] = [128, 512, 1024, 2048, 4096]
+    n_tokens = 32
+
+    torch.manual_seed(0)
+    model = build_model(n_layers, n_hidden, n_heads)
+
+    check_outputs(model, n_hidden)
+    logger.log('Static cache matches full computation', Text.success)
+
+    logger.log(['Context', '\t', 'Queue cache (ms/token)', '\t', 'Static cache (ms/token)'])
+    for context_len in context_lens:
+        queue = time_queue_cache(model, context_len, n_tokens, n_hidden)
+        static = time_static_cache(model, context_len, n_tokens, n_hidden, max(context_lens) + n_tokens)
+        logger.log([(f'{context_len :7d}', Text.key), '\t',
+                    (f'{queue * 1000 :22.2f}', Text.value), '\t',
+                    (f'{static * 1000 :23.2f}', Text.value)])
+
+
+#
+if __name__ == '__main__':
+    main()
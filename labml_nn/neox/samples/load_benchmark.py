@@ -0,0 +1,130 @@
+"""
+---
+title: Benchmark loading GPT-NeoX checkpoints
+summary: >
+     Compare the end-to-end load time of the serial and the prefetching checkpoint loaders
+---
+
+#  Benchmark loading GPT-NeoX checkpoints
+
+This compares the end-to-end time to load GPT-NeoX layers with
+[`LayerGenerator.load`](../model.html) serially and with background prefetching threads.
+It also loads from the [pre-merged memory-mapped checkpoint](../utils/mmap_checkpoint.html)
+if it has been converted.
+
+Each run is in a separate process, and it reports the peak resident memory
+and the private and shared resident memory after loading.
+Memory-mapped weights are shared through the page cache,
+so several processes serving the same model add little private memory each.
+
+Run it a second time to see the load time with a warm page cache.
+"""
+
+import argparse
+import multiprocessing
+import resource
+import time
+from pathlib import Path
+from typing import Optional, Set
+
+import torch
+
+from labml import logger
+from labml.logger import Text
+from labml_nn.neox.model import LayerGenerator
+from labml_nn.neox.utils.mmap_checkpoint import get_mmap_checkpoint_path
+
+
+def _memory():
+    """
+    ### Private and shared resident memory in MB
+    """
+    mem = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty'):
+                mem[key] = int(value.split()[0]) / 1024
+
+    return (mem.get('Private_Clean', 0) + mem.get('Private_Dirty', 0),
+            mem.get('Shared_Clean', 0) + mem.get('Shared_Dirty', 0))
+
+
+def _load(filter_layers: Optional[Set[int]], n_workers: int, prefetch: int, mmap_checkpoint: Optional[Path],
+          queue: multiprocessing.Queue):
+    """
+    ### Load the layers and report the time and memory
+    """
+    start = time.perf_counter()
+    layers = list(LayerGenerator(is_clone_layers=True,
+                                 filter_layers=filter_layers,
+                                 dtype=torch.float16,
+                                 device=torch.device('cpu'),
+                                 mmap_checkpoint=mmap_checkpoint,
+                                 ).load(n_workers=n_workers, prefetch=prefetch))
+    elapsed = time.perf_counter() - start
+
+    # Touch all the parameters, as a forward pass would
+    with torch.no_grad():
+        for layer in layers:
+            for p in layer.parameters():
+                p.sum()
+
+    private, shared = _memory()
+    queue.put((elapsed, len(layers), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, private, shared))
+
+
+def run(filter_layers: Optional[Set[int]], n_workers: int, prefetch: int, mmap_checkpoint: Optional[Path] = None):
+    """
+    ### Run the loader in a new process
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_load, args=(filter_layers, n_workers, prefetch, mmap_checkpoint, queue))
+    process.start()
+    res = queue.get()
+    process.join()
+
+    return res
+
+
+def main():
+    # Argument parser
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--layers", type=int, default=None, help="number of transformer layers to load")
+    parser.add_argument("--workers", type=int, default=4, help="number of loader threads")
+    parser.add_argument("--prefetch", type=int, default=2, help="number of layers to load ahead")
+
+    opt = parser.parse_args()
+
+    filter_layers = None
+    if opt.layers is not None:
+        filter_layers = {0, *range(1, opt.layers + 1), 45, 46}
+
+    results = {
+        'Serial': run(filter_layers, 0, 0),
+        f'Prefetch ({opt.workers} threads, {opt.prefetch} ahead)': run(filter_layers, opt.workers, opt.prefetch),
+    }
+
+    # Memory-mapped checkpoint, if converted
+    mmap_checkpoint = get_mmap_checkpoint_path()
+    if mmap_checkpoint.exists():
+        results['Memory-mapped'] = run(filter_layers, 0, 0, mmap_checkpoint)
+    else:
+        logger.log('Convert the checkpoint with `python -m labml_nn.neox.utils.mmap_checkpoint` '
+                   'to benchmark memory-mapped loading', Text.warning)
+
+    serial = results['Serial'][0]
+    for name, (elapsed, n_layers, peak_rss, private, shared) in results.items():
+        logger.log([(f'{name :<32}', Text.key),
+                    (f'{elapsed :8.1f}s', Text.value), ' for ', (f'{n_layers}', Text.value), ' layers, ',
+                    'peak RSS ', (f'{peak_rss :8.0f}MB', Text.value),
+                    ', private ', (f'{private :8.0f}MB', Text.value),
+                    ', shared ', (f'{shared :8.0f}MB', Text.value),
+                    ', speedup ', (f'{serial / elapsed :.2f}x', Text.success)])
+
+
+#
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+---
+title: Benchmark layer-streaming offloaded inference
+summary: >
+     Throughput of GPT-NeoX generation with streamed layers under different memory budgets
+---
+
+#  Benchmark layer-streaming offloaded inference
+
+This generates tokens for a batch of prompts with
+[layer-streaming offloaded inference](../utils/offload.html)
+under different memory budgets, and reports the throughput,
+the largest number of resident layers and the peak resident memory of the process.
+
+Convert the checkpoint to the [memory-mapped format](../utils/mmap_checkpoint.html)
+first for faster streaming; otherwise the original checkpoints are used.
+"""
+
+import argparse
+import multiprocessing
+import random
+import resource
+import time
+from typing import Optional, Set, List
+
+import torch
+
+from labml import logger
+from labml.logger import Text
+from labml_nn.neox.model import LayerGenerator
+from labml_nn.neox.utils.mmap_checkpoint import get_mmap_checkpoint_path
+from labml_nn.neox.utils.offload import OffloadedModel
+
+
+def _generate(filter_layers: Optional[Set[int]], memory_limit: int, prompts: List[List[int]], n_tokens: int,
+              queue: multiprocessing.Queue):
+    """
+    ### Generate and report the throughput
+    """
+    mmap_checkpoint = get_mmap_checkpoint_path()
+    generator = LayerGenerator(filter_layers=filter_layers,
+                               dtype=torch.float16 if mmap_checkpoint.exists() else torch.float,
+                               device=torch.device('cpu'),
+                               mmap_checkpoint=mmap_checkpoint if mmap_checkpoint.exists() else None)
+
+    model = OffloadedModel(generator, memory_limit)
+    start = time.perf_counter()
+    model.generate(prompts, n_tokens)
+    elapsed = time.perf_counter() - start
+
+    queue.put((len(prompts) * n_tokens / elapsed, model.max_window,
+               resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def run(filter_layers: Optional[Set[int]], memory_limit: int, prompts: List[List[int]], n_tokens: int):
+    """
+    ### Run in a new process to measure the peak memory
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_generate, args=(filter_layers, memory_limit, prompts, n_tokens, queue))
+    process.start()
+    res = queue.get()
+    process.join()
+
+    return res
+
+
+def main():
+    # Argument parser
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--layers", type=int, default=None, help="number of transformer layers")
+    parser.add_argument("--limits", type=float, nargs='+', default=[4, 8, 16, 32],
+                        help="memory budgets in GB")
+    parser.add_argument("--batch_size", type=int, default=16, help="number of prompts")
+    parser.add_argument("--tokens", type=int, default=8, help="number of tokens to generate")
+
+    opt = parser.parse_args()
+
+    filter_layers = None
+    if opt.layers is not None:
+        filter_layers = {0, *range(1, opt.layers + 1), 45, 46}
+
+    # Random prompts of different lengths
+    rnd = random.Random(0)
+    prompts = [[rnd.randrange(50_000) for _ in range(rnd.randint(16, 64))] for _ in range(opt.batch_size)]
+
+    for limit in opt.limits:
+        tokens_per_sec, window, peak_rss = run(filter_layers, int(limit * 2 ** 30), prompts, opt.tokens)
+        logger.log([(f'{limit :6.1f}GB budget', Text.key),
+                    ' throughput ', (f'{tokens_per_sec :8.2f} tokens/s', Text.value),
+                    ' resident layers ', (f'{window :3d}', Text.value),
+                    ' peak RSS ', (f'{peak_rss :8.0f}MB', Text.value)])
+
+
+#
+if __name__ == '__main__':
+    main()
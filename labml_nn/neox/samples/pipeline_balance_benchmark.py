@@ -0,0 +1,186 @@
+"""
+---
+title: Benchmark profile-guided pipeline balancing
+summary: >
+     Compare pipeline training throughput with even and profile-guided splits of GPT-NeoX layers
+---
+
+#  Benchmark profile-guided pipeline balancing
+
+This trains the biases of a small GPT-NeoX model with random weights
+(a few transformer layers with a small hidden size, and the full 50k-token vocabulary)
+with pipeline parallelism.
+Each stage runs in its own process on CPU, with a share of the CPU threads,
+and activations and gradients are passed between the stages through queues.
+Micro-batches are scheduled as in GPipe; all forward passes and then all backward passes.
+
+It compares the throughput of the [profile-guided split](../utils/pipeline_balance.html)
+with the even split of [`balance_layers_simple`](../utils/index.html).
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+from typing import List
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from labml import logger, monit
+from labml.logger import Text, inspect
+from labml_nn.neox.model import LayerGenerator
+from labml_nn.neox.utils import balance_layers_simple
+from labml_nn.neox.utils.finetune import FineTuneBiases
+from labml_nn.neox.utils.pipeline_balance import profile_layers, balance_layers, pipeline_time, stage_memory
+
+
+def create_layers(n_layers: int, n_hidden: int, n_heads: int):
+    """
+    ### Create a small model with random weights and trainable biases
+    """
+    generator = LayerGenerator(n_hidden=n_hidden, n_layers=n_layers, n_heads=n_heads,
+                               dtype=torch.float, device=torch.device('cpu'))
+    with monit.section('Create layers', is_silent=True):
+        layers = [layer for layer, _ in generator.get_layers()]
+    FineTuneBiases(layers).set_trainable_params()
+
+    return layers
+
+
+def _stage(rank: int, n_stages: int, layers: List[nn.Module], x: torch.Tensor, n_steps: int, n_threads: int,
+           queues: list, results: multiprocessing.Queue):
+    """
+    ### Run a pipeline stage
+
+    :param rank: is the index of the stage
+    :param layers: are the layers of the stage
+    :param x: are the token ids of the micro-batches `[chunks, micro_batch_size, seq_len + 1]`
+    :param queues: are the `(forward, backward)` queues between stage `i` and `i + 1`
+    """
+    torch.set_num_threads(n_threads)
+    model = nn.Sequential(*layers)
+    is_first, is_last = rank == 0, rank == n_stages - 1
+    chunks = x.shape[0]
+
+    start = time.perf_counter()
+    # The first step is a warmup
+    for step in range(n_steps + 1):
+        if step == 1:
+            start = time.perf_counter()
+
+        # Forward passes
+        inputs, outputs = [], []
+        for c in range(chunks):
+            if is_first:
+                inp = x[c, :, :-1]
+            else:
+                inp = queues[rank - 1][0].get().requires_grad_()
+            out = model(inp)
+            if not is_last:
+                queues[rank][0].put(out.detach())
+            inputs.append(inp)
+            outputs.append(out)
+
+        # Backward passes
+        for c in reversed(range(chunks)):
+            if is_last:
+                loss = F.cross_entropy(outputs[c].reshape(-1, outputs[c].shape[-1]), x[c, :, 1:].reshape(-1))
+                loss.backward()
+            else:
+                grad = queues[rank][1].get()
+                if outputs[c].requires_grad:
+                    outputs[c].backward(grad)
+            if not is_first:
+                queues[rank - 1][1].put(inputs[c].grad)
+
+        model.zero_grad(set_to_none=True)
+
+    results.put((rank, time.perf_counter() - start))
+
+
+def run_pipeline(layers: List[nn.Module], balance: List[int], x: torch.Tensor, n_steps: int, n_threads: int):
+    """
+    ### Run the pipeline and measure the time per step
+    """
+    ctx = multiprocessing.get_context('spawn')
+    n_stages = len(balance)
+    queues = [(ctx.Queue(), ctx.Queue()) for _ in range(n_stages - 1)]
+    results = ctx.Queue()
+
+    processes = []
+    start = 0
+    for rank, n in enumerate(balance):
+        p = ctx.Process(target=_stage, args=(rank, n_stages, layers[start:start + n], x, n_steps, n_threads,
+                                             queues, results))
+        p.start()
+        processes.append(p)
+        start += n
+
+    elapsed = max(results.get()[1] for _ in processes)
+    for p in processes:
+        p.join()
+
+    return elapsed / n_steps
+
+
+def main():
+    # Argument parser
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--layers", type=int, default=6, help="number of transformer layers")
+    parser.add_argument("--hidden", type=int, default=512, help="number of features in the embeddings")
+    parser.add_argument("--heads", type=int, default=8, help="number of attention heads")
+    parser.add_argument("--stages", type=int, default=4, help="number of pipeline stages")
+    parser.add_argument("--chunks", type=int, default=8, help="number of micro-batches")
+    parser.add_argument("--batch_size", type=int, default=32, help="batch size")
+    parser.add_argument("--seq_len", type=int, default=128, help="sequence length")
+    parser.add_argument("--steps", type=int, default=4, help="number of training steps to measure")
+    parser.add_argument("--threads", type=int, default=None, help="number of CPU threads per stage")
+
+    opt = parser.parse_args()
+
+    n_threads = opt.threads or max(1, (os.cpu_count() or 1) // opt.stages)
+    torch.set_num_threads(n_threads)
+
+    layers = create_layers(opt.layers, opt.hidden, opt.heads)
+
+    # Token ids of the micro-batches
+    micro_batch_size = opt.batch_size // opt.chunks
+    x = torch.randint(0, 50_000, (opt.chunks, micro_batch_size, opt.seq_len + 1))
+
+    # Profile with the same number of threads as a stage
+    profiles = profile_layers(layers, x[0, :, :-1], torch.device('cpu'))
+    for layer, p in zip(layers, profiles):
+        logger.log([(f'{type(layer).__name__ :<16}', Text.key),
+                    ' forward ', (f'{p.forward_time * 1000 :8.2f}ms', Text.value),
+                    ' backward ', (f'{p.backward_time * 1000 :8.2f}ms', Text.value),
+                    ' parameters ', (f'{p.param_memory / 2 ** 20 :8.1f}MB', Text.value),
+                    ' activations ', (f'{p.activation_memory / 2 ** 20 :8.1f}MB', Text.value)])
+
+    balances = {
+        'even': balance_layers_simple(len(layers), opt.stages),
+        'profiled': balance_layers(profiles, opt.stages, chunks=opt.chunks),
+    }
+
+    for name, balance in balances.items():
+        inspect(balance=balance)
+        step_time = run_pipeline(layers, balance, x, opt.steps, n_threads)
+
+        start = 0
+        memories = []
+        for n in balance:
+            memories.append(stage_memory(profiles[start:start + n], opt.chunks))
+            start += n
+
+        logger.log([(f'{name :<8}', Text.key),
+                    ' throughput ', (f'{opt.batch_size / step_time :8.2f} samples/s', Text.value),
+                    ' estimated step time ', (f'{pipeline_time(profiles, balance, opt.chunks) :6.3f}s', Text.value),
+                    ' measured step time ', (f'{step_time :6.3f}s', Text.value),
+                    ' largest stage memory ', (f'{max(memories) / 2 ** 20 :8.1f}MB', Text.value)])
+
+
+#
+if __name__ == '__main__':
+    main()
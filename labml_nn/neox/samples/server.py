@@ -0,0 +1,160 @@
+"""
+---
+title: Local generation server for GPT-NeoX
+summary: >
+     Local HTTP server for GPT-NeoX with continuous batching
+---
+
+#  Local generation server for GPT-NeoX
+
+This serves GPT-NeoX over HTTP using the
+[continuous batching engine](../utils/continuous_batching.html).
+Concurrent requests are decoded together.
+
+```bash
+curl -X POST localhost:8000/generate \
+     -d '{"prompt": "Einstein was born in", "max_tokens": 32, "temperature": 0.8, "top_k": 40}'
+```
+
+Each request can set `temperature`, `top_k` and `top_p` for [sampling](../../sampling/index.html).
+Greedy sampling is used if none of them is given.
+"""
+
+import argparse
+import json
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Any
+
+import torch
+from torch import nn
+
+from labml import logger
+from labml.logger import Text
+from labml_nn.neox.model import LayerGenerator
+from labml_nn.neox.tokenizer import get_tokenizer
+from labml_nn.neox.utils.continuous_batching import GenerationEngine, AsyncGenerationEngine, GenerationRequest
+from labml_nn.sampling import Sampler
+from labml_nn.sampling.greedy import GreedySampler
+from labml_nn.sampling.nucleus import NucleusSampler
+from labml_nn.sampling.temperature import TemperatureSampler
+from labml_nn.sampling.top_k import TopKSampler
+
+
+def get_sampler(params: Dict[str, Any]) -> Sampler:
+    """
+    ### Create a sampler from request parameters
+    """
+    temperature = params.get('temperature')
+    top_k = params.get('top_k')
+    top_p = params.get('top_p')
+
+    # Greedy sampling if no sampling parameters are given
+    if temperature is None and top_k is None and top_p is None:
+        return GreedySampler()
+
+    sampler = TemperatureSampler(temperature or 1.0)
+    if top_k is not None:
+        sampler = TopKSampler(top_k, sampler)
+    if top_p is not None:
+        sampler = NucleusSampler(top_p, sampler)
+
+    return sampler
+
+
+def create_handler(engine: AsyncGenerationEngine):
+    """
+    ### Create the HTTP request handler
+    """
+
+    tokenizer = get_tokenizer()
+    eot_token = tokenizer.token_to_id('<|endoftext|>')
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/generate':
+                self.send_error(404)
+                return
+
+            # Parse the request
+            try:
+                params = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                request = GenerationRequest(tokenizer.encode(params['prompt']).ids,
+                                            params.get('max_tokens', 32),
+                                            get_sampler(params),
+                                            stop_token=eot_token)
+                future = engine.submit(request)
+            except (KeyError, TypeError, ValueError) as e:
+                self.send_error(400, str(e))
+                return
+
+            # Wait for the generation
+            try:
+                ids = future.result()
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+
+            body = json.dumps({
+                'text': tokenizer.decode(ids),
+                'tokens': ids,
+                'time_to_first_token': request.time_to_first_token,
+            }).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+def main():
+    # Argument parser
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    parser.add_argument("--layers", type=int, default=None,
+                        help="number of transformer layers to load (for testing)")
+    parser.add_argument("--batch_size", type=int, default=8, help="maximum number of sequences decoded together")
+    parser.add_argument("--max_len", type=int, default=2048, help="maximum sequence length")
+    parser.add_argument("--cuda", action='store_true', help="whether to use the GPU")
+
+    opt = parser.parse_args()
+
+    # Device and data type
+    if opt.cuda:
+        device, dtype = torch.device('cuda:0'), torch.float16
+    else:
+        device, dtype = torch.device('cpu'), torch.float
+
+    # Layers to load
+    filter_layers = None
+    if opt.layers is not None:
+        filter_layers = {0, *range(1, opt.layers + 1), 45, 46}
+
+    # Load layers
+    layers = list(LayerGenerator(is_clone_layers=True,
+                                 filter_layers=filter_layers,
+                                 dtype=dtype,
+                                 device=device,
+                                 ).load())
+    model = nn.Sequential(*layers)
+
+    # Start the engine
+    engine = AsyncGenerationEngine(GenerationEngine(model,
+                                                    max_batch_size=opt.batch_size,
+                                                    max_len=opt.max_len,
+                                                    device=device)).start()
+
+    # Serve
+    server = ThreadingHTTPServer(('localhost', opt.port), create_handler(engine))
+    logger.log(['Listening on ', (f'localhost:{opt.port}', Text.value)])
+    try:
+        server.serve_forever()
+    finally:
+        engine.stop()
+
+
+#
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+---
+title: Benchmark continuous batching
+summary: >
+     Benchmark throughput and time-to-first-token of the continuous batching engine
+---
+
+#  Benchmark continuous batching
+
+This measures the throughput (generated tokens per second) and time-to-first-token
+of the [continuous batching engine](../utils/continuous_batching.html)
+for a set of prompts of different lengths submitted at once.
+It compares decoding one sequence at a time with decoding up to `batch_size` sequences together.
+
+It uses a small model with a few transformer layers (`filter_layers`) on CPU.
+Pass `--random_weights` to skip loading the checkpoints.
+"""
+
+import argparse
+import random
+import time
+from typing import List
+
+import torch
+from torch import nn
+
+from labml import logger
+from labml.logger import Text
+from labml_nn.neox.model import LayerGenerator
+from labml_nn.neox.utils.continuous_batching import GenerationEngine, GenerationRequest
+from labml_nn.sampling.temperature import TemperatureSampler
+
+
+def load_model(n_layers: int, random_weights: bool):
+    """
+    ### Load a small model with the first `n_layers` transformer layers
+    """
+    generator = LayerGenerator(is_clone_layers=True,
+                               filter_layers={0, *range(1, n_layers + 1), 45, 46},
+                               dtype=torch.float,
+                               device=torch.device('cpu'))
+    if random_weights:
+        layers = [layer for layer, _ in generator.get_layers()]
+    else:
+        layers = list(generator.load())
+
+    return nn.Sequential(*layers).eval()
+
+
+def run(model: nn.Module, prompts: List[List[int]], max_tokens: int, batch_size: int):
+    """
+    ### Generate for all prompts and get the stats
+
+    :return: generated tokens per second and the time-to-first-token of each request
+    """
+    engine = GenerationEngine(model, max_batch_size=batch_size,
+                              max_len=max(len(p) for p in prompts) + max_tokens)
+
+    torch.manual_seed(0)
+    start = time.perf_counter()
+    requests = [GenerationRequest(p, max_tokens, TemperatureSampler(0.8)) for p in prompts]
+    for req in requests:
+        engine.add(req)
+    engine.run()
+    elapsed = time.perf_counter() - start
+
+    n_tokens = sum(len(req.generated) for req in requests)
+    ttft = sorted(req.time_to_first_token for req in requests)
+
+    return n_tokens / elapsed, ttft
+
+
+def main():
+    # Argument parser
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--layers", type=int, default=2, help="number of transformer layers")
+    parser.add_argument("--requests", type=int, default=32, help="number of requests")
+    parser.add_argument("--max_tokens", type=int, default=32, help="maximum tokens to generate")
+    parser.add_argument("--random_weights", action='store_true', help="skip loading the checkpoints")
+
+    opt = parser.parse_args()
+
+    model = load_model(opt.layers, opt.random_weights)
+
+    # Random prompts of different lengths
+    rnd = random.Random(0)
+    prompts = [[rnd.randrange(50_000) for _ in range(rnd.randint(8, 128))] for _ in range(opt.requests)]
+
+    logger.log(['Batch size', '\t', 'Tokens/s', '\t', 'TTFT p50 (s)', '\t', 'TTFT p95 (s)'])
+    for batch_size in [1, 4, 8, 16]:
+        tokens_per_sec, ttft = run(model, prompts, opt.max_tokens, batch_size)
+        logger.log([(f'{batch_size :10d}', Text.key), '\t',
+                    (f'{tokens_per_sec :8.1f}', Text.value), '\t',
+                    (f'{ttft[len(ttft) // 2] :12.3f}', Text.value), '\t',
+                    (f'{ttft[int(len(ttft) * 0.95)] :12.3f}', Text.value)])
+
+
+#
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+---
+title: Speculative decoding with GPT-NeoX
+summary: >
+     Generate text with speculative decoding using a truncated GPT-NeoX as the draft model
+---
+
+#  Speculative decoding with GPT-NeoX
+
+This generates text with [speculative decoding](../utils/speculative.html).
+The draft model is the embedding layer, the first few transformer layers,
+the final normalization layer and the readout layer of the target model.
+It shares the layers with the target model, so it takes no extra memory.
+
+It reports the tokens per second with and without speculative decoding,
+and the acceptance rate of the draft tokens.
+"""
+
+import argparse
+
+import torch
+from torch import nn
+
+from labml import logger, monit
+from labml.logger import Text
+from labml_nn.neox.model import LayerGenerator
+from labml_nn.neox.samples.generate import PROMPT
+from labml_nn.neox.utils import get_tokens
+from labml_nn.neox.utils.speculative import SpeculativeDecoder, benchmark
+
+
+def main():
+    # Argument parser
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--layers", type=int, default=None, help="number of transformer layers of the target")
+    parser.add_argument("--draft_layers", type=int, default=4, help="number of transformer layers of the draft")
+    parser.add_argument("--k", type=int, nargs='+', default=[2, 4, 6], help="numbers of draft tokens")
+    parser.add_argument("--temperature", type=float, default=0., help="sampling temperature")
+    parser.add_argument("--tokens", type=int, default=64, help="number of tokens to generate")
+    parser.add_argument("--cuda", action='store_true', help="whether to use the GPU")
+
+    opt = parser.parse_args()
+
+    # Device and data type
+    if opt.cuda:
+        device, dtype = torch.device('cuda:0'), torch.float16
+    else:
+        device, dtype = torch.device('cpu'), torch.float
+
+    # Layers of the target model
+    n_layers = opt.layers if opt.layers is not None else 44
+    filter_layers = {0, *range(1, n_layers + 1), 45, 46}
+
+    # Load the target model
+    layers = list(LayerGenerator(is_clone_layers=True,
+                                 filter_layers=filter_layers,
+                                 dtype=dtype,
+                                 device=device,
+                                 ).load())
+    target = nn.Sequential(*layers).eval()
+    # Draft model shares the embedding, the first `draft_layers` transformer layers
+    # and the final layers with the target
+    draft = nn.Sequential(*layers[:opt.draft_layers + 1], *layers[-2:]).eval()
+
+    ids = get_tokens(PROMPT)
+
+    for k in opt.k:
+        decoder = SpeculativeDecoder(target, draft, k=k, temperature=opt.temperature, device=device)
+        with monit.section(f'k={k}'):
+            baseline, speculative = benchmark(decoder, ids, opt.tokens)
+        logger.log([(f'k={k}', Text.key),
+                    ' target only ', (f'{baseline :7.2f} tokens/s', Text.value),
+                    ' speculative ', (f'{speculative :7.2f} tokens/s', Text.value),
+                    ' speedup ', (f'{speculative / baseline :.2f}x', Text.success),
+                    ' acceptance rate ', (f'{decoder.acceptance_rate * 100 :.1f}%', Text.value)])
+
+
+#
+if __name__ == '__main__':
+    main()
@@ -8,9 +8,17 @@ summary: >
 # Utilities and Helpers
 
 * [Cache for intermediate activations (for faster inference)](cache.html)
+* [Static key-value cache](kv_cache.html)
+* [Continuous batching generation engine](continuous_batching.html)
+* [Memory-mapped checkpoint](mmap_checkpoint.html)
+* [CPU weight-only quantization](cpu_quantization.html)
+* [Layer-streaming offloaded inference](offload.html)
+* [Speculative decoding](speculative.html)
+* [Profile-guided pipeline balancing](pipeline_balance.html)
 * [Tools for finetuning](finetune.html)
 * [Trainer](trainer.html)
 * [Text dataset](text_dataset.html)
+* [Pre-tokenized token file](token_file.html)
 """
 import typing
 from typing import List, Optional
@@ -0,0 +1,320 @@
+"""
+---
+title: Continuous Batching Generation Engine
+summary: >
+    Generation engine that serves many prompts concurrently with continuous batching
+---
+
+# Continuous Batching Generation Engine
+
+This generates text for many concurrent requests.
+Sequences are admitted and retired between decoding steps (continuous batching),
+so that a finished sequence doesn't hold the batch back and new requests don't wait for the
+whole batch to finish.
+
+Each step,
+
+1. Finished sequences are retired, and the last active sequences are moved to their
+   rows in the [static key-value cache](kv_cache.html) so that active sequences are always in
+   the first rows.
+2. Waiting requests are admitted if there are free rows.
+   Their prompts are right padded and fed together (prefill),
+   and the key-value cache masks out the padding.
+   The first token is sampled from the logits of the last prompt token.
+3. All active sequences decode one token together.
+
+Each request has its own [sampler](../../sampling/index.html).
+
+The [`AsyncGenerationEngine`](#AsyncGenerationEngine) runs the engine on a background thread
+and gives futures for requests.
+Here's a [local HTTP server](../samples/server.html) that uses it.
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import List, Optional, Deque
+
+import torch
+from torch import nn
+
+from labml_nn.neox.utils.kv_cache import KVCache
+from labml_nn.sampling import Sampler
+from labml_nn.sampling.greedy import GreedySampler
+
+
+class GenerationRequest:
+    """
+    ## Generation request
+    """
+
+    def __init__(self, ids: List[int], max_tokens: int, sampler: Optional[Sampler] = None,
+                 stop_token: Optional[int] = None):
+        """
+        :param ids: are the prompt token ids
+        :param max_tokens: is the maximum number of tokens to generate
+        :param sampler: is the [sampler](../../sampling/index.html) for this request.
+            Defaults to greedy sampling
+        :param stop_token: is the token that ends the generation (e.g. end of text)
+        """
+        if not ids:
+            raise ValueError('Empty prompt')
+        if max_tokens < 1:
+            raise ValueError('At least one token should be generated')
+
+        self.ids = ids
+        self.max_tokens = max_tokens
+        self.sampler = sampler or GreedySampler()
+        self.stop_token = stop_token
+
+        # Generated token ids
+        self.generated: List[int] = []
+        # Future that gets the generated token ids
+        self.future: Future = Future()
+
+        # Timestamps for benchmarking
+        self.arrival_time = time.perf_counter()
+        self.first_token_time: Optional[float] = None
+        self.finish_time: Optional[float] = None
+
+    @property
+    def is_done(self):
+        """
+        Whether the generation is complete
+        """
+        if len(self.generated) >= self.max_tokens:
+            return True
+        return self.stop_token is not None and len(self.generated) > 0 and self.generated[-1] == self.stop_token
+
+    @property
+    def time_to_first_token(self):
+        """
+        Time from arrival to the first generated token
+        """
+        return self.first_token_time - self.arrival_time
+
+
+class GenerationEngine:
+    """
+    ## Generation engine
+    """
+
+    def __init__(self, model: nn.Module, *, max_batch_size: int = 8, max_len: int = 2048,
+                 device: torch.device = torch.device('cpu')):
+        """
+        :param model: is the NeoX model (`nn.Sequential` of [layers](../model.html))
+        :param max_batch_size: is the maximum number of sequences decoded together
+        :param max_len: is the maximum length of prompt and generated tokens
+        :param device: is the device of the model
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_len = max_len
+        self.device = device
+
+        # [Static key-value cache](kv_cache.html) with a row for each active sequence
+        self.kv_cache = KVCache.for_model(model, max_batch_size, max_len)
+
+        # Requests waiting to be admitted
+        self.waiting: Deque[GenerationRequest] = deque()
+        # Active requests. `active[i]` uses row `i` of the key-value cache
+        self.active: List[GenerationRequest] = []
+
+    def add(self, request: GenerationRequest):
+        """
+        ### Add a request
+
+        :return: the future that gets the generated token ids
+        """
+        if len(request.ids) + request.max_tokens > self.max_len:
+            raise ValueError(f'Prompt and generated tokens exceed the maximum length {self.max_len}')
+
+        self.waiting.append(request)
+
+        return request.future
+
+    @property
+    def has_work(self):
+        """
+        Whether there are active or waiting requests
+        """
+        return bool(self.active or self.waiting)
+
+    def _sample(self, requests: List[GenerationRequest], logits: torch.Tensor):
+        """
+        #### Sample the next token for each request
+
+        :param requests: are the requests
+        :param logits: are the logits of shape `[len(requests), n_vocab]`
+        """
+        now = time.perf_counter()
+        logits = logits.float()
+        for req, lg in zip(requests, logits):
+            # Sample with the sampler of the request
+            req.generated.append(int(req.sampler(lg[None, :])[0]))
+            if req.first_token_time is None:
+                req.first_token_time = now
+
+    def _retire(self):
+        """
+        #### Retire finished sequences
+        """
+        i = 0
+        while i < len(self.active):
+            req = self.active[i]
+            if not req.is_done:
+                i += 1
+                continue
+
+            # Complete the request
+            req.finish_time = time.perf_counter()
+            req.future.set_result(req.generated)
+
+            # Move the last active sequence to this row
+            last = len(self.active) - 1
+            if i != last:
+                self.kv_cache.move(last, i)
+                self.active[i] = self.active[last]
+            self.kv_cache.reset(last)
+            self.active.pop()
+
+    def _admit(self):
+        """
+        #### Admit waiting requests and prefill their prompts
+        """
+        # Admit requests to free rows
+        new = []
+        while self.waiting and len(self.active) + len(new) < self.max_batch_size:
+            new.append(self.waiting.popleft())
+        if not new:
+            return
+
+        # Right pad the prompts
+        lengths = [len(req.ids) for req in new]
+        ids = torch.zeros((len(new), max(lengths)), dtype=torch.long)
+        for i, req in enumerate(new):
+            ids[i, :lengths[i]] = torch.tensor(req.ids, dtype=torch.long)
+
+        # Prefill into the rows after the active sequences.
+        # The key-value cache masks out the padding in the following steps.
+        first_row = len(self.active)
+        with self.kv_cache.step(lengths, first_row=first_row):
+            logits = self.model(ids.to(self.device))
+
+        # Sample the first token from the logits of the last prompt token
+        last = torch.tensor(lengths, device=logits.device) - 1
+        self._sample(new, logits[torch.arange(len(new), device=logits.device), last])
+
+        self.active += new
+
+    def _decode(self):
+        """
+        #### Decode one token for all active sequences
+        """
+        if not self.active:
+            return
+
+        # Feed the last generated token of each sequence
+        ids = torch.tensor([[req.generated[-1]] for req in self.active], dtype=torch.long)
+        with self.kv_cache.step():
+            logits = self.model(ids.to(self.device))
+
+        self._sample(self.active, logits[:, -1])
+
+    @torch.no_grad()
+    def step(self):
+        """
+        ### Run one step
+
+        Retires finished sequences, admits waiting requests and decodes a token.
+        """
+        self._retire()
+        self._admit()
+        # Sequences that finished with the first token
+        self._retire()
+        self._decode()
+        self._retire()
+
+    def run(self):
+        """
+        ### Run until all requests are complete
+        """
+        while self.has_work:
+            self.step()
+
+
+class AsyncGenerationEngine:
+    """
+    <a id="AsyncGenerationEngine"></a>
+
+    ## Engine running on a background thread
+    """
+
+    def __init__(self, engine: GenerationEngine):
+        """
+        :param engine: is the generation engine
+        """
+        self.engine = engine
+        # Condition to wake up the thread when requests arrive
+        self._condition = threading.Condition()
+        self._is_stopped = False
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def start(self):
+        """
+        ### Start the background thread
+        """
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        ### Stop the background thread
+        """
+        with self._condition:
+            self._is_stopped = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _loop(self):
+        while True:
+            # Wait for requests
+            with self._condition:
+                while not self._is_stopped and not self.engine.has_work:
+                    self._condition.wait()
+                if self._is_stopped:
+                    return
+
+            # Run a step. This is outside the lock so that requests can be submitted meanwhile;
+            # appending to the waiting queue is thread-safe.
+            try:
+                self.engine.step()
+            except Exception as e:
+                # Fail all requests, so that the clients don't wait forever
+                for req in self.engine.active + list(self.engine.waiting):
+                    req.future.set_exception(e)
+                self.engine.active.clear()
+                self.engine.waiting.clear()
+                self.engine.kv_cache.reset()
+
+    def submit(self, request: GenerationRequest) -> Future:
+        """
+        ### Submit a request
+
+        :return: a `concurrent.futures.Future` that gets the generated token ids
+        """
+        with self._condition:
+            future = self.engine.add(request)
+            self._condition.notify()
+
+        return future
+
+    async def generate(self, request: GenerationRequest) -> List[int]:
+        """
+        ### Generate with `asyncio`
+
+        :return: the generated token ids
+        """
+        return await asyncio.wrap_future(self.submit(request))
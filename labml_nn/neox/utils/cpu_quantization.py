@@ -0,0 +1,160 @@
+"""
+---
+title: CPU weight-only quantization for GPT-NeoX
+summary: >
+    Weight-only int8 and int4 quantized linear layers for CPU inference
+---
+
+# CPU weight-only quantization for GPT-NeoX
+
+[LLM.int8()](llm_int8.html) needs `bitsandbytes` and a GPU.
+This is a weight-only quantization for CPU inference.
+Weights of linear layers are stored as 8-bit or 4-bit integers with a scale per group of
+`group_size` input features for each output feature,
+
+$$W_{ij} \approx s_{i, \lfloor j / g \rfloor} Q_{ij}$$
+
+where $Q_{ij}$ is in $[-127, 127]$ for int8 and $[-8, 7]$ for int4.
+Two int4 values are packed into a byte.
+
+Activations stay in floating point.
+The matrix multiplication dequantizes a block of output features at a time,
+so the full precision weights are never materialized.
+
+The code to transform GPT-NoeX layers is defined in [model.py](../model.html#post_load_prepare),
+and here's [a benchmark](../samples/cpu_quantization_benchmark.html) of quality, memory and speed.
+"""
+
+import torch
+from torch import nn
+
+
+def quantize(weight: torch.Tensor, bits: int, group_size: int):
+    """
+    ## Quantize a weight matrix
+
+    :param weight: is the weight of shape `[out_features, in_features]`
+    :param bits: is the number of bits (`8` or `4`)
+    :param group_size: is the number of input features that share a scale
+    :return: the quantized (and packed) weights and the scales of shape `[out_features, n_groups]`
+    """
+    out_features, in_features = weight.shape
+    if in_features % group_size != 0:
+        raise ValueError(f'in_features {in_features} is not divisible by group_size {group_size}')
+
+    # Largest integer value
+    q_max = {8: 127, 4: 7}[bits]
+
+    # Split into groups `[out_features, n_groups, group_size]`
+    weight = weight.float().view(out_features, in_features // group_size, group_size)
+    # Symmetric scales per group
+    scales = weight.abs().amax(dim=-1).clamp(min=1e-8) / q_max
+    # Quantize
+    q = torch.round(weight / scales[:, :, None]).clamp(-q_max - (bits == 4), q_max).to(torch.int8)
+    q = q.view(out_features, in_features)
+
+    # Pack two 4-bit values to a byte
+    if bits == 4:
+        q = q.to(torch.uint8) & 0xF
+        q = q[:, 0::2] | (q[:, 1::2] << 4)
+
+    return q, scales
+
+
+def dequantize(q: torch.Tensor, scales: torch.Tensor, bits: int, group_size: int, dtype: torch.dtype):
+    """
+    ## Dequantize a block of rows
+
+    :param q: are the quantized weights of the rows
+    :param scales: are the scales of the rows `[rows, n_groups]`
+    :param bits: is the number of bits
+    :param group_size: is the number of input features that share a scale
+    :param dtype: is the data type to dequantize to
+    :return: the weights of shape `[rows, in_features]`
+    """
+    # Unpack 4-bit values and sign extend
+    if bits == 4:
+        low = (q & 0xF).to(torch.int8)
+        high = (q >> 4).to(torch.int8)
+        q = torch.stack((low, high), dim=-1).view(q.shape[0], -1)
+        q = q - ((q >= 8).to(torch.int8) << 4)
+
+    rows, in_features = q.shape
+    weight = q.to(dtype).view(rows, -1, group_size) * scales[:, :, None].to(dtype)
+
+    return weight.view(rows, in_features)
+
+
+class QuantizedLinear(nn.Module):
+    """
+    ## Weight-only quantized linear layer
+    """
+
+    def __init__(self, linear: nn.Linear, bits: int = 8, group_size: int = 128, block_size: int = 1024):
+        """
+        :param linear: is the linear layer to quantize
+        :param bits: is the number of bits (`8` or `4`)
+        :param group_size: is the number of input features that share a scale
+        :param block_size: is the number of output features dequantized at a time
+        """
+        super().__init__()
+
+        if bits not in (8, 4):
+            raise ValueError(f'Only 8-bit and 4-bit quantization is supported, not {bits}')
+
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.bits = bits
+        self.group_size = group_size
+        self.block_size = block_size
+
+        # Quantize the weights
+        q, scales = quantize(linear.weight.data, bits, group_size)
+        self.register_buffer('q_weight', q)
+        self.register_buffer('scales', scales.to(linear.weight.dtype))
+
+        # Bias is kept in floating point
+        if linear.bias is not None:
+            self.bias = nn.Parameter(linear.bias.data.clone(), requires_grad=False)
+        else:
+            self.bias = None
+
+    def forward(self, x: torch.Tensor):
+        """
+        :param x: has shape `[..., in_features]`
+        """
+        # Flatten the batch dimensions
+        x_flat = x.reshape(-1, self.in_features)
+        output = x.new_empty((x_flat.shape[0], self.out_features))
+
+        # Dequantize a block of rows at a time and multiply
+        for start in range(0, self.out_features, self.block_size):
+            end = min(start + self.block_size, self.out_features)
+            weight = dequantize(self.q_weight[start:end], self.scales[start:end],
+                                self.bits, self.group_size, x.dtype)
+            output[:, start:end] = torch.matmul(x_flat, weight.t())
+
+        # Add bias
+        if self.bias is not None:
+            output += self.bias
+
+        return output.view(*x.shape[:-1], self.out_features)
+
+    def extra_repr(self):
+        return (f'in_features={self.in_features}, out_features={self.out_features}, '
+                f'bits={self.bits}, group_size={self.group_size}')
+
+
+def make_cpu_quantized_linear(linear_module: nn.Linear, bits: int = 8, group_size: int = 128):
+    """
+    ## Transform a `nn.Linear` layer to a weight-only quantized linear layer
+
+    :param linear_module: is the `nn.Linear` layer to transform
+    :param bits: is the number of bits (`8` or `4`)
+    :param group_size: is the number of input features that share a scale
+    """
+
+    #
+    assert isinstance(linear_module, nn.Linear)
+
+    return QuantizedLinear(linear_module, bits, group_size)
@@ -0,0 +1,289 @@
+"""
+---
+title: Static Key-Value Cache
+summary: >
+    Preallocated key-value cache for faster incremental decoding with GPT-NeoX.
+---
+
+# Static Key-Value Cache
+
+The [queue based cache](cache.html) pops the past keys and values of each attention layer,
+concatenates the new ones and pushes the result back.
+This copies the whole key/value history on every token in every layer.
+
+This cache preallocates `[batch_size, max_len, n_heads, d_k]` key and value buffers per layer
+and writes the keys and values of new positions in place.
+Attention layers get views of the filled prefix of the buffers, so nothing is copied.
+
+It keeps track of the length of each sequence in the batch.
+This allows sequences of different lengths in the same batch
+(e.g. prompts of different lengths or sequences that started at different times),
+and truncating the cache to roll back tokens.
+
+Here's how to use it:
+
+```python
+kv_cache = KVCache.for_model(model, batch_size=1, max_len=2048)
+with kv_cache.step():
+    logits = model(prompt)
+for i in range(100):
+    with kv_cache.step():
+        logits = model(next_token)
+```
+
+Attention layers pick the cache up from the [global cache](cache.html) while inside `step()`.
+"""
+
+from contextlib import contextmanager
+from typing import List, Optional, Union
+
+import torch
+from torch import nn
+
+from labml_nn.neox.utils.cache import get_cache
+
+
+class KVCache:
+    """
+    ## Static Key-Value Cache
+    """
+
+    def __init__(self, n_layers: int, batch_size: int, max_len: int, n_heads: int, d_k: int, *,
+                 dtype: torch.dtype = torch.float16,
+                 device: torch.device = torch.device('cpu')):
+        """
+        :param n_layers: is the number of attention layers
+        :param batch_size: is the maximum number of sequences
+        :param max_len: is the maximum number of tokens in a sequence
+        :param n_heads: is the number of attention heads
+        :param d_k: is the number of features per head
+        :param dtype: is the data type of keys and values
+        :param device: is the device of the model
+        """
+        self.max_len = max_len
+        self.device = device
+
+        # Key and value buffers of shape `[batch_size, max_len, n_heads, d_k]` for each layer
+        self.keys = [torch.zeros((batch_size, max_len, n_heads, d_k), dtype=dtype, device=device)
+                     for _ in range(n_layers)]
+        self.values = [torch.zeros((batch_size, max_len, n_heads, d_k), dtype=dtype, device=device)
+                       for _ in range(n_layers)]
+
+        # Number of cached tokens for each sequence. This is kept on CPU to avoid synchronizations.
+        self.lengths = torch.zeros(batch_size, dtype=torch.long)
+
+        # The index of the next attention layer in the current step
+        self._layer_idx = 0
+        # The row of the first sequence of the batch in the current step
+        self._first_row = 0
+        # Number of valid new tokens for each sequence in the current step
+        self._n_tokens: Optional[List[int]] = None
+        # Whether the current step is prepared
+        self._is_prepared = False
+        # Batch size and number of new tokens in the current step
+        self._batch_size = 0
+        self._n_new = 0
+        # Length of the filled prefix after writing the new tokens
+        self._end = 0
+        # Positions offset of the new tokens. This is an `int` when all sequences have the same length
+        # and a tensor of shape `[batch_size]` otherwise.
+        self._offset: Union[int, torch.Tensor] = 0
+        # Positions of the new tokens `[batch_size, n_new]`, when sequences have different lengths
+        self._positions: Optional[torch.Tensor] = None
+        # Attention mask `[batch_size, n_new, end, 1]`, when sequences have different lengths
+        self._mask: Optional[torch.Tensor] = None
+
+    @classmethod
+    def for_model(cls, model: nn.Module, batch_size: int, max_len: int, *, dtype: Optional[torch.dtype] = None):
+        """
+        ### Create a cache for a model
+
+        :param model: is the model (e.g. `nn.Sequential` of [NeoX layers](../model.html))
+        :param batch_size: is the maximum number of sequences
+        :param max_len: is the maximum number of tokens in a sequence
+        :param dtype: is the data type of keys and values.
+            Defaults to the data type of the attention output bias.
+        """
+        from labml_nn.neox.model import AttentionLayer
+
+        # Get all attention layers
+        layers = [m for m in model.modules() if isinstance(m, AttentionLayer)]
+        if not layers:
+            raise ValueError('The model has no attention layers')
+
+        # Get the shapes from the first attention layer
+        attn = layers[0]
+        bias = attn.output.bias
+        n_hidden = bias.shape[0]
+
+        return cls(len(layers), batch_size, max_len, attn.n_heads, n_hidden // attn.n_heads,
+                   dtype=dtype or bias.dtype, device=bias.device)
+
+    @contextmanager
+    def step(self, n_tokens: Optional[List[int]] = None, first_row: int = 0):
+        """
+        ### Run a forward pass of the model with the cache
+
+        :param n_tokens: is the number of valid new tokens of each sequence.
+            Use this when the inputs are right padded to the same length.
+            All new tokens are considered valid if `None`.
+        :param first_row: is the row of the cache for the first sequence of the batch.
+            The batch uses rows `first_row` to `first_row + batch_size`.
+
+        The lengths are updated when the step finishes without an exception.
+        """
+        self._layer_idx = 0
+        self._n_tokens = n_tokens
+        self._first_row = first_row
+        self._is_prepared = False
+
+        cache = get_cache()
+        cache.set('kv_cache', self)
+        try:
+            yield self
+        finally:
+            cache.set('kv_cache', None)
+
+        # Update the lengths if the model was called
+        if self._is_prepared:
+            rows = slice(first_row, first_row + self._batch_size)
+            if self._n_tokens is None:
+                self.lengths[rows] += self._n_new
+            else:
+                self.lengths[rows] += torch.tensor(self._n_tokens, dtype=torch.long)
+
+    def _prepare(self, x: torch.Tensor):
+        """
+        #### Prepare the step from the inputs of the first attention layer
+
+        :param x: has shape `[batch_size, n_new, n_heads, d_k]`
+        """
+        batch_size, n_new = x.shape[:2]
+        if self._first_row + batch_size > len(self.lengths):
+            raise ValueError(f'KV cache has only {len(self.lengths)} rows')
+        lengths = self.lengths[self._first_row:self._first_row + batch_size]
+
+        # Check if there's space for the new tokens
+        end = int(lengths.max()) + n_new
+        if end > self.max_len:
+            raise ValueError(f'KV cache overflow: {end} > {self.max_len}')
+
+        self._batch_size = batch_size
+        self._n_new = n_new
+        self._end = end
+
+        # All sequences have the same length.
+        # We write to a slice and the attention layer uses its causal mask.
+        if bool((lengths == lengths[0]).all()):
+            self._offset = int(lengths[0])
+            self._positions = None
+            self._mask = None
+        # Sequences have different lengths
+        else:
+            # Positions of the new tokens
+            positions = lengths[:, None] + torch.arange(n_new)[None, :]
+            self._offset = lengths.to(self.device)
+            self._positions = positions.to(self.device)
+            # Query at position $i$ can attend to keys at positions $j \le i$.
+            # This also masks out stale keys beyond the length of each sequence.
+            mask = torch.arange(end, device=self.device)[None, None, :] > self._positions[:, :, None]
+            # Add the heads dimension
+            self._mask = mask[:, :, :, None]
+
+        self._is_prepared = True
+
+    def get_offset(self, x: torch.Tensor) -> Union[int, torch.Tensor]:
+        """
+        ### Get position offset of the new tokens
+
+        :param x: is the query or key of shape `[batch_size, n_new, n_heads, d_k]`
+        :return: an `int` if all sequences have the same length;
+            otherwise a tensor of shape `[batch_size]`
+        """
+        if not self._is_prepared:
+            self._prepare(x)
+
+        return self._offset
+
+    def update(self, k: torch.Tensor, v: torch.Tensor):
+        """
+        ### Write keys and values of new tokens and get the full keys and values
+
+        This is called by each attention layer in order.
+
+        :param k: are the keys of the new tokens `[batch_size, n_new, n_heads, d_k]`
+        :param v: are the values of the new tokens `[batch_size, n_new, n_heads, d_k]`
+        :return: views of the keys and values of shape `[batch_size, end, n_heads, d_k]`
+            and the attention mask of shape `[batch_size, n_new, end, 1]`
+            (`None` when the causal mask is sufficient)
+        """
+        if not self._is_prepared:
+            self._prepare(k)
+
+        # Get the buffers of the layer
+        keys, values = self.keys[self._layer_idx], self.values[self._layer_idx]
+        self._layer_idx += 1
+
+        # Rows of the batch
+        first, last = self._first_row, self._first_row + self._batch_size
+
+        # Write the new keys and values in place
+        if self._positions is None:
+            keys[first:last, self._offset:self._end] = k
+            values[first:last, self._offset:self._end] = v
+        else:
+            rows = torch.arange(first, last, device=self.device)[:, None]
+            keys[rows, self._positions] = k
+            values[rows, self._positions] = v
+
+        # Return the views of the filled prefix
+        return keys[first:last, :self._end], values[first:last, :self._end], self._mask
+
+    def truncate(self, idx: int, length: int):
+        """
+        ### Roll back a sequence
+
+        :param idx: is the index of the sequence in the batch
+        :param length: is the new length
+        """
+        assert length <= self.lengths[idx]
+        self.lengths[idx] = length
+
+    def reset(self, idx: Optional[int] = None):
+        """
+        ### Clear a sequence, or all sequences if `idx` is `None`
+
+        The buffers are not cleared since stale keys and values are always masked.
+        """
+        if idx is None:
+            self.lengths.zero_()
+        else:
+            self.lengths[idx] = 0
+
+    def copy(self, src: int, dst: int):
+        """
+        ### Copy a sequence to another row
+
+        This is used to share a cached prefix between sequences.
+
+        :param src: is the index of the sequence to copy
+        :param dst: is the index to copy it to
+        """
+        length = int(self.lengths[src])
+        for keys, values in zip(self.keys, self.values):
+            keys[dst, :length] = keys[src, :length]
+            values[dst, :length] = values[src, :length]
+        self.lengths[dst] = length
+
+    def move(self, src: int, dst: int):
+        """
+        ### Move a sequence to another row
+
+        This is used to keep active sequences in the first rows of the batch,
+        so that attention layers get views without gathering rows.
+
+        :param src: is the index of the sequence to move
+        :param dst: is the index to move it to
+        """
+        self.copy(src, dst)
+        self.lengths[src] = 0
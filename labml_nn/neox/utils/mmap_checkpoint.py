@@ -0,0 +1,183 @@
+"""
+---
+title: Memory-mapped GPT-NeoX Checkpoint
+summary: >
+    Convert GPT-NeoX checkpoints to a pre-merged memory-mappable file
+---
+
+# Memory-mapped GPT-NeoX Checkpoint
+
+The [original checkpoints](../checkpoint.html) have two tensor-parallel partitions per layer.
+Every load un-pickles both partition files and merges them into freshly allocated parameters.
+
+This converts them once to a single flat file with the merged parameters of all layers,
+and an index (a JSON file) of the names, offsets, data types and shapes of the tensors.
+Each tensor starts on a page boundary.
+
+[`LayerGenerator`](../model.html) with `mmap_checkpoint` set creates the layers on the `meta` device
+and assigns tensors that point directly into the memory-mapped file.
+Nothing is copied when the data type and the device match, so the load is almost instant;
+pages are read from the disk as the parameters are used.
+Processes that map the same file share the weights through the page cache.
+
+Run this file to convert the checkpoints.
+
+```bash
+python -m labml_nn.neox.utils.mmap_checkpoint
+```
+"""
+
+import json
+import mmap
+from pathlib import Path, PurePath
+from typing import Dict, Optional
+
+import torch
+
+from labml import logger
+from labml.logger import Text
+from labml_nn.neox.checkpoint import get_checkpoints_download_path
+
+# Tensors are aligned to page boundaries
+ALIGNMENT = 4096
+
+
+def get_mmap_checkpoint_path() -> Path:
+    """
+    ### Default path of the converted checkpoint
+
+    The index is stored next to it with `.json` extension.
+    """
+    return get_checkpoints_download_path().parent / 'merged' / 'neox.bin'
+
+
+def _index_path(path: PurePath):
+    return Path(path).with_suffix('.json')
+
+
+def convert(path: Optional[PurePath] = None, *, dtype: torch.dtype = torch.float16, n_workers: int = 4):
+    """
+    ## Convert the checkpoints
+
+    :param path: is the path of the output file
+    :param dtype: is the data type to store the parameters in
+    :param n_workers: is the number of threads to [load the checkpoints](../model.html)
+    """
+    from labml_nn.neox.model import LayerGenerator
+
+    if path is None:
+        path = get_mmap_checkpoint_path()
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    generator = LayerGenerator(is_clone_layers=True, dtype=dtype, device=torch.device('cpu'))
+
+    # Index of tensors
+    tensors = {}
+    # Layer indexes in the same order as `LayerGenerator`
+    layer_indexes = sorted(generator.filter_layers)
+
+    with open(str(path), 'wb') as f:
+        # Layers are loaded and written one at a time, so memory stays at a few layers
+        for idx, layer in zip(layer_indexes, generator.load(n_workers=n_workers)):
+            for name, tensor in layer.state_dict().items():
+                tensor = tensor.detach().contiguous()
+
+                # Pad to alignment
+                offset = f.tell()
+                if offset % ALIGNMENT != 0:
+                    f.write(b'\0' * (ALIGNMENT - offset % ALIGNMENT))
+                    offset = f.tell()
+
+                # Write the raw bytes
+                f.write(tensor.reshape(-1).view(torch.uint8).numpy().data)
+
+                tensors[f'{idx}/{name}'] = {
+                    'offset': offset,
+                    'dtype': str(tensor.dtype).replace('torch.', ''),
+                    'shape': list(tensor.shape),
+                }
+
+    # Write the index
+    with open(str(_index_path(path)), 'w') as f:
+        json.dump({
+            'alignment': ALIGNMENT,
+            'n_vocab': generator.n_vocab,
+            'n_hidden': generator.n_hidden,
+            'n_layers': generator.n_layers,
+            'n_heads': generator.n_heads,
+            'tensors': tensors,
+        }, f)
+
+    logger.log(['Converted checkpoint: ', (str(path), Text.value)])
+
+
+class MmapCheckpoint:
+    """
+    ## Memory-mapped checkpoint reader
+    """
+
+    def __init__(self, path: PurePath):
+        """
+        :param path: is the path of the converted checkpoint
+        """
+        path = Path(path)
+        with open(str(_index_path(path))) as f:
+            self.index = json.load(f)
+
+        # Map the file copy-on-write. Pages are shared with other processes
+        # through the page cache unless a parameter is modified in place.
+        with open(str(path), 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    def check_config(self, *, n_vocab: int, n_hidden: int, n_layers: int, n_heads: int):
+        """
+        ### Check that the checkpoint matches the model configurations
+        """
+        config = dict(n_vocab=n_vocab, n_hidden=n_hidden, n_layers=n_layers, n_heads=n_heads)
+        for k, v in config.items():
+            if self.index[k] != v:
+                raise ValueError(f'Checkpoint {k}={self.index[k]} does not match the model {k}={v}')
+
+    def get_tensor(self, key: str) -> torch.Tensor:
+        """
+        ### Get a tensor backed by the memory-mapped file
+        """
+        info = self.index['tensors'][key]
+        dtype = getattr(torch, info['dtype'])
+        shape = info['shape']
+
+        # Number of elements
+        numel = 1
+        for s in shape:
+            numel *= s
+
+        return torch.frombuffer(self._mmap, dtype=dtype, count=numel, offset=info['offset']).view(shape)
+
+    def state_dict(self, idx: int, *, dtype: torch.dtype, device: torch.device) -> Dict[str, torch.Tensor]:
+        """
+        ### Get the state dictionary of a layer
+
+        :param idx: is the index of the layer (as in `filter_layers` of `LayerGenerator`)
+        :param dtype: is the data type of the model
+        :param device: is the device of the model
+        :return: the tensors; these are views of the file if the data type and the device match
+        """
+        prefix = f'{idx}/'
+        state = {}
+        for key in self.index['tensors']:
+            if not key.startswith(prefix):
+                continue
+            tensor = self.get_tensor(key)
+            # This copies only if the data type or the device is different
+            state[key[len(prefix):]] = tensor.to(device=device, dtype=dtype)
+
+        if not state:
+            raise KeyError(f'Layer {idx} is not in the checkpoint')
+
+        return state
+
+
+#
+if __name__ == '__main__':
+    convert()
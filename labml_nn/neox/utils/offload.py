@@ -0,0 +1,273 @@
+"""
+---
+title: Layer-streaming offloaded inference
+summary: >
+    Run GPT-NeoX inference under a fixed memory budget by streaming layers from disk
+---
+
+# Layer-streaming offloaded inference
+
+The full 20B model doesn't fit in memory on most machines.
+This keeps only a window of layers in memory.
+A background thread loads the upcoming layers (from the original checkpoints or,
+much faster, from a [memory-mapped checkpoint](mmap_checkpoint.html))
+while the current layer is running, and layers are evicted after they are used.
+The window grows as long as the layers fit in the memory budget.
+
+Each pass over the layers processes the whole batch of prompts,
+so the cost of reading the weights is shared by all the prompts in the batch.
+Generation keeps the keys and values in a [static key-value cache](kv_cache.html),
+which is counted in the memory budget.
+
+The memory budget covers the weights of the resident layers and the key-value cache;
+activations are small in comparison for decoding.
+
+Here's [a benchmark](../samples/offload_benchmark.html) of the throughput for different memory budgets.
+"""
+
+import threading
+from collections import deque
+from typing import List, Deque, Tuple, Optional
+
+import torch
+
+from labml import monit
+from labml_nn.neox.model import LayerGenerator, NeoXModule
+from labml_nn.neox.utils.kv_cache import KVCache
+
+
+class LayerStreamer:
+    """
+    ## Layer streamer
+
+    This loads layers on a background thread in the order they are used, pass after pass,
+    as long as the resident layers fit in the memory budget.
+    """
+
+    def __init__(self, generator: LayerGenerator, memory_limit: int):
+        """
+        :param generator: is the layer generator to load layers with
+        :param memory_limit: is the memory budget for the resident layers in bytes
+        """
+        self.generator = generator
+        self.memory_limit = memory_limit
+
+        # Layer indexes in the order they are used
+        self.indexes = sorted(generator.filter_layers)
+        # Size of each layer
+        self.sizes = {idx: generator.layer_size(idx) for idx in self.indexes}
+
+        largest = max(self.sizes.values())
+        if largest > memory_limit:
+            raise ValueError(f'The largest layer needs {largest / 2 ** 20 :.0f}MB, '
+                             f'which is more than the memory budget {memory_limit / 2 ** 20 :.0f}MB')
+
+        # Loaded layers in the order they will be used
+        self._loaded: Deque[Tuple[int, NeoXModule]] = deque()
+        # Bytes of the layers that are loaded, being loaded or being used
+        self._resident = 0
+        # Largest number of layers in memory at once
+        self.max_window = 0
+
+        self._condition = threading.Condition()
+        self._is_stopped = False
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def start(self):
+        """
+        ### Start loading layers
+        """
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        ### Stop loading layers and release them
+        """
+        with self._condition:
+            self._is_stopped = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._loaded.clear()
+
+    def _loop(self):
+        """
+        #### Load layers in order, pass after pass
+        """
+        pos = 0
+        try:
+            while True:
+                idx = self.indexes[pos % len(self.indexes)]
+                size = self.sizes[idx]
+
+                # Wait for space in the memory budget
+                with self._condition:
+                    while not self._is_stopped and self._resident + size > self.memory_limit:
+                        self._condition.wait()
+                    if self._is_stopped:
+                        return
+                    # Reserve the memory
+                    self._resident += size
+
+                # Load the layer, without `monit` sections since this is not the main thread
+                layer = self.generator.load_layer(idx, is_monit=False)
+
+                with self._condition:
+                    self._loaded.append((idx, layer))
+                    self.max_window = max(self.max_window, len(self._loaded) + 1)
+                    self._condition.notify_all()
+
+                pos += 1
+        except BaseException as e:
+            with self._condition:
+                self._error = e
+                self._condition.notify_all()
+
+    def next_layer(self) -> Tuple[int, NeoXModule]:
+        """
+        ### Get the next layer
+
+        Call `release` after using it.
+        """
+        with self._condition:
+            while not self._loaded and self._error is None:
+                self._condition.wait()
+            if self._error is not None:
+                raise RuntimeError('Failed to load a layer') from self._error
+
+            return self._loaded.popleft()
+
+    def release(self, idx: int):
+        """
+        ### Release a layer after using it
+
+        The caller should drop its references to the layer so that its memory is freed.
+        """
+        with self._condition:
+            self._resident -= self.sizes[idx]
+            self._condition.notify_all()
+
+
+class OffloadedModel:
+    """
+    ## Model with streamed layers
+    """
+
+    def __init__(self, generator: LayerGenerator, memory_limit: int):
+        """
+        :param generator: is the layer generator.
+            Use a [memory-mapped checkpoint](mmap_checkpoint.html) for faster loading.
+        :param memory_limit: is the memory budget in bytes for the layers and the key-value cache
+        """
+        self.generator = generator
+        self.memory_limit = memory_limit
+        self.device = generator.device
+
+        # Number of transformer layers
+        self.n_attention_layers = len([idx for idx in generator.filter_layers
+                                       if 0 < idx <= generator.n_layers])
+
+        self.streamer: Optional[LayerStreamer] = None
+        # Largest number of layers in memory at once
+        self.max_window = 0
+
+    def _kv_cache_size(self, batch_size: int, max_len: int):
+        """
+        #### Size of the key-value cache in bytes
+        """
+        return (2 * self.n_attention_layers * batch_size * max_len * self.generator.n_hidden *
+                torch.finfo(self.generator.dtype).bits // 8)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        ### Stop the streamer
+        """
+        if self.streamer is not None:
+            self.streamer.stop()
+            self.max_window = max(self.max_window, self.streamer.max_window)
+            self.streamer = None
+
+    def _start(self, reserved: int):
+        """
+        #### Start streaming with `reserved` bytes of the budget used by the key-value cache
+        """
+        self.close()
+        self.streamer = LayerStreamer(self.generator, self.memory_limit - reserved).start()
+
+    @torch.no_grad()
+    def _forward(self, x: torch.Tensor):
+        """
+        #### Run a pass over all the layers
+        """
+        for _ in range(len(self.streamer.indexes)):
+            idx, layer = self.streamer.next_layer()
+            x = layer(x)
+            # Drop the layer and release its memory
+            del layer
+            self.streamer.release(idx)
+
+        return x
+
+    @torch.no_grad()
+    def forward(self, x: torch.Tensor):
+        """
+        ### Run the model on a batch of token ids `[batch_size, seq_len]`
+        """
+        self._start(0)
+        try:
+            return self._forward(x.to(self.device))
+        finally:
+            self.close()
+
+    @torch.no_grad()
+    def generate(self, prompts: List[List[int]], n_tokens: int) -> List[List[int]]:
+        """
+        ### Greedily generate tokens for a batch of prompts
+
+        :param prompts: are the prompt token ids
+        :param n_tokens: is the number of tokens to generate
+        :return: the generated token ids for each prompt
+        """
+        batch_size = len(prompts)
+        lengths = [len(p) for p in prompts]
+        max_len = max(lengths) + n_tokens
+
+        # Static key-value cache, counted in the memory budget
+        kv_cache_size = self._kv_cache_size(batch_size, max_len)
+        if kv_cache_size >= self.memory_limit:
+            raise ValueError(f'The key-value cache needs {kv_cache_size / 2 ** 20 :.0f}MB, '
+                             f'which is more than the memory budget')
+        n_hidden, n_heads = self.generator.n_hidden, self.generator.n_heads
+        kv_cache = KVCache(self.n_attention_layers, batch_size, max_len, n_heads, n_hidden // n_heads,
+                           dtype=self.generator.dtype, device=self.device)
+
+        self._start(kv_cache_size)
+        try:
+            # Right pad the prompts and prefill
+            ids = torch.zeros((batch_size, max(lengths)), dtype=torch.long)
+            for i, p in enumerate(prompts):
+                ids[i, :lengths[i]] = torch.tensor(p, dtype=torch.long)
+            with monit.section('Prefill'), kv_cache.step(lengths):
+                logits = self._forward(ids.to(self.device))
+            # Sample from the last prompt token
+            last = torch.tensor(lengths, device=logits.device) - 1
+            next_tokens = logits[torch.arange(batch_size, device=logits.device), last].argmax(dim=-1)
+            generated = [next_tokens]
+
+            # Decode
+            for _ in monit.iterate('Decode', n_tokens - 1):
+                with kv_cache.step():
+                    logits = self._forward(next_tokens[:, None])
+                next_tokens = logits[:, -1].argmax(dim=-1)
+                generated.append(next_tokens)
+        finally:
+            self.close()
+
+        return torch.stack(generated, dim=1).tolist()
@@ -0,0 +1,254 @@
+"""
+---
+title: Profile-guided Pipeline Balancing
+summary: >
+    Split GPT-NeoX layers into pipeline stages based on the measured time and memory of the layers
+---
+
+# Profile-guided Pipeline Balancing
+
+[`balance_layers_simple`](index.html) splits the layers evenly by count.
+But the layers are very different;
+the embedding and final norm layers are cheap and the readout layer
+(a projection to a vocabulary of 50k tokens) costs a lot more than a transformer layer.
+So the stages with those layers are imbalanced, and the pipeline runs at the speed of the slowest stage.
+
+This measures the forward and backward time and the memory of each type of layer on the target device,
+and splits the layers into contiguous stages so that the time of the slowest stage is minimal,
+while the memory of each stage is within a limit.
+
+Here's [a benchmark](../samples/pipeline_balance_benchmark.html) comparing the throughput
+with the even split, with pipeline stages in separate processes on CPU.
+"""
+
+import time
+from typing import List, NamedTuple, Optional, Dict
+
+import torch
+from torch import nn
+
+from labml import monit
+
+
+class LayerProfile(NamedTuple):
+    """
+    ## Profile of a layer for a single micro-batch
+    """
+    # Forward pass time in seconds
+    forward_time: float
+    # Backward pass time in seconds
+    backward_time: float
+    # Bytes of parameters and buffers, and gradients and Adam optimizer state of the trainable parameters
+    param_memory: int
+    # Bytes of activations saved for the backward pass
+    activation_memory: int
+
+    @property
+    def time(self):
+        return self.forward_time + self.backward_time
+
+
+def _synchronize(device: torch.device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def _param_memory(layer: nn.Module):
+    """
+    #### Memory of parameters, buffers, gradients and optimizer state
+    """
+    memory = 0
+    for p in layer.parameters():
+        size = p.numel() * p.element_size()
+        # Parameter, and gradient and two moments for trainable parameters
+        memory += size * 4 if p.requires_grad else size
+    for b in layer.buffers():
+        memory += b.numel() * b.element_size()
+
+    return memory
+
+
+def profile_layer(layer: nn.Module, x: torch.Tensor, device: torch.device, *,
+                  n_iterations: int = 3, n_warmup: int = 1):
+    """
+    ## Profile a layer
+
+    :param layer: is the layer, on `device`
+    :param x: is the input for a micro-batch
+    :param device: is the device
+    :param n_iterations: is the number of iterations to average the time over
+    :param n_warmup: is the number of iterations to run before measuring
+    :return: the profile and the output of the layer
+    """
+    x = x.to(device)
+    if x.is_floating_point():
+        x = x.detach().requires_grad_()
+
+    # Parameters are saved for backward too; we only count activations
+    param_ptrs = {p.data_ptr() for p in layer.parameters()}
+    saved: Dict[int, int] = {}
+
+    def pack(t: torch.Tensor):
+        if t.data_ptr() not in param_ptrs:
+            saved[t.data_ptr()] = max(saved.get(t.data_ptr(), 0), t.numel() * t.element_size())
+        return t
+
+    forward_time, backward_time = 0., 0.
+    out = None
+    for i in range(n_warmup + n_iterations):
+        # Count the activations of a single iteration;
+        # the tensors of earlier iterations are freed and their addresses may be reused
+        saved.clear()
+        _synchronize(device)
+        start = time.perf_counter()
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            out = layer(x)
+        _synchronize(device)
+        forward_end = time.perf_counter()
+
+        # Backward pass if there's anything to compute gradients for
+        if out.requires_grad:
+            out.backward(torch.ones_like(out))
+        _synchronize(device)
+        backward_end = time.perf_counter()
+
+        if i >= n_warmup:
+            forward_time += forward_end - start
+            backward_time += backward_end - forward_end
+
+    # Clear gradients
+    layer.zero_grad(set_to_none=True)
+
+    profile = LayerProfile(forward_time / n_iterations, backward_time / n_iterations,
+                           _param_memory(layer), sum(saved.values()))
+
+    return profile, out.detach()
+
+
+def profile_layers(layers: List[nn.Module], x: torch.Tensor, device: torch.device, *,
+                   n_iterations: int = 3, n_warmup: int = 1) -> List[LayerProfile]:
+    """
+    ## Profile the layers of a model
+
+    Only the first layer of each type is profiled, since layers of the same type
+    (e.g. transformer layers) cost the same.
+    Each profiled layer is moved to `device` and moved back afterwards.
+    So the device only needs memory for one layer at a time.
+
+    :param layers: are the layers of the model
+    :param x: is the input to the model for a micro-batch
+    :param device: is the device the layers will run on
+    :param n_iterations: is the number of iterations to average the time over
+    :param n_warmup: is the number of iterations to run before measuring
+    :return: the profile of each layer
+    """
+    profiles: Dict[type, LayerProfile] = {}
+    outputs: Dict[type, torch.Tensor] = {}
+
+    res = []
+    for layer in layers:
+        key = type(layer)
+        if key not in profiles:
+            with monit.section(f'Profile {key.__name__}'):
+                # Move the layer to the device
+                param = next(layer.parameters(), None)
+                original_device = param.device if param is not None else device
+                layer.to(device)
+
+                profiles[key], outputs[key] = profile_layer(layer, x, device,
+                                                            n_iterations=n_iterations, n_warmup=n_warmup)
+
+                # Move the layer back
+                layer.to(original_device)
+        res.append(profiles[key])
+        # Input to the next layer
+        x = outputs[key]
+
+    return res
+
+
+def stage_memory(profiles: List[LayerProfile], chunks: int):
+    """
+    ### Memory of a stage
+
+    A stage keeps the activations of all `chunks` micro-batches for the backward pass.
+    """
+    return sum(p.param_memory + chunks * p.activation_memory for p in profiles)
+
+
+def balance_layers(profiles: List[LayerProfile], n_stages: int, *, chunks: int = 1,
+                   memory_limit: Optional[int] = None) -> List[int]:
+    """
+    ## Split layers into stages
+
+    This finds the contiguous split of layers into `n_stages` non-empty stages with the
+    smallest time of the slowest stage, such that the memory of each stage is within `memory_limit`.
+    It's a dynamic program over the number of stages and the number of layers in the first stages.
+
+    :param profiles: are the profiles of the layers
+    :param n_stages: is the number of stages
+    :param chunks: is the number of micro-batches
+    :param memory_limit: is the maximum memory of a stage in bytes
+    :return: a list with the number of layers for each stage
+    """
+    n = len(profiles)
+    if n < n_stages:
+        raise ValueError(f'Cannot split {n} layers into {n_stages} stages')
+
+    # Prefix sums of time and memory
+    times = [0.]
+    memories = [0]
+    for p in profiles:
+        times.append(times[-1] + p.time)
+        memories.append(memories[-1] + p.param_memory + chunks * p.activation_memory)
+
+    inf = float('inf')
+    # `best[s][j]` is the smallest bottleneck time of splitting the first `j` layers into `s` stages
+    best = [[inf] * (n + 1) for _ in range(n_stages + 1)]
+    # `split[s][j]` is the start of the last stage for `best[s][j]`
+    split = [[-1] * (n + 1) for _ in range(n_stages + 1)]
+    best[0][0] = 0.
+
+    for s in range(1, n_stages + 1):
+        # Leave at least one layer for each of the remaining stages
+        for j in range(s, n - (n_stages - s) + 1):
+            for i in range(s - 1, j):
+                if best[s - 1][i] == inf:
+                    continue
+                # Skip if the stage of layers `i` to `j` doesn't fit in memory
+                if memory_limit is not None and memories[j] - memories[i] > memory_limit:
+                    continue
+                bottleneck = max(best[s - 1][i], times[j] - times[i])
+                if bottleneck < best[s][j]:
+                    best[s][j] = bottleneck
+                    split[s][j] = i
+
+    if best[n_stages][n] == inf:
+        raise ValueError(f'Layers do not fit in {n_stages} stages with memory limit {memory_limit}')
+
+    # Get the number of layers of each stage
+    balance = []
+    j = n
+    for s in range(n_stages, 0, -1):
+        i = split[s][j]
+        balance.append(j - i)
+        j = i
+
+    return list(reversed(balance))
+
+
+def pipeline_time(profiles: List[LayerProfile], balance: List[int], chunks: int):
+    """
+    ## Estimated time of a training step
+
+    With GPipe scheduling, `chunks` micro-batches go through
+    `len(balance)` stages in `chunks + len(balance) - 1` steps of the slowest stage.
+    This ignores the time to transfer activations between stages.
+    """
+    stage_times = []
+    start = 0
+    for n in balance:
+        stage_times.append(sum(p.time for p in profiles[start:start + n]))
+        start += n
+
+    return (chunks + len(balance) - 1) * max(stage_times)
@@ -0,0 +1,223 @@
+"""
+---
+title: Speculative Decoding
+summary: >
+    Speculative decoding for GPT-NeoX with a draft model made of the first few layers
+---
+
+# Speculative Decoding
+
+This is an implementation of speculative decoding from the papers
+[Fast Inference from Transformers via Speculative Decoding](https://arxiv.org/abs/2211.17192) and
+[Accelerating Large Language Model Decoding with Speculative Sampling](https://arxiv.org/abs/2302.01318).
+
+A small draft model proposes $k$ tokens one at a time.
+The target model scores all of them in a single forward pass over the cached prefix.
+Draft token $\tilde{x}_i$ is accepted with probability
+$\min \Big(1, \frac{p_i(\tilde{x}_i)}{q_i(\tilde{x}_i)} \Big)$
+where $p_i$ and $q_i$ are the target and draft distributions.
+At the first rejection we sample from the normalized residual distribution
+$\big(p_i - q_i\big)_+$ and discard the rest of the draft.
+If all $k$ are accepted we sample one more token from $p_{k+1}$.
+The generated tokens have exactly the same distribution as sampling from the target model.
+
+With temperature $0$ this is greedy decoding: draft tokens are accepted while they match the
+target model's most likely token.
+
+The draft model here is GPT-NeoX truncated to the first few transformer layers,
+created with `filter_layers` of [`LayerGenerator`](../model.html) from the same checkpoint.
+
+Both models keep a [static key-value cache](kv_cache.html).
+After verification, the caches are truncated to roll back the rejected tokens.
+"""
+
+import time
+from typing import List
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from labml_nn.neox.utils.kv_cache import KVCache
+
+
+class SpeculativeDecoder:
+    """
+    ## Speculative decoder
+    """
+
+    def __init__(self, target: nn.Module, draft: nn.Module, *, k: int = 4, temperature: float = 1.0,
+                 max_len: int = 2048, device: torch.device = torch.device('cpu')):
+        """
+        :param target: is the target model
+        :param draft: is the draft model
+        :param k: is the number of tokens proposed by the draft model at a time
+        :param temperature: is the sampling temperature; `0` for greedy decoding
+        :param max_len: is the maximum length of prompt and generated tokens
+        :param device: is the device of the models
+        """
+        self.target = target
+        self.draft = draft
+        self.k = k
+        self.temperature = temperature
+        self.max_len = max_len
+        self.device = device
+
+        # Stats
+        self.n_proposed = 0
+        self.n_accepted = 0
+
+    @property
+    def acceptance_rate(self):
+        """
+        Fraction of draft tokens accepted
+        """
+        return self.n_accepted / max(1, self.n_proposed)
+
+    def _probs(self, logits: torch.Tensor):
+        """
+        #### Get the sampling distribution from logits
+
+        This is a one-hot distribution on the most likely token for greedy decoding.
+        """
+        logits = logits.float()
+        if self.temperature == 0:
+            return F.one_hot(logits.argmax(dim=-1), logits.shape[-1]).float()
+
+        return torch.softmax(logits / self.temperature, dim=-1)
+
+    @staticmethod
+    def _sample(probs: torch.Tensor) -> int:
+        """
+        #### Sample a token from a distribution
+        """
+        return int(torch.multinomial(probs, 1)[0])
+
+    def _run(self, model: nn.Module, kv_cache: KVCache, ids: List[int]):
+        """
+        #### Feed tokens to a model with its cache
+
+        :return: logits of shape `[len(ids), n_vocab]`
+        """
+        with kv_cache.step():
+            return model(torch.tensor([ids], device=self.device))[0]
+
+    @torch.no_grad()
+    def generate(self, ids: List[int], n_tokens: int) -> List[int]:
+        """
+        ### Generate tokens
+
+        :param ids: are the prompt token ids
+        :param n_tokens: is the number of tokens to generate
+        :return: the generated token ids
+        """
+        if len(ids) + n_tokens + self.k + 1 > self.max_len:
+            raise ValueError(f'Prompt and generated tokens exceed the maximum length {self.max_len}')
+
+        target_cache = KVCache.for_model(self.target, 1, self.max_len)
+        draft_cache = KVCache.for_model(self.draft, 1, self.max_len)
+
+        # Prefill both models with all but the last prompt token.
+        # `pending` are the tokens that are not in the cache of each model yet.
+        if len(ids) > 1:
+            self._run(self.target, target_cache, ids[:-1])
+            self._run(self.draft, draft_cache, ids[:-1])
+        target_pending = [ids[-1]]
+        draft_pending = [ids[-1]]
+
+        generated = []
+        while len(generated) < n_tokens:
+            # Number of tokens in the target cache before this round
+            n_cached = int(target_cache.lengths[0])
+
+            # Propose $k$ tokens with the draft model
+            drafts = []
+            draft_probs = []
+            for i in range(self.k):
+                logits = self._run(self.draft, draft_cache, draft_pending)
+                q = self._probs(logits[-1])
+                token = self._sample(q)
+                drafts.append(token)
+                draft_probs.append(q)
+                draft_pending = [token]
+
+            # Score all draft tokens with the target model in one pass.
+            # `target_probs[i]` is the distribution of the token after `drafts[i - 1]`.
+            logits = self._run(self.target, target_cache, target_pending + drafts)
+            target_probs = self._probs(logits[-(self.k + 1):])
+
+            # Accept or reject the draft tokens
+            n_accepted = 0
+            next_token = None
+            for i, token in enumerate(drafts):
+                p, q = target_probs[i], draft_probs[i]
+                if torch.rand(()) < torch.clamp(p[token] / q[token], max=1.):
+                    n_accepted += 1
+                else:
+                    # Sample from the residual distribution $(p - q)_+$
+                    residual = torch.clamp(p - q, min=0)
+                    if residual.sum() <= 0:
+                        residual = p
+                    next_token = self._sample(residual / residual.sum())
+                    break
+
+            # All accepted; sample one more token from the target
+            if next_token is None:
+                next_token = self._sample(target_probs[self.k])
+
+            self.n_proposed += self.k
+            self.n_accepted += n_accepted
+
+            accepted = drafts[:n_accepted]
+            generated += accepted + [next_token]
+
+            # Length of the sequence with the accepted tokens, excluding `next_token`
+            length = n_cached + len(target_pending) + n_accepted
+
+            # Roll back the target cache to the accepted tokens
+            target_cache.truncate(0, length)
+            target_pending = [next_token]
+
+            # The draft cache has all the draft tokens except the last one
+            if n_accepted < self.k:
+                draft_cache.truncate(0, length)
+                draft_pending = [next_token]
+            else:
+                # The last draft token was never fed to the draft model
+                draft_pending = [drafts[-1], next_token]
+
+        return generated[:n_tokens]
+
+    @torch.no_grad()
+    def generate_target_only(self, ids: List[int], n_tokens: int) -> List[int]:
+        """
+        ### Generate tokens with only the target model
+
+        This is the baseline for the speedup.
+        """
+        target_cache = KVCache.for_model(self.target, 1, self.max_len)
+
+        logits = self._run(self.target, target_cache, ids)
+        generated = [self._sample(self._probs(logits[-1]))]
+        while len(generated) < n_tokens:
+            logits = self._run(self.target, target_cache, generated[-1:])
+            generated.append(self._sample(self._probs(logits[-1])))
+
+        return generated
+
+
+def benchmark(decoder: SpeculativeDecoder, ids: List[int], n_tokens: int):
+    """
+    ## Measure tokens per second with and without speculative decoding
+
+    :return: tokens per second of target-only decoding and speculative decoding
+    """
+    start = time.perf_counter()
+    decoder.generate_target_only(ids, n_tokens)
+    baseline = n_tokens / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    decoder.generate(ids, n_tokens)
+    speculative = n_tokens / (time.perf_counter() - start)
+
+    return baseline, speculative
@@ -6,10 +6,14 @@ summary: >
 ---
 
 # Text Dataset for GPT-NeoX
+
+The text is tokenized once to a [token file](token_file.html),
+and training samples are served from a memory map of it.
 """
 from pathlib import PurePath, Path
-from typing import Optional, List
+from typing import Optional, List, Union
 
+import numpy as np
 import torch
 import torch.utils.data
 from labml import lab
@@ -17,7 +21,7 @@ from labml import monit
 from labml.logger import inspect
 from labml.utils.download import download_file
 
-from labml_nn.neox.tokenizer import get_tokenizer
+from labml_nn.neox.utils.token_file import tokenize_file, load_token_file, is_token_file_valid
 
 
 def load_text(path: PurePath, url: Optional[str] = None, *, filter_subset: Optional[int] = None):
@@ -56,23 +60,62 @@ class NeoXDataset(torch.utils.data.Dataset):
     """
     ## Dataset for fine-tuning GPT-NeoX
 
-    This is not optimized to very large datasets.
+    The tokens can be a memory-mapped [token file](token_file.html),
+    so that very large datasets use constant memory.
+    Samples are views of the tokens and only the sample is copied
+    when it's converted to `int64`.
     """
 
-    def __init__(self, tokens: List[int], seq_len: int):
+    def __init__(self, tokens: Union[List[int], np.ndarray], seq_len: int):
         """
-        :param tokens: is the list of token ids
+        :param tokens: is the list or array of token ids
         :param seq_len: is the sequence length of a single training sample
         """
 
         self.seq_len = seq_len
         # Number of samples
-        n_samples = len(tokens) // seq_len
+        n_samples = (len(tokens) - 1) // seq_len
         self.n_samples = n_samples
-        # Truncate
-        tokens = tokens[:n_samples * seq_len + 1]
-        # Create a PyTorch tensor
-        self.tokens = torch.tensor(tokens)
+        # Keep arrays (e.g. memory maps) as they are
+        if not isinstance(tokens, np.ndarray):
+            tokens = np.asarray(tokens, dtype=np.int64)
+        # Truncate; this is a view
+        self.tokens = tokens[:n_samples * seq_len + 1]
+        # Path of the token file, to re-open the memory map when the dataset is pickled
+        self._path: Optional[Path] = None
+
+    @classmethod
+    def from_token_file(cls, path: PurePath, seq_len: int, *, truncate: int = -1):
+        """
+        ### Create a dataset from a [token file](token_file.html)
+
+        :param path: is the location of the token file
+        :param seq_len: is the sequence length of a single training sample
+        :param truncate: is the number of samples to keep, if positive
+        """
+        tokens = load_token_file(path)
+        if truncate > 0:
+            tokens = tokens[:truncate * seq_len + 1]
+
+        dataset = cls(tokens, seq_len)
+        dataset._path = Path(path)
+
+        return dataset
+
+    def __getstate__(self):
+        """
+        Pickle the path of the token file instead of the tokens,
+        so that data loader workers map the file instead of copying the tokens
+        """
+        state = self.__dict__.copy()
+        if self._path is not None:
+            state['tokens'] = len(self.tokens)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._path is not None:
+            self.tokens = load_token_file(self._path)[:state['tokens']]
 
     def __len__(self):
         return self.n_samples
@@ -85,7 +128,9 @@ class NeoXDataset(torch.utils.data.Dataset):
         :return: the input and the target
         """
         offset = idx * self.seq_len
-        return self.tokens[offset:offset + self.seq_len], self.tokens[offset + 1:offset + 1 + self.seq_len]
+        # View of the tokens of the sample, converted to `int64`
+        sample = torch.from_numpy(self.tokens[offset:offset + self.seq_len + 1].astype(np.int64))
+        return sample[:-1], sample[1:]
 
 
 DATASETS = {
@@ -96,29 +141,38 @@ DATASETS = {
 }
 
 
+def get_token_file_path(dataset_name: str) -> Path:
+    """
+    ### Default path of the token file of a dataset
+    """
+    return lab.get_data_path() / 'neox_tokens' / f'{dataset_name}.bin'
+
+
 def get_training_data(seq_len: int = 32, dataset_name: str = 'tiny_shakespeare', truncate: int = -1):
     """
     ### Load Dataset
 
+    The text is tokenized to a [token file](token_file.html) the first time.
+
     :param seq_len: is the sequence length of a single training sample
     :param dataset_name: is the name of the dataset
+    :param truncate: is the number of samples to keep, if positive
     :return: the dataset
     """
 
     ds = DATASETS[dataset_name]
-    # Load the content
-    text = load_text(lab.get_data_path() / ds['file'], ds['url'])
-    # Tokenize
-    tokenizer = get_tokenizer()
-    tokens = tokenizer.encode_batch([text])[0]
+    text_path = Path(lab.get_data_path() / ds['file'])
+    path = get_token_file_path(dataset_name)
 
-    if truncate > 0:
-        token_ids = tokens.ids[:truncate * seq_len]
-    else:
-        token_ids = tokens.ids
+    # Tokenize if the token file doesn't exist or is stale
+    if not is_token_file_valid(path, text_path if text_path.exists() else None):
+        # Download if it doesn't exist
+        if not text_path.exists():
+            download_file(ds['url'], text_path)
+        tokenize_file(text_path, path)
 
     #
-    return NeoXDataset(token_ids, seq_len)
+    return NeoXDataset.from_token_file(path, seq_len, truncate=truncate)
 
 
 def _test():
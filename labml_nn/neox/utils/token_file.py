@@ -0,0 +1,238 @@
+"""
+---
+title: Pre-tokenized Token File
+summary: >
+    Tokenize large text files once into a memory-mappable file of token ids
+---
+
+# Pre-tokenized Token File
+
+Tokenizing the whole text on every run and keeping the tokens as a Python list
+takes a long time and a lot of memory for large corpora.
+
+This tokenizes a text file once into a flat file of `uint16` token ids
+(the GPT-NeoX vocabulary has less than $2^{16}$ tokens),
+with an index (a JSON file) of the number of tokens and
+where each chunk of text starts in the text file and in the token file.
+The index also records the size, the modification time and a SHA-256 hash of the text file,
+so that a token file is not reused after the text changes.
+
+The text file is read in chunks that end at a line break followed by a non-whitespace character.
+The GPT-NeoX pre-tokenizer never merges across such a boundary,
+so the chunks tokenize to the same tokens as the whole text.
+A batch of chunks is tokenized in parallel with `encode_batch` and appended to the token file,
+so the memory used is independent of the size of the corpus.
+
+[`NeoXDataset`](text_dataset.html) serves training samples from a `np.memmap` of the token file;
+so startup is instant and only the pages that are used are read from the disk.
+
+Run this file to tokenize tiny Shakespeare.
+
+```bash
+python -m labml_nn.neox.utils.token_file
+```
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path, PurePath
+from typing import Optional
+
+import numpy as np
+
+from labml import monit, logger
+from labml.logger import Text
+from labml_nn.neox.tokenizer import get_tokenizer
+
+# Data type of the token ids
+DTYPE = np.uint16
+
+
+def _index_path(path: PurePath):
+    return Path(path).with_suffix('.json')
+
+
+def _hash_file(path: Path, block_size: int = 1 << 20) -> str:
+    """
+    #### SHA-256 hash of a file
+    """
+    h = hashlib.sha256()
+    with open(str(path), 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def _read_chunk(f, chunk_size: int):
+    """
+    #### Read about `chunk_size` bytes of text ending at a safe boundary
+
+    The chunk ends after a line break that is followed by a non-whitespace character,
+    or at the end of the file.
+    """
+    data = f.read(chunk_size)
+    if not data:
+        return data
+
+    # Read until a safe boundary
+    while True:
+        # Search for a line break followed by a non-whitespace character
+        pos = data.rfind(b'\n', 0, len(data) - 1)
+        while pos >= 0:
+            if not data[pos + 1:pos + 2].isspace():
+                # Go back to the start of the rest of the chunk
+                f.seek(pos + 1 - len(data), os.SEEK_CUR)
+                return data[:pos + 1]
+            pos = data.rfind(b'\n', 0, pos)
+        # No boundary; read more
+        more = f.read(chunk_size)
+        if not more:
+            return data
+        data += more
+
+
+def tokenize_file(text_path: PurePath, path: PurePath, *, chunk_size: int = 1 << 20, batch_chunks: int = 64):
+    """
+    ## Tokenize a text file to a token file
+
+    :param text_path: is the location of the text file
+    :param path: is the location of the token file. The index is stored next to it with `.json` extension
+    :param chunk_size: is the approximate number of bytes of text in a chunk
+    :param batch_chunks: is the number of chunks to tokenize in parallel
+    """
+    text_path, path = Path(text_path), Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    tokenizer = get_tokenizer()
+    vocab_size = tokenizer.get_vocab_size()
+    if vocab_size > np.iinfo(DTYPE).max + 1:
+        raise ValueError(f'Vocabulary size {vocab_size} does not fit in {np.dtype(DTYPE).name}')
+
+    # `(byte offset, token offset)` of each chunk
+    chunks = []
+    n_tokens = 0
+    text_stat = text_path.stat()
+    text_size = text_stat.st_size
+    # Hash of the text; the chunks are consecutive, so hashing them hashes the whole file
+    text_hash = hashlib.sha256()
+
+    # Write to a temporary file and rename when done
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(str(text_path), 'rb') as f, open(str(tmp_path), 'wb') as out:
+        with monit.section('Tokenize'):
+            while True:
+                # Read a batch of chunks
+                batch = []
+                for _ in range(batch_chunks):
+                    start = f.tell()
+                    data = _read_chunk(f, chunk_size)
+                    if not data:
+                        break
+                    text_hash.update(data)
+                    batch.append((start, data.decode('utf-8')))
+                if not batch:
+                    break
+
+                # Tokenize the chunks in parallel
+                encodings = tokenizer.encode_batch([text for _, text in batch])
+                for (start, _), encoding in zip(batch, encodings):
+                    chunks.append((start, n_tokens))
+                    np.asarray(encoding.ids, dtype=DTYPE).tofile(out)
+                    n_tokens += len(encoding.ids)
+
+                monit.progress(f.tell() / max(1, text_size))
+
+    # Write the index
+    index = {
+        'dtype': np.dtype(DTYPE).name,
+        'n_tokens': n_tokens,
+        'text_path': str(text_path),
+        'text_size': text_size,
+        'text_mtime_ns': text_stat.st_mtime_ns,
+        'text_sha256': text_hash.hexdigest(),
+        'chunks': chunks,
+    }
+    with open(str(_index_path(path)), 'w') as f:
+        json.dump(index, f)
+    tmp_path.replace(path)
+
+    logger.log([('Tokenized ', Text.meta), (f'{n_tokens :,}', Text.value), (' tokens to ', Text.meta),
+                (str(path), Text.value)])
+
+
+def is_token_file_valid(path: PurePath, text_path: Optional[PurePath] = None):
+    """
+    ### Check if the token file and index exist and match the text file
+
+    The text file matches if it has the same size and modification time as when it was tokenized.
+    If only the modification time changed (e.g. the file was copied or touched)
+    the text is hashed and compared with the hash in the index.
+    """
+    path = Path(path)
+    index_path = _index_path(path)
+    if not path.exists() or not index_path.exists():
+        return False
+
+    with open(str(index_path), 'r') as f:
+        index = json.load(f)
+
+    if path.stat().st_size != index['n_tokens'] * np.dtype(index['dtype']).itemsize:
+        return False
+    if text_path is None:
+        return True
+
+    # Indexes written before the modification time and hash were recorded can't be checked
+    if 'text_mtime_ns' not in index or 'text_sha256' not in index:
+        return False
+
+    text_stat = Path(text_path).stat()
+    if text_stat.st_size != index['text_size']:
+        return False
+    if text_stat.st_mtime_ns == index['text_mtime_ns']:
+        return True
+
+    return _hash_file(Path(text_path)) == index['text_sha256']
+
+
+def load_token_file(path: PurePath) -> np.memmap:
+    """
+    ## Memory-map a token file
+
+    :return: a read-only `np.memmap` of token ids
+    """
+    path = Path(path)
+    with open(str(_index_path(path)), 'r') as f:
+        index = json.load(f)
+
+    if index['n_tokens'] == 0:
+        return np.zeros(0, dtype=index['dtype'])
+
+    return np.memmap(str(path), dtype=index['dtype'], mode='r', shape=(index['n_tokens'],))
+
+
+def _test():
+    """
+    ### Tokenize tiny Shakespeare and compare with tokenizing the whole text
+    """
+    from labml import lab
+    from labml_nn.neox.utils.text_dataset import load_text, DATASETS, get_token_file_path
+
+    ds = DATASETS['tiny_shakespeare']
+    text_path = lab.get_data_path() / ds['file']
+    text = load_text(text_path, ds['url'])
+
+    path = get_token_file_path('tiny_shakespeare')
+    # Use small chunks to test the boundaries
+    tokenize_file(text_path, path, chunk_size=4096)
+
+    tokens = load_token_file(path)
+    expected = get_tokenizer().encode(text).ids
+    assert tokens.tolist() == expected, 'Tokens do not match'
+    logger.log([('Tokens match', Text.success)])
+
+
+#
+if __name__ == '__main__':
+    _test()
@@ -178,5 +178,47 @@ def grad_scaler(c: TrainerConf):
 class PipelineParallelTrainerConf(TrainerConf):
     is_checkpointing: bool = False
     chunks: int
+    # Number of layers for each stage;
+    # `'Simple'` splits them evenly and `'Profiled'` splits them by measured time and memory
+    balance: List[int] = 'Simple'
+    # Fraction of the GPU memory kept free when balancing the layers,
+    # for the CUDA context, allocator fragmentation and temporary buffers that are not profiled
+    balance_memory_margin: float = 0.1
 
     fine_tuner: FineTuner
+
+
+@option(PipelineParallelTrainerConf.balance, 'Simple')
+def simple_balance(c: PipelineParallelTrainerConf):
+    """
+    Split the layers evenly by count
+    """
+    from labml_nn.neox.utils import balance_layers_simple
+    return balance_layers_simple(len(c.layers), c.n_gpus)
+
+
+@option(PipelineParallelTrainerConf.balance, 'Profiled')
+def profiled_balance(c: PipelineParallelTrainerConf):
+    """
+    [Split the layers based on their measured time and memory](pipeline_balance.html)
+    """
+    from labml_nn.neox.utils.pipeline_balance import profile_layers, balance_layers, pipeline_time
+
+    # Make sure trainable parameters are set, since they change the backward pass
+    _ = c.fine_tuner
+
+    # A micro-batch of token ids
+    x = torch.zeros((c.batch_size // c.chunks, c.max_seq_len), dtype=torch.long)
+    profiles = profile_layers(c.layers, x, torch.device('cuda:0'))
+
+    # Memory limit of a stage is the memory of the smallest GPU, less the margin
+    total_memory = min(torch.cuda.get_device_properties(i).total_memory for i in range(c.n_gpus))
+    memory_limit = int(total_memory * (1 - c.balance_memory_margin))
+    balance = balance_layers(profiles, c.n_gpus, chunks=c.chunks, memory_limit=memory_limit)
+
+    # Log the estimated speedup over the even split
+    from labml_nn.neox.utils import balance_layers_simple
+    simple = pipeline_time(profiles, balance_layers_simple(len(c.layers), c.n_gpus), c.chunks)
+    tracker.add('pipeline.estimated_speedup', simple / pipeline_time(profiles, balance, c.chunks))
+
+    return balance
@@ -162,7 +162,7 @@ class DeepNormTransformerLayer(nn.Module):
         # Create causal mask
         if self.mask is None or self.mask.size(0) != len(x):
             # Subsequent mask, will mask out tokens from seeing future tokens
-            self.mask = subsequent_mask(len(x)).to(x.device)
+            self.mask = subsequent_mask(len(x), x.device)
 
         # Run through self attention, i.e. keys and values are from self
         x = self.self_attn_norm(x, self.self_attn(query=x, key=x, value=x, mask=self.mask))
@@ -17,6 +17,10 @@ and derivatives and enhancements of it.
 * [Transformer Encoder and Decoder Models](models.html)
 * [Position-wise Feed Forward Network (FFN)](feed_forward.html)
 * [Fixed positional encoding](positional_encoding.html)
+* [Chunked memory-efficient attention](chunked/index.html)
+* [Attention backends](attention_backend/index.html)
+* [Benchmark of attention and token mixing layers](benchmark.html)
+* [Cache of attention masks and biases](mask_cache.html)
 
 ## [Transformer XL](xl/index.html)
 This implements Transformer XL model using
@@ -53,6 +53,14 @@ Although $w'_{t,t'}$ is $0$ outside the local window the AFT operation still use
 other areas. This is different from local transformers where embeddings outside the local window are
  completely not visible.
 
+Since $w'_{t,t'}$ is $0$ outside the window, the terms outside the window are sums of keys and values,
+which are computed with cumulative sums.
+So we only need the $2s - 1$ position biases in the window of each token.
+We keep only those as parameters, a $T \times (2s - 1)$ band instead of a $T \times T$ matrix,
+and the [banded computation](#banded) takes $O(Tsd)$ time and memory instead of $O(T^2 d)$,
+including the parameters, their gradients and the optimizer state.
+Here's [a test](test.html) that checks it matches the dense computation and compares their speed.
+
 Here is [the training code](experiment.html) for a AFT Local model.
 """
 
@@ -61,6 +69,8 @@ from typing import Optional
 import torch
 from torch import nn
 
+from labml_nn.transformers.attention_backend import is_causal_mask
+from labml_nn.transformers.mask_cache import local_mask
 
 
 class AFTLocal(nn.Module):
@@ -94,14 +104,15 @@ class AFTLocal(nn.Module):
 
         # Local window size $s$
         self.local_window_size = local_window_size
+        # Whether to use the [banded computation](#banded) when there's no mask or the mask is causal
+        self.is_banded = True
         # These transform the `query`, `key` and `value` vectors.
         self.query = nn.Linear(d_model, d_model, bias=bias)
         self.key = nn.Linear(d_model, d_model, bias=bias)
         self.value = nn.Linear(d_model, d_model, bias=bias)
-        # Pair-wise positional biases $w \in \mathbb{R}^{T \times T}$
-        self.pos_bias = nn.Parameter(torch.zeros(seq_len, seq_len), requires_grad=True)
-        # Mask for $w_{t,t'}$
-        self.local_mask = nn.Parameter(self.create_local_mask(seq_len, local_window_size), requires_grad=False)
+        # Pair-wise positional biases in the window, stored as a band of shape `[seq_len, 2 * s - 1]`;
+        # $w_{t,t'}$ for $\lvert t - t' \rvert \lt s$ is `pos_bias[t, t' - t + s - 1]`
+        self.pos_bias = nn.Parameter(torch.zeros(seq_len, 2 * local_window_size - 1), requires_grad=True)
         # Activation $\sigma$
         self.activation = nn.Sigmoid()
         # Output layer
@@ -112,7 +123,7 @@ class AFTLocal(nn.Module):
         """
         #### Create local mask
 
-        This creates a mask for
+        This creates a new mask for
 
         \begin{align}
         m_{t,t'} =
@@ -121,6 +132,8 @@ class AFTLocal(nn.Module):
         0, & \text{otherwise}
         \end{cases}
         \end{align}
+
+        The layer uses a view of a [cached mask](../mask_cache.html#local_mask) instead.
         """
 
         # Initialize to ones
@@ -146,6 +159,10 @@ class AFTLocal(nn.Module):
         `mask` has shape `[seq_len, seq_len, batch_size]` and
         `mask[i, j, b]` indicates whether for batch `b`,
         query at position `i` has access to key-value at position `j`.
+        All keys are visible if `mask` is `None`.
+
+        The [banded computation](#banded) is used when there's no mask or the mask is causal
+        (unless `is_banded` is `False`), and the [dense computation](#dense) otherwise.
         """
 
         # `query`, `key` and `value`  have shape `[seq_len, batch_size, d_model]`
@@ -164,21 +181,6 @@ class AFTLocal(nn.Module):
         key = self.key(key)
         value = self.value(value)
 
-        # Get
-        #
-        #     \begin{align}
-        #     w'_{t,t'} =
-        #     \begin{cases}
-        #     w_{t,t'},  & {\text{for }\lvert t-t' \rvert \lt s} \\
-        #     0, & \text{otherwise}
-        #     \end{cases}
-        #     \end{align}
-        #
-        # using the mask
-        pos_bias = self.pos_bias[:seq_len, :seq_len] * self.local_mask[:seq_len, :seq_len]
-        pos_bias = pos_bias.unsqueeze(-1)
-        pos_bias.masked_fill_(~mask, float('-inf'))
-
         # \begin{align}
         # Y_t &= \sigma(Q_t) \odot
         # \frac{\sum_{t'=1}^T \exp(K_{t'} + w_{t,t'}) \odot V_{t'}}
@@ -188,10 +190,7 @@ class AFTLocal(nn.Module):
         #    {\sum_{t'=1}^T \exp(w_{t,t'}) \odot \exp(K_{t'})}
         # \end{align}
         #
-        # We compute $\exp(w_{t,t'})$, $\exp(K_{t'}) \odot V_{t'}$ and $\exp(K_{t'})$
-        # separately and do a matrix multiplication. We use einsum for clarity.
-
-        # We subtract $\max_{t'}(K_{t'})$ and $\max_{t'}(w_{t,t'})$ before calculating the exponents to stabilize
+        # We subtract $\max_{t'}(K_{t'})$ before calculating the exponents to stabilize
         # the softmax calculation.
         #
         # If $x_i$ is large $\exp(x_i)$ becomes huge and the computation of
@@ -200,17 +199,15 @@ class AFTLocal(nn.Module):
         # and can help stabilize the computation.
         # So we subtract $\max(x_i)$ to stabilize the computation.
         max_key = key.max(dim=0, keepdims=True)[0]
-        max_pos_bias = pos_bias.max(dim=1,  keepdims=True)[0]
-
         # $\exp \big(K_{t'}- \max_{t'}(K_{t'})\big)$
         exp_key = torch.exp(key - max_key)
-        # $\exp \big(w_{t,t'} - \max_{t'}(w_{t,t'})\big)$
-        exp_pos_bias = torch.exp(pos_bias - max_pos_bias)
 
         # The numerator part $\sum_{t'=1}^T \exp(w_{t,t'}) \odot \exp(K_{t'}) \odot V_{t'}$
-        num = torch.einsum('ijb,jbd->ibd', exp_pos_bias, exp_key * value)
-        # The denominator part $\sum_{t'=1}^T \exp(w_{t,t'}) \odot \exp(K_{t'})$
-        den = torch.einsum('ijb,jbd->ibd', exp_pos_bias, exp_key)
+        # and the denominator part $\sum_{t'=1}^T \exp(w_{t,t'}) \odot \exp(K_{t'})$
+        if self.is_banded and query.shape[0] == key.shape[0] and (mask is None or self.is_causal(mask)):
+            num, den = self.banded(exp_key, value, is_causal=mask is not None)
+        else:
+            num, den = self.dense(exp_key, value, mask)
 
         # Output $$Y_t = \sigma(Q_t) \odot
         #         \frac{\sum_{t'=1}^T \exp(w_{t,t'}) \odot \exp(K_{t'}) \odot V_{t'}}
@@ -220,6 +217,156 @@ class AFTLocal(nn.Module):
         # Output layer
         return self.output(y)
 
+    @staticmethod
+    def is_causal(mask: torch.Tensor):
+        """
+        #### Whether the mask is the causal mask, the same for all batches
+        """
+        if mask.shape[0] != mask.shape[1] or mask.shape[2] != 1:
+            return False
+        return is_causal_mask(mask.permute(2, 0, 1)[None], mask.shape[0], mask.shape[1])
+
+    def dense(self, exp_key: torch.Tensor, value: torch.Tensor, mask: Optional[torch.Tensor]):
+        r"""
+        <a id="dense"></a>
+
+        #### Dense computation
+
+        This computes $\exp(w'_{t,t'})$ for all $T \times T$ pairs and does a matrix multiplication,
+        which takes $O(T^2 d)$ time.
+        """
+        seq_len = exp_key.shape[0]
+        s = self.local_window_size
+        device = exp_key.device
+
+        # Get
+        #
+        #     \begin{align}
+        #     w'_{t,t'} =
+        #     \begin{cases}
+        #     w_{t,t'},  & {\text{for }\lvert t-t' \rvert \lt s} \\
+        #     0, & \text{otherwise}
+        #     \end{cases}
+        #     \end{align}
+        #
+        # from the band of position biases,
+        # using the local mask, which is a view of a [cached mask](../mask_cache.html)
+        t = torch.arange(seq_len, device=device)
+        band_idx = (t[None, :] - t[:, None] + s - 1).clamp(0, 2 * s - 2)
+        pos_bias = self.pos_bias[t[:, None], band_idx]
+        pos_bias = pos_bias.masked_fill(~local_mask(seq_len, s, device), 0.)
+        pos_bias = pos_bias.unsqueeze(-1)
+        if mask is not None:
+            pos_bias = pos_bias.masked_fill(~mask, float('-inf'))
+
+        # We subtract $\max_{t'}(w_{t,t'})$ before calculating the exponents
+        max_pos_bias = pos_bias.max(dim=1, keepdims=True)[0]
+        # $\exp \big(w_{t,t'} - \max_{t'}(w_{t,t'})\big)$
+        exp_pos_bias = torch.exp(pos_bias - max_pos_bias)
+
+        # We compute $\exp(w_{t,t'})$, $\exp(K_{t'}) \odot V_{t'}$ and $\exp(K_{t'})$
+        # separately and do a matrix multiplication. We use einsum for clarity.
+        num = torch.einsum('ijb,jbd->ibd', exp_pos_bias, exp_key * value)
+        den = torch.einsum('ijb,jbd->ibd', exp_pos_bias, exp_key)
+
+        #
+        return num, den
+
+    def banded(self, exp_key: torch.Tensor, value: torch.Tensor, is_causal: bool):
+        r"""
+        <a id="banded"></a>
+
+        #### Banded computation
+
+        Since $w'_{t,t'} = 0$ outside the window,
+
+        $$\sum_{t'} \exp(w'_{t,t'}) \odot x_{t'} =
+         \sum_{\lvert t - t' \rvert \lt s} \exp(w_{t,t'}) \odot x_{t'} +
+         \sum_{t' \le t - s} x_{t'} + \sum_{t' \ge t + s} x_{t'}$$
+
+        for $x_{t'} = \exp(K_{t'}) \odot V_{t'}$ and $x_{t'} = \exp(K_{t'})$.
+        With a causal mask only $t' \le t$ are visible, so the last sum is not there.
+
+        The sums outside the window are cumulative sums along the sequence.
+        The sums in the window are computed for blocks of $s$ queries at a time,
+        with a matrix multiplication by the keys that are in the window of any of the queries in the block.
+        The keys of the blocks are overlapping views of the keys, with `unfold`.
+
+        This takes $O(T s d)$ time and memory instead of $O(T^2 d)$.
+        The gradient of the position biases is also $O(T s)$, since they are stored as a band.
+        """
+        seq_len, batch_size, d_model = exp_key.shape
+        s = self.local_window_size
+        device = exp_key.device
+
+        # $x_{t'}$; $\exp(K_{t'}) \odot V_{t'}$ and $\exp(K_{t'})$ concatenated,
+        # so that they are computed together
+        x = torch.cat((exp_key * value, exp_key), dim=-1)
+
+        # Keys in the window are $t - left \le t' \le t + right$
+        left, right = s - 1, (0 if is_causal else s - 1)
+        # Number of blocks of $s$ queries
+        n_blocks = (seq_len + s - 1) // s
+        # Number of keys in the windows of a block
+        span = s + left + right
+
+        # Query positions $t$ of shape `[n_blocks, s, 1]`;
+        # the last block is padded past `seq_len`
+        t = torch.arange(n_blocks * s, device=device).view(n_blocks, s, 1)
+        # Key positions $t'$ of shape `[n_blocks, 1, span]`
+        t_k = (torch.arange(n_blocks, device=device).view(n_blocks, 1, 1) * s +
+               torch.arange(span, device=device).view(1, 1, span) - left)
+        # Whether $t'$ is in the window of $t$ and both are in the sequence
+        in_window = (t_k >= t - left) & (t_k <= t + right) & (t_k >= 0) & (t_k < seq_len) & (t < seq_len)
+
+        # $w_{t,t'}$ in the window, and $-\infty$ elsewhere; it's at $t' - t + s - 1$ in the band
+        w = self.pos_bias[t.clamp(max=seq_len - 1), (t_k - t + s - 1).clamp(0, 2 * s - 2)]
+        w = w.masked_fill(~in_window, float('-inf'))
+
+        # Whether there are visible keys outside the window, which have $w'_{t,t'} = 0$
+        has_outside = t >= s
+        if not is_causal:
+            has_outside |= t < seq_len - s
+        # $\max_{t'}(w'_{t,t'})$ over visible keys to stabilize the exponents.
+        # It cancels out, so we don't need gradients for it.
+        max_pos_bias = w.max(dim=-1, keepdim=True)[0].detach()
+        max_pos_bias = torch.where(has_outside, max_pos_bias.clamp(min=0.), max_pos_bias)
+        # Padded queries have no keys
+        max_pos_bias = max_pos_bias.masked_fill(t >= seq_len, 0.)
+        # $\exp \big(w_{t,t'} - \max_{t'}(w'_{t,t'})\big)$ in the window, and $0$ elsewhere
+        exp_pos_bias = torch.exp(w - max_pos_bias)
+
+        # Pad $x$ so that every block has `span` keys, and get overlapping blocks
+        # of shape `[n_blocks, batch_size, 2 * d_model, span]` as a view
+        x_pad = torch.cat((x.new_zeros(left, batch_size, 2 * d_model),
+                           x,
+                           x.new_zeros(n_blocks * s - seq_len + right, batch_size, 2 * d_model)), dim=0)
+        x_blocks = x_pad.unfold(0, span, s)
+        # $\sum_{\lvert t - t' \rvert \lt s} \exp(w_{t,t'}) \odot x_{t'}$
+        in_window_sum = torch.einsum('nqk,nbdk->nqbd', exp_pos_bias, x_blocks)
+        in_window_sum = in_window_sum.reshape(n_blocks * s, batch_size, 2 * d_model)[:seq_len]
+
+        # $\sum_{t' \le t - s} x_{t'} + \sum_{t' \ge t + s} x_{t'}$
+        outside_sum = x.new_zeros(x.shape)
+        if seq_len > s:
+            outside_sum[s:] = x.cumsum(dim=0)[:-s]
+            if not is_causal:
+                outside_sum[:-s] += x.flip(0).cumsum(dim=0).flip(0)[s:]
+
+        # Keys outside the window have $\exp \big(0 - \max_{t'}(w'_{t,t'})\big)$.
+        # It's $0$ for queries without keys outside the window,
+        # since the exponent can overflow to $\infty$ when the position biases are very negative,
+        # and $\infty \times 0$ would be `NaN`.
+        outside_scale = torch.where(has_outside, torch.exp(-max_pos_bias), torch.zeros_like(max_pos_bias))
+        outside_scale = outside_scale.view(-1, 1, 1)[:seq_len]
+        total = outside_sum * outside_scale + in_window_sum
+
+        # Split into the numerator and denominator parts
+        num, den = total.split(d_model, dim=-1)
+
+        #
+        return num, den
+
 
 def _test_local_mask():
     """
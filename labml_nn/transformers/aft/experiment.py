@@ -48,7 +48,7 @@ class AutoregressiveTransformer(nn.Module):
         # or if the size of the mask is different
         if self.mask is None or self.mask.size(0) != len(x):
             # Subsequent mask, will mask out tokens from seeing future tokens
-            self.mask = subsequent_mask(len(x)).to(x.device)
+            self.mask = subsequent_mask(len(x), x.device)
 
         # Get the token embeddings with positional encodings
         x = self.src_embed(x)
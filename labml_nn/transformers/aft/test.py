@@ -0,0 +1,114 @@
+"""
+---
+title: Test banded AFT Local
+summary: >
+  Compare the banded computation of AFT Local with the dense computation and measure their speed
+---
+
+# Test Banded AFT Local
+
+This compares the outputs and gradients of the [banded computation](index.html#banded) of AFT Local
+with the [dense computation](index.html#dense), with a causal mask and without a mask,
+and measures the time and the memory saved for the backward pass.
+"""
+
+import time
+
+import torch
+
+from labml import logger, monit
+from labml.logger import Text
+from labml_nn.transformers.aft import AFTLocal
+from labml_nn.transformers.utils import subsequent_mask
+
+
+def _check(name: str, a: torch.Tensor, b: torch.Tensor, atol: float = 1e-4):
+    diff = (a - b).abs().max().item()
+    passed = diff <= atol
+    logger.log([(f'{name :<32}', Text.key), (f'{diff :.2e}', Text.value),
+                (' [PASSED]' if passed else ' [FAILED]', Text.success if passed else Text.danger)])
+    return passed
+
+
+def test(seq_len: int, local_window_size: int, *, is_causal: bool, batch_size: int = 3, d_model: int = 32,
+         pos_bias_mean: float = 0.):
+    """
+    ### Compare outputs and gradients with the dense computation
+
+    * `pos_bias_mean` is the mean of the position biases;
+     very negative biases check that the exponents don't overflow
+    """
+    torch.manual_seed(0)
+    aft = AFTLocal(d_model, seq_len, local_window_size)
+    # Position biases are initialized to zeros
+    with torch.no_grad():
+        aft.pos_bias.normal_(mean=pos_bias_mean, std=2.)
+    x = torch.randn(seq_len, batch_size, d_model, requires_grad=True)
+    d_out = torch.randn(seq_len, batch_size, d_model)
+    mask = subsequent_mask(seq_len) if is_causal else None
+
+    grads = []
+    for is_banded in [False, True]:
+        aft.is_banded = is_banded
+        out = aft(query=x, key=x, value=x, mask=mask)
+        out.backward(d_out)
+        grads.append((out.detach(), x.grad, aft.pos_bias.grad, aft.key.weight.grad))
+        x.grad = None
+        aft.zero_grad()
+
+    with monit.section(f'seq_len={seq_len} window={local_window_size} causal={is_causal} '
+                       f'pos_bias_mean={pos_bias_mean}'):
+        passed = all([_check(n, a, b) for n, a, b in zip(['output', 'dx', 'd_pos_bias', 'd_key'], *grads)])
+
+    return passed
+
+
+def measure(seq_len: int, local_window_size: int, *, batch_size: int = 4, d_model: int = 256, n_repeat: int = 3):
+    """
+    ### Measure memory saved for backward, and time of the forward and backward passes
+    """
+    aft = AFTLocal(d_model, seq_len, local_window_size)
+    x = torch.randn(seq_len, batch_size, d_model, requires_grad=True)
+    mask = subsequent_mask(seq_len)
+
+    for name, is_banded in [('dense', False), ('banded', True)]:
+        aft.is_banded = is_banded
+        saved = {}
+
+        def pack(t: torch.Tensor):
+            saved[t.data_ptr()] = t.numel() * t.element_size()
+            return t
+
+        times = []
+        for _ in range(n_repeat):
+            start = time.perf_counter()
+            with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+                out = aft(query=x, key=x, value=x, mask=mask)
+            out.sum().backward()
+            times.append(time.perf_counter() - start)
+        aft.zero_grad()
+
+        logger.log([(f'{seq_len :6d} {name :<8}', Text.key),
+                    ' saved ', (f'{sum(saved.values()) / 2 ** 20 :10.1f}MB', Text.value),
+                    ' forward and backward ', (f'{min(times) * 1000 :10.1f}ms', Text.value)])
+
+
+def main():
+    passed = True
+    for is_causal in [True, False]:
+        for seq_len, local_window_size in [(100, 16), (128, 32), (37, 64), (50, 1)]:
+            passed = test(seq_len, local_window_size, is_causal=is_causal) and passed
+        passed = test(100, 16, is_causal=is_causal, pos_bias_mean=-200.) and passed
+
+    if passed:
+        logger.log('[PASSED]', Text.success)
+    else:
+        logger.log('[FAILED]', Text.danger)
+
+    for seq_len in [1024, 2048, 4096, 8192]:
+        measure(seq_len, 128)
+
+
+#
+if __name__ == '__main__':
+    main()
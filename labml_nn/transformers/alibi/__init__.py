@@ -37,6 +37,7 @@ import torch
 from torch import nn
 
 from labml.logger import inspect
+from labml_nn.transformers.mask_cache import alibi_biases
 from labml_nn.transformers.mha import MultiHeadAttention
 
 
@@ -115,9 +116,6 @@ class AlibiMultiHeadAttention(MultiHeadAttention):
     def __init__(self, heads: int, d_model: int, dropout_prob: float = 0.1):
         super().__init__(heads, d_model, dropout_prob)
 
-        # To cache AliBi the biases
-        self.alibi_biases = None
-
     def forward(self, *,
                 query: torch.Tensor,
                 key: torch.Tensor,
@@ -137,54 +135,19 @@ class AlibiMultiHeadAttention(MultiHeadAttention):
         assert mask is not None
         assert mask.shape[0] == mask.shape[1] and mask.shape[2] == 1
 
-        # `query`, `key` and `value` have shape `[seq_len, batch_size, d_model]`
-        seq_len, batch_size, _ = query.shape
-
-        # Add head dimension to mask and check its shape.
-        mask = self.prepare_mask(mask, query.shape, key.shape)
-
-        # Prepare `query`, `key` and `value` for attention computation.
-        # These will then have shape `[seq_len, batch_size, heads, d_k]`.
-        query = self.query(query)
-        key = self.key(key)
-        value = self.value(value)
-
-        # Compute attention scores $Q K^\top$.
-        # This gives a tensor of shape `[seq_len, seq_len, batch_size, heads]`.
-        scores = self.get_scores(query, key)
-
-        # Scale scores $\frac{Q K^\top}{\sqrt{d_k}}$
-        scores *= self.scale
-
-        # Create AliBi biases if it's not cached
-        if self.alibi_biases is None or self.alibi_biases.shape[1] < seq_len:
-            # `mask` has shape `[seq_len, seq_len, 1, 1]`
-            self.alibi_biases = get_alibi_biases(scores.shape[-1], mask[:, :, 0, 0])
-
-        # Add AliBi biases to attention scores.
-        # ALiBi biases has shape `[seq_len, seq_len, n_heads]`
-        # and `scores` has shape `[seq_len, seq_len, batch_size, n_heads]`
-        scores += self.alibi_biases[:seq_len, :seq_len, None, :]
+        return super().forward(query=query, key=key, value=value, mask=mask)
 
-        # Apply mask
-        scores = scores.masked_fill(mask == 0, float('-inf'))
-
-        # $softmax$ attention along the key sequence dimension
-        # $\underset{seq}{softmax}\Bigg(\frac{Q K^\top}{\sqrt{d_k}}\Bigg)$
-        attn = self.softmax(scores)
-
-        # Apply dropout
-        attn = self.dropout(attn)
-
-        # Multiply by values
-        # $$\underset{seq}{softmax}\Bigg(\frac{Q K^\top}{\sqrt{d_k}}\Bigg)V$$
-        x = torch.einsum("ijbh,jbhd->ibhd", attn, value)
-
-        # Concatenate multiple heads
-        x = x.reshape(seq_len, batch_size, -1)
+    def get_score_bias(self, query: torch.Tensor, key: torch.Tensor):
+        """
+        ### Get ALiBi biases
 
-        # Output layer
-        return self.output(x)
+        This returns biases of shape `[1, key_len, 1, heads]`, which are broadcast over the queries.
+        """
+        # The mask is causal, so the bias of a key that's not masked is $m (j + 1)$
+        # for all queries, including the queries after `self.offset` in
+        # [incremental decoding](../mha.html#incremental).
+        # These are views of [cached biases](../mask_cache.html).
+        return alibi_biases(self.heads, key.shape[0], query.device)
 
 
 def _test_alibi():
@@ -199,6 +162,10 @@ def _test_alibi():
 
     inspect(get_alibi_biases(12, mask)[:, :, 3], _n=-1)
 
+    # The [cached biases](../mask_cache.html#alibi_biases) are the same for the keys that are not masked
+    cached = alibi_biases(12, 8)[0, :, 0, :]
+    inspect((cached[None, :, :] - get_alibi_biases(12, mask)).masked_fill(~mask[:, :, None], 0.).abs().max())
+
 
 #
 if __name__ == '__main__':
@@ -0,0 +1,348 @@
+"""
+---
+title: Attention Backends
+summary: >
+  Pick the fastest available attention kernel among einsum, PyTorch scaled dot-product attention,
+  chunked memory-efficient attention and Triton flash attention.
+---
+
+# Attention Backends
+
+Attention modules compute scores, mask, softmax and the weighted sum of values in many ways.
+This provides a single [`attention`](#attention) function
+that computes attention with one of these backends:
+
+* `einsum`: the reference implementation that computes the full score matrix
+* `sdpa`: [`torch.nn.functional.scaled_dot_product_attention`](https://pytorch.org/docs/stable/generated/torch.nn.functional.scaled_dot_product_attention.html),
+  which uses fused kernels when they are available
+* `chunked`: [chunked memory-efficient attention](../chunked/index.html) in pure PyTorch
+* `flash`: our [Triton flash attention](../flash/index.html) kernel
+
+The backend is [selected](#select_backend) based on the device, data type, mask and head size.
+It can be overridden for a call with the `backend` argument,
+or for a block of code with [`use_backend`](#use_backend).
+
+[Multi-head attention](../mha.html), [RoPE](../rope/index.html), [RoPER](../rope/value_pe/index.html),
+[ALiBi](../alibi/index.html), [relative multi-head attention](../xl/relative_mha.html),
+[GPT-NeoX attention](../../neox/model.html) and
+[Stable Diffusion cross attention](../../diffusion/stable_diffusion/model/unet_attention.html)
+use this.
+
+Here's [the test](test.html) that checks the backends give the same results.
+"""
+
+import importlib.util
+import math
+import weakref
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+from labml_nn.transformers.mask_cache import mask_cache, causal_mask
+
+# Names of the backends
+BACKENDS = ('einsum', 'sdpa', 'chunked', 'flash')
+# Head sizes supported by the [Triton flash attention](../flash/index.html) kernel
+FLASH_HEAD_SIZES = {16, 32, 64, 128, 256}
+# Use [chunked attention](../chunked/index.html) instead of a kernel that computes the full score matrix
+# when the score matrix has more than this many elements
+CHUNKED_MIN_SCORES = 1 << 24
+
+# Backend set by [`use_backend`](#use_backend)
+_override: Optional[str] = None
+
+# Results of [`is_causal_mask`](#is_causal_mask) for masks that are not views of the cached causal mask,
+# keyed by the id of the mask's base tensor and the layout of the view.
+# The base tensor is held with a weak reference, so that an entry is not used for another tensor
+# after the mask is freed, and its version counter detects in-place changes.
+_causal_checks: Dict[Tuple, Tuple[weakref.ref, int, bool]] = {}
+# Maximum number of cached results
+_CAUSAL_CHECKS_SIZE = 64
+
+
+@contextmanager
+def use_backend(backend: Optional[str]):
+    """
+    <a id="use_backend"></a>
+
+    ## Use a backend for all attention computed in a block of code
+
+    ```python
+    with use_backend('chunked'):
+        loss = model(x)
+    ```
+
+    `None` selects the backend automatically.
+    """
+    global _override
+    if backend is not None and backend not in BACKENDS:
+        raise ValueError(f'Unknown attention backend {backend}')
+    previous = _override
+    _override = backend
+    try:
+        yield
+    finally:
+        _override = previous
+
+
+def is_sdpa_available():
+    """
+    ### Whether `scaled_dot_product_attention` is available (PyTorch 2.0 and above)
+    """
+    return hasattr(F, 'scaled_dot_product_attention')
+
+
+def is_sdpa_fused(q: torch.Tensor, mask: Optional[torch.Tensor]):
+    """
+    <a id="is_sdpa_fused"></a>
+
+    ### Whether `scaled_dot_product_attention` has a fused kernel for the inputs
+
+    On GPUs the memory-efficient kernel takes masks.
+    On CPUs there's a flash attention kernel from PyTorch 2.2, but it doesn't take masks.
+    Otherwise, it computes the full score matrix.
+    """
+    if not is_sdpa_available():
+        return False
+    if q.is_cuda:
+        return True
+    version = tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2])
+    return mask is None and version >= (2, 2)
+
+
+def is_flash_available():
+    """
+    ### Whether the Triton flash attention kernel can run
+    """
+    return torch.cuda.is_available() and importlib.util.find_spec('triton') is not None
+
+
+def is_flash_supported(q: torch.Tensor, k: torch.Tensor, mask: Optional[torch.Tensor], is_causal: bool,
+                       dropout_prob: float):
+    """
+    ### Whether the Triton flash attention kernel supports the inputs
+
+    The kernel doesn't take a mask or dropout,
+    and its causal mask is only the same as ours when there are as many queries as keys.
+    """
+    return (q.is_cuda and
+            q.dtype in (torch.float16, torch.bfloat16) and
+            q.shape[-1] in FLASH_HEAD_SIZES and
+            q.shape[1] == k.shape[1] and
+            mask is None and
+            dropout_prob == 0. and
+            (not is_causal or q.shape[2] == k.shape[2]) and
+            is_flash_available())
+
+
+def select_backend(q: torch.Tensor, k: torch.Tensor, mask: Optional[torch.Tensor] = None, *,
+                   is_causal: bool = False, dropout_prob: float = 0., backend: Optional[str] = None) -> str:
+    """
+    <a id="select_backend"></a>
+
+    ## Select a backend
+
+    `backend` overrides the selection, followed by the backend set with [`use_backend`](#use_backend).
+    Otherwise,
+
+    * Triton flash attention is used on GPUs for half precision without masks or dropout
+    * `scaled_dot_product_attention` is used if it has a [fused kernel](#is_sdpa_fused) for the inputs
+    * Chunked attention is used for large score matrices that would be fully computed otherwise
+    * The einsum implementation is used for the rest
+    """
+    if backend is None:
+        backend = _override
+    if backend is not None:
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown attention backend {backend}')
+        return backend
+
+    if is_flash_supported(q, k, mask, is_causal, dropout_prob):
+        return 'flash'
+
+    if is_sdpa_fused(q, mask):
+        return 'sdpa'
+
+    # Number of elements in the score matrix
+    n_scores = q.shape[0] * q.shape[1] * q.shape[2] * k.shape[2]
+    if n_scores >= CHUNKED_MIN_SCORES:
+        return 'chunked'
+
+    if is_sdpa_available():
+        return 'sdpa'
+
+    return 'einsum'
+
+
+def is_causal_mask(mask: torch.Tensor, q_seq_len: int, kv_seq_len: int, *, block: int = 256):
+    """
+    <a id="is_causal_mask"></a>
+
+    ### Check if a boolean mask is the causal mask
+
+    `mask` should be broadcastable to `[batch_size, heads, q_seq_len, kv_seq_len]`.
+
+    Views of the [cached causal mask](../mask_cache.html) are recognized from their storage and strides.
+    Other masks are compared with the causal mask, and the result is cached for the mask
+    (masks are usually created once and passed on every step), so they are only read once.
+    The rows are compared in blocks to avoid creating another mask of the same size.
+    """
+    if mask.dtype != torch.bool or mask.shape != (1, 1, q_seq_len, kv_seq_len):
+        return False
+    # Views of the [cached causal mask](../mask_cache.html) are causal
+    if mask_cache.is_causal_view(mask, q_seq_len, kv_seq_len):
+        return True
+
+    # Look up the result for the mask
+    base = mask if mask._base is None else mask._base
+    key = (id(base), mask.storage_offset(), tuple(mask.shape), mask.stride())
+    cached = _causal_checks.get(key)
+    if cached is not None and cached[0]() is base and cached[1] == base._version:
+        return cached[2]
+
+    # Query $i$ attends to keys $j \le i + shift$
+    shift = kv_seq_len - q_seq_len
+    k_pos = torch.arange(kv_seq_len, device=mask.device)
+    is_causal = True
+    for start in range(0, q_seq_len, block):
+        q_pos = torch.arange(start, min(start + block, q_seq_len), device=mask.device)
+        if not torch.equal(mask[0, 0, start:start + block], k_pos[None, :] <= q_pos[:, None] + shift):
+            is_causal = False
+            break
+
+    # Cache the result, after dropping the entries of freed masks
+    if len(_causal_checks) >= _CAUSAL_CHECKS_SIZE:
+        for k in [k for k, (ref, _, _) in _causal_checks.items() if ref() is None]:
+            del _causal_checks[k]
+        if len(_causal_checks) >= _CAUSAL_CHECKS_SIZE:
+            _causal_checks.clear()
+    _causal_checks[key] = (weakref.ref(base), base._version, is_causal)
+
+    #
+    return is_causal
+
+
+def _causal_mask(q_seq_len: int, kv_seq_len: int, device: torch.device):
+    """
+    #### Causal mask with the queries aligned with the last keys
+
+    This is a view of the [cached causal mask](../mask_cache.html#causal_mask).
+    """
+    return causal_mask(q_seq_len, kv_seq_len, device)[:, :, 0]
+
+
+def _add_causal_mask(mask: Optional[torch.Tensor], q_seq_len: int, kv_seq_len: int, device: torch.device):
+    """
+    #### Combine a mask with the causal mask
+    """
+    causal = _causal_mask(q_seq_len, kv_seq_len, device)
+    if mask is None:
+        return causal
+    if mask.dtype == torch.bool:
+        return mask & causal
+    return mask.masked_fill(~causal, float('-inf'))
+
+
+def einsum_attention(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, mask: Optional[torch.Tensor],
+                     is_causal: bool, scale: float, dropout_prob: float):
+    """
+    ### Reference attention
+
+    Scores of half precision inputs are computed in `float32` since they can overflow.
+    """
+    dtype = v.dtype
+    if q.dtype == torch.float16:
+        q, k, v = q.float(), k.float(), v.float()
+
+    # $S_{ij} = \sigma Q_i K_j^\top$
+    scores = torch.einsum('bhid,bhjd->bhij', q, k) * scale
+    if is_causal:
+        mask = _add_causal_mask(mask, q.shape[2], k.shape[2], q.device)
+    # Apply the mask
+    if mask is not None:
+        if mask.dtype == torch.bool:
+            scores = scores.masked_fill(~mask, float('-inf'))
+        else:
+            scores = scores + mask
+
+    # $softmax$ along the key sequence dimension
+    attn = torch.softmax(scores, dim=-1)
+    if dropout_prob > 0.:
+        attn = F.dropout(attn, dropout_prob)
+
+    return torch.einsum('bhij,bhjd->bhid', attn, v).to(dtype)
+
+
+def sdpa_attention(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, mask: Optional[torch.Tensor],
+                   is_causal: bool, scale: float, dropout_prob: float):
+    """
+    ### Attention with `scaled_dot_product_attention`
+
+    Its causal mask aligns queries with the first keys,
+    so we pass our own causal mask when there are fewer queries than keys.
+    """
+    # `scaled_dot_product_attention` scales by $\frac{1}{\sqrt{d_k}}$
+    default_scale = 1 / math.sqrt(q.shape[-1])
+    if scale != default_scale:
+        q = q * (scale / default_scale)
+
+    if is_causal and (mask is not None or q.shape[2] != k.shape[2]):
+        mask = _add_causal_mask(mask, q.shape[2], k.shape[2], q.device)
+        is_causal = False
+    # Additive masks should be of the same type as the queries
+    if mask is not None and mask.dtype != torch.bool:
+        mask = mask.to(q.dtype)
+
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=dropout_prob, is_causal=is_causal)
+
+
+def flash_attention(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, is_causal: bool, scale: float):
+    """
+    ### Attention with the [Triton flash attention](../flash/index.html) kernel
+    """
+    from labml_nn.transformers.flash import attention as triton_attention
+
+    return triton_attention(q.contiguous(), k.contiguous(), v.contiguous(), is_causal, scale)
+
+
+def attention(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, mask: Optional[torch.Tensor] = None, *,
+              is_causal: bool = False, scale: Optional[float] = None, dropout_prob: float = 0.,
+              backend: Optional[str] = None):
+    r"""
+    <a id="attention"></a>
+
+    ## Attention
+
+    :param q: has shape `[batch_size, heads, q_seq_len, d_k]`
+    :param k: has shape `[batch_size, heads, kv_seq_len, d_k]`
+    :param v: has shape `[batch_size, heads, kv_seq_len, d_k]`
+    :param mask: is a boolean mask (`True` for keys that are attended to)
+     or a bias added to the scores, broadcastable to `[batch_size, heads, q_seq_len, kv_seq_len]`
+    :param is_causal: whether to apply a causal mask.
+     When `q_seq_len < kv_seq_len` the queries are the last `q_seq_len` positions.
+    :param scale: is the softmax scale factor; defaults to $\frac{1}{\sqrt{d_k}}$
+    :param dropout_prob: is the dropout probability of attention probabilities
+    :param backend: is the backend to use; it's [selected](#select_backend) if `None`
+    :return: the output of shape `[batch_size, heads, q_seq_len, d_k]`
+    """
+    if scale is None:
+        scale = 1 / math.sqrt(q.shape[-1])
+
+    # Replace causal masks with `is_causal` so that kernels don't have to read the mask
+    if mask is not None and is_causal_mask(mask, q.shape[2], k.shape[2]):
+        mask, is_causal = None, True
+
+    backend = select_backend(q, k, mask, is_causal=is_causal, dropout_prob=dropout_prob, backend=backend)
+
+    if backend == 'flash':
+        assert mask is None and dropout_prob == 0., 'Flash attention does not support masks or dropout'
+        return flash_attention(q, k, v, is_causal, scale)
+    elif backend == 'sdpa':
+        return sdpa_attention(q, k, v, mask, is_causal, scale, dropout_prob)
+    elif backend == 'chunked':
+        from labml_nn.transformers.chunked import chunked_attention
+        return chunked_attention(q, k, v, mask, is_causal=is_causal, scale=scale, dropout_prob=dropout_prob)
+    else:
+        return einsum_attention(q, k, v, mask, is_causal, scale, dropout_prob)
@@ -0,0 +1,198 @@
+"""
+---
+title: Test Attention Backends
+summary: >
+  Check that attention backends and the attention modules that use them give the same results
+---
+
+# Test Attention Backends
+
+This compares the outputs and gradients of each available [attention backend](index.html)
+with the einsum implementation, for different masks and sequence lengths,
+and compares the outputs of the attention modules with each backend.
+"""
+
+from typing import Callable, List
+
+import torch
+from torch import nn
+
+from labml import logger, monit
+from labml.logger import Text
+from labml_nn.transformers.attention_backend import attention, use_backend, is_sdpa_available, is_flash_supported
+from labml_nn.transformers.utils import subsequent_mask
+
+
+def _check(name: str, a: torch.Tensor, b: torch.Tensor, atol: float):
+    diff = (a.float() - b.float()).abs().max().item()
+    passed = diff <= atol
+    logger.log([(f'{name :<48}', Text.key), (f'{diff :.2e}', Text.value),
+                (' [PASSED]' if passed else ' [FAILED]', Text.success if passed else Text.danger)])
+    return passed
+
+
+def get_backends(device: torch.device, dtype: torch.dtype):
+    """
+    ### Backends to test
+    """
+    backends = ['chunked']
+    if is_sdpa_available():
+        backends.append('sdpa')
+    q = torch.zeros(1, 1, 1, 64, device=device, dtype=dtype)
+    if is_flash_supported(q, q, None, False, 0.):
+        backends.append('flash')
+
+    return backends
+
+
+def test_function(backend: str, *, q_seq_len: int, kv_seq_len: int, mask_type: str, is_causal: bool,
+                  batch_size: int = 2, heads: int = 4, d_k: int = 64,
+                  device: torch.device, dtype: torch.dtype, atol: float):
+    """
+    ### Compare a backend with einsum
+    """
+    torch.manual_seed(0)
+    q = torch.randn(batch_size, heads, q_seq_len, d_k, device=device, dtype=dtype, requires_grad=True)
+    k = torch.randn(batch_size, heads, kv_seq_len, d_k, device=device, dtype=dtype, requires_grad=True)
+    v = torch.randn(batch_size, heads, kv_seq_len, d_k, device=device, dtype=dtype, requires_grad=True)
+    d_out = torch.randn(batch_size, heads, q_seq_len, d_k, device=device, dtype=dtype)
+
+    if mask_type == 'bool':
+        # Random mask, keeping the diagonal so that every query has a visible key
+        mask = torch.rand(batch_size, 1, q_seq_len, kv_seq_len, device=device) > 0.3
+        mask[..., torch.arange(q_seq_len), torch.arange(kv_seq_len - q_seq_len, kv_seq_len)] = True
+    elif mask_type == 'bias':
+        mask = torch.randn(1, heads, q_seq_len, kv_seq_len, device=device, dtype=dtype)
+    elif mask_type == 'causal':
+        mask = torch.ones(q_seq_len, kv_seq_len, dtype=torch.bool, device=device).tril(kv_seq_len - q_seq_len)
+        mask = mask[None, None]
+    else:
+        mask = None
+
+    results = []
+    for b in ['einsum', backend]:
+        out = attention(q, k, v, mask, is_causal=is_causal, backend=b)
+        out.backward(d_out)
+        results.append((out.detach(), q.grad, k.grad, v.grad))
+        q.grad, k.grad, v.grad = None, None, None
+
+    name = f'{backend} {q_seq_len}x{kv_seq_len} mask={mask_type} causal={is_causal}'
+    return all([_check(f'{name} {n}', a, b, atol) for n, a, b in zip(['O', 'dQ', 'dK', 'dV'], *results)])
+
+
+def _create_modules(d_model: int, heads: int) -> List[Callable[[], nn.Module]]:
+    """
+    #### Attention modules with their inputs
+    """
+    from labml_nn.transformers.mha import MultiHeadAttention
+    from labml_nn.transformers.rope import RotaryPEMultiHeadAttention
+    from labml_nn.transformers.rope.value_pe import RotaryValuePEMultiHeadAttention
+    from labml_nn.transformers.alibi import AlibiMultiHeadAttention
+    from labml_nn.transformers.xl.relative_mha import RelativeMultiHeadAttention
+
+    return [
+        lambda: MultiHeadAttention(heads, d_model, dropout_prob=0.),
+        lambda: RotaryPEMultiHeadAttention(heads, d_model),
+        lambda: RotaryValuePEMultiHeadAttention(heads, d_model),
+        lambda: AlibiMultiHeadAttention(heads, d_model, dropout_prob=0.),
+        lambda: RelativeMultiHeadAttention(heads, d_model, dropout_prob=0.),
+    ]
+
+
+def test_modules(backends: List[str], *, seq_len: int = 50, batch_size: int = 2, d_model: int = 128,
+                 heads: int = 4, device: torch.device, atol: float):
+    """
+    ### Compare the outputs of the attention modules with each backend
+    """
+    passed = True
+    torch.manual_seed(0)
+    x = torch.randn(seq_len, batch_size, d_model, device=device)
+    mask = subsequent_mask(seq_len).to(device)
+
+    for create in _create_modules(d_model, heads):
+        module = create().to(device).eval()
+        # Relative attention has zero initialized positional parameters
+        with torch.no_grad():
+            for p in module.parameters():
+                p.normal_(std=0.1)
+
+        with use_backend('einsum'):
+            expected = module(query=x, key=x, value=x, mask=mask)
+        for backend in backends:
+            with use_backend(backend):
+                out = module(query=x, key=x, value=x, mask=mask)
+            passed = _check(f'{type(module).__name__} {backend}', out, expected, atol) and passed
+
+    # GPT-NeoX attention layer, with queries and keys of different lengths from the cache
+    from labml_nn.neox.model import AttentionLayer
+    from labml_nn.neox.utils.cache import get_cache
+    layer = AttentionLayer(d_model, heads).to(device).eval()
+    xb = x.transpose(0, 1)
+    for backend in backends:
+        outputs = []
+        for b in ['einsum', backend]:
+            layer.backend = b
+            get_cache().set('use_cache', True)
+            get_cache().set('state_ids', (None, 1))
+            out = [layer(xb[:, :seq_len - 8])]
+            get_cache().set('state_ids', (1, 2))
+            out.append(layer(xb[:, seq_len - 8:]))
+            get_cache().clear_all()
+            outputs.append(torch.cat(out, dim=1))
+        passed = _check(f'NeoX AttentionLayer {backend}', outputs[1], outputs[0], atol) and passed
+    layer.backend = None
+
+    # Stable Diffusion cross attention
+    from labml_nn.diffusion.stable_diffusion.model.unet_attention import CrossAttention
+    cond = torch.randn(batch_size, 7, 32, device=device)
+    xb = x.transpose(0, 1)
+    for c in [None, cond]:
+        # Self attention when `cond` is `None`
+        d_cond = d_model if c is None else cond.shape[-1]
+        cross = CrossAttention(d_model, d_cond, heads, d_model // heads).to(device).eval()
+        with use_backend('einsum'):
+            expected = cross(xb, c)
+        for backend in backends:
+            with use_backend(backend):
+                out = cross(xb, c)
+            passed = _check(f'CrossAttention {backend} cond={c is not None}', out, expected, atol) and passed
+
+    return passed
+
+
+def main():
+    device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
+    dtypes = [torch.float32]
+    if device.type == 'cuda':
+        dtypes.append(torch.float16)
+
+    passed = True
+    for dtype in dtypes:
+        atol = 1e-4 if dtype == torch.float32 else 1e-2
+        backends = get_backends(device, dtype)
+        with monit.section(f'Backends {dtype}'):
+            for backend in backends:
+                for q_seq_len, kv_seq_len in [(130, 130), (37, 130)]:
+                    for mask_type in ['none', 'causal', 'bool', 'bias']:
+                        for is_causal in [False, True]:
+                            # The flash kernel doesn't take masks
+                            if backend == 'flash' and (mask_type != 'none' or
+                                                       (is_causal and q_seq_len != kv_seq_len)):
+                                continue
+                            passed = test_function(backend, q_seq_len=q_seq_len, kv_seq_len=kv_seq_len,
+                                                   mask_type=mask_type, is_causal=is_causal,
+                                                   device=device, dtype=dtype, atol=atol) and passed
+
+    with monit.section('Modules'):
+        backends = [b for b in get_backends(device, torch.float32) if b != 'flash']
+        passed = test_modules(backends, device=device, atol=1e-4) and passed
+
+    if passed:
+        logger.log('[PASSED]', Text.success)
+    else:
+        logger.log('[FAILED]', Text.danger)
+
+
+#
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,371 @@
+"""
+---
+title: Benchmark attention and token mixing layers
+summary: >
+  Measure forward and backward time, peak memory and allocations of attention and token mixing layers on CPU,
+  and compare with a previous report.
+---
+
+# Benchmark attention and token mixing layers
+
+This measures the time of the forward and backward passes,
+the peak memory and the number of memory allocations of
+
+* [Multi-head attention](mha.html), with the selected [attention backend](attention_backend/index.html)
+  and with the einsum implementation
+* [Rotary positional embeddings](rope/index.html)
+* [ALiBi](alibi/index.html)
+* [AFT Local](aft/index.html)
+* [FNet mixing](fnet/index.html)
+* [gMLP block](gmlp/index.html)
+* [MLP-Mixer](mlp_mixer/index.html)
+* [Fast weights attention](fast_weights/index.html)
+
+for a sweep of batch sizes, numbers of heads and sequence lengths, on CPU.
+
+Each measurement runs in a separate process so that a case that runs out of memory
+or takes longer than `--timeout` doesn't stop the sweep.
+Time is the median of `--repeat` runs after a warmup.
+Peak memory and allocations are counted with the PyTorch profiler;
+the peak is the largest amount of tensor memory allocated during the forward and backward passes,
+above what was allocated before.
+
+The results are written to a JSON report.
+If a `--baseline` report is given, the results are compared with it, and
+cases that are slower or use more memory or allocations than the thresholds are reported as regressions.
+
+```bash
+python -m labml_nn.transformers.benchmark --layers mha rope --seq_len 1024 4096 16384
+python -m labml_nn.transformers.benchmark --baseline before.json
+```
+"""
+
+import argparse
+import json
+import multiprocessing
+import platform
+import statistics
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+from torch import nn
+
+from labml import logger, lab
+from labml.logger import Text
+
+# Thresholds of relative increase for a regression
+TIME_THRESHOLD = 0.15
+MEMORY_THRESHOLD = 0.05
+ALLOCATIONS_THRESHOLD = 0.05
+
+
+def _mha(heads: int, d_model: int, seq_len: int, backend: Optional[str] = None):
+    from labml_nn.transformers.mha import MultiHeadAttention
+    from labml_nn.transformers.utils import subsequent_mask
+    module = MultiHeadAttention(heads, d_model, dropout_prob=0.)
+    module.backend = backend
+    mask = subsequent_mask(seq_len)
+    return module, lambda x: module(query=x, key=x, value=x, mask=mask)
+
+
+def _mha_einsum(heads: int, d_model: int, seq_len: int):
+    return _mha(heads, d_model, seq_len, 'einsum')
+
+
+def _rope(heads: int, d_model: int, seq_len: int):
+    from labml_nn.transformers.rope import RotaryPEMultiHeadAttention
+    from labml_nn.transformers.utils import subsequent_mask
+    module = RotaryPEMultiHeadAttention(heads, d_model)
+    mask = subsequent_mask(seq_len)
+    return module, lambda x: module(query=x, key=x, value=x, mask=mask)
+
+
+def _alibi(heads: int, d_model: int, seq_len: int):
+    from labml_nn.transformers.alibi import AlibiMultiHeadAttention
+    from labml_nn.transformers.utils import subsequent_mask
+    module = AlibiMultiHeadAttention(heads, d_model, dropout_prob=0.)
+    mask = subsequent_mask(seq_len)
+    return module, lambda x: module(query=x, key=x, value=x, mask=mask)
+
+
+def _aft_local(heads: int, d_model: int, seq_len: int):
+    from labml_nn.transformers.aft import AFTLocal
+    from labml_nn.transformers.utils import subsequent_mask
+    module = AFTLocal(d_model, seq_len, local_window_size=128)
+    mask = subsequent_mask(seq_len)
+    return module, lambda x: module(query=x, key=x, value=x, mask=mask)
+
+
+def _fnet(heads: int, d_model: int, seq_len: int):
+    from labml_nn.transformers.fnet import FNetMix
+    module = FNetMix()
+    return module, lambda x: module(query=x, key=x, value=x)
+
+
+def _gmlp(heads: int, d_model: int, seq_len: int):
+    from labml_nn.transformers.gmlp import GMLPBlock
+    module = GMLPBlock(d_model, d_model * 4, seq_len)
+    return module, lambda x: module(x=x)
+
+
+def _mlp_mixer(heads: int, d_model: int, seq_len: int):
+    from labml_nn.transformers.feed_forward import FeedForward
+    from labml_nn.transformers.mlp_mixer import MLPMixer
+    module = MLPMixer(FeedForward(seq_len, seq_len, dropout=0.))
+    return module, lambda x: module(query=x, key=x, value=x)
+
+
+def _fast_weights(heads: int, d_model: int, seq_len: int):
+    from labml_nn.transformers.fast_weights import FastWeightsAttention, DPFP
+    module = FastWeightsAttention(heads, d_model, 0., DPFP())
+    return module, lambda x: module(x)
+
+
+# Layers to benchmark; a function that takes `heads`, `d_model` and `seq_len` and returns
+# the module and a function that runs it on an input of shape `[seq_len, batch_size, d_model]`,
+# and whether the layer has heads
+LAYERS: Dict[str, Tuple[Callable[[int, int, int], Tuple[nn.Module, Callable]], bool]] = {
+    'mha': (_mha, True),
+    'mha_einsum': (_mha_einsum, True),
+    'rope': (_rope, True),
+    'alibi': (_alibi, True),
+    'aft_local': (_aft_local, False),
+    'fnet': (_fnet, False),
+    'gmlp': (_gmlp, False),
+    'mlp_mixer': (_mlp_mixer, False),
+    'fast_weights': (_fast_weights, True),
+}
+
+
+def profile_memory(fn: Callable[[], None]):
+    """
+    ### Measure peak memory and allocations with the profiler
+
+    :return: the peak tensor memory allocated in bytes, the number of allocations
+     and the total bytes allocated
+    """
+    from torch.profiler import profile, ProfilerActivity
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+
+    # Memory events in the order they happened
+    events = sorted((e for e in prof.events() if e.name == '[memory]'), key=lambda e: e.time_range.start)
+
+    current, peak, n_allocations, allocated = 0, 0, 0, 0
+    for e in events:
+        current += e.cpu_memory_usage
+        peak = max(peak, current)
+        if e.cpu_memory_usage > 0:
+            n_allocations += 1
+            allocated += e.cpu_memory_usage
+
+    return peak, n_allocations, allocated
+
+
+def measure(layer: str, batch_size: int, heads: int, seq_len: int, d_model: int, *,
+            n_repeat: int = 5, n_warmup: int = 1, n_threads: Optional[int] = None):
+    """
+    ## Measure a layer
+    """
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+    torch.manual_seed(0)
+
+    create, _ = LAYERS[layer]
+    module, run = create(heads, d_model, seq_len)
+    x = torch.randn(seq_len, batch_size, d_model, requires_grad=True)
+
+    def forward():
+        return run(x)
+
+    def forward_backward():
+        out = run(x)
+        out.sum().backward()
+        module.zero_grad(set_to_none=True)
+        x.grad = None
+
+    res = {}
+    for name, fn in [('forward', forward), ('forward_backward', forward_backward)]:
+        # Warmup
+        for _ in range(n_warmup):
+            fn()
+        # Time
+        times = []
+        for _ in range(n_repeat):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        res[f'{name}_time'] = statistics.median(times)
+
+    # Memory of the forward and backward passes
+    peak, n_allocations, allocated = profile_memory(forward_backward)
+    res['peak_memory'] = peak
+    res['allocations'] = n_allocations
+    res['allocated_memory'] = allocated
+
+    return res
+
+
+def _measure_process(queue: multiprocessing.Queue, args: tuple, kwargs: dict):
+    try:
+        queue.put(('ok', measure(*args, **kwargs)))
+    except Exception as e:
+        queue.put(('failed', f'{type(e).__name__}: {e}'))
+
+
+def measure_in_process(layer: str, batch_size: int, heads: int, seq_len: int, d_model: int, *,
+                       timeout: float, **kwargs):
+    """
+    ### Measure in a separate process
+
+    :return: the status (`ok`, `failed` or `timeout`) and the results or the error
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    p = ctx.Process(target=_measure_process, args=(queue, (layer, batch_size, heads, seq_len, d_model), kwargs))
+    p.start()
+    p.join(timeout)
+    if p.is_alive():
+        p.terminate()
+        p.join()
+        return 'timeout', None
+    if queue.empty():
+        # The process was killed; usually because it ran out of memory
+        return 'failed', f'exit code {p.exitcode}'
+
+    return queue.get()
+
+
+def case_key(layer: str, batch_size: int, heads: Optional[int], seq_len: int):
+    """
+    #### Key of a case in the report
+    """
+    return f'{layer}/b{batch_size}/h{heads if heads is not None else "-"}/n{seq_len}'
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], *,
+            time_threshold: float = TIME_THRESHOLD,
+            memory_threshold: float = MEMORY_THRESHOLD,
+            allocations_threshold: float = ALLOCATIONS_THRESHOLD) -> List[str]:
+    """
+    ## Compare results with a baseline
+
+    :return: a list of regressions
+    """
+    thresholds = {
+        'forward_time': time_threshold,
+        'forward_backward_time': time_threshold,
+        'peak_memory': memory_threshold,
+        'allocations': allocations_threshold,
+    }
+
+    regressions = []
+    for key, res in results.items():
+        base = baseline.get(key)
+        if base is None or base['status'] != 'ok':
+            continue
+        if res['status'] != 'ok':
+            regressions.append(f'{key} {res["status"]}')
+            continue
+        for metric, threshold in thresholds.items():
+            if res[metric] > base[metric] * (1 + threshold):
+                regressions.append(f'{key} {metric} {base[metric]} -> {res[metric]}')
+
+    return regressions
+
+
+def _log_result(key: str, res: dict):
+    if res['status'] != 'ok':
+        logger.log([(f'{key :<32}', Text.key), (f' {res["status"]} {res.get("error", "")}', Text.danger)])
+        return
+
+    logger.log([(f'{key :<32}', Text.key),
+                ' forward ', (f'{res["forward_time"] * 1000 :10.2f}ms', Text.value),
+                ' forward+backward ', (f'{res["forward_backward_time"] * 1000 :10.2f}ms', Text.value),
+                ' peak ', (f'{res["peak_memory"] / 2 ** 20 :10.1f}MB', Text.value),
+                ' allocations ', (f'{res["allocations"] :8,}', Text.value)])
+
+
+def main():
+    # Argument parser
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--layers", type=str, nargs='+', default=list(LAYERS.keys()), choices=list(LAYERS.keys()),
+                        help="layers to benchmark")
+    parser.add_argument("--batch_size", type=int, nargs='+', default=[1, 4], help="batch sizes")
+    parser.add_argument("--heads", type=int, nargs='+', default=[4, 8], help="numbers of heads")
+    parser.add_argument("--seq_len", type=int, nargs='+', default=[512, 1024, 2048, 4096, 8192, 16384],
+                        help="sequence lengths")
+    parser.add_argument("--d_model", type=int, default=256, help="number of features in embeddings")
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed runs")
+    parser.add_argument("--threads", type=int, default=None, help="number of CPU threads")
+    parser.add_argument("--timeout", type=float, default=600., help="timeout for a case in seconds")
+    parser.add_argument("--output", type=str, default=None, help="path of the report")
+    parser.add_argument("--baseline", type=str, default=None, help="path of a report to compare with")
+    parser.add_argument("--time_threshold", type=float, default=TIME_THRESHOLD,
+                        help="relative increase of time for a regression")
+    parser.add_argument("--memory_threshold", type=float, default=MEMORY_THRESHOLD,
+                        help="relative increase of peak memory for a regression")
+    parser.add_argument("--allocations_threshold", type=float, default=ALLOCATIONS_THRESHOLD,
+                        help="relative increase of allocations for a regression")
+
+    opt = parser.parse_args()
+
+    results = {}
+    for layer in opt.layers:
+        _, has_heads = LAYERS[layer]
+        # Layers without heads are measured once for each batch size and sequence length
+        for heads in (opt.heads if has_heads else [None]):
+            for batch_size in opt.batch_size:
+                for seq_len in opt.seq_len:
+                    key = case_key(layer, batch_size, heads, seq_len)
+                    status, res = measure_in_process(layer, batch_size, heads or opt.heads[0], seq_len, opt.d_model,
+                                                     timeout=opt.timeout, n_repeat=opt.repeat,
+                                                     n_threads=opt.threads)
+                    if status == 'ok':
+                        results[key] = {'status': status, **res}
+                    else:
+                        results[key] = {'status': status, 'error': res}
+                    _log_result(key, results[key])
+
+    report = {
+        'environment': {
+            'torch': torch.__version__,
+            'threads': opt.threads or torch.get_num_threads(),
+            'processor': platform.processor(),
+            'platform': platform.platform(),
+        },
+        'd_model': opt.d_model,
+        'results': results,
+    }
+
+    # Write the report
+    output = Path(opt.output) if opt.output else lab.get_data_path() / 'benchmarks' / 'transformers.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(str(output), 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.log([('Report ', Text.meta), (str(output), Text.value)])
+
+    # Compare with the baseline
+    if opt.baseline:
+        with open(opt.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline['environment'] != report['environment'] or baseline['d_model'] != report['d_model']:
+            logger.log('The baseline was measured on a different environment or configuration', Text.warning)
+        regressions = compare(results, baseline['results'],
+                              time_threshold=opt.time_threshold,
+                              memory_threshold=opt.memory_threshold,
+                              allocations_threshold=opt.allocations_threshold)
+        for r in regressions:
+            logger.log([('Regression ', Text.danger), r])
+        if regressions:
+            raise SystemExit(1)
+        logger.log('No regressions', Text.success)
+
+
+#
+if __name__ == '__main__':
+    main()
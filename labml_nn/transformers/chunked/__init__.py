@@ -0,0 +1,370 @@
+r"""
+---
+title: Chunked Memory-Efficient Attention
+summary: >
+  A pure PyTorch implementation of memory-efficient attention that computes attention
+  in blocks of queries and keys with online softmax, and recomputes attention in the backward pass.
+---
+
+# Chunked Memory-Efficient Attention
+
+[Multi-head attention](../mha.html) computes the full attention score matrix
+of shape `[seq_len, seq_len, batch_size, heads]` and keeps the attention probabilities
+for the backward pass.
+So memory grows quadratically with the sequence length, and long contexts run out of memory.
+
+[Flash attention](../flash/index.html) avoids this, but it's a Triton kernel that only runs on GPUs.
+This is a pure PyTorch implementation of the same algorithm that runs on any device.
+
+It splits the queries into blocks of `q_block` and the keys and values into blocks of `k_block`.
+For each block of queries it iterates over the blocks of keys and maintains
+the running max of scores $m_i$, the running sum of exponents $l_i$ and the unnormalized output $\tilde{O}_i$,
+rescaling them whenever the max changes
+(see the [flash attention forward pass](../flash/index.html#forward-pass)).
+
+Only $O$ and $\log L_i$ are saved for the backward pass,
+which [recomputes](../flash/index.html#backward-pass) the attention probabilities block by block.
+
+So the memory for the scores is $O(q_{block} \cdot k_{block})$ per batch and head,
+instead of $O(N^2)$, and the saved memory is $O(N)$.
+Blocks of keys that are entirely masked by the causal mask are skipped.
+
+Dropout on attention probabilities is supported by seeding a generator for each block,
+so that the backward pass regenerates the same dropout masks.
+
+Here's [the test](test.html) that compares this with [multi-head attention](../mha.html)
+and measures the memory.
+"""
+
+import math
+from typing import Any, Optional, Tuple
+
+import torch
+
+from labml_nn.transformers.mask_cache import mask_cache
+from labml_nn.transformers.mha import MultiHeadAttention
+
+# Precision of scores, softmax statistics and accumulators
+HI_PRES_TORCH: torch.dtype = torch.float32
+
+
+def _key_blocks(q_start: int, q_end: int, kv_seq_len: int, k_block: int, is_causal: bool, shift: int):
+    r"""
+    #### Ranges of key blocks for a block of queries
+
+    With a causal mask, query $i$ attends to keys $j \le i + shift$,
+    so key blocks after the last query's keys are skipped.
+    """
+    end = kv_seq_len
+    if is_causal:
+        end = min(end, max(0, q_end + shift))
+    for k_start in range(0, end, k_block):
+        yield k_start, min(k_start + k_block, end)
+
+
+def _scores(q: torch.Tensor, k: torch.Tensor, mask: Optional[torch.Tensor], is_causal: bool, scale: float,
+            q_start: int, q_end: int, k_start: int, k_end: int, shift: int):
+    """
+    #### Masked scores of a block of queries and a block of keys
+
+    `q` has shape `[batch_size, heads, q_end - q_start, d_k]` and
+    `k` has shape `[batch_size, heads, k_end - k_start, d_k]`.
+    """
+    # $S_{ij} = \sigma Q_i K_j^\top$
+    s = torch.matmul(q, k.transpose(-2, -1)) * scale
+
+    # Apply the mask
+    if mask is not None:
+        # Dimensions of size $1$ are broadcast
+        if mask.shape[-2] != 1:
+            mask = mask[..., q_start:q_end, :]
+        if mask.shape[-1] != 1:
+            mask = mask[..., k_start:k_end]
+        if mask.dtype == torch.bool:
+            s = s.masked_fill(~mask, float('-inf'))
+        else:
+            s = s + mask
+
+    # Apply the causal mask if the block is not entirely visible
+    if is_causal and k_end - 1 > q_start + shift:
+        q_pos = torch.arange(q_start, q_end, device=s.device)
+        k_pos = torch.arange(k_start, k_end, device=s.device)
+        s = s.masked_fill(k_pos[None, :] > q_pos[:, None] + shift, float('-inf'))
+
+    return s
+
+
+def _dropout_scale(seed: int, q_start: int, k_start: int, kv_seq_len: int, shape: torch.Size, dropout_prob: float,
+                   device: torch.device):
+    r"""
+    #### Dropout mask of a block, scaled by $\frac{1}{1 - p}$
+
+    The generator is seeded by the position of the block,
+    so that the backward pass gets the same mask.
+    """
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed + q_start * (kv_seq_len + 1) + k_start)
+    keep = torch.rand(shape, generator=generator, device=device, dtype=HI_PRES_TORCH) >= dropout_prob
+
+    return keep.to(HI_PRES_TORCH) / (1. - dropout_prob)
+
+
+class ChunkedAttentionFunc(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx: Any,
+                q: torch.Tensor, k: torch.Tensor, v: torch.Tensor,
+                mask: Optional[torch.Tensor], is_causal: bool, scale: float, dropout_prob: float,
+                q_block: int, k_block: int) -> torch.Tensor:
+        r"""
+        ### Forward pass
+
+        Returns the output in shape `[batch_size, heads, q_seq_len, d_k]`.
+
+        :param ctx: is the context for torch gradient descent
+        :param q: has shape `[batch_size, heads, q_seq_len, d_k]`
+        :param k: has shape `[batch_size, heads, kv_seq_len, d_k]`
+        :param v: has shape `[batch_size, heads, kv_seq_len, d_k]`
+        :param mask: is a boolean mask (`True` for keys that are attended to)
+         or a bias added to the scores, broadcastable to `[batch_size, heads, q_seq_len, kv_seq_len]`
+        :param is_causal: whether to apply a causal mask
+        :param scale: is the softmax scale factor $\sigma$
+        :param dropout_prob: is the dropout probability of attention probabilities
+        :param q_block: is the number of queries in a block
+        :param k_block: is the number of keys in a block
+        """
+        batch_size, heads, q_seq_len, d_k = q.shape
+        kv_seq_len = k.shape[2]
+        # Queries are aligned with the last keys; i.e. query $i$ is at position $i + shift$
+        shift = kv_seq_len - q_seq_len
+        # Seed for dropout masks
+        seed = int(torch.randint(0, 2 ** 62, ())) if dropout_prob > 0. else 0
+
+        # Compute in high precision
+        q_hp, k_hp, v_hp = q.to(HI_PRES_TORCH), k.to(HI_PRES_TORCH), v.to(HI_PRES_TORCH)
+
+        # Tensor for the output
+        o = torch.empty((batch_size, heads, q_seq_len, d_k), dtype=HI_PRES_TORCH, device=q.device)
+        # Tensor for log of sum of exponentials $\log L_i = \log \sum_j e^{S_{ij}}$
+        lse = torch.empty((batch_size, heads, q_seq_len), dtype=HI_PRES_TORCH, device=q.device)
+
+        for q_start in range(0, q_seq_len, q_block):
+            q_end = min(q_start + q_block, q_seq_len)
+            q_b = q_hp[:, :, q_start:q_end]
+
+            # $m_i$, $l_i$ and $\tilde{O}_i$ for the block of queries
+            m = torch.full(q_b.shape[:-1], float('-inf'), dtype=HI_PRES_TORCH, device=q.device)
+            l = torch.zeros_like(m)
+            o_b = torch.zeros_like(q_b)
+
+            for k_start, k_end in _key_blocks(q_start, q_end, kv_seq_len, k_block, is_causal, shift):
+                s = _scores(q_b, k_hp[:, :, k_start:k_end], mask, is_causal, scale,
+                            q_start, q_end, k_start, k_end, shift)
+
+                # $m_i^{\text{new}} = \max(m_i, \max_j S_{ij})$
+                m_new = torch.maximum(m, s.amax(dim=-1))
+                # Use $0$ for rows without any visible keys so far, to avoid $-\infty - (-\infty)$
+                m_safe = m_new.masked_fill(m_new == float('-inf'), 0.)
+                # $\tilde{P}_{ij} = \exp(S_{ij} - m_i^{\text{new}})$
+                p = torch.exp(s - m_safe[..., None])
+                # $e^{m_i - m_{i}^{\text{new}}}$
+                alpha = torch.exp(m - m_safe)
+
+                # $l_i \leftarrow e^{m_i - m_{i}^{\text{new}}} l_i + \sum_j \tilde{P}_{ij}$
+                l = alpha * l + p.sum(dim=-1)
+                # Dropout
+                if dropout_prob > 0.:
+                    p = p * _dropout_scale(seed, q_start, k_start, kv_seq_len, p.shape, dropout_prob, q.device)
+                # $\tilde{O}_i \leftarrow e^{m_i - m_{i}^{\text{new}}} \tilde{O}_i + \tilde{P}_{ij} V_j$
+                o_b = alpha[..., None] * o_b + torch.matmul(p, v_hp[:, :, k_start:k_end])
+                m = m_new
+
+            # $O_i = \frac{\tilde{O}_i}{l_i}$
+            o[:, :, q_start:q_end] = o_b / l[..., None]
+            # $\log L_i = m_i + \log l_i$
+            lse[:, :, q_start:q_end] = m + torch.log(l)
+
+        o = o.to(q.dtype)
+
+        # Save the inputs, outputs and $\log L_i$ for the backward pass
+        ctx.save_for_backward(q, k, v, o, lse, mask)
+        ctx.is_causal = is_causal
+        ctx.scale = scale
+        ctx.dropout_prob = dropout_prob
+        ctx.seed = seed
+        ctx.q_block = q_block
+        ctx.k_block = k_block
+
+        return o
+
+    @staticmethod
+    def backward(ctx: Any, do: torch.Tensor) -> Tuple[Optional[torch.Tensor], ...]:
+        r"""
+        ### Backward pass
+
+        This recomputes the attention probabilities block by block from $\log L_i$.
+
+        :param ctx: is the context for torch gradient descent
+        :param do: is the gradient tensor of the attention output with shape `[batch_size, heads, q_seq_len, d_k]`
+        """
+        # Get saved tensors and attributes
+        q, k, v, o, lse, mask = ctx.saved_tensors
+        is_causal, scale, dropout_prob = ctx.is_causal, ctx.scale, ctx.dropout_prob
+
+        q_seq_len = q.shape[2]
+        kv_seq_len = k.shape[2]
+        shift = kv_seq_len - q_seq_len
+
+        # Compute in high precision
+        q_hp, k_hp, v_hp = q.to(HI_PRES_TORCH), k.to(HI_PRES_TORCH), v.to(HI_PRES_TORCH)
+        do = do.to(HI_PRES_TORCH)
+
+        # $D_i = dO_i O_i^\top$
+        pdp = (do * o.to(HI_PRES_TORCH)).sum(dim=-1)
+
+        # Tensors for input gradients
+        dq = torch.zeros_like(q_hp)
+        dk = torch.zeros_like(k_hp)
+        dv = torch.zeros_like(v_hp)
+
+        for q_start in range(0, q_seq_len, ctx.q_block):
+            q_end = min(q_start + ctx.q_block, q_seq_len)
+            q_b = q_hp[:, :, q_start:q_end]
+            do_b = do[:, :, q_start:q_end]
+
+            for k_start, k_end in _key_blocks(q_start, q_end, kv_seq_len, ctx.k_block, is_causal, shift):
+                k_b = k_hp[:, :, k_start:k_end]
+                v_b = v_hp[:, :, k_start:k_end]
+
+                # Recompute $P_{ij} = \exp(S_{ij} - \log L_i)$
+                s = _scores(q_b, k_b, mask, is_causal, scale, q_start, q_end, k_start, k_end, shift)
+                p = torch.exp(s - lse[:, :, q_start:q_end, None])
+
+                # $dP_{ij} = dO_i V_j^\top$
+                dp = torch.matmul(do_b, v_b.transpose(-2, -1))
+                if dropout_prob > 0.:
+                    drop = _dropout_scale(ctx.seed, q_start, k_start, kv_seq_len, p.shape, dropout_prob, q.device)
+                    # $dV_j \mathrel{+}= \sum_i \text{dropout}(P_{ij}) dO_i$
+                    dv[:, :, k_start:k_end] += torch.matmul((p * drop).transpose(-2, -1), do_b)
+                    dp = dp * drop
+                else:
+                    # $dV_j \mathrel{+}= \sum_i P_{ij} dO_i$
+                    dv[:, :, k_start:k_end] += torch.matmul(p.transpose(-2, -1), do_b)
+
+                # $dS_{ij} = P_{ij} dP_{ij} - D_i P_{ij}$, with the scale $\sigma$
+                ds = p * (dp - pdp[:, :, q_start:q_end, None]) * scale
+
+                # $dQ_i \mathrel{+}= \sigma \sum_j dS_{ij} K_j$
+                dq[:, :, q_start:q_end] += torch.matmul(ds, k_b)
+                # $dK_j \mathrel{+}= \sigma \sum_i dS_{ij} Q_i$
+                dk[:, :, k_start:k_end] += torch.matmul(ds.transpose(-2, -1), q_b)
+
+        #
+        return dq.to(q.dtype), dk.to(k.dtype), dv.to(v.dtype), None, None, None, None, None, None
+
+
+def chunked_attention(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, mask: Optional[torch.Tensor] = None, *,
+                      is_causal: bool = False, scale: Optional[float] = None, dropout_prob: float = 0.,
+                      q_block: int = 512, k_block: int = 512):
+    r"""
+    ## Chunked attention
+
+    :param q: has shape `[batch_size, heads, q_seq_len, d_k]`
+    :param k: has shape `[batch_size, heads, kv_seq_len, d_k]`
+    :param v: has shape `[batch_size, heads, kv_seq_len, d_k]`
+    :param mask: is a boolean mask (`True` for keys that are attended to)
+     or a bias added to the scores, broadcastable to `[batch_size, heads, q_seq_len, kv_seq_len]`.
+     The bias doesn't get gradients.
+    :param is_causal: whether to apply a causal mask.
+     When `q_seq_len < kv_seq_len` the queries are the last `q_seq_len` positions,
+     as in [incremental decoding](../mha.html#incremental).
+    :param scale: is the softmax scale factor $\sigma$; defaults to $\frac{1}{\sqrt{d_k}}$
+    :param dropout_prob: is the dropout probability of attention probabilities
+    :param q_block: is the number of queries in a block
+    :param k_block: is the number of keys in a block
+    """
+    if scale is None:
+        scale = 1 / math.sqrt(q.shape[-1])
+    if mask is not None:
+        assert mask.dim() == 4, 'Mask should be broadcastable to `[batch_size, heads, q_seq_len, kv_seq_len]`'
+
+    return ChunkedAttentionFunc.apply(q, k, v, mask, is_causal, scale, dropout_prob, q_block, k_block)
+
+
+class ChunkedMultiHeadAttention(MultiHeadAttention):
+    """
+    <a id="ChunkedMHA"></a>
+
+    ## Chunked Multi-Head Attention
+
+    This is a drop-in replacement for [multi-head attention](../mha.html#MHA)
+    that computes attention with [`chunked_attention`](#chunked_attention).
+
+    Since attention probabilities are never materialized, `self.attn` is not set.
+    """
+
+    def __init__(self, heads: int, d_model: int, dropout_prob: float = 0.1, bias: bool = True, *,
+                 is_causal: bool = False, q_block: int = 512, k_block: int = 512):
+        """
+        * `heads` is the number of heads.
+        * `d_model` is the number of features in the `query`, `key` and `value` vectors.
+        * `is_causal` is whether to apply a causal mask, in addition to the `mask` passed to `forward`.
+          This avoids creating a mask of shape `[seq_len, seq_len]`.
+          A `mask` that is a view of the [cached causal mask](../mask_cache.html) is also applied this way,
+          without reading it.
+        * `q_block` and `k_block` are the numbers of queries and keys in a block.
+        """
+        super().__init__(heads, d_model, dropout_prob, bias)
+        self.is_causal = is_causal
+        self.q_block = q_block
+        self.k_block = k_block
+
+    def forward(self, *,
+                query: torch.Tensor,
+                key: torch.Tensor,
+                value: torch.Tensor,
+                mask: Optional[torch.Tensor] = None):
+        """
+        `query`, `key` and `value` have shape `[seq_len, batch_size, d_model]`,
+        and `mask` has shape `[seq_len, seq_len, batch_size]`.
+        """
+        # `query`, `key` and `value`  have shape `[seq_len, batch_size, d_model]`
+        seq_len, batch_size, _ = query.shape
+        is_cached = self.is_incremental and query is key
+
+        # Prepare `query`, `key` and `value` for attention computation.
+        # These will then have shape `[seq_len, batch_size, heads, d_k]`.
+        query = self.query(query)
+        key = self.key(key)
+        value = self.value(value)
+
+        # Add the cached keys and values in [incremental decoding](../mha.html#incremental)
+        if is_cached:
+            key, value, mask = self.update_kv_cache(key, value, mask)
+
+        is_causal = self.is_causal
+        # Skip the dense mask if it's a view of the [cached causal mask](../mask_cache.html)
+        # (e.g. from `subsequent_mask`), and apply the causal mask while computing the blocks.
+        # This only checks the storage and strides of the mask.
+        if mask is not None and mask.shape[-1] == 1 and \
+                mask_cache.is_causal_view(mask[:, :, 0], query.shape[0], key.shape[0]):
+            mask, is_causal = None, True
+
+        if mask is not None:
+            # Change the mask of shape `[seq_len_q, seq_len_k, batch_size, 1]`
+            # to `[batch_size, 1, seq_len_q, seq_len_k]`
+            mask = self.prepare_mask(mask, query.shape, key.shape).permute(2, 3, 0, 1).to(torch.bool)
+
+        # Attention with tensors of shape `[batch_size, heads, seq_len, d_k]`
+        x = chunked_attention(query.permute(1, 2, 0, 3), key.permute(1, 2, 0, 3), value.permute(1, 2, 0, 3),
+                              mask,
+                              is_causal=is_causal,
+                              scale=self.scale,
+                              dropout_prob=self.dropout.p if self.training else 0.,
+                              q_block=self.q_block,
+                              k_block=self.k_block)
+
+        # Concatenate multiple heads
+        x = x.permute(2, 0, 1, 3).reshape(seq_len, batch_size, -1)
+
+        # Output layer
+        return self.output(x)
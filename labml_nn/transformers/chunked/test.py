@@ -0,0 +1,182 @@
+"""
+---
+title: Test Chunked Memory-Efficient Attention
+summary: >
+  Compare chunked attention with multi-head attention and measure memory
+---
+
+# Test Chunked Memory-Efficient Attention
+
+This compares the outputs and gradients of [chunked attention](index.html)
+with [multi-head attention](../mha.html), with causal, arbitrary and no masks,
+and measures the memory saved for the backward pass and the time.
+"""
+
+import time
+
+import torch
+
+from labml import logger, monit
+from labml.logger import Text
+from labml_nn.transformers.chunked import ChunkedMultiHeadAttention, chunked_attention
+from labml_nn.transformers.mha import MultiHeadAttention
+from labml_nn.transformers.utils import subsequent_mask
+
+
+def _reference(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, mask, is_causal: bool, scale: float):
+    """
+    #### Attention that computes the full score matrix
+    """
+    s = torch.matmul(q, k.transpose(-2, -1)) * scale
+    if mask is not None:
+        s = s.masked_fill(~mask, float('-inf'))
+    if is_causal:
+        q_seq_len, kv_seq_len = q.shape[2], k.shape[2]
+        causal = torch.ones(q_seq_len, kv_seq_len, dtype=torch.bool).tril(kv_seq_len - q_seq_len)
+        s = s.masked_fill(~causal, float('-inf'))
+    return torch.matmul(torch.softmax(s, dim=-1), v)
+
+
+def _check(name: str, a: torch.Tensor, b: torch.Tensor, atol: float = 1e-4):
+    diff = (a - b).abs().max().item()
+    passed = diff <= atol
+    logger.log([(f'{name :<32}', Text.key), (f'{diff :.2e}', Text.value),
+                (' [PASSED]' if passed else ' [FAILED]', Text.success if passed else Text.danger)])
+    return passed
+
+
+def test_function(batch_size: int, heads: int, q_seq_len: int, kv_seq_len: int, d_k: int, *,
+                  is_causal: bool, is_masked: bool, q_block: int = 64, k_block: int = 48):
+    """
+    ### Compare outputs and gradients with the reference
+    """
+    torch.manual_seed(0)
+    q = torch.randn(batch_size, heads, q_seq_len, d_k, requires_grad=True)
+    k = torch.randn(batch_size, heads, kv_seq_len, d_k, requires_grad=True)
+    v = torch.randn(batch_size, heads, kv_seq_len, d_k, requires_grad=True)
+    d_out = torch.randn(batch_size, heads, q_seq_len, d_k)
+    scale = d_k ** -0.5
+
+    mask = None
+    if is_masked:
+        # Random mask, keeping the diagonal so that every query has a visible key
+        mask = torch.rand(batch_size, 1, q_seq_len, kv_seq_len) > 0.3
+        mask[..., torch.arange(q_seq_len), torch.arange(kv_seq_len - q_seq_len, kv_seq_len)] = True
+
+    grads = []
+    for fn in [lambda: _reference(q, k, v, mask, is_causal, scale),
+               lambda: chunked_attention(q, k, v, mask, is_causal=is_causal, scale=scale,
+                                         q_block=q_block, k_block=k_block)]:
+        out = fn()
+        out.backward(d_out)
+        grads.append((out.detach(), q.grad, k.grad, v.grad))
+        q.grad, k.grad, v.grad = None, None, None
+
+    name = f'{q_seq_len}x{kv_seq_len} causal={is_causal} masked={is_masked}'
+    with monit.section(name):
+        passed = all([_check(f'{n}', a, b) for n, a, b in zip(['O', 'dQ', 'dK', 'dV'], *grads)])
+
+    return passed
+
+
+def test_module(seq_len: int = 100, batch_size: int = 3, heads: int = 4, d_model: int = 64):
+    """
+    ### Compare with multi-head attention, including incremental decoding
+    """
+    torch.manual_seed(0)
+    mha = MultiHeadAttention(heads, d_model, dropout_prob=0.)
+    chunked = ChunkedMultiHeadAttention(heads, d_model, dropout_prob=0., q_block=32, k_block=32)
+    chunked.load_state_dict(mha.state_dict())
+
+    x = torch.randn(seq_len, batch_size, d_model)
+    mask = subsequent_mask(seq_len)
+    expected = mha(query=x, key=x, value=x, mask=mask)
+
+    passed = _check('module', chunked(query=x, key=x, value=x, mask=mask), expected)
+
+    # Causal without a mask
+    chunked.is_causal = True
+    passed = _check('module is_causal', chunked(query=x, key=x, value=x), expected) and passed
+
+    # Incremental decoding, a few tokens at a time
+    chunked.set_incremental(True)
+    outputs = []
+    for i in range(0, seq_len, 7):
+        xi = x[i:i + 7]
+        outputs.append(chunked(query=xi, key=xi, value=xi))
+    chunked.set_incremental(False)
+    passed = _check('module incremental', torch.cat(outputs), expected) and passed
+
+    return passed
+
+
+def test_dropout(seq_len: int = 64, d_k: int = 16, dropout_prob: float = 0.5):
+    """
+    ### Check that gradients with dropout match finite differences of the same dropout masks
+    """
+    torch.manual_seed(0)
+    q = torch.randn(1, 1, seq_len, d_k, dtype=torch.double, requires_grad=True)
+    k = torch.randn(1, 1, seq_len, d_k, dtype=torch.double, requires_grad=True)
+    v = torch.randn(1, 1, seq_len, d_k, dtype=torch.double, requires_grad=True)
+
+    def fn(q_, k_, v_):
+        # Same seed for every call so that the dropout masks are the same
+        torch.manual_seed(1)
+        return chunked_attention(q_, k_, v_, is_causal=True, dropout_prob=dropout_prob, q_block=16, k_block=16)
+
+    # Gradients are computed in `float32`
+    passed = torch.autograd.gradcheck(fn, (q, k, v), eps=1e-3, atol=1e-2, rtol=1e-2)
+    logger.log([(f'{"dropout gradients" :<32}', Text.key),
+                (' [PASSED]' if passed else ' [FAILED]', Text.success if passed else Text.danger)])
+
+    return passed
+
+
+def measure(seq_len: int, *, batch_size: int = 1, heads: int = 8, d_k: int = 64, block: int = 512):
+    """
+    ### Measure memory saved for backward, and time of the forward and backward passes
+    """
+    q, k, v = [torch.randn(batch_size, heads, seq_len, d_k, requires_grad=True) for _ in range(3)]
+    scale = d_k ** -0.5
+
+    for name, fn in [('full', lambda: _reference(q, k, v, None, True, scale)),
+                     ('chunked', lambda: chunked_attention(q, k, v, is_causal=True, scale=scale,
+                                                           q_block=block, k_block=block))]:
+        saved = {}
+
+        def pack(t: torch.Tensor):
+            saved[t.data_ptr()] = t.numel() * t.element_size()
+            return t
+
+        start = time.perf_counter()
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            out = fn()
+        out.sum().backward()
+        elapsed = time.perf_counter() - start
+
+        logger.log([(f'{seq_len :6d} {name :<8}', Text.key),
+                    ' saved ', (f'{sum(saved.values()) / 2 ** 20 :10.1f}MB', Text.value),
+                    ' forward and backward ', (f'{elapsed * 1000 :10.1f}ms', Text.value)])
+
+
+def main():
+    passed = True
+    for is_causal in [False, True]:
+        for is_masked in [False, True]:
+            passed = test_function(2, 3, 130, 130, 32, is_causal=is_causal, is_masked=is_masked) and passed
+            passed = test_function(2, 3, 37, 130, 32, is_causal=is_causal, is_masked=is_masked) and passed
+    passed = test_module() and passed
+    passed = test_dropout() and passed
+
+    if passed:
+        logger.log('[PASSED]', Text.success)
+    else:
+        logger.log('[FAILED]', Text.danger)
+
+    for seq_len in [1024, 2048, 4096]:
+        measure(seq_len)
+
+
+#
+if __name__ == '__main__':
+    main()
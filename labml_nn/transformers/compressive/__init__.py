@@ -38,6 +38,9 @@ on the compressed memory and on uncompressed memory and gets a mean squared erro
 between them.
 We have implemented the latter here since it gives better results.
 
+The memories can be kept in [ring buffers](#CompressiveMemory)
+that keep them normalized, instead of concatenating and normalizing them on every step.
+
 This implementation uses pre-layer normalization
 while the paper uses post-layer normalization.
 Pre-layer norm does the layer norm before [FFN](../feedforward.html) and
@@ -50,7 +53,7 @@ model on the Tiny Shakespeare dataset.
 [![Open In Colab](https://colab.research.google.com/assets/colab-badge.svg)](https://colab.research.google.com/github/labmlai/annotated_deep_learning_paper_implementations/blob/master/labml_nn/transformers/compressive/experiment.ipynb)
 """
 
-from typing import Optional, List
+from typing import Optional, List, Tuple, Union
 
 import torch
 import torch.nn.functional as F
@@ -58,6 +61,7 @@ from torch import nn
 
 from labml_nn.transformers.feed_forward import FeedForward
 from labml_nn.transformers.mha import PrepareForMultiHeadAttention
+from labml_nn.transformers.xl.memory import RingBuffer, XLMemory
 from labml_nn.transformers.xl.relative_mha import RelativeMultiHeadAttention
 from labml_nn.utils import clone_module_list
 
@@ -92,6 +96,121 @@ class Conv1dCompression(nn.Module):
         return c_mem.permute(2, 0, 1)
 
 
+class CompressiveMemory(XLMemory):
+    """
+    <a id="CompressiveMemory"></a>
+
+    ## Memory of a Compressive Transformer Layer
+
+    This keeps the normalized compressed memories, the normalized memories
+    and the normalized inputs of the current step, in that order, in one [ring buffer](../xl/memory.html).
+    So they are not normalized and concatenated on every step;
+    the keys and values of attention are a view of the buffer.
+    It also keeps the memories that are not normalized, to compress them.
+    """
+
+    def __init__(self, mem_len: int, c_mem_len: int, seq_len: int):
+        """
+        * `mem_len` is the number of memories to keep after compression
+        * `c_mem_len` is the number of compressed memories to keep
+        * `seq_len` is the maximum number of tokens in a step
+        """
+        # There are up to `mem_len + seq_len` memories before the oldest are compressed
+        super().__init__(c_mem_len + mem_len + seq_len, seq_len)
+        self.mem_len = mem_len
+        self.c_mem_len = c_mem_len
+        # Memories that are not normalized
+        self.raw_mem = RingBuffer(mem_len + seq_len)
+        # Number of compressed memories
+        self.n_c_mem = 0
+        # Compression that is not written to the buffer yet;
+        # the number of compressed memories before it, the number of memories compressed,
+        # and the new compressed memories
+        self.compressed: Optional[Tuple[int, int, torch.Tensor]] = None
+
+    def __len__(self):
+        return self.n_c_mem + self.n_mem
+
+    def clear(self):
+        """
+        ### Remove all memories
+        """
+        super().clear()
+        self.raw_mem.clear()
+        self.n_c_mem = 0
+        self.compressed = None
+
+    def concat(self, z: torch.Tensor):
+        """
+        ### Concatenate compressed memory and memory with the normalized inputs of the current step
+        """
+        # Write the last compression to the buffer
+        if self.compressed is not None and self.mem.matches(z):
+            self._write_compressed()
+        self.compressed = None
+
+        #
+        return super().concat(z)
+
+    @torch.no_grad()
+    def _write_compressed(self):
+        """
+        #### Replace the compressed memories and the oldest memories in the buffer
+
+        This is done before the next step instead of in `compress`,
+        since attention keeps a view of the buffer for the backward pass.
+        """
+        n_c_mem, n_old, c_mem = self.compressed
+        # Compressed memories to keep; only the compressed memories are copied, not the memories
+        c_mem = torch.cat((self.mem.pop(n_c_mem), c_mem), dim=0)
+        c_mem = c_mem[max(len(c_mem) - self.c_mem_len, 0):]
+        # Remove the memories that were compressed
+        self.mem.pop(n_old)
+        # Add the compressed memories before the remaining memories
+        self.mem.prepend(c_mem)
+
+    def append(self, x: torch.Tensor, z: torch.Tensor):
+        """
+        ### Add the inputs and the normalized inputs of the current step to memory
+        """
+        self.raw_mem.append(x.detach())
+        # Memories are only dropped when they are compressed
+        self.n_mem += len(z)
+
+    @torch.no_grad()
+    def compress(self, compress: 'Conv1dCompression', norm: nn.LayerNorm, compression_rate: int) \
+            -> Optional[torch.Tensor]:
+        """
+        ### Compress the oldest memories if there are more memories than `mem_len`
+
+        * `compress` is the compression function $f_c$ of the layer
+        * `norm` is the layer normalization before self attention
+        * `compression_rate` is $c$
+
+        Returns the memories that were compressed, or `None`.
+        """
+        if self.n_mem <= self.mem_len:
+            return None
+
+        # Calculate the number of compressed memories to make $n_{cm} = \bigg\lceil\frac{n'_m - N_m}{c}\bigg\rceil$,
+        # where $n'_m$ is the number of memories we have
+        # and $N_m$ is the maximum number of memories we maintain (`mem_len`).
+        n_c_mem = (self.n_mem - self.mem_len + compression_rate - 1) // compression_rate
+        # Number of memories to compress $c n_{cm}$
+        n_old = n_c_mem * compression_rate
+        # Remove the oldest memories.
+        # We copy the memories to compress since they are needed after the ring buffer is written to.
+        mem_to_compress = self.raw_mem.pop(n_old).clone()
+        # Compress and normalize.
+        # The buffer is updated before the next step.
+        self.compressed = (self.n_c_mem, n_old, norm(compress(mem_to_compress)))
+        self.n_mem -= n_old
+        self.n_c_mem = min(self.n_c_mem + n_c_mem, self.c_mem_len)
+
+        #
+        return mem_to_compress
+
+
 class CompressiveTransformerLayer(nn.Module):
     """
     ## Compressive Transformer Layer
@@ -143,12 +262,13 @@ class CompressiveTransformerLayer(nn.Module):
 
     def forward(self, *,
                 x: torch.Tensor,
-                mem: Optional[torch.Tensor],
+                mem: Optional[Union[torch.Tensor, XLMemory]],
                 c_mem: Optional[torch.Tensor],
                 mask: torch.Tensor):
         """
         * `x` is a tensor of token level feature vectors of shape `[seq_len, batch_size, d_model]`
-        * `mem` is a tensor of the past token level feature vectors (memory) of shape `[mem_len, batch_size, d_model]`
+        * `mem` is a tensor of the past token level feature vectors (memory) of shape `[mem_len, batch_size, d_model]`,
+         or a [`CompressiveMemory`](#CompressiveMemory) which has the compressed memory and gets updated with `x`
         * `c_mem` is a tensor of the compressed memory `[c_mem_len, batch_size, d_model]`
         * `mask` is a matrix of shape `[seq_len, c_mem_len + mem_len + seq_len, batch_size]` or `[seq_len, c_mem_len + mem_len + seq_len, 1]`.
         `mask[i, j]` is  true if token at `i` can see token at `j`.
@@ -156,8 +276,16 @@ class CompressiveTransformerLayer(nn.Module):
 
         # Normalize the vectors before doing self attention
         z = self.norm_self_attn(x)
+        # If the memory is kept in ring buffers
+        if isinstance(mem, XLMemory):
+            # Concatenate normalized compressed memory and memory with `z`;
+            # this is a view of the ring buffer with `z` written after the memory
+            m_z = mem.concat(z)
+            # Add `x` to memory
+            mem.append(x, z)
         # Normalize and concatenate memory and compressed memory
-        m_z = self.concat_memory(z, mem, c_mem)
+        else:
+            m_z = self.concat_memory(z, mem, c_mem)
         # Attention
         self_attn = self.self_attn(query=z, key=m_z, value=m_z, mask=mask)
         # Add the attention results
@@ -188,11 +316,13 @@ class CompressiveTransformer(nn.Module):
         # Final normalization layer
         self.norm = nn.LayerNorm([layer.size])
 
-    def forward(self, x: torch.Tensor, mem: List[torch.Tensor], c_mem: List[torch.Tensor], mask: torch.Tensor):
+    def forward(self, x: torch.Tensor, mem: Union[List[torch.Tensor], List[CompressiveMemory]],
+                c_mem: List[torch.Tensor], mask: torch.Tensor):
         """
         * `x` is a tensor of the token embeddings vectors of shape `[seq_len, batch_size, d_model]`
         * `mem` is a list of tensors of the past token level feature vectors of shape
-         `[mem_len, batch_size, d_model]` for each layer
+         `[mem_len, batch_size, d_model]` for each layer,
+         or a list of [`CompressiveMemory`](#CompressiveMemory) for each layer which get updated
         * `c_mem` is a list of tensors of the compressed memory
          `[c_mem_len, batch_size, d_model]` for each layer
         * `mask` is the masking matrix
@@ -8,7 +8,7 @@ summary: This experiment trains a compressive transformer model on tiny Shakespe
 
 This is an annotated PyTorch experiment to train a compressive transformer model.
 """
-from typing import List, Tuple, NamedTuple
+from typing import List, Optional
 
 import torch
 import torch.nn as nn
@@ -19,12 +19,8 @@ from labml_nn.experiments.nlp_autoregression import NLPAutoRegressionConfigs
 from labml_nn.helpers.metrics import SimpleStateModule
 from labml_nn.helpers.trainer import BatchIndex
 from labml_nn.transformers.compressive import CompressiveTransformer, AttentionReconstructionLoss, \
-    CompressiveTransformerLayer, Conv1dCompression
-
-
-class CompressedMemory(NamedTuple):
-    mem: List[torch.Tensor]
-    c_mem: List[torch.Tensor]
+    CompressiveTransformerLayer, Conv1dCompression, CompressiveMemory
+from labml_nn.transformers.mask_cache import causal_mask
 
 
 class AutoregressiveModel(nn.Module):
@@ -40,42 +36,19 @@ class AutoregressiveModel(nn.Module):
         self.transformer = transformer
         # Final layer
         self.generator = nn.Linear(d_model, n_vocab)
-        # Masks
-        self.mask_x = None
-        self.mask_mem = None
-
-    def forward(self, x: torch.Tensor, mem: CompressedMemory):
-        # Get memory and compressed memory
-        if mem is not None:
-            mem, c_mem = mem.mem, mem.c_mem
-        else:
-            mem = []
-            c_mem = []
 
+    def forward(self, x: torch.Tensor, mem: List[CompressiveMemory]):
         # Total length of the memory and compressed memory (for masks)
         m_len = len(mem[0]) if mem else 0
-        if c_mem:
-            m_len += len(c_mem[0])
-
-        # Create a subsequent mask for tokens
-        if self.mask_x is None or self.mask_x.shape[0] < len(x):
-            from labml_nn.transformers.utils import subsequent_mask
-            self.mask_x = subsequent_mask(len(x)).to(x.device)
-        # Create an all ones (full visibility) mask for memory
-        if self.mask_mem is None or self.mask_mem.shape[1] < m_len or self.mask_mem.shape[0] < len(x):
-            self.mask_mem = self.mask_x.new_ones(len(x), m_len, 1)
-
-        # Concatenate the masks if there is memory
-        if m_len:
-            mask = torch.cat((self.mask_mem[:len(x), :m_len], self.mask_x[:len(x), :len(x)]), dim=1)
-        # Use only the subsequent mask otherwise
-        else:
-            mask = self.mask_x[:len(x), :len(x)]
+
+        # Mask where the tokens see all the memories and the previous tokens.
+        # This is a view of a [cached causal mask](../mask_cache.html) of `m_len + len(x)` keys.
+        mask = causal_mask(len(x), m_len + len(x), x.device)
 
         # Token embeddings
         x = self.src_embed(x)
         # Run it through the transformer
-        res, mem = self.transformer(x, mem, c_mem, mask)
+        res, mem = self.transformer(x, mem, [], mask)
         # Generate logits of the next token
         res = self.generator(res)
         #
@@ -121,74 +94,40 @@ class Configs(NLPAutoRegressionConfigs):
         # This will keep the accuracy metric stats and memories separate for training and validation.
         self.state_modules = [self.accuracy, self.memory]
 
-    @torch.no_grad()
-    def merge_compress_memory(self, mem: CompressedMemory, new_mem: List[torch.Tensor]) \
-            -> Tuple[CompressedMemory, List[torch.Tensor]]:
+    def new_memory(self, seq_len: Optional[int] = None) -> List[CompressiveMemory]:
         """
-        Concatenate new memories and compress the oldest memories.
+        Create [ring buffer memories](index.html#CompressiveMemory) for each layer.
+        The layers add their inputs to the memories.
+
+        `seq_len` is the maximum number of tokens in a step; it's `self.seq_len` if `None`.
         """
 
         # If the configurations specify not to use memory
         if self.mem_len == 0 and self.c_mem_len == 0:
-            return CompressedMemory([], []), []
-
-        # Get memory and compressed memory
-        if mem is not None:
-            mem, c_mem = mem.mem, mem.c_mem
-        else:
-            mem, c_mem = [], []
-
-        # Concatenate new memories with old memory
-        if mem:
-            mem = [torch.cat((m, x), dim=0) for m, x in zip(mem, new_mem)]
-        else:
-            mem = new_mem
-
-        # Compress the oldest memories if there are more memories than `mem_len`
-        if len(mem[0]) > self.mem_len:
-            # Calculate the number of compressed memories to make $n_{cm} = \bigg\lceil\frac{n'_m - N_m}{c}\bigg\rceil$,
-            # where $n'_m$ is the number of memories we have
-            # and $N_m$ is the maximum number of memories we maintain (`mem_len`).
-            n_c_mem = (len(mem[0]) - self.mem_len + self.compression_rate - 1) // self.compression_rate
-            # Number of memories to compress $c n_{cm}$
-            n_old = n_c_mem * self.compression_rate
-            # A list to keep memories that need to be compressed for each layer.
-            mem_to_compress = []
-            # A list to keep the memories that do not get compressed for each layer.
-            uncompressed_mem = []
-            # Iterate through memories of each layer.
-            for m in mem:
-                # Split the memories at $c n_{cm}$
-                cm, m = torch.split(m, [n_old, len(m) - n_old])
-                # Collect memories to compress
-                mem_to_compress.append(cm)
-                # Collect remaining memories
-                uncompressed_mem.append(m)
-            # Update the memories
-            mem = uncompressed_mem
-
-            # Compress the memories
-            new_c_mem = []
-            for i, layer in enumerate(self.model.transformer.layers):
-                new_c_mem.append(layer.compress(mem_to_compress[i]))
-
-            # Concatenate newly compressed memories with old compressed memories
-            if c_mem:
-                c_mem = [torch.cat((m, nm), dim=0) for m, nm in zip(c_mem, new_c_mem)]
-            # If there are no old compressed memories
-            else:
-                c_mem = new_c_mem
-
-            # Truncate old memories
-            if len(c_mem[0]) > self.c_mem_len:
-                c_mem = [m[-self.c_mem_len:] for m in c_mem]
-        # No memories are compressed if the number of memories is less than `mem_len`
-        else:
-            mem_to_compress = []
-
-        # Return memories and the memories that were compressed.
+            return []
+
+        #
+        return [CompressiveMemory(self.mem_len, self.c_mem_len, seq_len or self.seq_len)
+                for _ in range(self.n_layers)]
+
+    def compress_memory(self, mem: List[CompressiveMemory]) -> List[torch.Tensor]:
+        """
+        Compress the oldest memories if there are more than `mem_len` memories.
+        """
+
+        # Memories that were compressed, for each layer
+        mem_to_compress = []
+        # Iterate through memories of each layer.
+        for m, layer in zip(mem, self.model.transformer.layers):
+            cm = m.compress(layer.compress, layer.norm_self_attn, self.compression_rate)
+            # No memories are compressed if the number of memories is less than `mem_len`;
+            # all layers have the same number of memories
+            if cm is None:
+                return []
+            mem_to_compress.append(cm)
+
         # Memories that were compressed are needed for the reconstruction loss computation.
-        return CompressedMemory(mem, c_mem), mem_to_compress
+        return mem_to_compress
 
     def step(self, batch: any, batch_idx: BatchIndex):
         """
@@ -204,12 +143,14 @@ class Configs(NLPAutoRegressionConfigs):
 
         # Get memories
         mem = self.memory.get()
-        # Run the model
+        # Create memories on the first step
+        if mem is None:
+            mem = self.new_memory()
+            self.memory.set(mem)
+        # Run the model, which also adds the inputs of each layer to the memories
         output, new_mem = self.model(data, mem)
-        # Merge and compress memory
-        mem, mem_to_compress = self.merge_compress_memory(mem, new_mem)
-        # Update memories
-        self.memory.set(mem)
+        # Compress memory
+        mem_to_compress = self.compress_memory(mem)
 
         # Calculate and log cross entropy loss
         loss = self.loss_func(output, target)
@@ -254,8 +195,8 @@ class Configs(NLPAutoRegressionConfigs):
         prompt = self.prompt
         # Collect output for printing
         log = [(prompt, Text.subtle)]
-        # memory
-        mem = CompressedMemory([], [])
+        # Memory, with space for the prompt which can be longer than `seq_len`
+        mem = self.new_memory(max(self.seq_len, len(self.text.text_to_i(prompt))))
         # Sample 25 tokens
         for i in monit.iterate('Sample', 25):
             # Tokenize the prompt
@@ -263,7 +204,7 @@ class Configs(NLPAutoRegressionConfigs):
             # Move to device
             data = data.to(self.device)
             # Get the model output
-            output, new_mem = self.model(data, mem)
+            output, _ = self.model(data, mem)
             # Get the model prediction (greedy)
             output = output.argmax(dim=-1).squeeze(1)
             # Add the prediction to prompt
@@ -272,8 +213,8 @@ class Configs(NLPAutoRegressionConfigs):
             prompt = prompt[-1:]
             # Add the prediction for logging
             log += [(self.prompt_separator + self.text.itos[output[-1]], Text.value)]
-            # Update and compress memory
-            mem, _ = self.merge_compress_memory(mem, new_mem)
+            # Compress memory
+            self.compress_memory(mem)
 
         # Print the sampled output
         logger.log(log)
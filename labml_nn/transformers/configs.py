@@ -217,6 +217,24 @@ calculate(TransformerConfigs.decoder_attn, 'relative', _relative_mha)
 calculate(TransformerConfigs.decoder_mem_attn, 'relative', _relative_mha)
 
 
+# ### [Chunked memory-efficient Multi-head Attention](chunked/index.html)
+def _chunked_mha(c: TransformerConfigs):
+    from labml_nn.transformers.chunked import ChunkedMultiHeadAttention
+    return ChunkedMultiHeadAttention(c.n_heads, c.d_model, dropout_prob=c.dropout)
+
+
+# Decoder self-attention is causal, so the causal mask is applied
+# while computing the blocks instead of reading a dense mask
+def _chunked_causal_mha(c: TransformerConfigs):
+    from labml_nn.transformers.chunked import ChunkedMultiHeadAttention
+    return ChunkedMultiHeadAttention(c.n_heads, c.d_model, dropout_prob=c.dropout, is_causal=True)
+
+
+calculate(TransformerConfigs.encoder_attn, 'chunked', _chunked_mha)
+calculate(TransformerConfigs.decoder_attn, 'chunked', _chunked_causal_mha)
+calculate(TransformerConfigs.decoder_mem_attn, 'chunked', _chunked_mha)
+
+
 @option(TransformerConfigs.ffn, 'default')
 def _feed_forward(c: TransformerConfigs):
     """
@@ -86,6 +86,11 @@ The paper introduces a new linear attention projection function $\textcolor{ligh
 a new update rule for $\textcolor{cyan}{W^{(i)}} = f(\textcolor{cyan}{W^{(i-1)}})$ and change the normalization
 $\frac{1}{z^{(i)} \cdot \textcolor{lightgreen}{\phi(q^{(i)})}}$
 
+The fast weights are updated one step at a time in the paper.
+We also compute them [a chunk of steps at a time](#chunkwise), with matrix multiplications inside a chunk,
+and only carry the fast weights from chunk to chunk.
+Here's [a benchmark](benchmark.html) that checks both give the same outputs and compares their speed.
+
 Here are [the training code](experiment.html) and a notebook for training a fast weights
  transformer on the Tiny Shakespeare dataset.
 
@@ -198,11 +203,25 @@ class FastWeightsAttention(nn.Module):
     where $\textcolor{orange}{W_\beta}$ is a trainable parameter and $\sigma$ is the sigmoid function.
 
     Note that we don't need the normalization term $z$ because $\textcolor{lightgreen}{\phi'}$ is normalized.
+
+    The fast weights are computed [one step at a time](#sequential),
+    or [a chunk of steps at a time](#chunkwise) with matrix multiplications.
     """
 
-    def __init__(self, heads: int, d_model: int, dropout_prob: float, phi: DPFP):
+    def __init__(self, heads: int, d_model: int, dropout_prob: float, phi: DPFP, chunk_size: int = 64):
+        """
+        * `heads` is the number of heads
+        * `d_model` is the number of features in `x`
+        * `dropout_prob` is the dropout probability
+        * `phi` is the projection function, such as `DPFP`
+        * `chunk_size` is the number of steps in a chunk for the [chunkwise computation](#chunkwise);
+         the steps are computed [one at a time](#sequential) if it's `0`
+        """
         super().__init__()
 
+        # Number of steps in a chunk
+        self.chunk_size = chunk_size
+
         # Number of features per head $d_k$
         self.d_k = d_model // heads
         # Number of heads
@@ -228,8 +247,6 @@ class FastWeightsAttention(nn.Module):
         self.dropout = nn.Dropout(dropout_prob)
 
     def forward(self, x: torch.Tensor):
-        # Get the number of steps $L$
-        seq_len = x.shape[0]
         # $\textcolor{lightgreen}{\phi'(q^{(i)})}$ for all steps and heads
         query = self.phi(self.query(x))
         # $\textcolor{lightgreen}{\phi'(k^{(i)})}$ for all steps and heads
@@ -239,6 +256,31 @@ class FastWeightsAttention(nn.Module):
         # $\beta^{(i)}$ for all steps and heads
         beta = self.interpolation_weight(x)
 
+        # $y^{(i)}$ for all steps and heads
+        if self.chunk_size:
+            y = self.chunkwise(query, key, value, beta)
+        else:
+            y = self.sequential(query, key, value, beta)
+
+        # Merge multiple heads
+        x = y.reshape(y.shape[0], y.shape[1], -1)
+
+        # Output layer
+        return self.output(x)
+
+    @staticmethod
+    def sequential(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor, beta: torch.Tensor):
+        """
+        <a id="sequential"></a>
+
+        ### Compute one step at a time
+
+        `query`, `key`, `value` and `beta` have shape `[seq_len, batch_size, heads, d]`.
+        This returns $y^{(i)}$ of shape `[seq_len, batch_size, heads, d_value]`.
+        """
+        # Get the number of steps $L$
+        seq_len = key.shape[0]
+
         # $\textcolor{cyan}{W^{(0)}}$
         weights = key.new_zeros((key.shape[1], key.shape[2], value.shape[3], key.shape[3]))
         # List to store outputs $y^{(i)}$
@@ -257,14 +299,93 @@ class FastWeightsAttention(nn.Module):
             # $$y^{(i)} = \textcolor{cyan}{W^{(i)}} \textcolor{lightgreen}{\phi'(q^{(i)})}$$
             y = torch.einsum('bhvk,bhk->bhv', weights, query[i])
 
-            # Merge multiple heads and append to `outputs`
-            outputs.append(y.reshape(y.shape[0], -1))
+            # Append to `outputs`
+            outputs.append(y)
 
         # Stack outputs at each step into a single tensor
-        x = torch.stack(outputs)
+        return torch.stack(outputs)
+
+    def chunkwise(self, query: torch.Tensor, key: torch.Tensor, value: torch.Tensor, beta: torch.Tensor):
+        r"""
+        <a id="chunkwise"></a>
+
+        ### Compute a chunk of steps at a time
+
+        `query`, `key`, `value` and `beta` have shape `[seq_len, batch_size, heads, d]`.
+        This returns $y^{(i)}$ of shape `[seq_len, batch_size, heads, d_value]`.
+
+        Let $u^{(i)} = \beta^{(i)} \Big( v^{(i)} - \bar{v}^{(i)} \Big )$ be the value written at step $i$,
+        so that $\textcolor{cyan}{W^{(i)}} = \textcolor{cyan}{W^{(0)}} + \sum_{j \le i} u^{(j)} \otimes k^{(j)}$
+        for the steps of a chunk, where $\textcolor{cyan}{W^{(0)}}$ are the fast weights before the chunk
+        and we write $k^{(j)}$ for $\textcolor{lightgreen}{\phi'(k^{(j)})}$
+        and $q^{(i)}$ for $\textcolor{lightgreen}{\phi'(q^{(i)})}$.
+        Then,
+
+        \begin{align}
+        u^{(i)} &= \beta^{(i)} \Big( v^{(i)} - \textcolor{cyan}{W^{(0)}} k^{(i)} -
+         \sum_{j < i} \big(k^{(i)} \cdot k^{(j)} \big) u^{(j)} \Big) \\
+        y^{(i)} &= \textcolor{cyan}{W^{(0)}} q^{(i)} + \sum_{j \le i} \big(q^{(i)} \cdot k^{(j)} \big) u^{(j)}
+        \end{align}
+
+        With the steps of a chunk as rows of matrices $Q$, $K$, $V$ and $U$, $B = \text{diag}(\beta)$
+        and $A = I + B \, \text{tril}_{-1}(K K^\top)$, which is lower triangular with ones on the diagonal,
+
+        \begin{align}
+        U &= A^{-1} B V - A^{-1} B K \textcolor{cyan}{W^{(0)}}^\top \\
+        Y &= Q \textcolor{cyan}{W^{(0)}}^\top + \text{tril}(Q K^\top) U \\
+        \textcolor{cyan}{W^{(C)}} &= \textcolor{cyan}{W^{(0)}} + U^\top K
+        \end{align}
+
+        $A^{-1} B V$, $A^{-1} B K$ and $\text{tril}(Q K^\top)$ don't depend on the fast weights,
+        so they are computed for all chunks at once.
+        Only the fast weights are carried from chunk to chunk, with a few matrix multiplications for each chunk.
+        """
+        seq_len, batch_size, heads, d_key = key.shape
+        d_value = value.shape[-1]
+        c = self.chunk_size
+        n_chunks = (seq_len + c - 1) // c
+
+        def to_chunks(t: torch.Tensor):
+            # Pad with zeros; padded steps have $\beta = 0$ and $k = 0$ so they don't change the fast weights
+            t = torch.cat((t, t.new_zeros(n_chunks * c - seq_len, *t.shape[1:])))
+            # Change the shape to `[batch_size, heads, n_chunks, chunk_size, d]`
+            return t.view(n_chunks, c, batch_size, heads, -1).permute(2, 3, 0, 1, 4)
+
+        query, key, value, beta = to_chunks(query), to_chunks(key), to_chunks(value), to_chunks(beta)
+
+        # Causal masks $j \le i$ and $j < i$
+        causal = torch.ones(c, c, dtype=torch.bool, device=key.device).tril()
+        strictly_causal = causal.tril(-1)
+
+        # $A = I + B \, \text{tril}_{-1}(K K^\top)$
+        a = (beta * (key @ key.transpose(-1, -2))).masked_fill(~strictly_causal, 0.)
+        a = a + torch.eye(c, dtype=a.dtype, device=a.device)
+        # $A^{-1} B V$ and $A^{-1} B K$ with a triangular solve
+        solved = torch.linalg.solve_triangular(a, torch.cat((beta * value, beta * key), dim=-1),
+                                               upper=False, unitriangular=True)
+        u_value, u_key = solved.split([d_value, d_key], dim=-1)
+        # $\text{tril}(Q K^\top)$
+        qk = (query @ key.transpose(-1, -2)).masked_fill(~causal, 0.)
 
-        # Output layer
-        return self.output(x)
+        # $\textcolor{cyan}{W^{(0)}}$
+        weights = key.new_zeros((batch_size, heads, d_value, d_key))
+        # List to store outputs of each chunk
+        outputs = []
+
+        # Iterate through chunks
+        for n in range(n_chunks):
+            # $U = A^{-1} B V - A^{-1} B K \textcolor{cyan}{W^{(0)}}^\top$
+            u = u_value[:, :, n] - u_key[:, :, n] @ weights.transpose(-1, -2)
+            # $Y = Q \textcolor{cyan}{W^{(0)}}^\top + \text{tril}(Q K^\top) U$
+            outputs.append(query[:, :, n] @ weights.transpose(-1, -2) + qk[:, :, n] @ u)
+            # $\textcolor{cyan}{W^{(C)}} = \textcolor{cyan}{W^{(0)}} + U^\top K$
+            weights = weights + u.transpose(-1, -2) @ key[:, :, n]
+
+        # Stack the outputs of the chunks and change the shape to `[seq_len, batch_size, heads, d_value]`
+        y = torch.stack(outputs, dim=2).permute(2, 3, 0, 1, 4).reshape(n_chunks * c, batch_size, heads, d_value)
+
+        #
+        return y[:seq_len]
 
 
 class FastWeightsAttentionTransformerLayer(nn.Module):
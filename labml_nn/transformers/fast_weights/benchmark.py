@@ -0,0 +1,122 @@
+"""
+---
+title: Benchmark chunkwise fast weights
+summary: >
+  Check that chunkwise fast weights attention matches updating the fast weights one step at a time,
+  and compare their speed in tokens per second.
+---
+
+# Benchmark Chunkwise Fast Weights
+
+This compares [fast weights attention](index.html) computed [one step at a time](index.html#sequential)
+with the [chunkwise computation](index.html#chunkwise).
+
+It checks that the outputs and gradients are the same for a few sequence lengths and chunk sizes,
+and then measures tokens per second of the forward pass and of the forward and backward passes
+at several sequence lengths.
+
+```bash
+python -m labml_nn.transformers.fast_weights.benchmark --seq_len 256 1024 4096 --chunk_size 32 64 128
+```
+"""
+
+import argparse
+import time
+
+import torch
+
+from labml import logger, monit
+from labml.logger import Text
+from labml_nn.transformers.fast_weights import FastWeightsAttention, DPFP
+
+
+def _check(name: str, a: torch.Tensor, b: torch.Tensor, atol: float = 1e-4):
+    diff = (a - b).abs().max().item()
+    passed = diff <= atol
+    logger.log([(f'{name :<32}', Text.key), (f'{diff :.2e}', Text.value),
+                (' [PASSED]' if passed else ' [FAILED]', Text.success if passed else Text.danger)])
+    return passed
+
+
+def test(seq_len: int, chunk_size: int, *, batch_size: int = 3, heads: int = 4, d_model: int = 32, nu: int = 1):
+    """
+    ### Compare outputs and gradients with the sequential computation
+    """
+    torch.manual_seed(0)
+    attn = FastWeightsAttention(heads, d_model, 0., DPFP(nu=nu))
+    x = torch.randn(seq_len, batch_size, d_model, requires_grad=True)
+    d_out = torch.randn(seq_len, batch_size, d_model)
+
+    grads = []
+    for c in [0, chunk_size]:
+        attn.chunk_size = c
+        out = attn(x)
+        out.backward(d_out)
+        grads.append((out.detach(), x.grad, attn.key.linear.weight.grad,
+                      attn.interpolation_weight[0].linear.weight.grad))
+        x.grad = None
+        attn.zero_grad()
+
+    with monit.section(f'seq_len={seq_len} chunk_size={chunk_size} nu={nu}'):
+        passed = all([_check(n, a, b) for n, a, b in zip(['output', 'dx', 'd_key', 'd_beta'], *grads)])
+
+    return passed
+
+
+def measure(seq_len: int, chunk_sizes, *, batch_size: int, heads: int, d_model: int, n_repeat: int = 3):
+    """
+    ### Measure tokens per second
+    """
+    torch.manual_seed(0)
+    attn = FastWeightsAttention(heads, d_model, 0., DPFP())
+    x = torch.randn(seq_len, batch_size, d_model, requires_grad=True)
+    n_tokens = seq_len * batch_size
+
+    for c in [0] + list(chunk_sizes):
+        attn.chunk_size = c
+        forward, backward = [], []
+        for _ in range(n_repeat):
+            start = time.perf_counter()
+            with torch.no_grad():
+                attn(x)
+            forward.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            attn(x).sum().backward()
+            backward.append(time.perf_counter() - start)
+        attn.zero_grad()
+
+        name = f'chunk_size={c}' if c else 'sequential'
+        logger.log([(f'seq_len={seq_len :6d} {name :<16}', Text.key),
+                    ' forward ', (f'{n_tokens / min(forward) :12,.0f} tokens/s', Text.value),
+                    ' forward and backward ', (f'{n_tokens / min(backward) :12,.0f} tokens/s', Text.value)])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--seq_len", type=int, nargs='+', default=[256, 1024, 4096], help="sequence lengths")
+    parser.add_argument("--chunk_size", type=int, nargs='+', default=[32, 64, 128], help="chunk sizes")
+    parser.add_argument("--batch_size", type=int, default=4, help="batch size")
+    parser.add_argument("--heads", type=int, default=8, help="number of heads")
+    parser.add_argument("--d_model", type=int, default=256, help="number of features in embeddings")
+
+    opt = parser.parse_args()
+
+    passed = True
+    for seq_len, chunk_size in [(64, 16), (100, 32), (20, 64), (128, 1)]:
+        passed = test(seq_len, chunk_size) and passed
+    passed = test(100, 16, nu=2) and passed
+
+    if passed:
+        logger.log('[PASSED]', Text.success)
+    else:
+        logger.log('[FAILED]', Text.danger)
+
+    for seq_len in opt.seq_len:
+        measure(seq_len, opt.chunk_size, batch_size=opt.batch_size, heads=opt.heads, d_model=opt.d_model)
+
+
+#
+if __name__ == '__main__':
+    main()
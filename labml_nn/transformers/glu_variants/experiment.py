@@ -43,7 +43,7 @@ class AutoregressiveModel(nn.Module):
     def forward(self, src: torch.Tensor):
         # Create subsequent mask, so that the transformer can only pay attention to past tokens.
         if self.src_mask is None or self.src_mask.size(0) != len(src):
-            self.src_mask = subsequent_mask(len(src)).to(src.device)
+            self.src_mask = subsequent_mask(len(src), src.device)
         # Embed the tokens (`src`) and run it through the the transformer
         res = self.encoder(self.src_embed(src), self.src_mask)
         # Generate logits of the next token
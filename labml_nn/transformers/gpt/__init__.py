@@ -50,6 +50,10 @@ class GPT(nn.Module):
     a final linear layer that gives token logits.
     """
 
+    # This can feed only the new tokens in [incremental decoding](../utils.html#IncrementalDecoding),
+    # if all the attention modules support it
+    is_incremental_supported = True
+
     def __init__(self, encoder: Encoder, src_embed: nn.Module, generator: nn.Module):
         """
         * `encoder` is the transformer [Encoder](../models.html#Encoder)
@@ -70,7 +74,7 @@ class GPT(nn.Module):
         # or if the size of the mask is different
         if self.mask is None or self.mask.size(0) != len(x):
             # Subsequent mask, will mask out tokens from seeing future tokens
-            self.mask = subsequent_mask(len(x)).to(x.device)
+            self.mask = subsequent_mask(len(x), x.device)
         # Get the token embeddings with positional encodings
         x = self.src_embed(x)
         # Transformer encoder
@@ -226,7 +226,7 @@ class AutoregressiveMask(nn.Module):
         # Create a mask if we haven't created or sizes have changed
         if self.mask is None or self.mask.size(0) != len(x):
             # [Subsequent mask](../utils.html), will mask out tokens from seeing future tokens
-            self.mask = subsequent_mask(len(x)).to(x.device)
+            self.mask = subsequent_mask(len(x), x.device)
 
         #
         return self.mask
@@ -0,0 +1,203 @@
+r"""
+---
+title: Cache of attention masks and biases
+summary: >
+  Hand out views of preallocated causal masks, local window masks and ALiBi biases
+  instead of creating them again for every sequence length.
+---
+
+# Cache of Attention Masks and Biases
+
+Masks and biases like the [subsequent (causal) mask](utils.html),
+the local window mask of [AFT Local](aft/index.html) and the [ALiBi](alibi/index.html) biases
+are $O(N^2)$ tensors that were created again whenever the sequence length changed.
+With [Transformer XL](xl/index.html) memory the number of keys changes on every step until the memory fills up,
+and when sampling it changes with every token.
+
+[`MaskCache`](#MaskCache) keeps one tensor of the maximum length for each kind of mask,
+number of heads, window size, device and data type,
+and hands out views of it for any length up to the maximum.
+The masks of all the lengths are slices of the largest one:
+
+* The causal mask of $N_q$ queries and $N_k$ keys, where the queries are the last $N_q$ positions,
+  is rows $N_k - N_q$ to $N_k - 1$ and the first $N_k$ columns of a causal mask.
+  This is also the mask of [Transformer XL](xl/index.html) with $N_k - N_q$ memories.
+* The local window mask of length $N$ is the top-left $N \times N$ block.
+* The ALiBi biases with a causal mask are $m (j + 1)$ for key $j$; they don't depend on the query
+  (the biases of the masked keys don't matter).
+  So they are kept as a $[N, heads]$ tensor and broadcast over the queries.
+
+The tensor is doubled in size when a longer length is requested,
+so there are $O(\log N)$ allocations in total.
+The views share memory with the cache, so they should not be modified in place.
+
+Here's [a benchmark](mask_cache_benchmark.html) of the allocations saved at $4k$ to $16k$ tokens.
+"""
+
+from typing import Dict, Optional, Tuple
+
+import torch
+
+
+def _device(device: Optional[torch.device]) -> torch.device:
+    """
+    #### Device with an index, so that `cuda` and `cuda:0` are the same key
+    """
+    if device is None:
+        return torch.device('cpu')
+    device = torch.device(device)
+    if device.type == 'cuda' and device.index is None:
+        return torch.device('cuda', torch.cuda.current_device())
+    return device
+
+
+def _causal(size: int, *, device: torch.device, dtype: torch.dtype, **_):
+    r"""
+    #### Causal mask $m_{ij} = [j \le i]$ of shape `[size, size]`
+    """
+    return torch.ones(size, size, dtype=torch.bool, device=device).tril_().to(dtype)
+
+
+def _local(size: int, *, window: int, device: torch.device, dtype: torch.dtype, **_):
+    r"""
+    #### Local window mask $m_{ij} = [\lvert i - j \rvert \lt s]$ of shape `[size, size]`
+    """
+    return torch.ones(size, size, dtype=torch.bool, device=device).tril_(window - 1).triu_(-(window - 1)).to(dtype)
+
+
+def _alibi(size: int, *, heads: int, device: torch.device, dtype: torch.dtype, **_):
+    """
+    #### ALiBi biases $m (j + 1)$ of shape `[size, heads]`
+    """
+    # ALiBi imports this module
+    from labml_nn.transformers.alibi import get_slopes
+
+    m = get_slopes(heads).to(device=device, dtype=dtype)
+    distance = torch.arange(1, size + 1, device=device, dtype=dtype)
+    return distance[:, None] * m[None, :]
+
+
+# Functions that create each kind of tensor
+_BUILDERS = {
+    'causal': _causal,
+    'local': _local,
+    'alibi': _alibi,
+}
+
+
+class MaskCache:
+    """
+    <a id="MaskCache"></a>
+
+    ## Mask and bias cache
+
+    Tensors are keyed by `(kind, heads, window, device, dtype)`, and the requested
+    length picks a view of the tensor.
+    """
+
+    def __init__(self, min_len: int = 1024):
+        """
+        * `min_len` is the smallest length to allocate, so that short sequences don't cause many reallocations
+        """
+        self.min_len = min_len
+        self.tensors: Dict[Tuple, torch.Tensor] = {}
+
+    def clear(self):
+        """
+        ### Free all the tensors
+        """
+        self.tensors.clear()
+
+    def get(self, kind: str, length: int, *,
+            heads: int = 0, window: int = 0,
+            device: Optional[torch.device] = None,
+            dtype: torch.dtype = torch.bool) -> torch.Tensor:
+        """
+        ### Get the tensor of a kind with at least `length` positions
+
+        The first dimension of the tensor is the position.
+        """
+        key = (kind, heads, window, _device(device), dtype)
+        cached = self.tensors.get(key)
+        if cached is not None and cached.shape[0] >= length:
+            return cached
+
+        # Double the size, so that growing to length $N$ takes $O(\log N)$ allocations
+        size = max(length, self.min_len, 2 * cached.shape[0] if cached is not None else 0)
+        # Free the old tensor before creating the new one
+        self.tensors.pop(key, None)
+        with torch.no_grad():
+            self.tensors[key] = _BUILDERS[kind](size, heads=heads, window=window, device=key[3], dtype=dtype)
+
+        #
+        return self.tensors[key]
+
+    def is_causal_view(self, mask: torch.Tensor, q_seq_len: int, kv_seq_len: int) -> bool:
+        """
+        ### Whether a mask is a view of the cached causal mask for `q_seq_len` queries and `kv_seq_len` keys
+
+        This checks the storage and strides, without reading the mask.
+        The last two dimensions of `mask` should be the queries and keys.
+        """
+        cached = self.tensors.get(('causal', 0, 0, _device(mask.device), torch.bool))
+        if cached is None or mask.dtype != torch.bool or mask.shape[-2:] != (q_seq_len, kv_seq_len):
+            return False
+        if mask.untyped_storage().data_ptr() != cached.untyped_storage().data_ptr():
+            return False
+        # Rows `kv_seq_len - q_seq_len` to `kv_seq_len - 1` starting at the first column
+        size = cached.shape[1]
+        return (mask.stride(-1) == 1 and (q_seq_len == 1 or mask.stride(-2) == size) and
+                mask.storage_offset() == (kv_seq_len - q_seq_len) * size)
+
+
+# Cache shared by the attention modules
+mask_cache = MaskCache()
+
+
+def causal_mask(q_seq_len: int, kv_seq_len: Optional[int] = None,
+                device: Optional[torch.device] = None) -> torch.Tensor:
+    """
+    <a id="causal_mask"></a>
+
+    ## Causal mask
+
+    * `q_seq_len` is the number of queries
+    * `kv_seq_len` is the number of keys; the queries are the last `q_seq_len` positions.
+     It's the same as `q_seq_len` if `None`.
+
+    This returns a view of shape `[q_seq_len, kv_seq_len, 1]`,
+    where `mask[i, j, 0]` is whether query $i$ can see key $j$.
+    """
+    if kv_seq_len is None:
+        kv_seq_len = q_seq_len
+    assert kv_seq_len >= q_seq_len
+
+    mask = mask_cache.get('causal', kv_seq_len, device=device)
+    return mask[kv_seq_len - q_seq_len:kv_seq_len, :kv_seq_len, None]
+
+
+def local_mask(seq_len: int, local_window_size: int, device: Optional[torch.device] = None) -> torch.Tensor:
+    r"""
+    <a id="local_mask"></a>
+
+    ## Local window mask
+
+    This returns a view of shape `[seq_len, seq_len]`,
+    where `mask[i, j]` is whether $\lvert i - j \rvert \lt s$ for window size $s$.
+    """
+    mask = mask_cache.get('local', seq_len, window=local_window_size, device=device)
+    return mask[:seq_len, :seq_len]
+
+
+def alibi_biases(heads: int, kv_seq_len: int, device: Optional[torch.device] = None,
+                 dtype: torch.dtype = torch.float32) -> torch.Tensor:
+    """
+    <a id="alibi_biases"></a>
+
+    ## ALiBi biases with a causal mask
+
+    This returns a view of shape `[1, kv_seq_len, 1, heads]` with the bias $m (j + 1)$ of key $j$,
+    which is the same as [`get_alibi_biases`](alibi/index.html) for the keys that are not masked.
+    """
+    biases = mask_cache.get('alibi', kv_seq_len, heads=heads, device=device, dtype=dtype)
+    return biases[None, :kv_seq_len, None, :]
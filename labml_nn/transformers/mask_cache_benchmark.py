@@ -0,0 +1,188 @@
+"""
+---
+title: Benchmark the cache of attention masks and biases
+summary: >
+  Compare the allocations of creating masks and biases for every sequence length
+  with views of the mask cache, at 4k to 16k tokens.
+---
+
+# Benchmark the Cache of Attention Masks and Biases
+
+This compares creating masks and biases for every length,
+like the code did before the [mask cache](mask_cache.html),
+with views of the cache.
+For each maximum length $N$ it gets the masks for `n_steps` lengths up to $N$,
+like the keys of [Transformer XL](xl/index.html) growing as the memory fills up.
+
+It reports the number of allocations, the total bytes allocated, the peak memory and the time,
+for creating the masks, for the cache starting empty and for the cache after it has been filled.
+Masks created without the cache that would need more than `--max_bytes` are skipped.
+
+It first checks that the cached masks and biases are the same as the ones created.
+
+```bash
+python -m labml_nn.transformers.mask_cache_benchmark --seq_len 4096 8192 16384
+```
+"""
+
+import argparse
+import time
+from typing import Callable, Dict, List, Tuple
+
+import torch
+
+from labml import logger, monit
+from labml.logger import Text
+from labml_nn.transformers.aft import AFTLocal
+from labml_nn.transformers.alibi import get_alibi_biases
+from labml_nn.transformers.benchmark import profile_memory
+from labml_nn.transformers.mask_cache import mask_cache, causal_mask, local_mask, alibi_biases
+
+# Local window size of AFT Local
+WINDOW = 128
+
+
+def _subsequent(n: int):
+    """
+    #### Subsequent mask created for a length
+    """
+    return torch.tril(torch.ones(n, n)).to(torch.bool).unsqueeze(-1)
+
+
+def _xl(n: int):
+    """
+    #### Transformer XL mask with $3/4$ of the keys in memory
+    """
+    seq_len = n // 4
+    return torch.cat((torch.ones(seq_len, n - seq_len, 1, dtype=torch.bool), _subsequent(seq_len)), dim=1)
+
+
+def _alibi(n: int, heads: int):
+    """
+    #### ALiBi biases created from the causal mask
+    """
+    return get_alibi_biases(heads, _subsequent(n)[:, :, 0])
+
+
+# Cases; a function that creates the mask of length $N$, a function that gets it from the cache,
+# and the approximate bytes allocated to create it for `heads`
+CASES: Dict[str, Tuple[Callable, Callable, Callable[[int, int], int]]] = {
+    'subsequent': (lambda n, h: _subsequent(n),
+                   lambda n, h: causal_mask(n),
+                   lambda n, h: 5 * n * n),
+    'xl': (lambda n, h: _xl(n),
+           lambda n, h: causal_mask(n // 4, n),
+           lambda n, h: 2 * n * n),
+    'alibi': (lambda n, h: _alibi(n, h),
+              lambda n, h: alibi_biases(h, n),
+              lambda n, h: (13 + 4 * h) * n * n),
+    'aft_local': (lambda n, h: AFTLocal.create_local_mask(n, WINDOW),
+                  lambda n, h: local_mask(n, WINDOW),
+                  lambda n, h: n * n),
+}
+
+
+def _check(name: str, a: torch.Tensor, b: torch.Tensor):
+    passed = a.shape == b.shape and torch.equal(a, b)
+    logger.log([(f'{name :<16}', Text.key),
+                (' [PASSED]' if passed else ' [FAILED]', Text.success if passed else Text.danger)])
+    return passed
+
+
+def test(seq_len: int = 300, heads: int = 8):
+    """
+    ### Check that the cached masks and biases are the same as the created ones
+    """
+    passed = True
+    for name in ['subsequent', 'xl', 'aft_local']:
+        create, cached, _ = CASES[name]
+        passed = _check(name, cached(seq_len, heads), create(seq_len, heads)) and passed
+
+    # ALiBi biases are the same for the keys that are not masked
+    mask = _subsequent(seq_len)
+    cached = alibi_biases(heads, seq_len).expand(seq_len, -1, -1, -1)[:, :, 0, :]
+    created = _alibi(seq_len, heads)
+    passed = _check('alibi', cached.masked_fill(~mask, 0.), created.masked_fill(~mask, 0.)) and passed
+
+    return passed
+
+
+def _run(fn: Callable[[int, int], torch.Tensor], lengths: List[int], heads: int, *, clear: bool = False):
+    """
+    #### Get the masks for all lengths, and measure the time and allocations
+
+    * `clear` is whether to empty the cache before each run
+    """
+
+    def get():
+        for n in lengths:
+            fn(n, heads)
+
+    if clear:
+        mask_cache.clear()
+    start = time.perf_counter()
+    get()
+    elapsed = time.perf_counter() - start
+
+    if clear:
+        mask_cache.clear()
+    peak, n_allocations, allocated = profile_memory(get)
+
+    return elapsed, peak, n_allocations, allocated
+
+
+def measure(name: str, seq_len: int, *, heads: int, n_steps: int, max_bytes: int):
+    """
+    ### Measure a case for lengths up to `seq_len`
+    """
+    create, cached, size = CASES[name]
+    lengths = [seq_len * (i + 1) // n_steps for i in range(n_steps)]
+
+    results = {}
+    if size(seq_len, heads) <= max_bytes:
+        results['created'] = _run(create, lengths, heads)
+    # Starting with an empty cache
+    results['cached cold'] = _run(cached, lengths, heads, clear=True)
+    # With the cache filled by the previous run
+    results['cached warm'] = _run(cached, lengths, heads)
+    mask_cache.clear()
+
+    logger.log([(f'{name} seq_len={seq_len}', Text.key)])
+    if 'created' not in results:
+        logger.log([(f'{"created" :>16}', Text.key), (' skipped', Text.warning)])
+    for k, (elapsed, peak, n_allocations, allocated) in results.items():
+        logger.log([(f'{k :>16}', Text.key),
+                    ' time ', (f'{elapsed * 1000 :10.2f}ms', Text.value),
+                    ' allocations ', (f'{n_allocations :6,}', Text.value),
+                    ' allocated ', (f'{allocated / 2 ** 20 :10.1f}MB', Text.value),
+                    ' peak ', (f'{peak / 2 ** 20 :10.1f}MB', Text.value)])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--cases", nargs='+', default=list(CASES.keys()), choices=list(CASES.keys()),
+                        help="masks and biases to benchmark")
+    parser.add_argument("--seq_len", type=int, nargs='+', default=[4096, 8192, 16384], help="maximum lengths")
+    parser.add_argument("--heads", type=int, default=8, help="number of heads for ALiBi")
+    parser.add_argument("--n_steps", type=int, default=16, help="number of lengths up to the maximum")
+    parser.add_argument("--max_bytes", type=int, default=4 * 2 ** 30,
+                        help="skip creating masks that need more memory than this")
+
+    opt = parser.parse_args()
+
+    with monit.section('Test'):
+        passed = test()
+    if passed:
+        logger.log('[PASSED]', Text.success)
+    else:
+        logger.log('[FAILED]', Text.danger)
+
+    for name in opt.cases:
+        for seq_len in opt.seq_len:
+            measure(name, seq_len, heads=opt.heads, n_steps=opt.n_steps, max_bytes=opt.max_bytes)
+
+
+#
+if __name__ == '__main__':
+    main()
@@ -22,12 +22,13 @@ with MHA for NLP auto-regression.
 """
 
 import math
-from typing import Optional, List
+from typing import Optional, List, Tuple
 
 import torch
 from torch import nn
 
 from labml import tracker
+from labml_nn.transformers.attention_backend import attention, is_causal_mask, select_backend
 
 
 class PrepareForMultiHeadAttention(nn.Module):
@@ -87,6 +88,10 @@ class MultiHeadAttention(nn.Module):
     Softmax is calculated along the axis of of the sequence (or time).
     """
 
+    # Whether this supports [incremental decoding](#incremental).
+    # Sub-classes that change `forward` or `get_scores` without handling cached positions should set this to `False`.
+    is_incremental_supported = True
+
     def __init__(self, heads: int, d_model: int, dropout_prob: float = 0.1, bias: bool = True):
         """
         * `heads` is the number of heads.
@@ -115,16 +120,93 @@ class MultiHeadAttention(nn.Module):
         # Scaling factor before the softmax
         self.scale = 1 / math.sqrt(self.d_k)
 
-        # We store attentions so that it can be used for logging, or other computations if needed
+        # We store attentions so that it can be used for logging, or other computations if needed.
+        # This is only set when attention is computed with the full score matrix;
+        # i.e. when a sub-class overrides `get_scores` or when the `einsum`
+        # [attention backend](attention_backend/index.html) is selected.
         self.attn = None
+        # [Attention backend](attention_backend/index.html) to use; it's selected automatically if `None`
+        self.backend: Optional[str] = None
+
+        # Whether [incremental decoding](#incremental) is on
+        self.is_incremental = False
+        # Projected keys and values of the past positions in incremental decoding
+        self.kv_cache: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
+        # Position of the first query. This is the number of cached positions in incremental decoding.
+        self.offset = 0
+
+    def set_incremental(self, is_incremental: bool):
+        """
+        <a id="incremental"></a>
+
+        ### Turn incremental decoding on or off
+
+        In incremental decoding the model is only fed the new tokens.
+        The projected keys and values of self-attention are cached,
+        and the queries of the new tokens attend to the cached keys and values as well as the new ones.
+        The `mask` passed to `forward` is for the new tokens only,
+        and all cached positions are visible to all new tokens (i.e. a causal mask).
+
+        This clears the cache.
+        """
+        self.is_incremental = is_incremental
+        self.kv_cache = None
+        self.offset = 0
+
+    def update_kv_cache(self, key: torch.Tensor, value: torch.Tensor, mask: Optional[torch.Tensor]):
+        """
+        ### Add keys and values of new positions to the cache
+
+        `key` and `value` are projected keys and values of shape `[seq_len, batch_size, heads, d_k]`,
+        and `mask` has shape `[seq_len, seq_len, batch_size]`.
+
+        This returns keys and values of all positions,
+        and the mask extended to the cached positions.
+        """
+        if self.kv_cache is None:
+            self.offset = 0
+        else:
+            past_key, past_value = self.kv_cache
+            self.offset = past_key.shape[0]
+            # Concatenate with the cached keys and values
+            key = torch.cat([past_key, key], dim=0)
+            value = torch.cat([past_value, value], dim=0)
+            # Cached positions are visible to all the new queries
+            if mask is not None:
+                past_mask = mask.new_ones((mask.shape[0], self.offset, mask.shape[2]))
+                mask = torch.cat([past_mask, mask], dim=1)
+
+        self.kv_cache = (key, value)
+
+        return key, value, mask
+
+    def get_query_key(self, query: torch.Tensor, key: torch.Tensor):
+        """
+        ### Transform queries and keys before the dot-product
+
+        This method can be overridden for variations like rotary positional embeddings.
+        """
+        return query, key
+
+    def get_score_bias(self, query: torch.Tensor, key: torch.Tensor) -> Optional[torch.Tensor]:
+        """
+        ### Bias added to the scaled scores
+
+        This method can be overridden for variations like relative attention and ALiBi.
+        It returns `None` or a tensor of shape `[seq_len_q, seq_len_k, batch_size or 1, heads]`.
+        """
+        return None
 
     def get_scores(self, query: torch.Tensor, key: torch.Tensor):
         """
         ### Calculate scores between queries and keys
 
-        This method can be overridden for other variations like relative attention.
+        This method can be overridden for other variations,
+        but then attention is computed with the full score matrix instead of an
+        [attention backend](attention_backend/index.html).
         """
 
+        query, key = self.get_query_key(query, key)
         # Calculate $Q K^\top$ or $S_{ijbh} = \sum_d Q_{ibhd} K_{jbhd}$
         return torch.einsum('ibhd,jbhd->ijbh', query, key)
 
@@ -161,9 +243,9 @@ class MultiHeadAttention(nn.Module):
 
         # `query`, `key` and `value`  have shape `[seq_len, batch_size, d_model]`
         seq_len, batch_size, _ = query.shape
-
-        if mask is not None:
-            mask = self.prepare_mask(mask, query.shape, key.shape)
+        # Only self-attention is cached in incremental decoding;
+        # keys and values from a source don't change
+        is_cached = self.is_incremental and query is key
 
         # Prepare `query`, `key` and `value` for attention computation.
         # These will then have shape `[seq_len, batch_size, heads, d_k]`.
@@ -171,6 +253,87 @@ class MultiHeadAttention(nn.Module):
         key = self.key(key)
         value = self.value(value)
 
+        # Add the cached keys and values in [incremental decoding](#incremental)
+        if is_cached:
+            key, value, mask = self.update_kv_cache(key, value, mask)
+
+        if mask is not None:
+            mask = self.prepare_mask(mask, query.shape, key.shape)
+
+        # Compute attention.
+        # This gives a tensor of shape `[seq_len, batch_size, heads, d_k]`.
+        x = self.compute_attention(query, key, value, mask)
+
+        # Concatenate multiple heads
+        x = x.reshape(seq_len, batch_size, -1)
+
+        # Output layer
+        return self.output(x)
+
+    def compute_attention(self, query: torch.Tensor, key: torch.Tensor, value: torch.Tensor,
+                          mask: Optional[torch.Tensor]):
+        """
+        ### Compute attention
+
+        `query`, `key` and `value` are the projected vectors of shape `[seq_len, batch_size, heads, d_k]`
+        and `mask` is the prepared mask of shape `[seq_len_q, seq_len_k, batch_size, 1]`.
+
+        If a sub-class overrides `get_scores`, this computes the full score matrix.
+        Otherwise it uses an [attention backend](attention_backend/index.html),
+        with queries and keys from `get_query_key` and the bias from `get_score_bias`.
+        If the `einsum` backend is selected, the full score matrix is computed here instead,
+        so that the attention probabilities are kept in `self.attn` and logged with `tracker.debug`.
+        """
+
+        if type(self).get_scores is not MultiHeadAttention.get_scores:
+            return self.compute_attention_scores(query, key, value, mask)
+
+        bias = self.get_score_bias(query, key)
+        query, key = self.get_query_key(query, key)
+
+        # Change the mask and bias to shape `[batch_size, heads, seq_len_q, seq_len_k]`
+        if bias is not None:
+            attn_mask = bias if mask is None else bias.masked_fill(mask == 0, float('-inf'))
+            attn_mask = attn_mask.permute(2, 3, 0, 1)
+        elif mask is not None:
+            # Boolean masks are used as they are,
+            # so that views of the [cached causal mask](mask_cache.html) are recognized without reading them
+            attn_mask = (mask if mask.dtype == torch.bool else mask != 0).permute(2, 3, 0, 1)
+        else:
+            attn_mask = None
+
+        # Tensors of shape `[batch_size, heads, seq_len, d_k]`
+        q, k, v = query.permute(1, 2, 0, 3), key.permute(1, 2, 0, 3), value.permute(1, 2, 0, 3)
+        dropout_prob = self.dropout.p if self.training else 0.
+
+        # Replace causal masks with `is_causal` so that kernels don't have to read the mask
+        is_causal = False
+        if attn_mask is not None and is_causal_mask(attn_mask, q.shape[2], k.shape[2]):
+            attn_mask, is_causal = None, True
+
+        # Compute the full score matrix here if the `einsum` backend is selected
+        backend = select_backend(q, k, attn_mask, is_causal=is_causal, dropout_prob=dropout_prob,
+                                 backend=self.backend)
+        if backend == 'einsum':
+            scores = torch.einsum('ibhd,jbhd->ijbh', query, key) * self.scale
+            return self.attend(scores, bias, value, mask)
+
+        # Attention with an attention backend
+        x = attention(q, k, v, attn_mask, is_causal=is_causal, scale=self.scale, dropout_prob=dropout_prob,
+                      backend=backend)
+
+        # Attention probabilities are not computed by the other backends
+        self.attn = None
+
+        # Change to shape `[seq_len, batch_size, heads, d_k]`
+        return x.permute(2, 0, 1, 3)
+
+    def compute_attention_scores(self, query: torch.Tensor, key: torch.Tensor, value: torch.Tensor,
+                                 mask: Optional[torch.Tensor]):
+        """
+        ### Compute attention with the full score matrix
+        """
+
         # Compute attention scores $Q K^\top$.
         # This gives a tensor of shape `[seq_len, seq_len, batch_size, heads]`.
         scores = self.get_scores(query, key)
@@ -178,6 +341,21 @@ class MultiHeadAttention(nn.Module):
         # Scale scores $\frac{Q K^\top}{\sqrt{d_k}}$
         scores *= self.scale
 
+        #
+        return self.attend(scores, self.get_score_bias(query, key), value, mask)
+
+    def attend(self, scores: torch.Tensor, bias: Optional[torch.Tensor], value: torch.Tensor,
+               mask: Optional[torch.Tensor]):
+        """
+        ### Attention probabilities and the weighted sum of values
+
+        `scores` are the scaled scores of shape `[seq_len_q, seq_len_k, batch_size, heads]`.
+        """
+
+        # Add the bias
+        if bias is not None:
+            scores = scores + bias
+
         # Apply mask
         if mask is not None:
             scores = scores.masked_fill(mask == 0, float('-inf'))
@@ -196,11 +374,7 @@ class MultiHeadAttention(nn.Module):
         # $$\underset{seq}{softmax}\Bigg(\frac{Q K^\top}{\sqrt{d_k}}\Bigg)V$$
         x = torch.einsum("ijbh,jbhd->ibhd", attn, value)
 
-        # Save attentions for any other calculations 
+        # Save attentions for any other calculations
         self.attn = attn.detach()
 
-        # Concatenate multiple heads
-        x = x.reshape(seq_len, batch_size, -1)
-
-        # Output layer
-        return self.output(x)
+        return x
@@ -33,9 +33,22 @@ class EmbeddingsWithPositionalEncoding(nn.Module):
         self.linear = nn.Embedding(n_vocab, d_model)
         self.d_model = d_model
         self.register_buffer('positional_encodings', get_positional_encoding(d_model, max_len))
+        # Whether [incremental decoding](mha.html#incremental) is on
+        self.is_incremental = False
+        # Position of the first token. This is the number of tokens seen before in incremental decoding.
+        self.offset = 0
+
+    def set_incremental(self, is_incremental: bool):
+        """
+        Turn [incremental decoding](mha.html#incremental) on or off
+        """
+        self.is_incremental = is_incremental
+        self.offset = 0
 
     def forward(self, x: torch.Tensor):
-        pe = self.positional_encodings[:x.shape[0]].requires_grad_(False)
+        pe = self.positional_encodings[self.offset:self.offset + x.shape[0]].requires_grad_(False)
+        if self.is_incremental:
+            self.offset += x.shape[0]
         return self.linear(x) * math.sqrt(self.d_model) + pe
 
 
@@ -51,9 +64,22 @@ class EmbeddingsWithLearnedPositionalEncoding(nn.Module):
         self.linear = nn.Embedding(n_vocab, d_model)
         self.d_model = d_model
         self.positional_encodings = nn.Parameter(torch.zeros(max_len, 1, d_model), requires_grad=True)
+        # Whether [incremental decoding](mha.html#incremental) is on
+        self.is_incremental = False
+        # Position of the first token. This is the number of tokens seen before in incremental decoding.
+        self.offset = 0
+
+    def set_incremental(self, is_incremental: bool):
+        """
+        Turn [incremental decoding](mha.html#incremental) on or off
+        """
+        self.is_incremental = is_incremental
+        self.offset = 0
 
     def forward(self, x: torch.Tensor):
-        pe = self.positional_encodings[:x.shape[0]]
+        pe = self.positional_encodings[self.offset:self.offset + x.shape[0]]
+        if self.is_incremental:
+            self.offset += x.shape[0]
         return self.linear(x) * math.sqrt(self.d_model) + pe
 
 
@@ -64,6 +90,10 @@ class TransformerLayer(nn.Module):
     ## Transformer Layer
 
     This can act as an encoder layer or a decoder layer. We use pre-norm.
+
+    In [incremental decoding](mha.html#incremental) only the new tokens are passed through the layer;
+    self attention caches the keys and values of the past tokens,
+    and everything else is position-wise.
     """
 
     def __init__(self, *,
@@ -47,6 +47,9 @@ class MultiDConvHeadAttention(MultiHeadAttention):
     and add the spatial depth-wise convolution to query, key and value projections.
         """
 
+    # The convolutions need the past inputs, so this doesn't support incremental decoding
+    is_incremental_supported = False
+
     def __init__(self, heads: int, d_model: int, dropout_prob: float = 0.1):
         super().__init__(heads, d_model, dropout_prob)
 
@@ -64,6 +64,9 @@ class MultiDSharedConvHeadAttention(MultiHeadAttention):
     and add the spatial depth-wise shared convolution to query, key and value projections.
     """
 
+    # The convolutions need the past inputs, so this doesn't support incremental decoding
+    is_incremental_supported = False
+
     def __init__(self, heads: int, d_model: int, dropout_prob: float = 0.1):
         super().__init__(heads, d_model, dropout_prob)
 
@@ -130,6 +133,9 @@ class MultiDPHConvHeadAttention(MultiHeadAttention):
     and add the spatial depth-wise convolution to query, key and value projections.
     """
 
+    # The convolutions need the past inputs, so this doesn't support incremental decoding
+    is_incremental_supported = False
+
     def __init__(self, heads: int, d_model: int, dropout_prob: float = 0.1):
         super().__init__(heads, d_model, dropout_prob)
 
@@ -126,17 +126,17 @@ class RotaryPositionalEmbeddings(nn.Module):
         self.cos_cached = None
         self.sin_cached = None
 
-    def _build_cache(self, x: torch.Tensor):
+    def _build_cache(self, x: torch.Tensor, offset: int = 0):
         """
         Cache $\cos$ and $\sin$ values
         """
+        # Get sequence length
+        seq_len = offset + x.shape[0]
+
         # Return if cache is already built
-        if self.cos_cached is not None and x.shape[0] <= self.cos_cached.shape[0]:
+        if self.cos_cached is not None and seq_len <= self.cos_cached.shape[0]:
             return
 
-        # Get sequence length
-        seq_len = x.shape[0]
-
         # $\Theta = {\theta_i = 10000^{-\frac{2(i-1)}{d}}, i \in [1, 2, ..., \frac{d}{2}]}$
         theta = 1. / (self.base ** (torch.arange(0, self.d, 2).float() / self.d)).to(x.device)
 
@@ -161,12 +161,14 @@ class RotaryPositionalEmbeddings(nn.Module):
         # Calculate $[-x^{(\frac{d}{2} + 1)}, -x^{(\frac{d}{2} + 2)}, ..., -x^{(d)}, x^{(1)}, x^{(2)}, ..., x^{(\frac{d}{2})}]$
         return torch.cat([-x[:, :, :, d_2:], x[:, :, :, :d_2]], dim=-1)
 
-    def forward(self, x: torch.Tensor):
+    def forward(self, x: torch.Tensor, offset: int = 0):
         """
         * `x` is the Tensor at the head of a key or a query with shape `[seq_len, batch_size, n_heads, d]`
+        * `offset` is the position of the first element of `x`.
+         This is non-zero for queries in incremental decoding.
         """
         # Cache $\cos$ and $\sin$ values
-        self._build_cache(x)
+        self._build_cache(x, offset)
 
         # Sequence length
         seq_len = x.shape[0]
@@ -188,7 +190,8 @@ class RotaryPositionalEmbeddings(nn.Module):
         # \end{align}
         #
         # for $i \in {1, 2, ..., \frac{d}{2}}$
-        x_rope = (x_rope * self.cos_cached[:seq_len]) + (neg_half_x * self.sin_cached[:seq_len])
+        x_rope = (x_rope * self.cos_cached[offset:offset + seq_len]) + \
+                 (neg_half_x * self.sin_cached[offset:offset + seq_len])
 
         #
         return torch.cat((x_rope, x_pass), dim=-1)
@@ -209,13 +212,15 @@ class RotaryPEMultiHeadAttention(MultiHeadAttention):
         self.query_rotary_pe = RotaryPositionalEmbeddings(d_rope)
         self.key_rotary_pe = RotaryPositionalEmbeddings(d_rope)
 
-    def get_scores(self, query: torch.Tensor, key: torch.Tensor):
+    def get_query_key(self, query: torch.Tensor, key: torch.Tensor):
         """
-        ### Calculate scores between queries and keys
+        ### Rotate queries and keys
+
+        The dot-product of the rotated queries and keys gives the scores with RoPE.
         """
 
-        # Calculate dot-product with RoPE
-        return torch.einsum('ibhd,jbhd->ijbh', self.query_rotary_pe(query), self.key_rotary_pe(key))
+        # Queries start at position `offset` in [incremental decoding](../mha.html#incremental).
+        return self.query_rotary_pe(query, self.offset), self.key_rotary_pe(key)
 
 
 def _test_rotary():
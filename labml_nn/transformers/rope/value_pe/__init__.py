@@ -129,12 +129,16 @@ class ReverseRotaryPositionalEmbeddings(RotaryPositionalEmbeddings):
     This inherits from [RoPE rotation implementation](../index.html) and changes the direction.
     """
 
-    def forward(self, x: torch.Tensor):
+    def forward(self, x: torch.Tensor, offset: int = 0):
         """
         * `x` is the Tensor at the head of a key or a query with shape `[seq_len, batch_size, n_heads, d]`
+        * `offset` is the position of the first element of `x`
         """
         # Cache $\cos$ and $\sin$ values
-        self._build_cache(x)
+        self._build_cache(x, offset)
+
+        # Sequence length
+        seq_len = x.shape[0]
 
         # Split the features, we can choose to apply rotary embeddings only to a partial set of features.
         x_rope, x_pass = x[..., :self.d], x[..., self.d:]
@@ -157,7 +161,8 @@ class ReverseRotaryPositionalEmbeddings(RotaryPositionalEmbeddings):
         # \end{align}
         #
         # for $i \in {1, 2, ..., \frac{d}{2}}$
-        x_rope = (x_rope * self.cos_cached[:x.shape[0]]) - (neg_half_x * self.sin_cached[:x.shape[0]])
+        x_rope = (x_rope * self.cos_cached[offset:offset + seq_len]) - \
+                 (neg_half_x * self.sin_cached[offset:offset + seq_len])
 
         #
         return torch.cat((x_rope, x_pass), dim=-1)
@@ -198,9 +203,8 @@ class RotaryValuePEMultiHeadAttention(RotaryPEMultiHeadAttention):
 
         # `query`, `key` and `value`  have shape `[seq_len, batch_size, d_model]`
         seq_len, batch_size, _ = query.shape
-
-        if mask is not None:
-            mask = self.prepare_mask(mask, query.shape, key.shape)
+        # Only self-attention is cached in incremental decoding
+        is_cached = self.is_incremental and query is key
 
         # Prepare `query`, `key` and `value` for attention computation.
         # These will then have shape `[seq_len, batch_size, heads, d_k]`.
@@ -208,36 +212,22 @@ class RotaryValuePEMultiHeadAttention(RotaryPEMultiHeadAttention):
         key = self.key(key)
         value = self.value(value)
 
-        # Compute attention scores $Q K^\top$.
-        # This gives a tensor of shape `[seq_len, seq_len, batch_size, heads]`.
-        scores = self.get_scores(query, key)
-
-        # Scale scores $\frac{Q K^\top}{\sqrt{d_k}}$
-        scores *= self.scale
+        # Add the cached keys and values in [incremental decoding](../../mha.html#incremental)
+        if is_cached:
+            key, value, mask = self.update_kv_cache(key, value, mask)
 
-        # Apply mask
         if mask is not None:
-            scores = scores.masked_fill(mask == 0, float('-inf'))
-
-        # $softmax$ attention along the key sequence dimension
-        # $\underset{seq}{softmax}\Bigg(\frac{Q K^\top}{\sqrt{d_k}}\Bigg)$
-        attn = self.softmax(scores)
-
-        # Apply dropout
-        attn = self.dropout(attn)
+            mask = self.prepare_mask(mask, query.shape, key.shape)
 
         # Rotate value embeddings before taking the weighted sum so that they contain positional information
         value = self.value_rotary_pe(value)
 
-        # Multiply by values
-        # $$\underset{seq}{softmax}\Bigg(\frac{Q K^\top}{\sqrt{d_k}}\Bigg)V$$
-        x = torch.einsum("ijbh,jbhd->ibhd", attn, value)
+        # Compute attention.
+        # This gives a tensor of shape `[seq_len, batch_size, heads, d_k]`.
+        x = self.compute_attention(query, key, value, mask)
 
         # Rotate in the opposite direction so that each embedding hold the relative positions
-        x = self.value_reverse_rotary_pe(x)
-
-        # Save attentions for any other calculations
-        self.attn = attn.detach()
+        x = self.value_reverse_rotary_pe(x, self.offset)
 
         # Concatenate multiple heads
         x = x.reshape(seq_len, batch_size, -1)
@@ -28,6 +28,13 @@ In our implementation this doesn't parallelize well when you have many or large
 happening on a single GPU.
 In a distributed setup you would have each FFN (each very large) on a different device.
 
+With `is_batched` the experts are kept as [stacked weights](#BatchedFeedForward)
+and tokens are [dispatched](#dispatch) by sorting them by route,
+so that all experts run as a single batched matrix multiplication instead of one at a time.
+Here's [a benchmark](benchmark.html) that compares the two.
+
+[Expert parallel switch feed-forward](expert_parallel.html) splits the experts among multiple processes.
+
 The paper introduces another loss term to balance load among the experts (FFNs) and
 discusses dropping tokens when routing is not balanced.
 
@@ -36,6 +43,8 @@ Here's [the training code](experiment.html) and a notebook for training a switch
 [![Open In Colab](https://colab.research.google.com/assets/colab-badge.svg)](https://colab.research.google.com/github/labmlai/annotated_deep_learning_paper_implementations/blob/master/labml_nn/transformers/switch/experiment.ipynb)
 """
 
+from typing import Optional
+
 import torch
 from torch import nn
 
@@ -44,6 +53,101 @@ from labml_nn.transformers.mha import MultiHeadAttention
 from labml_nn.utils import clone_module_list
 
 
+class BatchedFeedForward(nn.Module):
+    """
+    <a id="BatchedFeedForward"></a>
+
+    ## Experts with stacked weights
+
+    This keeps the weights of `n_experts` copies of a [FFN module](../feed_forward.html) stacked,
+    and runs all of them with batched matrix multiplications.
+    """
+
+    def __init__(self, expert: FeedForward, n_experts: int):
+        """
+        * `expert` is the expert layer; all experts are initialized with its weights
+        * `n_experts` is the number of experts
+        """
+        super().__init__()
+        self.n_experts = n_experts
+        self.activation = expert.activation
+        self.dropout = expert.dropout
+        self.is_gated = expert.is_gated
+
+        # Weights and biases of the linear layers of the experts, stacked.
+        # They have shapes `[n_experts, out_features, in_features]` and `[n_experts, out_features]`.
+        self.weight1, self.bias1 = self._stack(expert.layer1)
+        self.weight2, self.bias2 = self._stack(expert.layer2)
+        if self.is_gated:
+            self.weight_v, self.bias_v = self._stack(expert.linear_v)
+
+    def _stack(self, linear: nn.Linear):
+        weight = nn.Parameter(linear.weight.detach()[None].repeat(self.n_experts, 1, 1))
+        if linear.bias is None:
+            return weight, None
+        return weight, nn.Parameter(linear.bias.detach()[None].repeat(self.n_experts, 1))
+
+    @torch.no_grad()
+    def load_experts(self, experts: nn.ModuleList):
+        """
+        ### Copy the weights from a list of [FFN modules](../feed_forward.html)
+        """
+        for i, e in enumerate(experts):
+            self.weight1[i] = e.layer1.weight
+            self.weight2[i] = e.layer2.weight
+            if self.bias1 is not None:
+                self.bias1[i] = e.layer1.bias
+            if self.bias2 is not None:
+                self.bias2[i] = e.layer2.bias
+            if self.is_gated:
+                self.weight_v[i] = e.linear_v.weight
+                if self.bias_v is not None:
+                    self.bias_v[i] = e.linear_v.bias
+
+    @staticmethod
+    def _bias(bias: Optional[torch.Tensor], e: slice):
+        return None if bias is None else bias[e]
+
+    @staticmethod
+    def _linear(x: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor]):
+        # $x W^\top + b$ for each expert
+        if bias is None:
+            return torch.bmm(x, weight.transpose(1, 2))
+        return torch.baddbmm(bias[:, None, :], x, weight.transpose(1, 2))
+
+    def forward(self, x: torch.Tensor, expert: Optional[int] = None):
+        """
+        * `x` has shape `[n_experts, capacity, d_model]` with the tokens of each expert,
+         or `[n_tokens, d_model]` with the tokens of `expert`
+        * `expert` is the index of the expert to run, or `None` to run all of them
+        """
+        # Weights of all the experts, or of `expert`
+        if expert is None:
+            e = slice(None)
+        else:
+            e = slice(expert, expert + 1)
+            x = x[None]
+
+        # $f(x W_1 + b_1)$
+        g = self.activation(self._linear(x, self.weight1[e], self._bias(self.bias1, e)))
+        # If gated, $f(x W_1 + b_1) \otimes (x V + b) $
+        if self.is_gated:
+            x = g * self._linear(x, self.weight_v[e], self._bias(self.bias_v, e))
+        # Otherwise
+        else:
+            x = g
+        # Apply dropout
+        x = self.dropout(x)
+        # $(f(x W_1 + b_1) \otimes (x V + b)) W_2 + b_2$ or $f(x W_1 + b_1) W_2 + b_2$
+        x = self._linear(x, self.weight2[e], self._bias(self.bias2, e))
+
+        #
+        if expert is None:
+            return x
+        else:
+            return x[0]
+
+
 class SwitchFeedForward(nn.Module):
     """
     ## Routing among multiple FFNs
@@ -55,7 +159,9 @@ class SwitchFeedForward(nn.Module):
                  is_scale_prob: bool,
                  n_experts: int,
                  expert: FeedForward,
-                 d_model: int):
+                 d_model: int,
+                 is_batched: bool = False,
+                 max_buffer_factor: float = 2.):
         """
         * `capacity_factor` is the capacity of each expert as a factor relative to ideally balanced load
         * `drop_tokens` specifies whether to drop tokens if more tokens are routed to an expert than the capacity
@@ -65,6 +171,10 @@ class SwitchFeedForward(nn.Module):
         * `d_model` is the number of features in a token embedding
         * `d_ff` is the number of features in the hidden layer of the FFN
         * `dropout` is dropout probability in the FFN
+        * `is_batched` specifies whether to keep the experts as [stacked weights](#BatchedFeedForward)
+         and [dispatch](#dispatch) tokens to all experts at once
+        * `max_buffer_factor` is the maximum size of the [dispatch](#dispatch) buffer
+         relative to the number of tokens, when tokens are not dropped
         """
         super().__init__()
 
@@ -72,9 +182,14 @@ class SwitchFeedForward(nn.Module):
         self.is_scale_prob = is_scale_prob
         self.n_experts = n_experts
         self.drop_tokens = drop_tokens
+        self.is_batched = is_batched
+        self.max_buffer_factor = max_buffer_factor
 
         # make copies of the FFNs
-        self.experts = clone_module_list(expert, n_experts)
+        if is_batched:
+            self.experts = BatchedFeedForward(expert, n_experts)
+        else:
+            self.experts = clone_module_list(expert, n_experts)
         # Routing layer and softmax
         self.switch = nn.Linear(d_model, n_experts)
         self.softmax = nn.Softmax(dim=-1)
@@ -99,17 +214,58 @@ class SwitchFeedForward(nn.Module):
         # We route to the expert with highest probability
         route_prob_max, routes = torch.max(route_prob, dim=-1)
 
+        # Capacity of each expert.
+        # $$\mathrm{expert\;capacity} =
+        # \frac{\mathrm{tokens\;per\;batch}}{\mathrm{number\;of\;experts}}
+        # \times \mathrm{capacity\;factor}$$
+        capacity = int(self.capacity_factor * len(x) / self.n_experts)
+
+        # Run the experts
+        if self.is_batched:
+            final_output, counts, n_dropped = self.dispatch(x, routes, capacity)
+        else:
+            final_output, counts, n_dropped = self.run_experts(x, routes, capacity)
+
+        if self.is_scale_prob:
+            # Multiply by the expert outputs by the probabilities $y = p_i(x) E_i(x)$
+            final_output = final_output * route_prob_max.view(-1, 1)
+        else:
+            # Don't scale the values but multiply by $\frac{p}{\hat{p}} = 1$ so that the gradients flow
+            # (this is something we experimented with).
+            final_output = final_output * (route_prob_max / route_prob_max.detach()).view(-1, 1)
+
+        # Change the shape of the final output back to `[seq_len, batch_size, d_model]`
+        final_output = final_output.view(seq_len, batch_size, d_model)
+
+        # Return
+        #
+        # * the final output
+        # * number of tokens routed to each expert
+        # * sum of probabilities for each expert
+        # * number of tokens dropped.
+        # * routing probabilities of the selected experts
+        #
+        # These are used for the load balancing loss and logging
+        return final_output, counts, route_prob.sum(0), n_dropped, route_prob_max
+
+    def run_experts(self, x: torch.Tensor, routes: torch.Tensor, capacity: int):
+        """
+        <a id="run_experts"></a>
+
+        ### Run the experts one at a time
+
+        * `x` is the tokens of shape `[n_tokens, d_model]`
+        * `routes` is the expert of each token
+        * `capacity` is the capacity of each expert
+
+        Returns the outputs, the number of tokens routed to each expert and the number of dropped tokens.
+        """
         # Get indexes of tokens going to each expert
         indexes_list = [torch.eq(routes, i).nonzero(as_tuple=True)[0] for i in range(self.n_experts)]
 
         # Initialize an empty tensor to store outputs
         final_output = x.new_zeros(x.shape)
 
-        # Capacity of each expert.
-        # $$\mathrm{expert\;capacity} =
-        # \frac{\mathrm{tokens\;per\;batch}}{\mathrm{number\;of\;experts}}
-        # \times \mathrm{capacity\;factor}$$
-        capacity = int(self.capacity_factor * len(x) / self.n_experts)
         # Number of tokens routed to each expert.
         counts = x.new_tensor([len(indexes_list[i]) for i in range(self.n_experts)])
 
@@ -141,27 +297,75 @@ class SwitchFeedForward(nn.Module):
             dropped = torch.cat(dropped)
             final_output[dropped, :] = x[dropped, :]
 
-        if self.is_scale_prob:
-            # Multiply by the expert outputs by the probabilities $y = p_i(x) E_i(x)$
-            final_output = final_output * route_prob_max.view(-1, 1)
+        #
+        return final_output, counts, len(dropped)
+
+    def dispatch(self, x: torch.Tensor, routes: torch.Tensor, capacity: int):
+        """
+        <a id="dispatch"></a>
+
+        ### Run all the experts at once
+
+        This sorts the tokens by route once, packs them into a `[n_experts, capacity, d_model]` buffer,
+        runs all the [experts](#BatchedFeedForward) with batched matrix multiplications,
+        and writes the outputs back with a single scatter.
+
+        It drops the same number of tokens as [`run_experts`](#run_experts), and the dropped tokens
+        are also picked randomly among the tokens routed to an expert.
+
+        The buffer has space for the largest number of tokens kept for an expert.
+        Without dropping tokens (or with a large capacity factor)
+        it can be close to `n_experts` times the number of tokens when routing is skewed.
+        If the buffer would be larger than `max_buffer_factor` times the number of tokens,
+        the experts run one at a time on their segments of the sorted tokens instead.
+        """
+        n_tokens, d_model = x.shape
+
+        # Number of tokens routed to each expert
+        counts = torch.bincount(routes, minlength=self.n_experts)
+
+        # Sort tokens by route.
+        # When dropping tokens, the tokens routed to an expert are shuffled
+        # so that a random subset of them is over capacity.
+        if self.drop_tokens:
+            order = torch.argsort(routes * n_tokens + torch.randperm(n_tokens, device=x.device))
         else:
-            # Don't scale the values but multiply by $\frac{p}{\hat{p}} = 1$ so that the gradients flow
-            # (this is something we experimented with).
-            final_output = final_output * (route_prob_max / route_prob_max.detach()).view(-1, 1)
+            order = torch.argsort(routes, stable=True)
+        sorted_routes = routes[order]
+        # Position of each sorted token among the tokens of its expert
+        offsets = torch.cumsum(counts, dim=0) - counts
+        positions = torch.arange(n_tokens, device=x.device) - offsets[sorted_routes]
+
+        # Size of the buffer; the largest number of tokens an expert gets
+        max_count = int(counts.max())
+        # Only drop tokens if `drop_tokens` is `True`.
+        if self.drop_tokens:
+            # Keep only the tokens upto the capacity of the expert
+            keep = positions < capacity
+            order, sorted_routes, positions = order[keep], sorted_routes[keep], positions[keep]
+            max_count = min(max_count, capacity)
+        n_dropped = n_tokens - len(order)
+
+        # Run the experts on their segments of the sorted tokens if the buffer would be too large
+        if self.n_experts * max_count > self.max_buffer_factor * n_tokens:
+            # Number of tokens each expert runs on, after dropping
+            kept = counts.clamp(max=capacity) if self.drop_tokens else counts
+            segments = x[order].split(kept.tolist())
+            expert_output = torch.cat([self.experts(segments[i], i) for i in range(self.n_experts)])
+            final_output = x.index_put((order,), expert_output)
+            return final_output, counts.to(x.dtype), n_dropped
+
+        # Pack the tokens into a `[n_experts, max_count, d_model]` buffer
+        buffer = x.new_zeros(self.n_experts, max_count, d_model)
+        buffer[sorted_routes, positions] = x[order]
+        # Get outputs of the expert FFNs
+        expert_output = self.experts(buffer)
 
-        # Change the shape of the final output back to `[seq_len, batch_size, d_model]`
-        final_output = final_output.view(seq_len, batch_size, d_model)
+        # Assign the expert outputs to the tokens, and pass through the dropped tokens
+        final_output = x.index_put((order,), expert_output[sorted_routes, positions])
 
-        # Return
         #
-        # * the final output
-        # * number of tokens routed to each expert
-        # * sum of probabilities for each expert
-        # * number of tokens dropped.
-        # * routing probabilities of the selected experts
-        #
-        # These are used for the load balancing loss and logging
-        return final_output, counts, route_prob.sum(0), len(dropped), route_prob_max
+        return final_output, counts.to(x.dtype), n_dropped
 
 
 class SwitchTransformerLayer(nn.Module):
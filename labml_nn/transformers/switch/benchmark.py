@@ -0,0 +1,189 @@
+"""
+---
+title: Benchmark batched expert dispatch
+summary: >
+  Check that batched expert dispatch matches running experts one at a time,
+  and compare their speed for different numbers of experts.
+---
+
+# Benchmark Batched Expert Dispatch
+
+This compares [switch feed-forward](index.html) with experts that run one at a time,
+and with all experts running at once on [stacked weights](index.html#BatchedFeedForward)
+after [sorting tokens by route](index.html#dispatch).
+
+It checks that the outputs, gradients and load balancing statistics are the same,
+also with skewed routing, and that the same number of tokens is dropped,
+and then measures the time of the forward and backward passes for $8$ to $128$ experts.
+
+```bash
+python -m labml_nn.transformers.switch.benchmark --n_experts 8 16 32 64 128
+```
+"""
+
+import argparse
+import statistics
+import time
+
+import torch
+
+from labml import logger, monit
+from labml.logger import Text
+from labml_nn.transformers.feed_forward import FeedForward
+from labml_nn.transformers.switch import SwitchFeedForward
+
+
+def _check(name: str, a: torch.Tensor, b: torch.Tensor, atol: float = 1e-5):
+    diff = (a - b).abs().max().item() if a.numel() else 0.
+    passed = diff <= atol
+    logger.log([(f'{name :<32}', Text.key), (f'{diff :.2e}', Text.value),
+                (' [PASSED]' if passed else ' [FAILED]', Text.success if passed else Text.danger)])
+    return passed
+
+
+def create(n_experts: int, d_model: int, d_ff: int, *, drop_tokens: bool, capacity_factor: float = 1.0):
+    """
+    ### Create switch feed-forward modules with experts that run one at a time and batched
+
+    Both have the same weights.
+    """
+    ffs = []
+    for is_batched in [False, True]:
+        ffs.append(SwitchFeedForward(capacity_factor=capacity_factor,
+                                     drop_tokens=drop_tokens,
+                                     is_scale_prob=True,
+                                     n_experts=n_experts,
+                                     expert=FeedForward(d_model, d_ff, dropout=0.),
+                                     d_model=d_model,
+                                     is_batched=is_batched))
+    loop, batched = ffs
+
+    # Experts are copies of the same FFN; make them different
+    with torch.no_grad():
+        for p in loop.experts.parameters():
+            p.normal_(std=0.1)
+    batched.switch.load_state_dict(loop.switch.state_dict())
+    batched.experts.load_experts(loop.experts)
+
+    return loop, batched
+
+
+def test(n_experts: int = 16, n_tokens: int = 512, d_model: int = 32, d_ff: int = 64):
+    """
+    ### Check that batched dispatch gives the same results
+    """
+    torch.manual_seed(0)
+    passed = True
+
+    # Without dropping tokens the results should be the same.
+    # With skewed routing most tokens go to one expert,
+    # and the batched experts run on segments of the sorted tokens instead of a padded buffer.
+    for section, is_skewed in [('Without dropping', False), ('Skewed routing', True)]:
+        loop, batched = create(n_experts, d_model, d_ff, drop_tokens=False)
+        if is_skewed:
+            with torch.no_grad():
+                for ff in [loop, batched]:
+                    ff.switch.bias[0] += 5.
+        x = torch.randn(n_tokens, 1, d_model, requires_grad=True)
+        results = []
+        for ff in [loop, batched]:
+            out, counts, route_prob, n_dropped, route_prob_max = ff(x)
+            out.square().sum().backward()
+            results.append((out.detach(), counts, route_prob.detach(), n_dropped, x.grad, ff.switch.weight.grad))
+            x.grad = None
+
+        with monit.section(section):
+            for name, a, b in zip(['output', 'counts', 'route_prob', 'n_dropped', 'dx', 'd_switch'], *results):
+                if name == 'n_dropped':
+                    a, b = torch.tensor(float(a)), torch.tensor(float(b))
+                passed = _check(name, a, b) and passed
+
+    # With dropping tokens, the dropped tokens are picked randomly,
+    # so outputs are only the same for tokens routed to experts that are not over capacity
+    loop, batched = create(n_experts, d_model, d_ff, drop_tokens=True, capacity_factor=1.0)
+    x = torch.randn(n_tokens, 1, d_model)
+    with torch.no_grad():
+        results = [ff(x) for ff in [loop, batched]]
+        routes = torch.argmax(loop.switch(x.view(-1, d_model)), dim=-1)
+    capacity = int(n_tokens / n_experts)
+    under_capacity = results[0][1][routes] <= capacity
+
+    with monit.section('Dropping'):
+        passed = _check('counts', results[0][1], results[1][1]) and passed
+        passed = _check('n_dropped', torch.tensor(float(results[0][3])), torch.tensor(float(results[1][3]))) and passed
+        passed = _check('output under capacity',
+                        results[0][0].view(-1, d_model)[under_capacity],
+                        results[1][0].view(-1, d_model)[under_capacity]) and passed
+
+    # With a capacity factor larger than `max_buffer_factor` and skewed routing,
+    # the batched experts run on segments of the kept tokens
+    capacity_factor = 2.5
+    loop, batched = create(n_experts, d_model, d_ff, drop_tokens=True, capacity_factor=capacity_factor)
+    with torch.no_grad():
+        for ff in [loop, batched]:
+            ff.switch.bias[0] += 5.
+        results = [ff(x) for ff in [loop, batched]]
+        routes = torch.argmax(loop.switch(x.view(-1, d_model)), dim=-1)
+    capacity = int(capacity_factor * n_tokens / n_experts)
+    under_capacity = results[0][1][routes] <= capacity
+
+    with monit.section('Dropping with segments'):
+        passed = _check('counts', results[0][1], results[1][1]) and passed
+        passed = _check('n_dropped', torch.tensor(float(results[0][3])), torch.tensor(float(results[1][3]))) and passed
+        passed = _check('output under capacity',
+                        results[0][0].view(-1, d_model)[under_capacity],
+                        results[1][0].view(-1, d_model)[under_capacity]) and passed
+
+    return passed
+
+
+def measure(n_experts: int, *, n_tokens: int, d_model: int, d_ff: int, drop_tokens: bool, n_repeat: int = 10):
+    """
+    ### Measure the time of the forward and backward passes
+    """
+    torch.manual_seed(0)
+    loop, batched = create(n_experts, d_model, d_ff, drop_tokens=drop_tokens, capacity_factor=1.25)
+    x = torch.randn(n_tokens, 1, d_model, requires_grad=True)
+
+    res = {}
+    for name, ff in [('loop', loop), ('batched', batched)]:
+        times = []
+        for i in range(n_repeat + 1):
+            start = time.perf_counter()
+            out = ff(x)[0]
+            out.sum().backward()
+            # Ignore the first run as warmup
+            if i > 0:
+                times.append(time.perf_counter() - start)
+        ff.zero_grad()
+        res[name] = statistics.median(times)
+
+    logger.log([(f'n_experts={n_experts :4d}', Text.key),
+                ' loop ', (f'{res["loop"] * 1000 :10.2f}ms', Text.value),
+                ' batched ', (f'{res["batched"] * 1000 :10.2f}ms', Text.value),
+                ' speedup ', (f'{res["loop"] / res["batched"] :6.2f}x', Text.success)])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--n_experts", type=int, nargs='+', default=[8, 16, 32, 64, 128], help="numbers of experts")
+    parser.add_argument("--n_tokens", type=int, default=4096, help="number of tokens")
+    parser.add_argument("--d_model", type=int, default=128, help="number of features in embeddings")
+    parser.add_argument("--d_ff", type=int, default=512, help="number of features in the FFN hidden layer")
+    parser.add_argument("--drop_tokens", action='store_true', help="drop tokens over capacity")
+
+    opt = parser.parse_args()
+
+    if test():
+        logger.log('[PASSED]', Text.success)
+    else:
+        logger.log('[FAILED]', Text.danger)
+
+    for n_experts in opt.n_experts:
+        measure(n_experts, n_tokens=opt.n_tokens, d_model=opt.d_model, d_ff=opt.d_ff, drop_tokens=opt.drop_tokens)
+
+
+#
+if __name__ == '__main__':
+    main()
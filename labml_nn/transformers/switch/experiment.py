@@ -8,13 +8,24 @@ summary: This experiment trains a small switch transformer on tiny Shakespeare d
 
 This is an annotated PyTorch experiment to train a switch transformer.
 
+It can also train with the experts split among multiple processes on one machine,
+with [expert parallel switch feed-forward](expert_parallel.html):
+
+```bash
+python -m labml_nn.transformers.switch.experiment --world_size 4
+```
+
 [![Open In Colab](https://colab.research.google.com/assets/colab-badge.svg)](https://colab.research.google.com/github/labmlai/annotated_deep_learning_paper_implementations/blob/master/labml_nn/transformers/switch/experiment.ipynb)
 """
 
+import argparse
+import datetime
+
 import torch
+import torch.distributed
 import torch.nn as nn
 
-from labml import experiment, tracker
+from labml import experiment, tracker, monit
 from labml.configs import option
 from labml_nn.helpers.trainer import BatchIndex
 from labml_nn.experiments.nlp_autoregression import NLPAutoRegressionConfigs
@@ -39,7 +50,7 @@ class AutoregressiveModel(nn.Module):
         # Initialize the subsequent mask
         if self.mask is None or self.mask.size(0) != len(x):
             from labml_nn.transformers.utils import subsequent_mask
-            self.mask = subsequent_mask(len(x)).to(x.device)
+            self.mask = subsequent_mask(len(x), x.device)
         # Token embeddings
         x = self.src_embed(x)
         # Run it through the transformer
@@ -82,6 +93,10 @@ class Configs(NLPAutoRegressionConfigs):
     drop_tokens: bool = False
     # Capacity factor to determine capacity of each model
     capacity_factor: float = 1.0
+    # Whether to run all experts at once with stacked weights
+    is_batched: bool = False
+    # Whether to split the experts among the processes
+    is_expert_parallel: bool = False
 
     def init(self):
         super().init()
@@ -104,6 +119,12 @@ class Configs(NLPAutoRegressionConfigs):
 
         # Get model outputs.
         output, counts, route_prob, n_dropped, route_prob_max = self.model(data)
+        # Fraction of tokens dropped
+        dropped = counts.new_tensor(n_dropped) / counts.sum(dim=-1, keepdims=True)
+        # With experts split among processes, the load balancing loss is computed over the tokens of all of them
+        if self.is_expert_parallel:
+            from labml_nn.transformers.switch.expert_parallel import all_reduce_routing
+            counts, route_prob = all_reduce_routing(counts, route_prob)
 
         # Calculate and cross entropy loss
         cross_entropy_loss = self.loss_func(output, target)
@@ -123,7 +144,7 @@ class Configs(NLPAutoRegressionConfigs):
         load_balancing_loss = self.n_experts * (route_frac * route_prob).sum()
 
         # Track stats
-        tracker.add('dropped.', total.new_tensor(n_dropped) / total)
+        tracker.add('dropped.', dropped)
         tracker.add('route.min.', route_frac.min())
         tracker.add('route.max.', route_frac.max())
         tracker.add('route.std.', route_frac.std())
@@ -144,8 +165,15 @@ class Configs(NLPAutoRegressionConfigs):
         if self.mode.is_train:
             # Calculate gradients
             loss.backward()
+            # Average the gradients of the replicated parameters across the processes,
+            # and clip gradients by the norm across the processes
+            if self.is_expert_parallel:
+                from labml_nn.transformers.switch.expert_parallel import sync_gradients, clip_grad_norm
+                sync_gradients(self.model)
+                clip_grad_norm(self.model, max_norm=self.grad_norm_clip)
             # Clip gradients
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=self.grad_norm_clip)
+            else:
+                torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=self.grad_norm_clip)
             # Take optimizer step
             self.optimizer.step()
             # Log the model parameters and gradients on last batch of every epoch
@@ -163,8 +191,12 @@ def autoregressive_model(c: Configs):
     """
     ### Initialize the auto-regressive model
     """
-    m = AutoregressiveModel(c.n_tokens, c.d_model, c.transformer)
-    return m.to(c.device)
+    m = AutoregressiveModel(c.n_tokens, c.d_model, c.transformer).to(c.device)
+    # Start all the processes with the same replicated parameters
+    if c.is_expert_parallel:
+        from labml_nn.transformers.switch.expert_parallel import broadcast_parameters
+        broadcast_parameters(m)
+    return m
 
 
 @option(Configs.transformer)
@@ -176,19 +208,58 @@ def switch_transformer(c: Configs):
     from labml_nn.transformers import MultiHeadAttention
     from labml_nn.transformers.feed_forward import FeedForward
 
+    if c.is_expert_parallel:
+        from labml_nn.transformers.switch.expert_parallel import ExpertParallelSwitchFeedForward
+        feed_forward = ExpertParallelSwitchFeedForward(capacity_factor=c.capacity_factor,
+                                                       drop_tokens=c.drop_tokens,
+                                                       is_scale_prob=c.is_scale_prob,
+                                                       n_experts=c.n_experts,
+                                                       expert=FeedForward(c.d_model, c.d_ff, c.dropout),
+                                                       d_model=c.d_model)
+    else:
+        feed_forward = SwitchFeedForward(capacity_factor=c.capacity_factor,
+                                         drop_tokens=c.drop_tokens,
+                                         is_scale_prob=c.is_scale_prob,
+                                         n_experts=c.n_experts,
+                                         expert=FeedForward(c.d_model, c.d_ff, c.dropout),
+                                         d_model=c.d_model,
+                                         is_batched=c.is_batched)
+
     return SwitchTransformer(
         SwitchTransformerLayer(d_model=c.d_model,
                                attn=MultiHeadAttention(c.heads, c.d_model, c.dropout),
-                               feed_forward=SwitchFeedForward(capacity_factor=c.capacity_factor,
-                                                              drop_tokens=c.drop_tokens,
-                                                              is_scale_prob=c.is_scale_prob,
-                                                              n_experts=c.n_experts,
-                                                              expert=FeedForward(c.d_model, c.d_ff, c.dropout),
-                                                              d_model=c.d_model),
+                               feed_forward=feed_forward,
                                dropout_prob=c.dropout),
         c.n_layers)
 
 
+def _configs():
+    """
+    ### Configurations to override
+    """
+    return {'tokenizer': 'character',
+            'text': 'tiny_shakespeare',
+            'optimizer.learning_rate': 1.,
+            'optimizer.optimizer': 'Noam',
+            'prompt': 'It is',
+            'prompt_separator': '',
+
+            'transformer': 'switch_transformer',
+            'n_experts': 4,
+
+            'drop_tokens': True,
+            'capacity_factor': 1.2,
+
+            'train_loader': 'shuffled_train_loader',
+            'valid_loader': 'shuffled_valid_loader',
+
+            'seq_len': 64,
+            'epochs': 128,
+            'batch_size': 32,
+            'inner_iterations': 25,
+            }
+
+
 def main():
     """
     ### Run the experiment
@@ -198,29 +269,49 @@ def main():
     # Create configs
     conf = Configs()
     # Load configurations
-    experiment.configs(conf,
-                       # A dictionary of configurations to override
-                       {'tokenizer': 'character',
-                        'text': 'tiny_shakespeare',
-                        'optimizer.learning_rate': 1.,
-                        'optimizer.optimizer': 'Noam',
-                        'prompt': 'It is',
-                        'prompt_separator': '',
-
-                        'transformer': 'switch_transformer',
-                        'n_experts': 4,
-
-                        'drop_tokens': True,
-                        'capacity_factor': 1.2,
-
-                        'train_loader': 'shuffled_train_loader',
-                        'valid_loader': 'shuffled_valid_loader',
-
-                        'seq_len': 64,
-                        'epochs': 128,
-                        'batch_size': 32,
-                        'inner_iterations': 25,
-                        })
+    experiment.configs(conf, _configs())
+
+    # Set models for saving and loading
+    experiment.add_pytorch_models({'model': conf.model})
+
+    # Start the experiment
+    with experiment.start():
+        # `TrainValidConfigs.run`
+        conf.run()
+
+
+def main_expert_parallel(rank: int, world_size: int, n_experts: int, init_method: str = 'tcp://localhost:23456'):
+    """
+    ### Run the experiment with experts split among processes
+
+    This runs in the process with rank `rank`.
+    Each process trains on different batches,
+    and holds `n_experts / world_size` of the experts of each layer.
+    """
+    # Initialize PyTorch distributed process group
+    with monit.section('Distributed'):
+        torch.distributed.init_process_group('gloo',
+                                             timeout=datetime.timedelta(seconds=60),
+                                             init_method=init_method,
+                                             rank=rank,
+                                             world_size=world_size)
+    # Processes share the CPU cores
+    torch.set_num_threads(max(1, torch.get_num_threads() // world_size))
+    # Different random batches and experts on each process
+    torch.manual_seed(rank)
+
+    # Create experiment
+    experiment.create(name="switch_transformer_expert_parallel", comment='',
+                      distributed_world_size=world_size,
+                      distributed_rank=rank)
+    # Create configs
+    conf = Configs()
+    # Load configurations
+    experiment.configs(conf, {**_configs(),
+                              'device.use_cuda': False,
+                              'is_expert_parallel': True,
+                              'n_experts': n_experts,
+                              })
 
     # Set models for saving and loading
     experiment.add_pytorch_models({'model': conf.model})
@@ -233,4 +324,13 @@ def main():
 
 #
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--world_size", type=int, default=1, help="number of processes")
+    parser.add_argument("--n_experts", type=int, default=4, help="number of experts")
+    opt = parser.parse_args()
+
+    if opt.world_size == 1:
+        main()
+    else:
+        torch.multiprocessing.spawn(main_expert_parallel, args=(opt.world_size, opt.n_experts),
+                                    nprocs=opt.world_size, join=True)
@@ -0,0 +1,333 @@
+"""
+---
+title: Expert parallel Switch Transformer
+summary: >
+  Switch feed-forward with experts split among processes,
+  exchanging tokens with all-to-all communication.
+---
+
+# Expert Parallel Switch Feed-Forward
+
+With [switch feed-forward](index.html) all experts have to fit in one process.
+Here each process (rank) holds `n_experts / world_size` of the experts,
+and tokens are sent to the rank that holds their expert and the outputs sent back
+with `all_to_all` communication.
+This works with the `gloo` backend on CPUs.
+
+Each rank routes its own tokens with a copy of the router.
+The ranks share the number of tokens each of them routes to each expert,
+so that they all agree on the capacities and on how many tokens are dropped.
+The capacity of an expert is computed from the total number of tokens on all the ranks,
+and is split among the ranks in proportion to the number of tokens each of them routes to the expert.
+So the total number of dropped tokens is the same as when all tokens are routed in a single process.
+
+The parameters other than the experts are replicated and their gradients are averaged across the ranks
+with [`sync_gradients`](#sync_gradients), like in data parallel training.
+Gradients are [clipped](#clip_grad_norm) by the norm of the gradients of all the ranks,
+so that the replicated parameters get the same update on all ranks.
+The load balancing loss is computed with the [routing statistics of all the ranks](#all_reduce_routing).
+
+Here's [a test and benchmark](expert_parallel_test.html) that checks the results
+match a single process, and measures scaling as the number of experts and ranks grow.
+"""
+
+from typing import List, Optional
+
+import torch
+import torch.distributed as dist
+import torch.distributed.nn.functional as dist_fn
+from torch import nn
+
+from labml_nn.transformers.feed_forward import FeedForward
+from labml_nn.transformers.switch import BatchedFeedForward, SwitchFeedForward
+
+
+class AllToAll(torch.autograd.Function):
+    """
+    ## All-to-all with gradients
+
+    Sends `input_splits[r]` rows of the input to rank `r`
+    and receives `output_splits[r]` rows from rank `r`.
+    The gradients are sent back along the reverse path.
+    """
+
+    @staticmethod
+    def forward(ctx, x: torch.Tensor, output_splits: List[int], input_splits: List[int], group):
+        ctx.output_splits, ctx.input_splits, ctx.group = output_splits, input_splits, group
+        out = x.new_empty((sum(output_splits), *x.shape[1:]))
+        dist.all_to_all_single(out, x.contiguous(), output_splits, input_splits, group=group)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad: torch.Tensor):
+        # Send the gradients back, swapping the splits
+        return AllToAll.apply(grad, ctx.input_splits, ctx.output_splits, ctx.group), None, None, None
+
+
+class ExpertParallelSwitchFeedForward(SwitchFeedForward):
+    """
+    ## Switch feed-forward with experts split among ranks
+    """
+
+    def __init__(self, *,
+                 capacity_factor: float,
+                 drop_tokens: bool,
+                 is_scale_prob: bool,
+                 n_experts: int,
+                 expert: FeedForward,
+                 d_model: int,
+                 max_buffer_factor: float = 2.,
+                 group: Optional[dist.ProcessGroup] = None):
+        """
+        The arguments are the same as [`SwitchFeedForward`](index.html), and
+
+        * `group` is the process group of the ranks that share the experts
+        """
+        # We don't call `SwitchFeedForward.__init__` since it creates all the experts
+        nn.Module.__init__(self)
+
+        self.capacity_factor = capacity_factor
+        self.is_scale_prob = is_scale_prob
+        self.n_experts = n_experts
+        self.drop_tokens = drop_tokens
+        self.max_buffer_factor = max_buffer_factor
+        # Tokens are always [dispatched](#dispatch) to the batched experts
+        self.is_batched = True
+
+        # Routing layer and softmax; these are replicated on all ranks
+        self.switch = nn.Linear(d_model, n_experts)
+        self.softmax = nn.Softmax(dim=-1)
+
+        self.group = group
+        self.world_size = dist.get_world_size(group)
+        self.rank = dist.get_rank(group)
+        assert n_experts % self.world_size == 0, 'Number of experts should be divisible by the number of ranks'
+        # Number of experts on each rank
+        self.n_local_experts = n_experts // self.world_size
+        # Experts of this rank, `rank * n_local_experts` to `(rank + 1) * n_local_experts - 1`
+        self.experts = BatchedFeedForward(expert, self.n_local_experts)
+
+    def gather_counts(self, counts: torch.Tensor):
+        """
+        ### Number of tokens each rank routes to each expert, `[world_size, n_experts]`
+        """
+        gathered = [torch.empty_like(counts) for _ in range(self.world_size)]
+        dist.all_gather(gathered, counts, group=self.group)
+        return torch.stack(gathered)
+
+    def split_capacity(self, counts: torch.Tensor, capacity: int):
+        r"""
+        ### Number of tokens each rank can send to each expert
+
+        * `counts` is the number of tokens each rank routes to each expert, `[world_size, n_experts]`
+        * `capacity` is the capacity of each expert
+
+        The capacity is split in proportion to the counts.
+        With $c_r$ tokens from rank $r$ and $C$ capacity,
+        rank $r$ can send $\Big\lfloor \frac{C \sum_{s \le r} c_s}{\sum_s c_s} \Big\rfloor -
+        \Big\lfloor \frac{C \sum_{s < r} c_s}{\sum_s c_s} \Big\rfloor \le c_r$ tokens,
+        which add up to $C$.
+        """
+        total = counts.sum(dim=0, keepdim=True)
+        cum = torch.cumsum(counts, dim=0)
+        # $\Big\lfloor \frac{C \sum_{s \le r} c_s}{\sum_s c_s} \Big\rfloor$
+        cum_quota = torch.div(cum * capacity, total.clamp(min=1), rounding_mode='floor')
+        quota = cum_quota - torch.cat((cum_quota.new_zeros(1, self.n_experts), cum_quota[:-1]), dim=0)
+        # Experts within capacity keep all their tokens
+        return torch.where(total > capacity, quota, counts)
+
+    def dispatch(self, x: torch.Tensor, routes: torch.Tensor, capacity: int):
+        """
+        <a id="dispatch"></a>
+
+        ### Send tokens to the ranks that hold their experts, run the experts and get the outputs back
+
+        The `capacity` computed from the tokens of this rank is ignored;
+        the capacity is computed from the tokens of all the ranks.
+        """
+        n_tokens, d_model = x.shape
+
+        # Number of tokens this rank routes to each expert
+        counts = torch.bincount(routes, minlength=self.n_experts)
+        # Number of tokens each rank routes to each expert
+        all_counts = self.gather_counts(counts)
+        # The capacity is for the tokens on all the ranks
+        capacity = int(self.capacity_factor * all_counts.sum().item() / self.n_experts)
+        # Number of tokens each rank sends to each expert
+        if self.drop_tokens:
+            sent = self.split_capacity(all_counts, capacity)
+        else:
+            sent = all_counts
+
+        # Sort tokens by route; shuffle the tokens of each expert to drop a random subset
+        if self.drop_tokens:
+            order = torch.argsort(routes * n_tokens + torch.randperm(n_tokens, device=x.device))
+        else:
+            order = torch.argsort(routes, stable=True)
+        sorted_routes = routes[order]
+        # Position of each sorted token among the tokens of its expert
+        offsets = torch.cumsum(counts, dim=0) - counts
+        positions = torch.arange(n_tokens, device=x.device) - offsets[sorted_routes]
+        # Keep the tokens within this rank's share of the capacity
+        order = order[positions < sent[self.rank][sorted_routes]]
+        n_dropped = n_tokens - len(order)
+
+        # Tokens sent to each rank; the tokens are sorted by expert so the tokens for a rank are contiguous
+        sent = sent.view(self.world_size, self.world_size, self.n_local_experts)
+        input_splits = sent[self.rank].sum(dim=-1).tolist()
+        # Tokens received from each rank
+        received = sent[:, self.rank]
+        output_splits = received.sum(dim=-1).tolist()
+
+        # Exchange the tokens
+        tokens = AllToAll.apply(x[order], output_splits, input_splits, self.group)
+
+        # The received tokens are ordered by the sending rank and then by expert.
+        # Find the local expert and the position among its tokens of each received token.
+        seg_counts = received.flatten()
+        seg_ids = torch.repeat_interleave(torch.arange(len(seg_counts), device=x.device), seg_counts)
+        seg_starts = torch.cumsum(seg_counts, dim=0) - seg_counts
+        # Offset of the tokens from each rank among the tokens of an expert
+        rank_offsets = (torch.cumsum(received, dim=0) - received).flatten()
+        positions = torch.arange(len(tokens), device=x.device) - seg_starts[seg_ids] + rank_offsets[seg_ids]
+        experts = seg_ids % self.n_local_experts
+
+        # Number of tokens each local expert gets
+        expert_counts = received.sum(dim=0)
+        max_count = int(expert_counts.max()) if len(tokens) else 0
+        # Run the experts on their segments of the tokens sorted by expert if the buffer would be too large
+        if self.n_local_experts * max_count > self.max_buffer_factor * len(tokens):
+            by_expert = torch.argsort(experts, stable=True)
+            segments = tokens[by_expert].split(expert_counts.tolist())
+            expert_output = torch.cat([self.experts(segments[i], i) for i in range(self.n_local_experts)])
+            # Back to the order of the received tokens
+            expert_output = expert_output[torch.argsort(by_expert)]
+        # Pack into a `[n_local_experts, max_count, d_model]` buffer and run the experts
+        else:
+            buffer = x.new_zeros(self.n_local_experts, max_count, d_model)
+            buffer[experts, positions] = tokens
+            expert_output = self.experts(buffer)[experts, positions]
+
+        # Send the outputs back
+        expert_output = AllToAll.apply(expert_output, input_splits, output_splits, self.group)
+
+        # Assign the outputs to the tokens, and pass through the dropped tokens
+        final_output = x.index_put((order,), expert_output)
+
+        #
+        return final_output, counts.to(x.dtype), n_dropped
+
+
+def _expert_params(model: nn.Module):
+    """
+    #### Ids of the parameters of the experts, which are different on each rank
+    """
+    return {id(p) for m in model.modules() if isinstance(m, ExpertParallelSwitchFeedForward)
+            for p in m.experts.parameters()}
+
+
+def sync_gradients(model: nn.Module, group: Optional[dist.ProcessGroup] = None):
+    """
+    <a id="sync_gradients"></a>
+
+    ## Synchronize gradients across ranks
+
+    Gradients of the replicated parameters are averaged across ranks.
+    The gradients of the experts already include the tokens from all the ranks,
+    so they are only divided by the number of ranks to match the averaged loss.
+    """
+    world_size = dist.get_world_size(group)
+    expert_modules = [m for m in model.modules() if isinstance(m, ExpertParallelSwitchFeedForward)]
+    expert_params = _expert_params(model)
+
+    # Flatten the gradients of the replicated parameters for a single all-reduce
+    grads = [p.grad for p in model.parameters() if p.grad is not None and id(p) not in expert_params]
+    if grads:
+        flat = torch.cat([g.flatten() for g in grads])
+        dist.all_reduce(flat, group=group)
+        flat /= world_size
+        offset = 0
+        for g in grads:
+            g.copy_(flat[offset:offset + g.numel()].view_as(g))
+            offset += g.numel()
+
+    for m in expert_modules:
+        for p in m.experts.parameters():
+            if p.grad is not None:
+                p.grad /= world_size
+
+
+def clip_grad_norm(model: nn.Module, max_norm: float, group: Optional[dist.ProcessGroup] = None):
+    r"""
+    <a id="clip_grad_norm"></a>
+
+    ## Clip gradients by the norm across ranks
+
+    This should be called after [`sync_gradients`](#sync_gradients).
+    Clipping each rank's gradients by their own norm would scale the replicated gradients
+    by a different coefficient on each rank, and the replicated parameters would drift apart.
+
+    The replicated gradients are the same on all ranks and the experts are different,
+    so the squared norm of the gradients of the whole model is
+    $$\Vert g \Vert^2 = \Vert g_{replicated} \Vert^2 + \sum_r \Vert g_{experts,r} \Vert^2$$
+    All ranks clip with the same coefficient $\min \Big(1, \frac{max\_norm}{\Vert g \Vert} \Big)$.
+
+    Returns the norm $\Vert g \Vert$.
+    """
+    expert_params = _expert_params(model)
+    params = [p for p in model.parameters() if p.grad is not None]
+    device = next(model.parameters()).device
+
+    # Squared norms of the expert and the replicated gradients of this rank
+    sq_norms = torch.zeros(2, device=device)
+    for p in params:
+        sq_norms[0 if id(p) in expert_params else 1] += p.grad.detach().float().square().sum()
+    # Sum the squared norms of the experts of all ranks
+    expert_sq_norm = sq_norms[0].clone()
+    dist.all_reduce(expert_sq_norm, group=group)
+    # $\Vert g \Vert$
+    total_norm = (expert_sq_norm + sq_norms[1]).sqrt()
+
+    # Scale the gradients
+    clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.)
+    for p in params:
+        p.grad.detach().mul_(clip_coef.to(p.grad.dtype))
+
+    #
+    return total_norm
+
+
+def all_reduce_routing(counts: torch.Tensor, route_prob: torch.Tensor,
+                       group: Optional[dist.ProcessGroup] = None):
+    """
+    <a id="all_reduce_routing"></a>
+
+    ## Routing statistics of all the ranks
+
+    * `counts` is the number of tokens routed to each expert
+    * `route_prob` is the sum of routing probabilities for each expert
+
+    Returns the sums across ranks, so that the load balancing loss is the loss of all the tokens,
+    as with a single process.
+    The sum of `route_prob` is differentiable; its gradients are summed across ranks in the backward pass,
+    so that after [`sync_gradients`](#sync_gradients) averages them
+    the router gets the gradient of the load balancing loss.
+    """
+    counts = counts.clone()
+    dist.all_reduce(counts, group=group)
+    route_prob = dist_fn.all_reduce(route_prob, group=group)
+
+    return counts, route_prob
+
+
+def broadcast_parameters(model: nn.Module, src: int = 0, group: Optional[dist.ProcessGroup] = None):
+    """
+    ## Copy the replicated parameters from rank `src` to all ranks
+
+    The experts are not copied, since each rank has different experts.
+    """
+    expert_params = _expert_params(model)
+    with torch.no_grad():
+        for p in model.parameters():
+            if id(p) not in expert_params:
+                dist.broadcast(p, src, group=group)
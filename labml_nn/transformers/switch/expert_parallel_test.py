@@ -0,0 +1,206 @@
+"""
+---
+title: Test and benchmark expert parallel Switch Transformer
+summary: >
+  Check that expert parallel switch feed-forward matches a single process,
+  and measure scaling as experts and ranks grow.
+---
+
+# Test and Benchmark Expert Parallel Switch Feed-Forward
+
+This starts `world_size` processes on the machine that communicate with the `gloo` backend.
+
+The test gives every rank a slice of a batch and of the experts,
+and checks that the outputs and gradients of
+[expert parallel switch feed-forward](expert_parallel.html) are the same as
+[switch feed-forward](index.html) with all the tokens and experts in a single process,
+and that the same number of tokens is dropped in total.
+
+The benchmark keeps the number of experts and tokens on each rank fixed,
+and increases the number of ranks.
+Scaling efficiency is the time of a step with one rank divided by the time with `world_size` ranks;
+it's $1$ if the additional experts and tokens on the new ranks come for free.
+
+```bash
+python -m labml_nn.transformers.switch.expert_parallel_test --world_size 1 2 4 --experts_per_rank 8
+```
+"""
+
+import argparse
+import datetime
+import statistics
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from labml import logger
+from labml.logger import Text
+from labml_nn.transformers.feed_forward import FeedForward
+from labml_nn.transformers.switch import SwitchFeedForward
+from labml_nn.transformers.switch.expert_parallel import ExpertParallelSwitchFeedForward
+
+
+def _init(rank: int, world_size: int, port: int):
+    dist.init_process_group('gloo',
+                            timeout=datetime.timedelta(seconds=60),
+                            init_method=f'tcp://localhost:{port}',
+                            rank=rank,
+                            world_size=world_size)
+    # Processes share the CPU cores
+    torch.set_num_threads(max(1, torch.get_num_threads() // world_size))
+
+
+def _create(n_experts: int, d_model: int, d_ff: int, drop_tokens: bool, capacity_factor: float):
+    """
+    #### Create the single process module and the expert parallel module with the same weights
+    """
+    torch.manual_seed(0)
+    kwargs = dict(capacity_factor=capacity_factor, drop_tokens=drop_tokens, is_scale_prob=True,
+                  n_experts=n_experts, d_model=d_model)
+    full = SwitchFeedForward(expert=FeedForward(d_model, d_ff, dropout=0.), is_batched=True, **kwargs)
+    with torch.no_grad():
+        for p in full.experts.parameters():
+            p.normal_(std=0.1)
+
+    ep = ExpertParallelSwitchFeedForward(expert=FeedForward(d_model, d_ff, dropout=0.), **kwargs)
+    ep.switch.load_state_dict(full.switch.state_dict())
+    # Copy the experts of this rank
+    experts = slice(ep.rank * ep.n_local_experts, (ep.rank + 1) * ep.n_local_experts)
+    with torch.no_grad():
+        for name, p in ep.experts.named_parameters():
+            p.copy_(getattr(full.experts, name)[experts])
+
+    return full, ep, experts
+
+
+def _check(name: str, a: torch.Tensor, b: torch.Tensor, atol: float = 1e-5):
+    diff = (a - b).abs().max().item() if a.numel() else 0.
+    passed = diff <= atol
+    if dist.get_rank() == 0:
+        logger.log([(f'{name :<40}', Text.key), (f'{diff :.2e}', Text.value),
+                    (' [PASSED]' if passed else ' [FAILED]', Text.success if passed else Text.danger)])
+    return passed
+
+
+def test(rank: int, world_size: int, port: int, *,
+         experts_per_rank: int = 4, tokens_per_rank: int = 256, d_model: int = 32, d_ff: int = 64):
+    """
+    ### Compare with a single process
+    """
+    _init(rank, world_size, port)
+    n_experts = experts_per_rank * world_size
+    passed = True
+
+    for drop_tokens in [False, True]:
+        full, ep, experts = _create(n_experts, d_model, d_ff, drop_tokens, capacity_factor=1.0)
+        # The whole batch, and the tokens of this rank
+        x_full = torch.randn(tokens_per_rank * world_size, 1, d_model, requires_grad=True)
+        tokens = slice(rank * tokens_per_rank, (rank + 1) * tokens_per_rank)
+        x = x_full.detach()[tokens].clone().requires_grad_()
+
+        expected, expected_counts, _, expected_dropped, _ = full(x_full)
+        out, counts, _, n_dropped, _ = ep(x)
+
+        # Total number of dropped tokens
+        n_dropped = torch.tensor(float(n_dropped))
+        dist.all_reduce(n_dropped)
+        passed = _check(f'dropped drop_tokens={drop_tokens}', n_dropped, torch.tensor(float(expected_dropped))) \
+            and passed
+        # Total counts of tokens routed to each expert
+        dist.all_reduce(counts)
+        passed = _check(f'counts drop_tokens={drop_tokens}', counts, expected_counts) and passed
+
+        # The dropped tokens are random, so outputs and gradients are compared only without dropping
+        if drop_tokens:
+            continue
+
+        passed = _check('output', out, expected[tokens].detach()) and passed
+
+        expected.square().sum().backward()
+        out.square().sum().backward()
+        passed = _check('dx', x.grad, x_full.grad[tokens]) and passed
+        for name, p in ep.experts.named_parameters():
+            passed = _check(f'd_{name}', p.grad, getattr(full.experts, name).grad[experts]) and passed
+        # Gradients of the router add up across ranks
+        grad = ep.switch.weight.grad.clone()
+        dist.all_reduce(grad)
+        passed = _check('d_switch', grad, full.switch.weight.grad) and passed
+
+    if rank == 0:
+        logger.log([(f'world_size={world_size} ', Text.key),
+                    ('[PASSED]', Text.success) if passed else ('[FAILED]', Text.danger)])
+
+    dist.destroy_process_group()
+
+
+def measure(rank: int, world_size: int, port: int, queue,
+            experts_per_rank: int, tokens_per_rank: int, d_model: int, d_ff: int, n_repeat: int = 10):
+    """
+    ### Measure the time of a step with a fixed number of experts and tokens on each rank
+    """
+    _init(rank, world_size, port)
+    n_experts = experts_per_rank * world_size
+    ff = ExpertParallelSwitchFeedForward(capacity_factor=1.25, drop_tokens=True, is_scale_prob=True,
+                                         n_experts=n_experts, expert=FeedForward(d_model, d_ff, dropout=0.),
+                                         d_model=d_model)
+    x = torch.randn(tokens_per_rank, 1, d_model, requires_grad=True)
+
+    times = []
+    for i in range(n_repeat + 1):
+        dist.barrier()
+        start = time.perf_counter()
+        out = ff(x)[0]
+        out.sum().backward()
+        dist.barrier()
+        # Ignore the first run as warmup
+        if i > 0:
+            times.append(time.perf_counter() - start)
+
+    if rank == 0:
+        queue.put(statistics.median(times))
+
+    dist.destroy_process_group()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--world_size", type=int, nargs='+', default=[1, 2, 4], help="numbers of ranks")
+    parser.add_argument("--experts_per_rank", type=int, nargs='+', default=[4, 16], help="experts on each rank")
+    parser.add_argument("--tokens_per_rank", type=int, default=2048, help="tokens on each rank")
+    parser.add_argument("--d_model", type=int, default=128, help="number of features in embeddings")
+    parser.add_argument("--d_ff", type=int, default=512, help="number of features in the FFN hidden layer")
+    parser.add_argument("--port", type=int, default=23456, help="port for the process group")
+
+    opt = parser.parse_args()
+    port = opt.port
+
+    # Test
+    for world_size in opt.world_size:
+        mp.spawn(test, args=(world_size, port), nprocs=world_size, join=True)
+        port += 1
+
+    # Benchmark
+    ctx = mp.get_context('spawn')
+    for experts_per_rank in opt.experts_per_rank:
+        base = None
+        for world_size in opt.world_size:
+            queue = ctx.SimpleQueue()
+            mp.spawn(measure, args=(world_size, port, queue, experts_per_rank, opt.tokens_per_rank,
+                                    opt.d_model, opt.d_ff),
+                     nprocs=world_size, join=True)
+            port += 1
+            elapsed = queue.get()
+            if base is None:
+                base = elapsed
+            logger.log([(f'experts={experts_per_rank * world_size :4d} world_size={world_size :2d}', Text.key),
+                        ' step ', (f'{elapsed * 1000 :10.2f}ms', Text.value),
+                        ' tokens/s ', (f'{opt.tokens_per_rank * world_size / elapsed :12,.0f}', Text.value),
+                        ' efficiency ', (f'{base / elapsed :6.2f}', Text.success)])
+
+
+#
+if __name__ == '__main__':
+    main()
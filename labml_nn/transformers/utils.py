@@ -7,15 +7,121 @@ summary: A bunch of utility functions and classes for transformers.
 # Utilities for Transformer
 """
 
+from typing import Optional
+
 import torch
+from torch import nn
+
+from labml_nn.transformers.mask_cache import causal_mask
 
 
-def subsequent_mask(seq_len):
+def subsequent_mask(seq_len: int, device: Optional[torch.device] = None):
     """
     ## Subsequent mask to mask out data from future (subsequent) time steps
+
+    This is a view of a [cached mask](mask_cache.html) of shape `[seq_len, seq_len, 1]`,
+    so it should not be modified in place.
+    """
+    return causal_mask(seq_len, device=device)
+
+
+def is_incremental_decoding_supported(model: nn.Module):
+    """
+    ## Whether a model supports incremental decoding
+
+    The model should declare it with `is_incremental_supported`,
+    the self attention of all transformer layers should be
+    [multi-head attention that supports it](mha.html#incremental).
+    """
+    from labml_nn.transformers.mha import MultiHeadAttention
+    from labml_nn.transformers.models import TransformerLayer
+
+    if not getattr(model, 'is_incremental_supported', False):
+        return False
+
+    for m in model.modules():
+        if isinstance(m, TransformerLayer) and not isinstance(m.self_attn, MultiHeadAttention):
+            return False
+        if isinstance(m, MultiHeadAttention) and not m.is_incremental_supported:
+            return False
+
+    return True
+
+
+class IncrementalDecoding:
+    """
+    <a id="IncrementalDecoding"></a>
+
+    ## Incremental decoding
+
+    This is used to sample from auto-regressive models.
+    Call it with all the tokens so far, and it feeds the model only the tokens
+    that it hasn't seen yet.
+    The keys and values of the past tokens are cached in [multi-head attention](mha.html#incremental),
+    so each new token costs $O(n)$ instead of running the model on all $n$ tokens.
+
+    It falls back to running the model on all the tokens if the model doesn't support incremental decoding,
+    or if the tokens so far are not an extension of the tokens seen before
+    (e.g. when re-tokenizing changes earlier tokens).
+
+    ```python
+    with IncrementalDecoding(model) as decoder:
+        for i in range(n_tokens):
+            output, *_ = decoder(data)
+            data = torch.cat([data, output[-1:].argmax(dim=-1)])
+    ```
+
+    The model output only has the new tokens in incremental decoding;
+    the output at the last token is the same either way.
     """
-    mask = torch.tril(torch.ones(seq_len, seq_len)).to(torch.bool).unsqueeze(-1)
-    return mask
+
+    def __init__(self, model: nn.Module):
+        """
+        * `model` is the auto-regressive model
+        """
+        self.model = model
+        self.is_enabled = is_incremental_decoding_supported(model)
+        # Tokens seen by the model
+        self.seen: Optional[torch.Tensor] = None
+
+    def _set_incremental(self, is_incremental: bool):
+        """
+        Turn incremental decoding on or off for all modules, and clear their caches
+        """
+        for m in self.model.modules():
+            if hasattr(m, 'set_incremental'):
+                m.set_incremental(is_incremental)
+
+    def __enter__(self):
+        if self.is_enabled:
+            self._set_incremental(True)
+        self.seen = None
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.is_enabled:
+            self._set_incremental(False)
+        self.seen = None
+
+    def __call__(self, data: torch.Tensor):
+        """
+        * `data` are all the tokens so far, of shape `[seq_len, batch_size]`
+        """
+        if not self.is_enabled:
+            return self.model(data)
+
+        # Feed only the new tokens if `data` extends the tokens seen before
+        n_seen = 0 if self.seen is None else self.seen.shape[0]
+        if 0 < n_seen < data.shape[0] and torch.equal(data[:n_seen], self.seen):
+            new = data[n_seen:]
+        # Otherwise clear the caches and start over
+        else:
+            self._set_incremental(True)
+            new = data
+
+        self.seen = data
+
+        return self.model(new)
 
 
 def _subsequent_mask():
@@ -23,5 +129,59 @@ def _subsequent_mask():
     inspect(subsequent_mask(10)[:, :, 0])
 
 
+@torch.no_grad()
+def _test_incremental_decoding():
+    """
+    Check that incremental decoding gives the same outputs as running the model on all tokens
+    """
+    from labml import logger
+    from labml.logger import Text
+    from labml_nn.transformers.alibi import AlibiMultiHeadAttention
+    from labml_nn.transformers.feed_forward import FeedForward
+    from labml_nn.transformers.gpt import GPT
+    from labml_nn.transformers.mha import MultiHeadAttention
+    from labml_nn.transformers.models import TransformerLayer, Encoder, Generator, \
+        EmbeddingsWithPositionalEncoding, EmbeddingsWithLearnedPositionalEncoding
+    from labml_nn.transformers.rope import RotaryPEMultiHeadAttention
+    from labml_nn.transformers.rope.value_pe import RotaryValuePEMultiHeadAttention
+
+    d_model, heads, n_vocab = 32, 4, 16
+    # Attention and embeddings
+    variations = {
+        'mha': (MultiHeadAttention(heads, d_model, dropout_prob=0.),
+                EmbeddingsWithPositionalEncoding(d_model, n_vocab)),
+        'mha_learned_pos': (MultiHeadAttention(heads, d_model, dropout_prob=0.),
+                            EmbeddingsWithLearnedPositionalEncoding(d_model, n_vocab)),
+        'rope': (RotaryPEMultiHeadAttention(heads, d_model, 0.5), nn.Embedding(n_vocab, d_model)),
+        'roper': (RotaryValuePEMultiHeadAttention(heads, d_model, 1., 1.), nn.Embedding(n_vocab, d_model)),
+        'alibi': (AlibiMultiHeadAttention(heads, d_model, dropout_prob=0.), nn.Embedding(n_vocab, d_model)),
+    }
+
+    data = torch.randint(0, n_vocab, (16, 3))
+    for name, (attn, embed) in variations.items():
+        layer = TransformerLayer(d_model=d_model, self_attn=attn,
+                                 feed_forward=FeedForward(d_model, 4 * d_model, dropout=0.), dropout_prob=0.)
+        model = GPT(Encoder(layer, 2), embed, Generator(n_vocab, d_model)).eval()
+        # Learned positional encodings are initialized to zeros
+        if isinstance(embed, EmbeddingsWithLearnedPositionalEncoding):
+            nn.init.normal_(embed.positional_encodings)
+
+        assert is_incremental_decoding_supported(model)
+
+        # Outputs at the last token, running the model on all tokens.
+        # We start with a prompt of 4 tokens and add one token at a time.
+        full = [model(data[:i])[0][-1] for i in range(4, data.shape[0] + 1)]
+
+        max_diff = 0.
+        with IncrementalDecoding(model) as decoder:
+            for i, expected in zip(range(4, data.shape[0] + 1), full):
+                output, _ = decoder(data[:i])
+                max_diff = max(max_diff, (output[-1] - expected).abs().max().item())
+
+        logger.log([(f'{name :<16}', Text.key), ' max difference ',
+                    (f'{max_diff :.2e}', Text.success if max_diff < 1e-5 else Text.danger)])
+
+
 if __name__ == '__main__':
     _subsequent_mask()
+    _test_incremental_decoding()
@@ -26,18 +26,22 @@ are introduced at the attention calculation.
 
 Annotated implementation of relative multi-headed attention is in [`relative_mha.py`](relative_mha.html).
 
+The memories can be kept in a [ring buffer](memory.html) that keeps them normalized,
+instead of concatenating and normalizing them on every step.
+
 Here's [the training code](experiment.html) and a notebook for training a transformer XL model on Tiny Shakespeare dataset.
 
 [![Open In Colab](https://colab.research.google.com/assets/colab-badge.svg)](https://colab.research.google.com/github/labmlai/annotated_deep_learning_paper_implementations/blob/master/labml_nn/transformers/xl/experiment.ipynb)
 """
 
 
-from typing import List, Optional
+from typing import List, Optional, Union
 
 import torch
 import torch.nn as nn
 
 from labml_nn.utils import clone_module_list
+from .memory import XLMemory
 from .relative_mha import RelativeMultiHeadAttention
 from ..feed_forward import FeedForward
 
@@ -69,18 +73,25 @@ class TransformerXLLayer(nn.Module):
 
     def forward(self, *,
                 x: torch.Tensor,
-                mem: Optional[torch.Tensor],
+                mem: Optional[Union[torch.Tensor, XLMemory]],
                 mask: torch.Tensor):
         """
         * `x` is a tensor of the token level feature vectors of shape `[seq_len, batch_size, d_model]`
-        * `mem` is a tensor of the past token level feature vectors of shape `[mem_len, batch_size, d_model]`
+        * `mem` is a tensor of the past token level feature vectors of shape `[mem_len, batch_size, d_model]`,
+         or an [`XLMemory`](memory.html#XLMemory) which gets updated with `x`
         * `mask` is a matrix of shape `[seq_len, mem_len + seq_len, batch_size]` or `[seq_len, mem_len + seq_len, 1]`.
         `mask[i, j]` is  true if token at `i` can see token at `j`.
         """
         # Normalize the vectors before doing self attention
         z = self.norm_self_attn(x)
+        # If the memory is a ring buffer of normalized memories
+        if isinstance(mem, XLMemory):
+            # Concatenate with `z`; this is a view of the ring buffer with `z` written after the memory
+            m_z = mem.concat(z)
+            # Add `x` to memory
+            mem.append(x, z)
         # If there is memory
-        if mem is not None:
+        elif mem is not None:
             # Normalize it
             mem = self.norm_self_attn(mem)
             # Concatenate with `z`
@@ -118,11 +129,12 @@ class TransformerXL(nn.Module):
         # Final normalization layer
         self.norm = nn.LayerNorm([layer.size])
 
-    def forward(self, x: torch.Tensor, mem: List[torch.Tensor], mask: torch.Tensor):
+    def forward(self, x: torch.Tensor, mem: Union[List[torch.Tensor], List[XLMemory]], mask: torch.Tensor):
         """
         * `x` is a tensor of the token embeddings vectors of shape `[seq_len, batch_size, d_model]`
         * `mem` is a list of tensors of the past token level feature vectors of shape
-        `[mem_len, batch_size, d_model]`  for each layer
+        `[mem_len, batch_size, d_model]`  for each layer,
+        or a list of [`XLMemory`](memory.html#XLMemory) for each layer which get updated
         * `mask` is the masking matrix
         """
         # List to store token level feature vectors,
@@ -8,7 +8,7 @@ summary: This experiment trains a transformer XL model on tiny Shakespeare datas
 
 This is an annotated PyTorch experiment to train a transformer xl model.
 """
-from typing import List
+from typing import List, Optional
 
 import torch
 import torch.nn as nn
@@ -18,7 +18,9 @@ from labml.logger import Text
 from labml_nn.experiments.nlp_autoregression import NLPAutoRegressionConfigs
 from labml_nn.helpers.metrics import SimpleStateModule
 from labml_nn.helpers.trainer import BatchIndex
+from labml_nn.transformers.mask_cache import causal_mask
 from labml_nn.transformers.xl import TransformerXL, TransformerXLLayer
+from labml_nn.transformers.xl.memory import XLMemory
 
 
 class AutoregressiveModel(nn.Module):
@@ -34,27 +36,13 @@ class AutoregressiveModel(nn.Module):
         self.transformer = transformer
         # Final layer
         self.generator = nn.Linear(d_model, n_vocab)
-        # Masks
-        self.mask_x = None
-        self.mask_mem = None
 
-    def forward(self, x: torch.Tensor, mem: List[torch.Tensor]):
+    def forward(self, x: torch.Tensor, mem: List[XLMemory]):
         # Length of the memory
         m_len = len(mem[0]) if mem else 0
-        # Create a subsequent mask for tokens
-        if self.mask_x is None or self.mask_x.shape[0] < len(x):
-            from labml_nn.transformers.utils import subsequent_mask
-            self.mask_x = subsequent_mask(len(x)).to(x.device)
-        # Create an all ones (full visibility) mask for memory
-        if self.mask_mem is None or self.mask_mem.shape[1] < m_len or self.mask_mem.shape[0] < len(x):
-            self.mask_mem = self.mask_x.new_ones(len(x), m_len, 1)
-
-        # Concatenate the masks if there is memory
-        if m_len:
-            mask = torch.cat((self.mask_mem[:len(x), :m_len], self.mask_x[:len(x), :len(x)]), dim=1)
-        # Use the subsequent mask otherwise
-        else:
-            mask = self.mask_x[:len(x), :len(x)]
+        # Mask where the tokens see all the memories and the previous tokens.
+        # This is a view of a [cached causal mask](../mask_cache.html) of `m_len + len(x)` keys.
+        mask = causal_mask(len(x), m_len + len(x), x.device)
 
         # Token embeddings
         x = self.src_embed(x)
@@ -97,28 +85,21 @@ class Configs(NLPAutoRegressionConfigs):
         # This will keep the accuracy metric stats and memories separate for training and validation.
         self.state_modules = [self.accuracy, self.memory]
 
-    def merge_memory(self, old_mem, new_mem):
+    def new_memory(self, seq_len: Optional[int] = None) -> List[XLMemory]:
         """
-        Concatenate memories and remove old memories to keep a maximum of
-        `mem_len` memories.
+        Create [ring buffer memories](memory.html) that keep a maximum of
+        `mem_len` memories for each layer.
+        The layers add their inputs to the memories.
+
+        `seq_len` is the maximum number of tokens in a step; it's `self.seq_len` if `None`.
         """
 
         # If it's configured not to use memory
         if self.mem_len == 0:
             return []
 
-        # Concatenate with old memory
-        if old_mem:
-            mem = [torch.cat((m, x), dim=0) for m, x in zip(old_mem, new_mem)]
-        else:
-            mem = new_mem
-
-        # Truncate old memories
-        if len(mem[0]) > self.mem_len:
-            mem = [m[-self.mem_len:] for m in mem]
-
         #
-        return mem
+        return [XLMemory(self.mem_len, seq_len or self.seq_len) for _ in range(self.n_layers)]
 
     def step(self, batch: any, batch_idx: BatchIndex):
         """
@@ -134,12 +115,12 @@ class Configs(NLPAutoRegressionConfigs):
 
         # Get memories
         mem = self.memory.get()
-        # Run the model
-        output, new_mem = self.model(data, mem)
-        # Merge memory
-        mem = self.merge_memory(mem, new_mem)
-        # Update memories
-        self.memory.set(mem)
+        # Create memories on the first step
+        if mem is None:
+            mem = self.new_memory()
+            self.memory.set(mem)
+        # Run the model, which also adds the inputs of each layer to the memories
+        output, _ = self.model(data, mem)
 
         # Calculate and log cross entropy loss
         loss = self.loss_func(output, target)
@@ -175,8 +156,8 @@ class Configs(NLPAutoRegressionConfigs):
         prompt = self.prompt
         # Collect output for printing
         log = [(prompt, Text.subtle)]
-        # memory
-        mem = []
+        # Memory, with space for the prompt which can be longer than `seq_len`
+        mem = self.new_memory(max(self.seq_len, len(self.text.text_to_i(prompt))))
         # Sample 25 tokens
         for i in monit.iterate('Sample', 25):
             # Tokenize the prompt
@@ -184,7 +165,7 @@ class Configs(NLPAutoRegressionConfigs):
             # Move to device
             data = data.to(self.device)
             # Get the model output
-            output, new_mem = self.model(data, mem)
+            output, _ = self.model(data, mem)
             # Get the model prediction (greedy)
             output = output.argmax(dim=-1).squeeze(1)
             # Add the prediction to prompt
@@ -193,8 +174,6 @@ class Configs(NLPAutoRegressionConfigs):
             prompt = prompt[-1:]
             # Add the prediction for logging
             log += [(self.prompt_separator + self.text.itos[output[-1]], Text.value)]
-            # Update memory
-            mem = self.merge_memory(mem, new_mem)
 
         # Print the sampled output
         logger.log(log)
@@ -0,0 +1,257 @@
+"""
+---
+title: Ring buffer memory for Transformer XL
+summary: >
+  Fixed capacity memory that writes new states in place and keeps the normalized memory
+  so that it is not concatenated and normalized again on every step.
+---
+
+# Ring Buffer Memory for Transformer XL
+
+[Transformer XL](index.html) keeps the inputs of each layer from the previous steps as memory.
+The simple way is to concatenate the new states to the memory and truncate it on every step,
+and normalize the whole memory in every layer before attention.
+That allocates and computes $O(N_m)$ for every layer on every step, where $N_m$ is the memory length.
+
+[`RingBuffer`](#RingBuffer) is a fixed capacity buffer that writes new states in place of the oldest.
+[`XLMemory`](#XLMemory) keeps the normalized inputs of a layer in a ring buffer.
+The normalized inputs are computed by the layer for the current tokens anyway,
+so the memory is never normalized again.
+The normalized inputs of the current step are written to the buffer right after the memory,
+so the keys and values of attention are a view of the buffer and the memory is not copied
+to concatenate it with the current step.
+
+Since the memory is normalized once, it's normalized with the layer normalization parameters
+of the step it was computed in, similar to the memory itself which was computed with the model parameters
+of that step.
+So the gradients of the layer normalization parameters only come from the current tokens,
+since the memory is detached from the gradient computation.
+
+Here's [a benchmark](memory_benchmark.html) that compares it with concatenating memories.
+"""
+
+from typing import Optional
+
+import torch
+
+
+class RingBuffer:
+    r"""
+    <a id="RingBuffer"></a>
+
+    ## Ring Buffer
+
+    This keeps the last `capacity` states along the first dimension.
+
+    The states are stored twice, at positions $i$ and $i + capacity$, in a buffer of size $2 \times capacity$.
+    So the states from the oldest to the newest are always a contiguous slice of the buffer,
+    and `view` never copies.
+    Writing $n$ states costs $2n$, instead of copying the whole memory.
+    """
+
+    def __init__(self, capacity: int):
+        """
+        * `capacity` is the maximum number of states to keep
+        """
+        self.capacity = capacity
+        # Buffer of shape `[2 * capacity, ...]`; it's created on the first write
+        self.buffer: Optional[torch.Tensor] = None
+        # Position of the oldest state
+        self.start = 0
+        # Number of states
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def clear(self):
+        """
+        ### Remove all states
+        """
+        self.start = 0
+        self.length = 0
+
+    def matches(self, x: torch.Tensor):
+        """
+        ### Whether states like `x` can be written to the buffer
+        """
+        return (self.buffer is not None and self.buffer.shape[1:] == x.shape[1:] and
+                self.buffer.dtype == x.dtype and self.buffer.device == x.device)
+
+    def view(self) -> Optional[torch.Tensor]:
+        """
+        ### States from the oldest to the newest
+
+        This is a view of the buffer, so it changes with the next `append`.
+        """
+        if self.length == 0:
+            return None
+        return self.buffer[self.start:self.start + self.length]
+
+    def last(self, n: int) -> torch.Tensor:
+        """
+        ### The `n` newest states
+
+        This is a view of the buffer, so it changes with the next `append`.
+        """
+        assert n <= self.length
+        return self.buffer[self.start + self.length - n:self.start + self.length]
+
+    @torch.no_grad()
+    def _write(self, w: int, x: torch.Tensor):
+        """
+        #### Write `x` at position $w < capacity$ and its copy at $w + capacity$
+        """
+        n = len(x)
+        # Write to $[w, w + n)$; this doesn't go past $2 \times capacity$ since $n \le capacity$
+        self.buffer[w:w + n] = x
+        # Write the copy
+        if w + n <= self.capacity:
+            self.buffer[w + self.capacity:w + self.capacity + n] = x
+        else:
+            k = self.capacity - w
+            self.buffer[w + self.capacity:] = x[:k]
+            self.buffer[:n - k] = x[k:]
+
+    @torch.no_grad()
+    def append(self, x: torch.Tensor):
+        """
+        ### Add states, removing the oldest ones if there are more than `capacity`
+
+        * `x` has shape `[n, ...]`
+        """
+        if self.capacity == 0:
+            return
+        # Create the buffer, or create it again if the shape of the states has changed
+        if not self.matches(x):
+            self.buffer = x.new_empty((2 * self.capacity, *x.shape[1:]))
+            self.clear()
+
+        # Only the last `capacity` states are kept
+        if len(x) >= self.capacity:
+            x = x[-self.capacity:]
+            self.clear()
+
+        n = len(x)
+        # Write after the newest state
+        self._write((self.start + self.length) % self.capacity, x)
+
+        # Drop the oldest states that were overwritten
+        self.length += n
+        if self.length > self.capacity:
+            self.start = (self.start + self.length - self.capacity) % self.capacity
+            self.length = self.capacity
+
+    def pop(self, n: int) -> torch.Tensor:
+        """
+        ### Remove and return the `n` oldest states
+
+        This is a view of the buffer, so it changes with the next `append`.
+        """
+        assert n <= self.length
+        x = self.buffer[self.start:self.start + n]
+        self.start = (self.start + n) % self.capacity
+        self.length -= n
+
+        return x
+
+    def prepend(self, x: torch.Tensor):
+        """
+        ### Add states before the oldest state
+
+        There should be space for them; i.e. `len(self) + len(x) <= capacity`.
+        """
+        assert self.length + len(x) <= self.capacity
+        self.start = (self.start - len(x)) % self.capacity
+        self._write(self.start, x)
+        self.length += len(x)
+
+
+class _Concat(torch.autograd.Function):
+    """
+    <a id="Concat"></a>
+
+    ## Memory concatenated with the current step
+
+    `m_z` is a view of the buffer that ends with the normalized inputs of the current step `z`.
+    This returns `m_z`, and passes the gradients of its last `len(z)` states to `z`,
+    like `torch.cat((mem, z))` with a detached `mem`.
+
+    The buffer should not be written to before the backward pass, since attention saves `m_z` for it.
+    PyTorch checks this with the version counter of the buffer.
+    """
+
+    @staticmethod
+    def forward(ctx, z: torch.Tensor, m_z: torch.Tensor):
+        ctx.n = len(z)
+        return m_z
+
+    @staticmethod
+    def backward(ctx, grad: torch.Tensor):
+        return grad[-ctx.n:], None
+
+
+class XLMemory:
+    """
+    <a id="XLMemory"></a>
+
+    ## Memory of a Transformer XL layer
+
+    This keeps the last `mem_len` normalized inputs of a [Transformer XL layer](index.html).
+    The ring buffer has space for `mem_len + seq_len` states,
+    so that the normalized inputs of the current step can be written after the memory.
+    """
+
+    def __init__(self, mem_len: int, seq_len: int):
+        """
+        * `mem_len` is the number of memories to keep
+        * `seq_len` is the maximum number of tokens in a step
+        """
+        self.mem_len = mem_len
+        self.seq_len = seq_len
+        # Memories, followed by the normalized inputs of the current step after `concat`
+        self.mem = RingBuffer(mem_len + seq_len)
+        # Number of memories
+        self.n_mem = 0
+
+    def __len__(self):
+        return self.n_mem
+
+    def clear(self):
+        """
+        ### Remove all memories
+        """
+        self.mem.clear()
+        self.n_mem = 0
+
+    def concat(self, z: torch.Tensor):
+        """
+        ### Concatenate the memory with the normalized inputs of the current step
+
+        * `z` is the normalized inputs of shape `[seq_len, batch_size, d_model]`
+
+        This writes `z` to the buffer after the memory and returns a view of the buffer.
+        """
+        assert len(z) <= self.seq_len, f'More than {self.seq_len} tokens in a step'
+        # The buffer is created again, without memories, if the shape of the inputs changes
+        if not self.mem.matches(z):
+            self.clear()
+        # Write `z` after the memories; this drops the states that are older than the memories
+        self.mem.append(z.detach())
+        m_z = self.mem.last(len(self) + len(z))
+        # Pass the gradients to `z`
+        if z.requires_grad:
+            return _Concat.apply(z, m_z)
+        else:
+            return m_z
+
+    def append(self, x: torch.Tensor, z: torch.Tensor):
+        """
+        ### Add the inputs of the current step to memory
+
+        * `x` is the inputs of shape `[seq_len, batch_size, d_model]`
+        * `z` is the normalized inputs
+
+        `z` was written to the buffer by `concat`, so this only updates the number of memories.
+        """
+        self.n_mem = min(self.n_mem + len(z), self.mem_len)
@@ -0,0 +1,153 @@
+"""
+---
+title: Benchmark ring buffer memory for Transformer XL
+summary: >
+  Compare the time and allocations of Transformer XL steps with ring buffer memory
+  and with concatenated memory.
+---
+
+# Benchmark Ring Buffer Memory for Transformer XL
+
+This runs [Transformer XL](index.html) steps with memories kept in [ring buffers](memory.html)
+and with memories concatenated and truncated on every step, for different memory lengths.
+It checks that the outputs are the same, since the parameters don't change,
+and measures the time of a step (forward and backward) and
+the memory allocated in a step.
+The [relative attention](relative_mha.html) supports up to $4096$ keys,
+so `mem_len + seq_len` should be at most $4096$.
+
+```bash
+python -m labml_nn.transformers.xl.memory_benchmark --mem_len 128 512 2048 4032
+```
+"""
+
+import argparse
+import time
+from typing import List
+
+import torch
+
+from labml import logger
+from labml.logger import Text
+from labml_nn.transformers.benchmark import profile_memory
+from labml_nn.transformers.feed_forward import FeedForward
+from labml_nn.transformers.mask_cache import causal_mask
+from labml_nn.transformers.xl import TransformerXL, TransformerXLLayer
+from labml_nn.transformers.xl.memory import XLMemory
+from labml_nn.transformers.xl.relative_mha import RelativeMultiHeadAttention
+
+
+def _mask(seq_len: int, m_len: int):
+    """
+    #### Mask of the tokens and memories
+    """
+    return causal_mask(seq_len, m_len + seq_len)
+
+
+def _merge_memory(mem: List[torch.Tensor], new_mem: List[torch.Tensor], mem_len: int):
+    """
+    #### Concatenate memories and keep the last `mem_len`
+    """
+    if mem:
+        mem = [torch.cat((m, x), dim=0) for m, x in zip(mem, new_mem)]
+    else:
+        mem = new_mem
+    return [m[-mem_len:] for m in mem]
+
+
+def run(model: TransformerXL, x: List[torch.Tensor], mem_len: int, is_ring: bool, *, backward: bool = True):
+    """
+    ### Run steps
+
+    Returns the outputs, the mean time of the last three steps and the memories.
+    """
+    if is_ring:
+        mem = [XLMemory(mem_len, len(x[0])) for _ in model.layers]
+    else:
+        mem = []
+
+    outputs = []
+    times = []
+    for xi in x:
+        start = time.perf_counter()
+        m_len = len(mem[0]) if mem else 0
+        out, new_mem = model(xi, mem, _mask(len(xi), m_len))
+        if not is_ring:
+            mem = _merge_memory(mem, new_mem, mem_len)
+        if backward:
+            out.sum().backward()
+        times.append(time.perf_counter() - start)
+        outputs.append(out.detach())
+
+    return torch.cat(outputs), sum(times[-3:]) / len(times[-3:]), mem
+
+
+def measure(mem_len: int, *, seq_len: int, batch_size: int, d_model: int, heads: int, n_layers: int):
+    """
+    ### Compare ring buffer memory with concatenated memory
+    """
+    torch.manual_seed(0)
+    model = TransformerXL(TransformerXLLayer(d_model=d_model,
+                                             self_attn=RelativeMultiHeadAttention(heads, d_model, 0.),
+                                             feed_forward=FeedForward(d_model, d_model * 4, 0.),
+                                             dropout_prob=0.), n_layers)
+    # Enough steps to fill the memory, and a few more
+    n_steps = mem_len // seq_len + 3
+    x = [torch.randn(seq_len, batch_size, d_model) for _ in range(n_steps + 1)]
+
+    results = {}
+    for name, is_ring in [('concat', False), ('ring', True)]:
+        out, elapsed, mem = run(model, x[:-1], mem_len, is_ring)
+        model.zero_grad()
+
+        # Allocations of the last step, with a full memory
+        def step():
+            m_len = len(mem[0]) if mem else 0
+            y, new_mem = model(x[-1], mem, _mask(seq_len, m_len))
+            if not is_ring:
+                _merge_memory(mem, new_mem, mem_len)
+            y.sum().backward()
+
+        _, n_allocations, allocated = profile_memory(step)
+        model.zero_grad()
+        results[name] = out, elapsed, n_allocations, allocated
+
+    diff = (results['ring'][0] - results['concat'][0]).abs().max().item()
+    passed = diff < 1e-4
+    logger.log([(f'mem_len={mem_len :6d}', Text.key),
+                ' diff ', (f'{diff :.2e}', Text.success if passed else Text.danger)])
+    for name, (_, elapsed, n_allocations, allocated) in results.items():
+        logger.log([(f'{name :>16}', Text.key),
+                    ' step ', (f'{elapsed * 1000 :10.2f}ms', Text.value),
+                    ' allocations ', (f'{n_allocations :8,}', Text.value),
+                    ' allocated ', (f'{allocated / 2 ** 20 :10.1f}MB', Text.value)])
+
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--mem_len", type=int, nargs='+', default=[128, 512, 1024, 2048, 4032], help="memory lengths")
+    parser.add_argument("--seq_len", type=int, default=64, help="tokens in a step")
+    parser.add_argument("--batch_size", type=int, default=4, help="batch size")
+    parser.add_argument("--d_model", type=int, default=128, help="number of features in embeddings")
+    parser.add_argument("--heads", type=int, default=4, help="number of heads")
+    parser.add_argument("--n_layers", type=int, default=4, help="number of layers")
+
+    opt = parser.parse_args()
+
+    passed = True
+    for mem_len in opt.mem_len:
+        passed = measure(mem_len, seq_len=opt.seq_len, batch_size=opt.batch_size, d_model=opt.d_model,
+                         heads=opt.heads, n_layers=opt.n_layers) and passed
+
+    if passed:
+        logger.log('[PASSED]', Text.success)
+    else:
+        logger.log('[FAILED]', Text.danger)
+
+
+#
+if __name__ == '__main__':
+    main()
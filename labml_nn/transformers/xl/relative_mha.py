@@ -49,6 +49,9 @@ class RelativeMultiHeadAttention(MultiHeadAttention):
     write the `get_scores` method.
     """
 
+    # Relative positions are not handled for cached keys, so this doesn't support incremental decoding
+    is_incremental_supported = False
+
     def __init__(self, heads: int, d_model: int, dropout_prob: float = 0.1):
         # The linear transformations do not need a bias since we
         # explicitly include it when calculating scores.
@@ -66,8 +69,20 @@ class RelativeMultiHeadAttention(MultiHeadAttention):
         # Positional embeddings for the query is independent of the position of the query
         self.query_pos_bias = nn.Parameter(torch.zeros((heads, self.d_k)), requires_grad=True)
 
-    def get_scores(self, query: torch.Tensor, key: torch.Tensor):
+    def get_query_key(self, query: torch.Tensor, key: torch.Tensor):
+        r"""
+        ### Add $\textcolor{orange}{v^\top}$ to the queries
+
+        So that the dot-product gives
+        ${(\textcolor{lightgreen}{\mathbf{A + C}})}_{i,j} = Q_i^\top K_j + \textcolor{orange}{v^\top} K_j$.
+        [`get_score_bias`](#get_score_bias) gives the rest of the relative attention scores.
+        """
+        return query + self.query_pos_bias[None, None, :, :], key
+
+    def get_score_bias(self, query: torch.Tensor, key: torch.Tensor):
         r"""
+        <a id="get_score_bias"></a>
+
         ### Get relative attention scores
 
         With absolute attention
@@ -108,13 +123,10 @@ class RelativeMultiHeadAttention(MultiHeadAttention):
         key_pos_emb = self.key_pos_embeddings[self.P - key.shape[0]:self.P + query.shape[0]]
         # $\textcolor{orange}{S_k}$
         key_pos_bias = self.key_pos_bias[self.P - key.shape[0]:self.P + query.shape[0]]
-        # $\textcolor{orange}{v^\top}$
-        query_pos_bias = self.query_pos_bias[None, None, :, :]
 
-        # ${(\textcolor{lightgreen}{\mathbf{A + C}})}_{i,j} =
-        # Q_i^\top K_j +
-        # \textcolor{orange}{v^\top} K_j$
-        ac = torch.einsum('ibhd,jbhd->ijbh', query + query_pos_bias, key)
+        # $\textcolor{lightgreen}{\mathbf{A + C}}$ is computed by the attention backend
+        # with the queries from `get_query_key`.
+        #
         # $\textcolor{lightgreen}{\mathbf{B'}_{i,k}} = Q_i^\top \textcolor{orange}{R_k}$
         b = torch.einsum('ibhd,jhd->ijbh', query, key_pos_emb)
         # $\textcolor{lightgreen}{\mathbf{D'}_{i,k}} = \textcolor{orange}{S_k}$
@@ -125,13 +137,8 @@ class RelativeMultiHeadAttention(MultiHeadAttention):
         # Remove extra positions
         bd = bd[:, -key.shape[0]:]
 
-        # Return the sum $$
-        # \underset{\mathbf{\textcolor{lightgreen}{A}}}{Q_i^\top K_j} +
-        # \underset{\mathbf{\textcolor{lightgreen}{B}}}{Q_i^\top \textcolor{orange}{R_{i - j}}} +
-        # \underset{\mathbf{\textcolor{lightgreen}{C}}}{\textcolor{orange}{v^\top} K_j} +
-        # \underset{\mathbf{\textcolor{lightgreen}{D}}}{\textcolor{orange}{S_{i-j}}}
-        # $$
-        return ac + bd
+        # Return $\textcolor{lightgreen}{\mathbf{B + D}}$ scaled, since it's added to the scaled scores
+        return bd * self.scale
 
 
 def _test_shift_right():
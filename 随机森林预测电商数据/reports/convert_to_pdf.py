@@ -10,6 +10,7 @@ import sys
 from pathlib import Path
 from datetime import datetime
 import re
+from functools import lru_cache
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch, cm
@@ -21,8 +22,9 @@ from reportlab.pdfbase.ttfonts import TTFont
 import markdown
 from bs4 import BeautifulSoup
 
+@lru_cache(maxsize=None)
 def setup_fonts():
-    """设置中文字体"""
+    """设置中文字体（每个进程只注册一次）"""
     try:
         # 尝试注册系统中文字体
         font_paths = [
@@ -147,15 +149,22 @@ def create_styles(font_name):
     
     return styles
 
+TIME_PLACEHOLDER = '{datetime.now().strftime(\'%Y年%m月%d日 %H:%M:%S\')}'
+
+@lru_cache(maxsize=8)
+def markdown_to_html(content):
+    """将Markdown转换为HTML，相同内容只转换一次"""
+    md = markdown.Markdown(extensions=['tables', 'fenced_code', 'toc'])
+    return md.convert(content)
+
 def parse_markdown_content(content):
     """解析Markdown内容"""
-    # 替换时间占位符
-    current_time = datetime.now().strftime('%Y年%m月%d日 %H:%M:%S')
-    content = content.replace('{datetime.now().strftime(\'%Y年%m月%d日 %H:%M:%S\')}', current_time)
-    
     # 转换为HTML
-    md = markdown.Markdown(extensions=['tables', 'fenced_code', 'toc'])
-    html_content = md.convert(content)
+    html_content = markdown_to_html(content)
+    
+    # 替换时间占位符（在转换之后替换，使缓存不受当前时间影响）
+    current_time = datetime.now().strftime('%Y年%m月%d日 %H:%M:%S')
+    html_content = html_content.replace(TIME_PLACEHOLDER, current_time)
     
     # 解析HTML
     soup = BeautifulSoup(html_content, 'html.parser')
@@ -264,9 +273,18 @@ def convert_soup_to_story(soup, styles):
     
     return story
 
-def convert_markdown_to_pdf(markdown_file, output_file):
-    """将Markdown文件转换为PDF"""
+def convert_markdown_to_pdf(markdown_file, output_file, force=False):
+    """
+    将Markdown文件转换为PDF
+    
+    PDF已存在且比Markdown文件新时跳过转换，force=True 时总是重新生成
+    """
     try:
+        if (not force and os.path.exists(output_file)
+                and os.path.getmtime(output_file) >= os.path.getmtime(markdown_file)):
+            print(f"♻️ Markdown未变化，跳过转换: {output_file}")
+            return True
+        
         print(f"🚀 开始转换: {markdown_file}")
         
         # 设置字体
@@ -7,6 +7,11 @@
 
 import os
 import sys
+import json
+import base64
+import hashlib
+import inspect
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -17,6 +22,9 @@ from datetime import datetime, timedelta
 import warnings
 warnings.filterwarnings('ignore')
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from 销售汇总立方体 import 销售汇总立方体
+
 # 设置中文字体
 plt.rcParams['font.sans-serif'] = ['SimHei', 'Microsoft YaHei']
 plt.rcParams['axes.unicode_minus'] = False
@@ -33,10 +41,29 @@ COLOR_PALETTE = {
     'background': '#f8f9fa'    # 背景色 - 浅灰
 }
 
+# 图表章节：(输出文件, 生成方法, 依赖的输入指标, 进度提示)
+CHART_SECTIONS = [
+    ('01_执行摘要.png', 'create_executive_summary_chart', ['monthly_revenue'], '📊 生成执行摘要图表...'),
+    ('02_市场机会分析.png', 'create_market_opportunity_chart', [], '📈 生成市场机会分析图表...'),
+    ('03_技术架构.png', 'create_technical_architecture_chart', [], '🔧 生成技术架构图表...'),
+    ('04_财务预测.png', 'create_financial_projections_chart', [], '💰 生成财务预测图表...'),
+    ('05_风险分析.png', 'create_risk_analysis_chart', [], '⚠️ 生成风险分析图表...'),
+    ('06_投资决策仪表板.png', 'create_summary_dashboard', ['business_metrics'], '🎯 生成投资决策仪表板...'),
+]
+
+def render_section(project_path, method_name, business_metrics, monthly_revenue):
+    """在工作进程中生成单个图表"""
+    plt.switch_backend('Agg')
+    generator = InvestorReportGenerator(project_path, load_cube=False)
+    generator.business_metrics = business_metrics
+    generator.monthly_revenue = monthly_revenue
+    getattr(generator, method_name)()
+    return method_name
+
 class InvestorReportGenerator:
     """投资人报告生成器"""
     
-    def __init__(self, project_path):
+    def __init__(self, project_path, load_cube=True):
         self.project_path = project_path
         self.charts_path = os.path.join(project_path, 'charts')
         self.reports_path = os.path.join(project_path, 'reports')
@@ -45,7 +72,11 @@ class InvestorReportGenerator:
         self.output_path = os.path.join(self.reports_path, 'investor_report')
         os.makedirs(self.output_path, exist_ok=True)
         
-        # 模拟核心业务数据（基于分析报告）
+        # 构建缓存：记录各章节的输入签名和已编码的图片
+        self.cache_path = os.path.join(self.output_path, 'cache')
+        self.build_cache_file = os.path.join(self.cache_path, 'build_cache.json')
+        
+        # 核心业务数据（基于分析报告），销售相关指标从销售汇总立方体读取
         self.business_metrics = {
             'total_users': 10000,
             'active_users': 4586,
@@ -55,6 +86,26 @@ class InvestorReportGenerator:
             'model_accuracy': 85.2,
             'roi_improvement': 35.0
         }
+        self.monthly_revenue = None
+        if load_cube:
+            self.load_sales_cube()
+        
+    def load_sales_cube(self):
+        """从销售汇总立方体读取GMV、订单数和月度收入"""
+        cube_path = os.path.join(self.project_path, 'data', '销售汇总立方体.pkl')
+        if not os.path.exists(cube_path):
+            print("⚠️ 未找到销售汇总立方体，使用报告中的默认业务指标")
+            return
+        
+        cube = 销售汇总立方体.加载(cube_path)
+        totals = cube.查询()
+        self.business_metrics['total_gmv'] = float(totals['销售额'])
+        self.business_metrics['total_orders'] = int(totals['订单数'])
+        
+        monthly = cube.查询(['月份'])
+        single_year = monthly['月份'].dt.year.nunique() == 1
+        self.monthly_revenue = {(f'{period.month}月' if single_year else str(period)): value / 10000
+                                for period, value in zip(monthly['月份'], monthly['销售额'])}
         
     def create_executive_summary_chart(self):
         """创建执行摘要图表"""
@@ -86,8 +137,12 @@ class InvestorReportGenerator:
         ax1.grid(axis='x', alpha=0.3)
         
         # 2. 收入增长趋势
-        months = ['1月', '2月', '3月', '4月', '5月', '6月', '7月', '8月', '9月', '10月', '11月', '12月']
-        revenue = [180000, 195000, 210000, 225000, 240000, 255000, 270000, 285000, 300000, 315000, 330000, 345000]
+        if self.monthly_revenue:
+            months = list(self.monthly_revenue.keys())
+            revenue = list(self.monthly_revenue.values())
+        else:
+            months = ['1月', '2月', '3月', '4月', '5月', '6月', '7月', '8月', '9月', '10月', '11月', '12月']
+            revenue = [180000, 195000, 210000, 225000, 240000, 255000, 270000, 285000, 300000, 315000, 330000, 345000]
         
         ax2.plot(months, revenue, marker='o', linewidth=3, markersize=8, color=COLOR_PALETTE['primary'])
         ax2.fill_between(months, revenue, alpha=0.3, color=COLOR_PALETTE['primary'])
@@ -558,7 +613,7 @@ class InvestorReportGenerator:
             {'pos': (0.5, 3), 'size': (1.8, 2), 'title': '总用户数', 'value': '10,000', 'unit': '人', 'color': COLOR_PALETTE['primary']},
             {'pos': (2.5, 3), 'size': (1.8, 2), 'title': '转化率', 'value': '45.86', 'unit': '%', 'color': COLOR_PALETTE['success']},
             {'pos': (4.5, 3), 'size': (1.8, 2), 'title': '平均LTV', 'value': '4.7', 'unit': '万元', 'color': COLOR_PALETTE['warning']},
-            {'pos': (6.5, 3), 'size': (1.8, 2), 'title': '总GMV', 'value': '244', 'unit': '万元', 'color': COLOR_PALETTE['info']},
+            {'pos': (6.5, 3), 'size': (1.8, 2), 'title': '总GMV', 'value': f"{self.business_metrics['total_gmv'] / 10000:,.0f}", 'unit': '万元', 'color': COLOR_PALETTE['info']},
             {'pos': (8.5, 3), 'size': (1.8, 2), 'title': 'AI准确率', 'value': '85.2', 'unit': '%', 'color': COLOR_PALETTE['light']}
         ]
         
@@ -656,8 +711,83 @@ class InvestorReportGenerator:
         plt.savefig(os.path.join(self.output_path, '06_投资决策仪表板.png'), dpi=300, bbox_inches='tight')
         plt.close()
         
-    def generate_html_report(self):
-        """生成HTML格式的完整报告"""
+    def section_signature(self, method_name, inputs):
+        """章节签名：依赖的输入指标和生成方法的源码，任一变化都需要重新生成"""
+        payload = json.dumps({name: getattr(self, name) for name in inputs},
+                             ensure_ascii=False, sort_keys=True, default=str)
+        source = inspect.getsource(getattr(type(self), method_name))
+        return hashlib.sha256((payload + source).encode('utf-8')).hexdigest()
+    
+    def load_build_cache(self):
+        if not os.path.exists(self.build_cache_file):
+            return {}
+        with open(self.build_cache_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    def save_build_cache(self, cache):
+        os.makedirs(self.cache_path, exist_ok=True)
+        with open(self.build_cache_file, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False, indent=2)
+    
+    def encoded_image(self, filename, signature):
+        """返回图片的base64编码，按章节签名缓存，图片不变时不重复编码"""
+        encoded_file = os.path.join(self.cache_path, f'{signature}.b64')
+        if os.path.exists(encoded_file):
+            with open(encoded_file, 'r', encoding='ascii') as f:
+                return f.read()
+        
+        with open(os.path.join(self.output_path, filename), 'rb') as f:
+            encoded = base64.b64encode(f.read()).decode('ascii')
+        os.makedirs(self.cache_path, exist_ok=True)
+        with open(encoded_file, 'w', encoding='ascii') as f:
+            f.write(encoded)
+        return encoded
+    
+    def render_sections(self, force=False, parallel=True, max_workers=None):
+        """
+        生成输入发生变化的图表章节，返回 (章节签名, 重新生成的文件列表)
+        
+        parallel=True 时在多个工作进程中同时绘制图表
+        """
+        cache = self.load_build_cache()
+        signatures = {}
+        stale = []
+        
+        for filename, method_name, inputs, message in CHART_SECTIONS:
+            signatures[filename] = self.section_signature(method_name, inputs)
+            if (force or cache.get(filename) != signatures[filename]
+                    or not os.path.exists(os.path.join(self.output_path, filename))):
+                stale.append((filename, method_name, message))
+            else:
+                print(f"♻️ {filename} 输入未变化，跳过")
+        
+        if parallel and len(stale) > 1:
+            workers = min(len(stale), max_workers or os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = []
+                for filename, method_name, message in stale:
+                    print(message)
+                    futures.append(executor.submit(render_section, self.project_path, method_name,
+                                                   self.business_metrics, self.monthly_revenue))
+                for future in futures:
+                    future.result()
+        else:
+            for filename, method_name, message in stale:
+                print(message)
+                getattr(self, method_name)()
+        
+        for filename, _, _ in stale:
+            cache[filename] = signatures[filename]
+        self.save_build_cache(cache)
+        
+        return signatures, [filename for filename, _, _ in stale]
+        
+    def generate_html_report(self, signatures=None):
+        """
+        生成HTML格式的完整报告
+        
+        传入章节签名时，图片以base64内嵌到HTML中，得到可单独分发的报告文件
+        """
         html_content = f"""
 <!DOCTYPE html>
 <html lang="zh-CN">
@@ -943,39 +1073,33 @@ class InvestorReportGenerator:
 </html>
         """
         
+        if signatures:
+            for filename, _, _, _ in CHART_SECTIONS:
+                data_uri = f'data:image/png;base64,{self.encoded_image(filename, signatures[filename])}'
+                html_content = html_content.replace(f'src="{filename}"', f'src="{data_uri}"')
+        
         html_path = os.path.join(self.output_path, '投资人专业报告.html')
         with open(html_path, 'w', encoding='utf-8') as f:
             f.write(html_content)
         
         return html_path
         
-    def generate_complete_report(self):
-        """生成完整的投资人报告"""
+    def generate_complete_report(self, force=False, parallel=True, max_workers=None, embed_images=False):
+        """
+        生成完整的投资人报告
+        
+        只重新生成输入指标发生变化的图表；force=True 时全部重新生成。
+        """
         print("🚀 开始生成投资人级别专业可视化报告...")
         
         # 生成各个图表
-        print("📊 生成执行摘要图表...")
-        self.create_executive_summary_chart()
-        
-        print("📈 生成市场机会分析图表...")
-        self.create_market_opportunity_chart()
-        
-        print("🔧 生成技术架构图表...")
-        self.create_technical_architecture_chart()
-        
-        print("💰 生成财务预测图表...")
-        self.create_financial_projections_chart()
-        
-        print("⚠️ 生成风险分析图表...")
-        self.create_risk_analysis_chart()
-        
-        print("🎯 生成投资决策仪表板...")
-        self.create_summary_dashboard()
+        signatures, rebuilt = self.render_sections(force=force, parallel=parallel, max_workers=max_workers)
         
         print("📄 生成HTML报告...")
-        html_path = self.generate_html_report()
+        html_path = self.generate_html_report(signatures if embed_images else None)
         
         print(f"\n✅ 投资人报告生成完成！")
+        print(f"🔁 重新生成图表: {len(rebuilt)}/{len(CHART_SECTIONS)}")
         print(f"📁 报告保存路径: {self.output_path}")
         print(f"🌐 HTML报告: {html_path}")
         
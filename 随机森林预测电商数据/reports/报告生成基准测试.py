@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+报告生成基准测试
+对比投资人报告串行生成、多进程并行生成和增量缓存生成的耗时，
+以及PDF转换首次运行和再次运行的耗时
+"""
+
+import os
+import sys
+import time
+from pathlib import Path
+
+from 投资人可视化报告生成器 import InvestorReportGenerator
+import convert_to_pdf
+
+
+def timed(label, func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    print(f"⏱️ {label:<24} {elapsed:8.2f} 秒")
+    return elapsed
+
+
+def main():
+    """主函数"""
+    current_dir = Path(__file__).parent
+    project_path = sys.argv[1] if len(sys.argv) > 1 else str(current_dir.parent)
+
+    print("⏱️ 报告生成基准测试")
+    print("=" * 50)
+
+    generator = InvestorReportGenerator(project_path)
+    results = {
+        '串行全量生成': timed('串行全量生成', generator.generate_complete_report,
+                        force=True, parallel=False),
+        '并行全量生成': timed('并行全量生成', generator.generate_complete_report,
+                        force=True, parallel=True),
+        '增量生成（输入未变化）': timed('增量生成（输入未变化）', generator.generate_complete_report),
+        '增量生成并内嵌图片': timed('增量生成并内嵌图片', generator.generate_complete_report,
+                           embed_images=True),
+    }
+
+    markdown_file = current_dir / "吹风机电商数据分析_分析报告.md"
+    if markdown_file.exists():
+        output_file = current_dir / "benchmark_output.pdf"
+        results['PDF首次转换'] = timed('PDF首次转换', convert_to_pdf.convert_markdown_to_pdf,
+                                   markdown_file, output_file, force=True)
+        results['PDF再次转换（已缓存字体）'] = timed('PDF再次转换（已缓存字体）',
+                                          convert_to_pdf.convert_markdown_to_pdf,
+                                          markdown_file, output_file, force=True)
+        results['PDF未变化跳过'] = timed('PDF未变化跳过', convert_to_pdf.convert_markdown_to_pdf,
+                                    markdown_file, output_file)
+        os.remove(output_file)
+
+    print("\n📊 汇总")
+    print("=" * 50)
+    baseline = results['串行全量生成']
+    for label, elapsed in results.items():
+        print(f"{label:<24} {elapsed:8.2f} 秒")
+    print(f"\n🚀 并行加速比: {baseline / results['并行全量生成']:.1f}x")
+    print(f"♻️ 增量生成加速比: {baseline / results['增量生成（输入未变化）']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,7 @@ import pickle
 import os
 from datetime import datetime
 import json
+from 模型注册表 import 模型注册表
 
 def create_analysis_tables(connection):
     """创建分析结果相关的表"""
@@ -114,7 +115,7 @@ def save_analysis_report(connection):
 
 def save_model_info(connection):
     """保存模型信息到数据库"""
-    models_dir = "./models/"
+    models_dir = 模型注册表("./models/").最新版本路径()
     model_files = [
         ("LTV预测模型.pkl", "LTV预测", "随机森林回归"),
         ("购买概率模型.pkl", "购买预测", "随机森林分类"),
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分位数草图的单元测试
+
+运行：
+    python -m pytest test_分位数草图.py
+"""
+
+import numpy as np
+import pytest
+
+from 分位数草图 import KLL分位数草图, 合并草图, 分配价值等级
+
+q = np.linspace(0, 1, 11)[1:-1]
+
+
+def 模拟LTV(数量, 种子=0):
+    随机数 = np.random.default_rng(种子)
+    # 大量零值 + 长尾分布
+    LTV = np.concatenate([np.zeros(数量 // 5), 随机数.lognormal(8, 1.5, 数量 - 数量 // 5)])
+    随机数.shuffle(LTV)
+    return LTV
+
+
+def 排名误差(值, 估计):
+    """
+    估计值在全体数据中的归一化排名与查询分位数之差；
+    有重复值时取排名区间内离 q 最近的点
+    """
+    排序值 = np.sort(值)
+    下界 = np.searchsorted(排序值, 估计, side='left') / len(值)
+    上界 = np.searchsorted(排序值, 估计, side='right') / len(值)
+    return np.maximum(np.maximum(下界 - q, q - 上界), 0)
+
+
+def test_小数据量与精确分位数一致():
+    值 = 模拟LTV(150)
+    草图 = KLL分位数草图.从数组构建(值, k=200, 随机种子=0)
+    排序值 = np.sort(值)
+    # 不压缩时，分位数 q 是第 ceil(q·n) 个值
+    精确 = 排序值[np.maximum(np.ceil(q * len(值)).astype(int) - 1, 0)]
+
+    assert 草图.排名误差上界() == 0.0
+    np.testing.assert_array_equal(草图.分位数(q), 精确)
+
+
+@pytest.mark.parametrize('种子', [0, 1, 2])
+def test_排名误差在误差界内(种子):
+    值 = 模拟LTV(200000, 种子)
+    草图 = KLL分位数草图.从数组构建(值, 分块大小=10000, k=200, 随机种子=种子)
+
+    估计 = 草图.分位数(q)
+    assert np.all(排名误差(值, 估计) <= 草图.排名误差上界())
+    # 与 np.quantile 的精确边界在排名上也不超过误差界
+    assert np.all(排名误差(值, np.quantile(值, q)) <= 2 / len(值))
+
+
+def test_合并分区草图的排名误差():
+    值 = 模拟LTV(200000)
+    草图 = 合并草图((KLL分位数草图.从数组构建(分区, 随机种子=i)
+                 for i, 分区 in enumerate(np.array_split(值, 8))), 随机种子=0)
+
+    assert 草图.数量 == len(值)
+    assert np.all(排名误差(值, 草图.分位数(q)) <= 草图.排名误差上界())
+
+
+def test_固定种子结果可复现():
+    值 = 模拟LTV(100000)
+    边界 = [KLL分位数草图.从数组构建(值, 分块大小=7000, 随机种子=42).等级边界(5) for _ in range(3)]
+
+    for 其他 in 边界[1:]:
+        np.testing.assert_array_equal(边界[0], 其他)
+
+    等级 = [分配价值等级(值, b) for b in 边界]
+    for 其他 in 等级[1:]:
+        np.testing.assert_array_equal(等级[0].codes, 其他.codes)
+
+
+def test_合并草图固定种子结果可复现():
+    分区列表 = np.array_split(模拟LTV(100000), 4)
+
+    def 构建():
+        return 合并草图((KLL分位数草图.从数组构建(分区, 随机种子=i) for i, 分区 in enumerate(分区列表)),
+                    随机种子=42).等级边界(5)
+
+    np.testing.assert_array_equal(构建(), 构建())
+
+
+def test_边界两端为最小值和最大值():
+    值 = 模拟LTV(50000)
+    边界 = KLL分位数草图.从数组构建(值, 随机种子=0).等级边界(5)
+
+    assert 边界[0] == 值.min()
+    assert 边界[-1] == 值.max()
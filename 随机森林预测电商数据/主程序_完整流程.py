@@ -28,6 +28,7 @@ sys.path.append('.')
 from 吹风机电商数据生成器 import 吹风机电商数据生成器
 from 随机森林预测模型 import 随机森林预测模型
 from 数据可视化分析 import 电商数据可视化
+from 销售汇总立方体 import 销售汇总立方体
 
 # MySQL数据库连接
 try:
@@ -115,6 +116,11 @@ class 电商数据分析系统:
             数据.to_csv(文件路径, index=False, encoding='utf-8-sig')
             print(f"💾 {文件名} 保存成功，共 {len(数据)} 条记录")
         
+        # 重新生成的订单会复用订单ID，销售汇总立方体需要全量重建
+        销售汇总立方体.从订单构建(订单数据, 用户数据).保存(
+            os.path.join(self.数据路径, '销售汇总立方体.pkl'))
+        print("💾 销售汇总立方体.pkl 构建完成")
+        
         # 存储到数据库
         if self.数据库引擎 is not None:
             self.存储数据到数据库(数据文件)
@@ -24,6 +24,7 @@ import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import plotly.figure_factory as ff
 from datetime import datetime, timedelta
+from 销售汇总立方体 import 销售汇总立方体
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -59,6 +60,10 @@ class 电商数据可视化:
             self.订单数据['订单日期'] = pd.to_datetime(self.订单数据['订单日期'])
             self.行为数据['行为时间'] = pd.to_datetime(self.行为数据['行为时间'])
             
+            # 读取销售汇总立方体并追加新订单，图表中的汇总都从立方体查询
+            self.销售立方体 = 销售汇总立方体.加载或构建(
+                f'{数据路径}/销售汇总立方体.pkl', self.订单数据, self.用户数据)
+            
             print("✅ 数据加载成功！")
             return True
             
@@ -72,12 +77,8 @@ class 电商数据可视化:
         """
         print("📈 生成销售趋势分析图...")
         
-        # 按日期聚合销售数据
-        日销售 = self.订单数据.groupby('订单日期').agg({
-            '总金额': 'sum',
-            '订单ID': 'count',
-            '数量': 'sum'
-        }).reset_index()
+        # 按日期汇总销售数据
+        日销售 = self.销售立方体.查询(['订单日期'])
         
         日销售.columns = ['日期', '销售额', '订单数', '销售量']
         
@@ -102,12 +103,7 @@ class 电商数据可视化:
         axes[0,1].grid(True, alpha=0.3)
         
         # 3. 月度销售对比
-        月销售 = 日销售.copy()
-        月销售['月份'] = 月销售['日期'].dt.to_period('M')
-        月度统计 = 月销售.groupby('月份').agg({
-            '销售额': 'sum',
-            '订单数': 'sum'
-        }).reset_index()
+        月度统计 = self.销售立方体.查询(['月份'])[['月份', '销售额', '订单数']]
         
         axes[1,0].bar(range(len(月度统计)), 月度统计['销售额'], 
                      color=self.颜色方案['强调色'], alpha=0.7)
@@ -201,12 +197,8 @@ class 电商数据可视化:
         """
         print("🎁 生成产品分析图...")
         
-        # 计算产品销售统计
-        产品销售 = self.订单数据.groupby('产品ID').agg({
-            '总金额': 'sum',
-            '订单ID': 'count',
-            '数量': 'sum'
-        }).reset_index()
+        # 产品销售统计
+        产品销售 = self.销售立方体.查询(['产品ID'])
         
         产品销售 = 产品销售.merge(self.产品数据, on='产品ID')
         # 动态设置列名，避免长度不匹配
@@ -426,10 +418,10 @@ class 电商数据可视化:
         
         # 4. 消费行为时间序列
         if '订单日期' in 特征数据.columns:
-            # 这里需要从订单数据重新计算
-            日消费 = self.订单数据.groupby('订单日期')['总金额'].sum().reset_index()
+            # 从销售汇总立方体读取每日消费
+            日消费 = self.销售立方体.查询(['订单日期'])
             
-            axes[1,1].plot(日消费['订单日期'], 日消费['总金额'], 
+            axes[1,1].plot(日消费['订单日期'], 日消费['销售额'], 
                          color=self.颜色方案['信息色'], linewidth=2)
             axes[1,1].set_title('📅 消费趋势时间序列', fontsize=14, fontweight='bold')
             axes[1,1].set_ylabel('日消费金额')
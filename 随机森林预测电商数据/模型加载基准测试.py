@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+模型加载基准测试 - 对比旧版一次性加载与注册表按需加载
+
+每种方式在独立的子进程中运行，测量：
+1. 冷启动耗时（从导入到拿到所需模型）
+2. 进程RSS以及私有内存（Private）和共享内存（Shared）
+3. 多个工作进程同时加载时的平均私有内存
+
+用法：
+    python 模型加载基准测试.py [模型目录] [工作进程数]
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+# 在子进程中执行的加载代码，结果以JSON打印到标准输出
+子进程代码 = r'''
+import os, sys, json, time
+开始 = time.perf_counter()
+import joblib
+from 模型注册表 import 模型注册表
+
+模式, 模型目录 = sys.argv[1], sys.argv[2]
+全部模型 = ['购买概率模型', 'LTV预测模型', '客户分群模型', '特征编码器', '标准化器']
+
+if 模式 == '旧版全部加载':
+    模型 = {}
+    版本目录 = 模型注册表(模型目录).最新版本路径()
+    for 名称 in 全部模型:
+        路径 = os.path.join(版本目录, f'{名称}.pkl')
+        if os.path.exists(路径):
+            模型[名称] = joblib.load(路径)
+elif 模式 == '注册表按需加载':
+    版本 = 模型注册表(模型目录).打开()
+    模型 = {名称: 版本.获取(名称) for 名称 in ['标准化器', '客户分群模型']}
+elif 模式 == '注册表全部加载':
+    版本 = 模型注册表(模型目录).打开()
+    模型 = {名称: 版本.获取(名称) for 名称 in 全部模型}
+
+耗时 = time.perf_counter() - 开始
+
+内存 = {}
+try:
+    with open('/proc/self/smaps_rollup') as f:
+        for 行 in f:
+            键, _, 值 = 行.partition(':')
+            if 键 in ('Rss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty'):
+                内存[键] = int(值.split()[0])
+except OSError:
+    import resource
+    内存['Rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+if sys.argv[3:] == ['等待']:
+    sys.stdout.write(json.dumps({'耗时': 耗时, '内存': 内存}) + '\n')
+    sys.stdout.flush()
+    sys.stdin.readline()
+else:
+    print(json.dumps({'耗时': 耗时, '内存': 内存}))
+'''
+
+测试模式 = ['旧版全部加载', '注册表按需加载', '注册表全部加载']
+
+
+def 运行单进程(模式, 模型目录):
+    输出 = subprocess.run([sys.executable, '-c', 子进程代码, 模式, 模型目录],
+                        capture_output=True, text=True, check=True,
+                        cwd=os.path.dirname(os.path.abspath(__file__)))
+    return json.loads(输出.stdout.strip().splitlines()[-1])
+
+
+def 运行多进程(模式, 模型目录, 进程数):
+    """
+    同时启动多个进程加载模型，所有进程加载完成后再统计内存
+    """
+    进程列表 = [subprocess.Popen([sys.executable, '-c', 子进程代码, 模式, 模型目录, '等待'],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+              for _ in range(进程数)]
+    结果 = [json.loads(进程.stdout.readline()) for 进程 in 进程列表]
+    for 进程 in 进程列表:
+        进程.communicate('\n')
+    return 结果
+
+
+def 打印结果(模式, 结果):
+    内存 = 结果['内存']
+    私有 = 内存.get('Private_Clean', 0) + 内存.get('Private_Dirty', 0)
+    共享 = 内存.get('Shared_Clean', 0) + 内存.get('Shared_Dirty', 0)
+    print(f"{模式:<16} 冷启动 {结果['耗时'] * 1000:8.1f} ms   "
+          f"RSS {内存.get('Rss', 0) / 1024:7.1f} MB   "
+          f"私有 {私有 / 1024:7.1f} MB   共享 {共享 / 1024:7.1f} MB")
+
+
+def main():
+    模型目录 = sys.argv[1] if len(sys.argv) > 1 else './models/'
+    进程数 = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    print("⏱️ 模型加载基准测试")
+    print("=" * 50)
+    print(f"📂 模型目录：{模型目录}")
+
+    print("\n📊 单进程冷启动：")
+    for 模式 in 测试模式:
+        打印结果(模式, 运行单进程(模式, 模型目录))
+
+    print(f"\n📊 {进程数} 个进程同时加载（平均值）：")
+    for 模式 in 测试模式:
+        结果列表 = 运行多进程(模式, 模型目录, 进程数)
+        平均 = {'耗时': sum(r['耗时'] for r in 结果列表) / 进程数,
+              '内存': {键: sum(r['内存'].get(键, 0) for r in 结果列表) / 进程数
+                     for 键 in 结果列表[0]['内存']}}
+        打印结果(模式, 平均)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+模型注册表 - 版本化、按名称加载的模型存储
+
+功能：
+1. 按版本保存模型（models/v0001/、models/v0002/ ...），每个版本附带清单文件
+2. 按名称加载版本中的单个模型，已加载的模型会被缓存
+3. 兼容旧版平铺在 models/ 下的 .pkl 文件（视为版本0）
+
+说明：
+mmap_mode 默认不开启。joblib 可以把 numpy 数组映射为只读内存，
+但 sklearn 的决策树在反序列化（Tree.__setstate__）时会把节点数组复制一份，
+所以随机森林即使用 mmap_mode 打开，树的数组仍然在进程私有内存中，多个进程之间并不共享。
+
+作者：AI数据科学家
+日期：2024年
+"""
+
+import os
+import json
+import threading
+from datetime import datetime
+import joblib
+
+清单文件名 = 'manifest.json'
+最新版本文件名 = 'LATEST'
+
+
+class 模型版本:
+    """
+    注册表中的一个模型版本，按名称加载其中的模型
+    """
+
+    def __init__(self, 版本号, 路径, 文件映射, mmap_mode=None):
+        self.版本号 = 版本号
+        self.路径 = 路径
+        self.文件映射 = 文件映射
+        self.mmap_mode = mmap_mode
+        self._缓存 = {}
+        self._锁 = threading.Lock()
+
+    def 名称列表(self):
+        return list(self.文件映射.keys())
+
+    def 文件路径(self, 名称):
+        return os.path.join(self.路径, self.文件映射[名称])
+
+    def 已加载(self, 名称):
+        return 名称 in self._缓存
+
+    def 获取(self, 名称, 默认值=None):
+        """
+        获取模型，首次获取时从磁盘加载，之后使用缓存
+        """
+        if 名称 in self._缓存:
+            return self._缓存[名称]
+        if 名称 not in self.文件映射:
+            return 默认值
+
+        with self._锁:
+            if 名称 not in self._缓存:
+                文件路径 = self.文件路径(名称)
+                if not os.path.exists(文件路径):
+                    return 默认值
+                self._缓存[名称] = joblib.load(文件路径, mmap_mode=self.mmap_mode)
+
+        return self._缓存[名称]
+
+    def __getitem__(self, 名称):
+        if 名称 not in self.文件映射:
+            raise KeyError(名称)
+        return self.获取(名称)
+
+    def __contains__(self, 名称):
+        return 名称 in self.文件映射
+
+
+class 模型注册表:
+    """
+    版本化的模型注册表
+
+    目录结构：
+        models/
+        ├── LATEST                 # 最新版本号
+        ├── v0001/
+        │   ├── manifest.json      # 名称、文件、大小、创建时间、元数据
+        │   ├── 购买概率模型.pkl
+        │   └── ...
+        └── 购买概率模型.pkl        # 旧版平铺文件（版本0）
+    """
+
+    def __init__(self, 根路径='./models/', mmap_mode=None):
+        self.根路径 = 根路径
+        self.mmap_mode = mmap_mode
+
+    def _版本路径(self, 版本号):
+        if 版本号 == 0:
+            return self.根路径
+        return os.path.join(self.根路径, f'v{版本号:04d}')
+
+    def 版本列表(self):
+        """
+        列出所有已保存的版本号（升序）
+        """
+        if not os.path.isdir(self.根路径):
+            return []
+
+        版本 = []
+        for 名称 in os.listdir(self.根路径):
+            路径 = os.path.join(self.根路径, 名称)
+            if (名称.startswith('v') and 名称[1:].isdigit()
+                    and os.path.exists(os.path.join(路径, 清单文件名))):
+                版本.append(int(名称[1:]))
+
+        return sorted(版本)
+
+    def 最新版本(self):
+        """
+        返回最新版本号；只有旧版平铺文件时返回0，没有任何模型时返回None
+        """
+        标记文件 = os.path.join(self.根路径, 最新版本文件名)
+        if os.path.exists(标记文件):
+            with open(标记文件, 'r', encoding='utf-8') as f:
+                return int(f.read().strip())
+
+        版本 = self.版本列表()
+        if 版本:
+            return 版本[-1]
+
+        if self._旧版文件映射():
+            return 0
+
+        return None
+
+    def 最新版本路径(self):
+        版本号 = self.最新版本()
+        if 版本号 is None:
+            return self.根路径
+        return self._版本路径(版本号)
+
+    def _旧版文件映射(self):
+        if not os.path.isdir(self.根路径):
+            return {}
+        return {os.path.splitext(名称)[0]: 名称
+                for 名称 in os.listdir(self.根路径)
+                if 名称.endswith('.pkl')}
+
+    def 保存(self, 模型字典, 元数据=None):
+        """
+        将一组模型保存为新版本，返回版本号
+
+        模型以不压缩的方式保存，加载更快
+        """
+        版本 = self.版本列表()
+        版本号 = (版本[-1] + 1) if 版本 else 1
+        版本路径 = self._版本路径(版本号)
+        os.makedirs(版本路径, exist_ok=True)
+
+        清单 = {
+            '版本': 版本号,
+            '创建时间': datetime.now().isoformat(),
+            '元数据': 元数据 or {},
+            '模型': {}
+        }
+
+        for 名称, 模型 in 模型字典.items():
+            if 模型 is None:
+                continue
+            文件名 = f'{名称}.pkl'
+            文件路径 = os.path.join(版本路径, 文件名)
+            joblib.dump(模型, 文件路径, compress=0)
+            清单['模型'][名称] = {
+                '文件': 文件名,
+                '大小': os.path.getsize(文件路径),
+                '类型': type(模型).__name__
+            }
+
+        with open(os.path.join(版本路径, 清单文件名), 'w', encoding='utf-8') as f:
+            json.dump(清单, f, ensure_ascii=False, indent=2)
+
+        # 清单写完后再更新LATEST，保证读取方看到的总是完整版本
+        临时文件 = os.path.join(self.根路径, f'{最新版本文件名}.tmp')
+        with open(临时文件, 'w', encoding='utf-8') as f:
+            f.write(str(版本号))
+        os.replace(临时文件, os.path.join(self.根路径, 最新版本文件名))
+
+        return 版本号
+
+    def 清单(self, 版本号=None):
+        if 版本号 is None:
+            版本号 = self.最新版本()
+        if not 版本号:
+            return None
+        with open(os.path.join(self._版本路径(版本号), 清单文件名), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def 打开(self, 版本号=None):
+        """
+        打开指定版本（默认最新版本），不会立即加载任何模型
+        """
+        if 版本号 is None:
+            版本号 = self.最新版本()
+        if 版本号 is None:
+            raise FileNotFoundError(f'模型目录中没有可用的模型：{self.根路径}')
+
+        if 版本号 == 0:
+            文件映射 = self._旧版文件映射()
+        else:
+            文件映射 = {名称: 信息['文件'] for 名称, 信息 in self.清单(版本号)['模型'].items()}
+
+        return 模型版本(版本号, self._版本路径(版本号), 文件映射, self.mmap_mode)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+特征计算内核 - 向量化计算RFM、购买频率和LTV
+
+功能：
+1. 日期只转换一次，变成 int32 天数（自1970-01-01起）
+2. 在预分配的数组上一次性计算 R/F/M、购买天数跨度、购买频率和LTV
+3. 使用显式的参考日期，结果可复现、可缓存
+
+运行本文件可以对比原先逐列的pandas写法与本内核的耗时。
+
+作者：AI数据科学家
+日期：2024年
+"""
+
+import time
+import numpy as np
+import pandas as pd
+
+# 没有购买记录的用户的日期天数
+缺失天数 = np.iinfo(np.int32).min
+
+内核输出列 = ['购买天数跨度', '购买频率', 'R_最近购买天数', 'F_购买频率', 'M_消费金额', 'LTV']
+
+
+def 日期转天数(日期):
+    """
+    将日期列转换为 int32 天数，缺失值记为 缺失天数
+    """
+    天数 = pd.to_datetime(日期).to_numpy(dtype='datetime64[D]')
+    有效 = ~np.isnat(天数)
+    结果 = np.full(len(天数), 缺失天数, dtype=np.int32)
+    结果[有效] = 天数[有效].astype(np.int64)
+    return 结果
+
+
+def 参考日期转天数(参考日期):
+    return np.int32(np.datetime64(pd.Timestamp(参考日期).normalize().date(), 'D').astype(np.int64))
+
+
+def 计算RFM与LTV(首次天数, 最后天数, 订单次数, 总消费金额, 平均消费金额, 参考日期, 输出=None):
+    """
+    计算RFM与LTV特征
+
+    所有输入都是按用户对齐的数组，日期为 日期转天数 得到的 int32 天数。
+    输出 为预分配的 {列名: float64数组}，为空时新建；返回该字典。
+
+    - 购买天数跨度 = 最后购买天数 - 首次购买天数 + 1（无购买为0）
+    - 购买频率 = 订单次数 / 购买天数跨度（无购买为0）
+    - R = 参考日期 - 最后购买天数（无购买为NaN）
+    - LTV = 总消费金额 + 平均消费金额 × 购买频率 × 365
+    """
+    数量 = len(订单次数)
+    if 输出 is None:
+        输出 = {列: np.empty(数量, dtype=np.float64) for 列 in 内核输出列}
+
+    有效 = 最后天数 != 缺失天数
+
+    跨度 = 输出['购买天数跨度']
+    跨度.fill(0)
+    np.subtract(最后天数, 首次天数, out=跨度, where=有效, casting='unsafe')
+    np.add(跨度, 1, out=跨度, where=有效)
+
+    频率 = 输出['购买频率']
+    频率.fill(0)
+    np.divide(订单次数, 跨度, out=频率, where=跨度 > 0)
+
+    R = 输出['R_最近购买天数']
+    R.fill(np.nan)
+    np.subtract(参考日期转天数(参考日期), 最后天数, out=R, where=有效, casting='unsafe')
+
+    输出['F_购买频率'][:] = 订单次数
+    输出['M_消费金额'][:] = 总消费金额
+
+    LTV = 输出['LTV']
+    np.multiply(平均消费金额, 频率, out=LTV)
+    LTV *= 365
+    LTV += 总消费金额
+    np.nan_to_num(LTV, copy=False, nan=0.0)
+
+    return 输出
+
+
+def _原始写法(订单统计, 用户ID, 参考日期):
+    """原先 特征工程 中逐列计算的写法，仅用于基准对比"""
+    订单统计 = 订单统计.copy()
+    订单统计['首次购买日期'] = pd.to_datetime(订单统计['首次购买日期'])
+    订单统计['最后购买日期'] = pd.to_datetime(订单统计['最后购买日期'])
+    订单统计['购买天数跨度'] = (订单统计['最后购买日期'] - 订单统计['首次购买日期']).dt.days + 1
+    订单统计['购买频率'] = 订单统计['订单次数'] / 订单统计['购买天数跨度']
+    订单统计['购买频率'] = 订单统计['购买频率'].fillna(0)
+
+    特征数据 = pd.DataFrame({'用户ID': 用户ID}).merge(订单统计, on='用户ID', how='left')
+    数值列 = 特征数据.select_dtypes(include=[np.number]).columns
+    特征数据[数值列] = 特征数据[数值列].fillna(0)
+
+    特征数据['R_最近购买天数'] = (pd.Timestamp(参考日期) - 特征数据['最后购买日期']).dt.days
+    特征数据['F_购买频率'] = 特征数据['订单次数']
+    特征数据['M_消费金额'] = 特征数据['总消费金额']
+    特征数据['LTV'] = 特征数据['总消费金额'] + (特征数据['平均消费金额'] * 特征数据['购买频率'] * 365)
+    特征数据['LTV'] = 特征数据['LTV'].fillna(0)
+    return 特征数据
+
+
+def _内核写法(订单统计, 用户ID, 参考日期, 输出=None):
+    特征数据 = pd.DataFrame({'用户ID': 用户ID}).merge(订单统计, on='用户ID', how='left')
+    数值列 = 特征数据.select_dtypes(include=[np.number]).columns
+    特征数据[数值列] = 特征数据[数值列].fillna(0)
+
+    结果 = 计算RFM与LTV(日期转天数(特征数据['首次购买日期']), 日期转天数(特征数据['最后购买日期']),
+                    特征数据['订单次数'].to_numpy(), 特征数据['总消费金额'].to_numpy(),
+                    特征数据['平均消费金额'].to_numpy(), 参考日期, 输出)
+    return 特征数据.assign(**结果)
+
+
+def main():
+    """
+    微基准：对比原始写法与内核写法
+    """
+    print("⏱️ RFM/LTV特征计算微基准")
+    print("=" * 50)
+
+    随机数 = np.random.default_rng(42)
+    用户数 = 1000000
+    有购买用户数 = 用户数 // 2
+    用户ID = np.array([f'U{i:07d}' for i in range(用户数)])
+    首次 = pd.Timestamp('2023-01-01') + pd.to_timedelta(随机数.integers(0, 300, 有购买用户数), unit='D')
+    订单统计 = pd.DataFrame({
+        '用户ID': 用户ID[随机数.permutation(用户数)[:有购买用户数]],
+        '订单次数': 随机数.integers(1, 20, 有购买用户数),
+        '总消费金额': 随机数.uniform(50, 5000, 有购买用户数),
+        '平均消费金额': 随机数.uniform(50, 500, 有购买用户数),
+        '首次购买日期': 首次.strftime('%Y-%m-%d'),
+        '最后购买日期': (首次 + pd.to_timedelta(随机数.integers(0, 60, 有购买用户数), unit='D')).strftime('%Y-%m-%d'),
+    })
+    参考日期 = '2024-01-01'
+
+    开始 = time.perf_counter()
+    原始 = _原始写法(订单统计, 用户ID, 参考日期)
+    原始耗时 = time.perf_counter() - 开始
+
+    输出 = {列: np.empty(用户数, dtype=np.float64) for 列 in 内核输出列}
+    开始 = time.perf_counter()
+    内核 = _内核写法(订单统计, 用户ID, 参考日期, 输出)
+    内核耗时 = time.perf_counter() - 开始
+
+    for 列 in 内核输出列:
+        assert np.allclose(原始[列].to_numpy(dtype=np.float64), 内核[列].to_numpy(), equal_nan=True), 列
+
+    print(f"用户数：{用户数}")
+    print(f"原始写法：{原始耗时 * 1000:8.1f} ms")
+    print(f"内核写法：{内核耗时 * 1000:8.1f} ms")
+    print(f"加速比：{原始耗时 / 内核耗时:.1f}x（结果一致）")
+
+
+if __name__ == "__main__":
+    main()
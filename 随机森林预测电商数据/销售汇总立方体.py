@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+销售汇总立方体 - 预聚合的订单汇总，供图表和报告查询
+
+功能：
+1. 按 日期 × 产品 × 城市等级 × 会员等级 × 支付方式 预聚合订单
+2. 度量：销售额（总金额之和）、订单数、销售量（数量之和）
+3. 按订单ID水位线增量追加新订单，不重复计算已汇总的订单
+4. 任意维度组合的上卷查询（包括按月汇总）
+5. 记录已汇总订单和用户维度的指纹，源数据在主程序之外被重新生成时自动全量重建
+
+图表和报告只读取立方体中的几千个单元格，不再扫描全部原始订单。
+
+作者：AI数据科学家
+日期：2024年
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+立方体维度 = ['订单日期', '产品ID', '城市等级', '会员等级', '支付方式']
+立方体度量 = ['销售额', '订单数', '销售量']
+
+# 参与汇总的订单列和用户列，指纹只根据这些列计算
+订单指纹列 = ['订单ID', '用户ID', '产品ID', '订单日期', '数量', '总金额', '支付方式']
+用户指纹列 = ['用户ID', '城市等级', '会员等级']
+
+
+def _空单元格():
+    return pd.DataFrame({
+        '订单日期': pd.Series(dtype='datetime64[ns]'),
+        '产品ID': pd.Series(dtype=object),
+        '城市等级': pd.Series(dtype=object),
+        '会员等级': pd.Series(dtype=object),
+        '支付方式': pd.Series(dtype=object),
+        '销售额': pd.Series(dtype=np.float64),
+        '订单数': pd.Series(dtype=np.int64),
+        '销售量': pd.Series(dtype=np.int64),
+    })
+
+
+def 数据指纹(数据):
+    """
+    数据的指纹：行数、最大订单日期（有该列时）和逐行哈希之和
+
+    逐行哈希之和与行的顺序无关，并且可以按批相加，
+    增量追加订单时不需要重新扫描已汇总的订单。
+    """
+    哈希 = pd.util.hash_pandas_object(数据, index=False).to_numpy().sum(dtype=np.uint64) if len(数据) else 0
+    最大日期 = None
+    if '订单日期' in 数据.columns and len(数据) > 0:
+        最大日期 = str(pd.to_datetime(数据['订单日期']).max().normalize().date())
+    return {'行数': int(len(数据)), '最大订单日期': 最大日期, '哈希': int(哈希)}
+
+
+def _合并指纹(指纹, 其他):
+    日期 = [d for d in (指纹['最大订单日期'], 其他['最大订单日期']) if d is not None]
+    return {'行数': 指纹['行数'] + 其他['行数'],
+            '最大订单日期': max(日期) if 日期 else None,
+            '哈希': (指纹['哈希'] + 其他['哈希']) % 2 ** 64}
+
+
+class 销售汇总立方体:
+    def __init__(self, 单元格=None, 最大订单ID=None, 订单指纹=None, 用户指纹=None):
+        if 单元格 is None or len(单元格) == 0:
+            单元格 = _空单元格()
+        self.单元格 = 单元格
+        # 已汇总订单的最大订单ID（订单ID为定长编号，可以直接按字符串比较）
+        self.最大订单ID = 最大订单ID
+        # 已汇总订单的指纹，以及汇总时用户维度的指纹
+        self.订单指纹 = 订单指纹 or 数据指纹(pd.DataFrame(columns=订单指纹列))
+        self.用户指纹 = 用户指纹
+
+    @classmethod
+    def 从订单构建(cls, 订单数据, 用户数据):
+        """
+        从全部订单全量构建立方体
+        """
+        return cls().增量更新(订单数据, 用户数据)
+
+    @staticmethod
+    def _聚合(订单数据, 用户数据):
+        订单 = 订单数据[['订单ID', '用户ID', '产品ID', '订单日期', '数量', '总金额', '支付方式']]
+        订单 = 订单.merge(用户数据[['用户ID', '城市等级', '会员等级']], on='用户ID', how='left')
+        订单['订单日期'] = pd.to_datetime(订单['订单日期']).dt.normalize()
+
+        return 订单.groupby(立方体维度, observed=True, dropna=False).agg(
+            销售额=('总金额', 'sum'),
+            订单数=('订单ID', 'count'),
+            销售量=('数量', 'sum')
+        ).reset_index()
+
+    def _已汇总订单(self, 订单数据):
+        if self.最大订单ID is None:
+            return 订单数据.iloc[:0]
+        return 订单数据[订单数据['订单ID'] <= self.最大订单ID]
+
+    def 与数据一致(self, 订单数据, 用户数据):
+        """
+        检查源数据中已汇总的订单和用户维度是否与构建立方体时相同
+
+        数据在主程序之外被重新生成时订单ID会被复用，只看水位线无法发现，
+        所以比较水位线以内订单的指纹和用户维度的指纹。
+        """
+        if self.用户指纹 is None and self.最大订单ID is not None:
+            return False
+        if self.用户指纹 is not None and self.用户指纹 != 数据指纹(用户数据[用户指纹列]):
+            return False
+        return self.订单指纹 == 数据指纹(self._已汇总订单(订单数据)[订单指纹列])
+
+    def 增量更新(self, 订单数据, 用户数据):
+        """
+        追加订单ID大于水位线的新订单，并与已有单元格合并
+        """
+        if self.最大订单ID is not None:
+            订单数据 = 订单数据[订单数据['订单ID'] > self.最大订单ID]
+        self.用户指纹 = 数据指纹(用户数据[用户指纹列])
+        if len(订单数据) == 0:
+            return self
+
+        新单元格 = self._聚合(订单数据, 用户数据)
+        if len(self.单元格) > 0:
+            新单元格 = pd.concat([self.单元格, 新单元格], ignore_index=True)
+            新单元格 = 新单元格.groupby(立方体维度, observed=True, dropna=False)[立方体度量].sum().reset_index()
+
+        self.单元格 = 新单元格
+        self.订单指纹 = _合并指纹(self.订单指纹, 数据指纹(订单数据[订单指纹列]))
+        self.最大订单ID = 订单数据['订单ID'].max() if self.最大订单ID is None \
+            else max(self.最大订单ID, 订单数据['订单ID'].max())
+        return self
+
+    def 查询(self, 维度=None, 筛选=None):
+        """
+        按给定维度上卷汇总
+
+        维度 可以包含立方体维度以及派生维度 '月份'；为空时返回总计。
+        筛选 为 {维度: 取值或取值列表}。
+        """
+        单元格 = self.单元格
+        if 筛选:
+            for 列, 取值 in 筛选.items():
+                取值 = 取值 if isinstance(取值, (list, tuple, set)) else [取值]
+                单元格 = 单元格[单元格[列].isin(取值)]
+
+        维度 = list(维度 or [])
+        if '月份' in 维度:
+            单元格 = 单元格.assign(月份=单元格['订单日期'].dt.to_period('M'))
+
+        if not 维度:
+            return 单元格[立方体度量].sum()
+
+        return 单元格.groupby(维度, observed=True, dropna=False)[立方体度量].sum().reset_index()
+
+    def 保存(self, 文件路径):
+        os.makedirs(os.path.dirname(文件路径) or '.', exist_ok=True)
+        pd.to_pickle({'单元格': self.单元格, '最大订单ID': self.最大订单ID,
+                      '订单指纹': self.订单指纹, '用户指纹': self.用户指纹}, 文件路径)
+
+    @classmethod
+    def 加载(cls, 文件路径):
+        数据 = pd.read_pickle(文件路径)
+        return cls(数据['单元格'], 数据['最大订单ID'], 数据.get('订单指纹'), 数据.get('用户指纹'))
+
+    @classmethod
+    def 加载或构建(cls, 文件路径, 订单数据, 用户数据):
+        """
+        读取已保存的立方体并追加新订单；文件不存在，
+        或者源数据与立方体不一致（例如数据被重新生成）时全量构建
+        """
+        立方体 = cls.加载(文件路径) if os.path.exists(文件路径) else None
+        if 立方体 is not None and 立方体.与数据一致(订单数据, 用户数据):
+            立方体.增量更新(订单数据, 用户数据)
+        else:
+            if 立方体 is not None:
+                print("⚠️ 源数据与销售汇总立方体不一致，重新全量构建")
+            立方体 = cls.从订单构建(订单数据, 用户数据)
+        立方体.保存(文件路径)
+        return 立方体
@@ -14,6 +14,7 @@
 日期：2024年
 """
 
+import os
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -23,7 +24,10 @@ from sklearn.model_selection import train_test_split, cross_val_score, GridSearc
 from sklearn.preprocessing import LabelEncoder, StandardScaler
 from sklearn.metrics import mean_squared_error, r2_score, classification_report, confusion_matrix
 from sklearn.cluster import KMeans
-import joblib
+from 模型注册表 import 模型注册表
+from 分位数草图 import KLL分位数草图, 分配价值等级
+from 销售汇总立方体 import 销售汇总立方体
+from 特征计算内核 import 计算RFM与LTV, 日期转天数, 内核输出列
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -31,7 +35,49 @@ warnings.filterwarnings('ignore')
 plt.rcParams['font.sans-serif'] = ['SimHei']
 plt.rcParams['axes.unicode_minus'] = False
 
+class _懒加载模型:
+    """
+    模型属性：实例上尚未赋值时，从已打开的注册表版本中按需加载
+    """
+
+    def __init__(self, 模型名称=None):
+        self.模型名称 = 模型名称
+
+    def __set_name__(self, owner, 名称):
+        self.名称 = 名称
+        self.模型名称 = self.模型名称 or 名称
+
+    def __get__(self, 实例, owner):
+        if 实例 is None:
+            return self
+        if self.名称 in 实例.__dict__:
+            return 实例.__dict__[self.名称]
+
+        版本 = 实例.__dict__.get('_模型版本')
+        if 版本 is None:
+            return None
+
+        值 = 版本.获取(self.模型名称)
+        if 值 is not None:
+            实例.__dict__[self.名称] = 值
+        return 值
+
+    def __set__(self, 实例, 值):
+        实例.__dict__[self.名称] = 值
+
 class 随机森林预测模型:
+    模型名称列表 = ['购买概率模型', 'LTV预测模型', '客户分群模型', '特征编码器', '标准化器']
+
+    购买概率模型 = _懒加载模型()
+    LTV预测模型 = _懒加载模型()
+    客户分群模型 = _懒加载模型()
+    用户特征编码器 = _懒加载模型('特征编码器')
+    标准化器 = _懒加载模型()
+
+    # 注册表中的模型名称对应的实例属性
+    模型属性 = {'购买概率模型': '购买概率模型', 'LTV预测模型': 'LTV预测模型', '客户分群模型': '客户分群模型',
+              '特征编码器': '用户特征编码器', '标准化器': '标准化器'}
+
     def __init__(self):
         self.用户特征编码器 = {}
         self.标准化器 = StandardScaler()
@@ -39,6 +85,8 @@ class 随机森林预测模型:
         self.LTV预测模型 = None
         self.消费金额模型 = None
         self.客户分群模型 = None
+        # 固定随机种子，使模型和客户价值等级边界在多次运行之间保持一致
+        self.随机种子 = 42
         
     def 加载数据(self, 数据路径='./data/'):
         """
@@ -51,6 +99,8 @@ class 随机森林预测模型:
             self.产品数据 = pd.read_csv(f'{数据路径}/产品数据.csv')
             self.订单数据 = pd.read_csv(f'{数据路径}/订单数据.csv')
             self.行为数据 = pd.read_csv(f'{数据路径}/用户行为数据.csv')
+            self.销售立方体 = 销售汇总立方体.加载或构建(
+                f'{数据路径}/销售汇总立方体.pkl', self.订单数据, self.用户数据)
             
             print(f"✅ 数据加载成功！")
             print(f"用户数据：{len(self.用户数据)} 条")
@@ -64,12 +114,20 @@ class 随机森林预测模型:
             
         return True
     
-    def 特征工程(self):
+    def 特征工程(self, 价值等级边界=None, 参考日期=None, 分块大小=100000):
         """
         进行特征工程，构建机器学习特征
+        
+        价值等级边界 为空时由本批数据的LTV草图计算；分区或增量运行时，
+        可以传入合并各分区 self.LTV草图 后得到的全局边界。
+        参考日期 用于计算R（最近购买天数），为空时使用当天日期；
+        传入固定日期可以让结果可复现、可缓存。
+        分块大小 为计算RFM与LTV时每块的用户数，每块算完后立即把该块的LTV加入草图。
         """
         print("🔧 开始特征工程...")
         
+        self.参考日期 = pd.Timestamp(参考日期 if 参考日期 is not None else pd.Timestamp.now()).normalize()
+        
         # 1. 用户基础特征
         用户特征 = self.用户数据.copy()
         
@@ -93,13 +151,6 @@ class 随机森林预测模型:
         订单统计.columns = ['用户ID', '订单次数', '总消费金额', '平均消费金额', '消费标准差', 
                         '总购买数量', '平均折扣率', '首次购买日期', '最后购买日期']
         
-        # 计算购买频率和间隔
-        订单统计['首次购买日期'] = pd.to_datetime(订单统计['首次购买日期'])
-        订单统计['最后购买日期'] = pd.to_datetime(订单统计['最后购买日期'])
-        订单统计['购买天数跨度'] = (订单统计['最后购买日期'] - 订单统计['首次购买日期']).dt.days + 1
-        订单统计['购买频率'] = 订单统计['订单次数'] / 订单统计['购买天数跨度']
-        订单统计['购买频率'] = 订单统计['购买频率'].fillna(0)
-        
         # 3. 用户行为特征
         行为统计 = self.行为数据.groupby('用户ID').agg({
             '行为ID': 'count',  # 总行为次数
@@ -121,28 +172,34 @@ class 随机森林预测模型:
         数值列 = 特征数据.select_dtypes(include=[np.number]).columns
         特征数据[数值列] = 特征数据[数值列].fillna(0)
         
-        # 5. 计算RFM特征（重要的客户价值指标）
-        特征数据['R_最近购买天数'] = (pd.Timestamp.now() - 特征数据['最后购买日期']).dt.days
-        特征数据['F_购买频率'] = 特征数据['订单次数']
-        特征数据['M_消费金额'] = 特征数据['总消费金额']
+        # 5. 计算购买频率、RFM特征（重要的客户价值指标）和LTV
+        # 日期只转换一次为int32天数，按用户分块写入预分配的数组
+        # LTV计算（简化版：总消费金额 + 预期未来价值）
+        首次天数 = 日期转天数(特征数据['首次购买日期'])
+        最后天数 = 日期转天数(特征数据['最后购买日期'])
+        订单次数 = 特征数据['订单次数'].to_numpy()
+        总消费金额 = 特征数据['总消费金额'].to_numpy()
+        平均消费金额 = 特征数据['平均消费金额'].to_numpy()
+        
+        RFM特征 = {列: np.empty(len(特征数据), dtype=np.float64) for 列 in 内核输出列}
+        # 分块构建LTV分位数草图，边界可由多个分区的草图合并得到
+        self.LTV草图 = KLL分位数草图(随机种子=self.随机种子)
+        for 起点 in range(0, len(特征数据), 分块大小):
+            块 = slice(起点, 起点 + 分块大小)
+            块输出 = 计算RFM与LTV(首次天数[块], 最后天数[块], 订单次数[块], 总消费金额[块], 平均消费金额[块],
+                            self.参考日期, {列: 数组[块] for 列, 数组 in RFM特征.items()})
+            self.LTV草图.更新(块输出['LTV'])
+        特征数据 = 特征数据.assign(**RFM特征)
         
         # 6. 创建目标变量
         # 购买概率（是否有购买行为）
         特征数据['是否购买'] = (特征数据['订单次数'] > 0).astype(int)
         
-        # LTV计算（简化版：总消费金额 + 预期未来价值）
-        特征数据['LTV'] = 特征数据['总消费金额'] + (特征数据['平均消费金额'] * 特征数据['购买频率'] * 365)
-        特征数据['LTV'] = 特征数据['LTV'].fillna(0)
-        
-        # 客户价值分级（处理重复值问题）
-        try:
-            特征数据['客户价值等级'] = pd.qcut(特征数据['LTV'], q=5, labels=['低价值', '较低价值', '中等价值', '较高价值', '高价值'], duplicates='drop')
-        except ValueError:
-            # 如果仍然有问题，使用cut方法
-            ltv_min = 特征数据['LTV'].min()
-            ltv_max = 特征数据['LTV'].max()
-            bins = np.linspace(ltv_min, ltv_max, 6)
-            特征数据['客户价值等级'] = pd.cut(特征数据['LTV'], bins=bins, labels=['低价值', '较低价值', '中等价值', '较高价值', '高价值'], include_lowest=True)
+        # 客户价值分级
+        if 价值等级边界 is None:
+            价值等级边界 = self.LTV草图.等级边界(5)
+        self.价值等级边界 = 价值等级边界
+        特征数据['客户价值等级'] = 分配价值等级(特征数据['LTV'].to_numpy(), 价值等级边界)
         
         self.特征数据 = 特征数据
         print(f"✅ 特征工程完成！特征数据形状：{特征数据.shape}")
@@ -163,7 +220,7 @@ class 随机森林预测模型:
         y = self.特征数据['是否购买']
         
         # 分割训练测试集
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=self.随机种子)
         
         # 训练随机森林模型
         self.购买概率模型 = RandomForestClassifier(
@@ -171,7 +228,7 @@ class 随机森林预测模型:
             max_depth=10,
             min_samples_split=5,
             min_samples_leaf=2,
-            random_state=42
+            random_state=self.随机种子
         )
         
         self.购买概率模型.fit(X_train, y_train)
@@ -217,7 +274,7 @@ class 随机森林预测模型:
         y = 有购买用户['LTV']
         
         # 分割训练测试集
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=self.随机种子)
         
         # 训练随机森林模型
         self.LTV预测模型 = RandomForestRegressor(
@@ -225,7 +282,7 @@ class 随机森林预测模型:
             max_depth=15,
             min_samples_split=5,
             min_samples_leaf=2,
-            random_state=42
+            random_state=self.随机种子
         )
         
         self.LTV预测模型.fit(X_train, y_train)
@@ -264,7 +321,7 @@ class 随机森林预测模型:
         聚类数据_标准化 = self.标准化器.fit_transform(聚类数据)
         
         # K-means聚类
-        self.客户分群模型 = KMeans(n_clusters=5, random_state=42)
+        self.客户分群模型 = KMeans(n_clusters=5, random_state=self.随机种子)
         客户分群 = self.客户分群模型.fit_predict(聚类数据_标准化)
         
         # 根据RFM特征为分群添加有意义的标签
@@ -334,42 +391,56 @@ class 随机森林预测模型:
     
     def 保存模型(self, 保存路径='./models/'):
         """
-        保存训练好的模型
+        保存训练好的模型，每次保存在注册表中生成一个新版本
         """
-        import os
         os.makedirs(保存路径, exist_ok=True)
         
         print("💾 开始保存模型...")
         
-        if self.购买概率模型 is not None:
-            joblib.dump(self.购买概率模型, f'{保存路径}/购买概率模型.pkl')
-        
-        if self.LTV预测模型 is not None:
-            joblib.dump(self.LTV预测模型, f'{保存路径}/LTV预测模型.pkl')
-        
-        if self.客户分群模型 is not None:
-            joblib.dump(self.客户分群模型, f'{保存路径}/客户分群模型.pkl')
-        
-        # 保存编码器和标准化器
-        joblib.dump(self.用户特征编码器, f'{保存路径}/特征编码器.pkl')
-        joblib.dump(self.标准化器, f'{保存路径}/标准化器.pkl')
+        注册表 = 模型注册表(保存路径)
+        版本号 = 注册表.保存({
+            '购买概率模型': self.购买概率模型,
+            'LTV预测模型': self.LTV预测模型,
+            '客户分群模型': self.客户分群模型,
+            # 保存编码器和标准化器
+            '特征编码器': self.用户特征编码器,
+            '标准化器': self.标准化器
+        })
         
-        print("✅ 模型保存完成！")
+        print(f"✅ 模型保存完成！版本：v{版本号:04d}")
+        return 版本号
     
-    def 加载模型(self, 保存路径='./models/'):
+    def 加载模型(self, 保存路径='./models/', 版本号=None, 必需模型=None):
         """
         加载已保存的模型
+        
+        打开注册表中的指定版本（默认最新版本）。
+        必需模型 指定调用方需要的模型名称，默认为全部模型；这些模型在这里加载，
+        加载失败时返回False，不会把异常留到之后首次使用模型时才抛出。
+        其余模型在首次访问时才从注册表中加载。
         """
         print("📂 开始加载模型...")
         
         try:
-            self.购买概率模型 = joblib.load(f'{保存路径}/购买概率模型.pkl')
-            self.LTV预测模型 = joblib.load(f'{保存路径}/LTV预测模型.pkl')
-            self.客户分群模型 = joblib.load(f'{保存路径}/客户分群模型.pkl')
-            self.用户特征编码器 = joblib.load(f'{保存路径}/特征编码器.pkl')
-            self.标准化器 = joblib.load(f'{保存路径}/标准化器.pkl')
+            版本 = 模型注册表(保存路径).打开(版本号)
+            
+            必需模型 = 必需模型 or self.模型名称列表
+            缺失模型 = [名称 for 名称 in 必需模型
+                      if 名称 not in 版本 or not os.path.exists(版本.文件路径(名称))]
+            if 缺失模型:
+                raise FileNotFoundError(f"缺少模型文件：{', '.join(缺失模型)}")
+            
+            # 先加载必需模型，全部成功后再替换实例上的模型，避免加载到一半时留下新旧混合的状态
+            已加载 = {self.模型属性[名称]: 版本.获取(名称) for 名称 in 必需模型}
             
-            print("✅ 模型加载成功！")
+            # 清除实例上的旧值，其余模型从注册表中懒加载
+            for 属性 in self.模型属性.values():
+                self.__dict__.pop(属性, None)
+            self.__dict__['_模型版本'] = 版本
+            for 属性, 模型 in 已加载.items():
+                setattr(self, 属性, 模型)
+            
+            print(f"✅ 模型加载成功！版本：{版本.版本号}")
             return True
         except Exception as e:
             print(f"❌ 模型加载失败：{e}")
@@ -381,13 +452,22 @@ class 随机森林预测模型:
         """
         print("📋 开始生成预测报告...")
         
+        销售总计 = self.销售立方体.查询()
+        
         报告 = {
             '数据概览': {
                 '总用户数': len(self.特征数据),
                 '有购买用户数': len(self.特征数据[self.特征数据['是否购买'] == 1]),
                 '购买转化率': len(self.特征数据[self.特征数据['是否购买'] == 1]) / len(self.特征数据),
                 '平均LTV': self.特征数据['LTV'].mean(),
-                '总GMV': self.特征数据['总消费金额'].sum()
+                '总GMV': 销售总计['销售额'],
+                '总订单数': int(销售总计['订单数'])
+            },
+            '销售汇总': {
+                '按月': self.销售立方体.查询(['月份']),
+                '按城市等级': self.销售立方体.查询(['城市等级']),
+                '按会员等级': self.销售立方体.查询(['会员等级']),
+                '按支付方式': self.销售立方体.查询(['支付方式'])
             },
             '客户分群分析': self.特征数据.groupby('客户价值等级').agg({
                 'LTV': ['count', 'mean', 'sum'],